@@ -0,0 +1,110 @@
+# all_knn_benchmark.py
+"""
+Measures the all-kNN self-join (all_knn, the k nearest neighbours of every indexed point) for several numbers
+of threads, against the same graph computed by one brute-force scan per point (brute_force_knn, timed on a
+sample of the points and extrapolated) and by blocked matrix products over all the pairs of points.
+
+Every run checks the neighbours of a sample of points against the brute-force scans.
+
+Usage:
+    python benchmarks/all_knn_benchmark.py --data gist-960-euclidean.hdf5 --n-train 50000 --tree kd
+    python benchmarks/all_knn_benchmark.py --synthetic --dim 16 --n-train 100000 --tree r --threads 1 2 4 8
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from query_benchmark import brute_force_knn, recall
+from run_benchmark import build_tree, load_dataset, make_synthetic
+
+DEFAULT_VARIANTS = {
+    "kd": {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat", "builder": "level"},
+    "r": {"tree": "r", "packing": "str", "fanout": 16, "leaf_size": 10, "layout": "flat"},
+}
+
+
+def blocked_all_knn(train: np.ndarray, k: int, block_rows: int = 1024) -> np.ndarray:
+    """
+    Returns the ids of the k nearest neighbours of every point among the others by matrix products of
+    block_rows points against all of them.
+    """
+    train64 = train.astype(np.float64)
+    norms = (train64**2).sum(axis=1)
+    ids = np.empty((len(train), k), dtype=np.int64)
+    for start in range(0, len(train), block_rows):
+        rows = np.arange(start, min(start + block_rows, len(train)))
+        dists = norms[rows, None] + norms[None, :] - 2 * (train64[rows] @ train64.T)
+        dists[np.arange(len(rows)), rows] = np.inf
+        nearest = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        ids[rows] = np.take_along_axis(nearest, np.argsort(np.take_along_axis(dists, nearest, axis=1), axis=1), axis=1)
+    return ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train dataset)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 20000 with --synthetic")
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--block-size", type=int, default=64, help="largest nodes compared as blocks")
+    parser.add_argument("--n-check", type=int, default=200, help="points checked against (and timing) the brute-force scans")
+    parser.add_argument("--skip-blocked", action="store_true", help="skip the blocked brute force over all the pairs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, _ = make_synthetic(args.n_train or 20000, 1, args.dim, seed=args.seed)
+    else:
+        train, _, _ = load_dataset(args.data, args.n_train, 1)
+
+    random.seed(args.seed)
+    start_time = time.perf_counter()
+    tree = build_tree(DEFAULT_VARIANTS[args.tree], train)
+    build_time = time.perf_counter() - start_time
+
+    # the scans of the sample, with the point itself as its nearest neighbour
+    sample = np.random.default_rng(args.seed).choice(len(train), min(args.n_check, len(train)), replace=False)
+    start_time = time.perf_counter()
+    _, true_ids = brute_force_knn(train, train[sample], args.k + 1)
+    scan_time = (time.perf_counter() - start_time) * len(train) / len(sample)
+    true_ids = true_ids[:, 1:]
+
+    print(f"{os.cpu_count()} CPU cores, {len(train)} points, build {build_time:.2f}s")
+    print(f"{'method':<24}{'time (s)':>10}{'speedup':>9}{f'recall@{args.k}':>11}")
+    print(f"{'brute-force scans (est.)':<24}{scan_time:>10.2f}{1:>9.2f}{1:>11.4f}")
+    rows = [{"method": "scans", "time_s": scan_time}]
+    if not args.skip_blocked:
+        start_time = time.perf_counter()
+        blocked_ids = blocked_all_knn(train, args.k)
+        elapsed = time.perf_counter() - start_time
+        found = recall(blocked_ids[sample], true_ids)
+        rows.append({"method": "blocked", "time_s": elapsed, "speedup": scan_time / elapsed, f"recall@{args.k}": found})
+        print(f"{'blocked brute force':<24}{elapsed:>10.2f}{scan_time / elapsed:>9.2f}{found:>11.4f}")
+
+    for n_threads in args.threads:
+        start_time = time.perf_counter()
+        indptr, indices, _ = tree.all_knn(args.k, n_threads=n_threads, block_size=args.block_size)
+        elapsed = time.perf_counter() - start_time
+        found = recall([indices[indptr[i] : indptr[i + 1]] for i in sample], true_ids)
+        rows.append({"method": "all_knn", "n_threads": n_threads, "time_s": elapsed, "speedup": scan_time / elapsed, f"recall@{args.k}": found})
+        print(f"{f'all_knn, {n_threads} threads':<24}{elapsed:>10.2f}{scan_time / elapsed:>9.2f}{found:>11.4f}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "variant": DEFAULT_VARIANTS[args.tree], "build_time_s": build_time, "rows": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+# autotune.py
+"""
+Searches the variants of a tree for the one with the highest QPS at a required recall@k, within a build-time
+and a memory budget, instead of running a hand-picked grid on full builds.
+
+The search is a successive halving: a random sample of n_configs variants of the search space is evaluated
+on a small subsample of the train set, the best 1/eta of them are kept and evaluated again on a subsample eta
+times larger (the subsamples are nested prefixes of one permutation), and so on; the rung that is left with a
+single variant, if not an earlier one, evaluates it on the whole train set.
+Every evaluation builds the tree and sweeps the query budget of the KD-Tree (max_leaves of the best-bin-first
+search, from the smallest, stopping at the first budget that reaches the target recall), then measures the
+exact search (batched, it can be faster than a budget searched query by query). The variants are ranked by
+their QPS if they reach the target recall, after all the ones that do not (ranked by recall).
+
+Early stopping:
+- a variant whose build time (extrapolated from its last two rungs, by a power law of the number of points)
+  or index and vector memory (linear in the number of points) would exceed the budget on the whole train
+  set is dropped, as is one whose extrapolated build alone exceeds the time left;
+- the search stops when a single variant is left, or when time_budget_s is spent (returning the best variant
+  of the last completed rung).
+
+The evaluations are cached by variant, number of points, queries, k, target recall and seed, in memory and in
+cache_path if given, so that an interrupted or repeated search does not rebuild anything.
+
+Usage:
+    python benchmarks/autotune.py --data gist-960-euclidean.hdf5 --tree kd --target-recall 0.9 -k 10 --time-budget-s 600 --out tuned.json
+    python benchmarks/autotune.py --synthetic --dim 128 --n-train 100000 --tree r --max-build-s 10 --max-memory-mb 64
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from query_benchmark import brute_force_knn, recall
+from run_benchmark import build_tree, index_size, load_dataset, make_synthetic, vectors_size
+
+# the values tried for every constructor argument, and the arguments every variant gets
+SEARCH_SPACES = {
+    "kd": {
+        "dimension_choice": ["random", "alternate", "max_variance", "widest_interval", "top_variance", "random_projection", "pca"],
+        "split_position_choice": ["mean", "median", "random", "geometric_center"],
+        "leaf_size": [10, 20, 40, 80],
+        "max_depth": [None, 12, 20],
+        "vector_storage": [None, "int8"],
+    },
+    "r": {
+        "grouping_choice": ["closest_seed", "sorting_distance_to_one_seed"],
+        "seed_choice": ["one_dim_farthest", "approx_farthest", "farthest_euc_distance_blocked"],
+        "dimension_choice": ["random", "alternate", "max_variance", "widest_interval", "random_projection"],
+        "packing": [None, "str", "hilbert"],
+        "leaf_size": [10, 20, 40, 80],
+        "max_depth": [None, 12, 20],
+        "vector_storage": [None, "int8"],
+    },
+}
+
+FIXED_PARAMS = {
+    "kd": {"engine": "numpy", "layout": "flat", "builder": "level"},
+    "r": {"layout": "flat", "builder": "level"},
+}
+
+# the query budgets swept by every evaluation, increasing, None for the exact search
+QUERY_BUDGETS = {
+    "kd": [1, 2, 4, 8, 16, 32, 64, 128, None],
+    "r": [None],
+}
+
+
+def normalise(tree: str, config: dict) -> dict:
+    """
+    Returns the variant without the arguments its other arguments make unused, so that equivalent variants
+    are only evaluated once.
+    """
+    config = dict(config)
+    if tree == "r" and config.get("packing") is not None:
+        # a packed tree has no seed or grouping choice, and is not built level by level
+        for key in ("grouping_choice", "seed_choice", "dimension_choice", "builder"):
+            config.pop(key, None)
+    elif tree == "r" and config.get("seed_choice") != "one_dim_farthest":
+        config.pop("dimension_choice", None)
+    return config
+
+
+def sample_configs(tree: str, n_configs: int = None, space: dict = None, seed: int = 0) -> list[dict]:
+    """
+    Returns n_configs distinct variants of the search space (all of them if n_configs is None), in a random
+    order drawn from seed.
+    """
+    space = space or SEARCH_SPACES[tree]
+    configs = {}
+    for values in itertools.product(*space.values()):
+        config = normalise(tree, {**FIXED_PARAMS[tree], **dict(zip(space.keys(), values))})
+        configs.setdefault(json.dumps(config, sort_keys=True), config)
+    configs = list(configs.values())
+    random.Random(seed).shuffle(configs)
+    return configs if n_configs is None else configs[:n_configs]
+
+
+def extrapolate_build_time(times: dict, n_total: int) -> float:
+    """
+    Extrapolates the build times measured on some numbers of points (times maps the number of points to the
+    time) to n_total points: by n log n from a single measure, by the power law through the last two otherwise
+    (its exponent clipped between 1 and 2).
+    """
+    sizes = sorted(times)
+    n = sizes[-1]
+    if len(sizes) == 1 or n >= n_total:
+        return times[n] * n_total * math.log(max(n_total, 2)) / (n * math.log(max(n, 2)))
+    m = sizes[-2]
+    exponent = math.log(max(times[n], 1e-9) / max(times[m], 1e-9)) / math.log(n / m)
+    return times[n] * (n_total / n) ** min(max(exponent, 1.0), 2.0)
+
+
+def evaluate(tree: str, config: dict, train: np.ndarray, test: np.ndarray, true_ids: np.ndarray, k: int, target_recall: float, seed: int = 0) -> dict:
+    """
+    Builds a variant and sweeps its query budgets up to the first that reaches target_recall, then the exact
+    search.
+
+    Returns
+    -------
+    dict
+        The build time, the memory of the index and of the vectors scanned in memory (MB), the sweep (one
+        row per budget) and the operating point: the fastest budget reaching the target recall, or else the
+        one of highest recall.
+    """
+    random.seed(seed)
+    start_time = time.perf_counter()
+    index = build_tree({"tree": tree, **config}, train)
+    build_time = time.perf_counter() - start_time
+
+    # the budgets up to the first reaching the target, then the exact search (batched, it may be faster)
+    sweep = []
+    for budget in QUERY_BUDGETS[tree]:
+        if sweep and sweep[-1]["recall"] >= target_recall and budget is not None:
+            continue
+        params = {} if budget is None else {"max_leaves": budget}
+        start_time = time.perf_counter()
+        _, ids = index.query_batch(test, k, **params)
+        qps = len(test) / (time.perf_counter() - start_time)
+        sweep.append({"max_leaves": budget, "qps": qps, "recall": recall(ids, true_ids)})
+
+    reached = [row for row in sweep if row["recall"] >= target_recall]
+    best = max(reached, key=lambda row: row["qps"]) if reached else max(sweep, key=lambda row: row["recall"])
+    return {
+        "build_time_s": build_time,
+        "memory_mb": (index_size(index) + vectors_size(index)) / 2**20,
+        "sweep": sweep,
+        "query": {} if best["max_leaves"] is None else {"max_leaves": best["max_leaves"]},
+        "qps": best["qps"],
+        "recall": best["recall"],
+        "reached": bool(reached),
+    }
+
+
+def autotune(
+    train: np.ndarray,
+    test: np.ndarray,
+    tree: str = "kd",
+    k: int = 10,
+    target_recall: float = 0.9,
+    max_build_s: float = None,
+    max_memory_mb: float = None,
+    time_budget_s: float = None,
+    n_configs: int = 81,
+    eta: int = 3,
+    min_train: int = 2000,
+    space: dict = None,
+    true_ids: np.ndarray = None,
+    cache_path: str = None,
+    seed: int = 0,
+    verbose: bool = True,
+) -> dict:
+    """
+    Searches the variants of a tree for the highest QPS at target_recall by successive halving.
+
+    Parameters
+    ----------
+    train, test : np.ndarray
+        The points to index and the queries.
+    tree : str, optional
+        "kd" or "r", by default "kd".
+    k : int, optional
+        The number of neighbours of the recall, by default 10.
+    target_recall : float, optional
+        The required recall@k, by default 0.9.
+    max_build_s, max_memory_mb : float, optional
+        The budgets on the whole train set, by default None (no budget): the build time, and the memory of
+        the index structure and of the vectors scanned in memory.
+    time_budget_s : float, optional
+        The time the search may take, by default None.
+    n_configs : int, optional
+        The number of variants of the first rung, by default 81 (all of them if None).
+    eta : int, optional
+        The factor by which every rung cuts the variants and grows the subsample (the last rung takes the
+        whole train set), by default 3.
+    min_train : int, optional
+        The number of points of the first rung, by default 2000.
+    space : dict, optional
+        The values tried for every argument, by default SEARCH_SPACES[tree].
+    true_ids : np.ndarray, optional
+        The true neighbours of the queries in the whole train set (e.g. from the HDF5 file), by default
+        computed by a linear scan; those of the subsamples always are.
+    cache_path : str, optional
+        A JSON file where the evaluations are cached, by default None.
+    seed : int, optional
+        The seed of the sampling of the variants and of the subsamples, and of the random strategies.
+
+    Returns
+    -------
+    dict
+        "variant" (the constructor arguments), "query" (the query arguments), the measurements of the best
+        variant on the largest rung it reached, "reached" (whether it meets target_recall), and "history"
+        (one row per evaluation).
+    """
+    start_time = time.perf_counter()
+    n_total = len(train)
+    configs = sample_configs(tree, n_configs, space, seed)
+
+    # every rung grows the subsample by eta, up to the whole train set on the rung left with one variant
+    n_rungs = max(1, math.ceil(math.log(max(len(configs), 1), eta)) + 1)
+    sizes = sorted({min(min(min_train, n_total) * eta**rung, n_total) for rung in range(n_rungs - 1)} | {n_total})
+    order = np.random.default_rng(seed).permutation(n_total)
+
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    history = []
+    build_times = {}
+    survivors = configs
+    best = None
+    for rung, size in enumerate(sizes):
+        # the subsamples are nested prefixes of one permutation, kept in train order
+        subsample = train[np.sort(order[:size])] if size < n_total else train
+        rung_true_ids = true_ids if size == n_total and true_ids is not None else brute_force_knn(subsample, test, k)[1]
+
+        results = []
+        for config in survivors:
+            if time_budget_s is not None and time.perf_counter() - start_time > time_budget_s:
+                break
+            name = json.dumps(config, sort_keys=True)
+            key = json.dumps({"tree": tree, "variant": config, "n_train": size, "n_queries": len(test), "k": k, "target_recall": target_recall, "seed": seed}, sort_keys=True)
+            if key not in cache:
+                cache[key] = evaluate(tree, config, subsample, test, rung_true_ids, k, target_recall, seed)
+                if cache_path is not None:
+                    with open(cache_path, "w") as f:
+                        json.dump(cache, f)
+            result = cache[key]
+            build_times.setdefault(name, {})[size] = result["build_time_s"]
+
+            # the budgets on the whole train set
+            expected_build = extrapolate_build_time(build_times[name], n_total)
+            expected_memory = result["memory_mb"] * n_total / size
+            dropped = None
+            if max_build_s is not None and expected_build > max_build_s:
+                dropped = "build time"
+            elif max_memory_mb is not None and expected_memory > max_memory_mb:
+                dropped = "memory"
+            elif time_budget_s is not None and size < n_total and expected_build > time_budget_s - (time.perf_counter() - start_time):
+                dropped = "time budget"
+            row = {"rung": rung, "n_train": size, "variant": config, **result, "expected_build_time_s": expected_build, "expected_memory_mb": expected_memory, "dropped": dropped}
+            history.append(row)
+            if dropped is None:
+                results.append(row)
+            if verbose:
+                status = f"dropped ({dropped})" if dropped else f"{result['qps']:.1f} QPS, recall {result['recall']:.3f}"
+                print(f"rung {rung} ({size} points) {name}: build {result['build_time_s']:.2f}s, {status}")
+
+        if not results:
+            break
+        results.sort(key=lambda row: (row["reached"], row["qps"] if row["reached"] else row["recall"]), reverse=True)
+        best = results[0]
+        survivors = [row["variant"] for row in results[: max(1, len(results) // eta)]]
+        if len(results) == 1 or (time_budget_s is not None and time.perf_counter() - start_time > time_budget_s):
+            break
+
+    if best is None:
+        return {"variant": None, "history": history}
+    return {
+        "variant": {"tree": tree, **best["variant"]},
+        "query": best["query"],
+        "n_train": best["n_train"],
+        "qps": best["qps"],
+        f"recall@{k}": best["recall"],
+        "reached": best["reached"],
+        "build_time_s": best["build_time_s"],
+        "memory_mb": best["memory_mb"],
+        "expected_build_time_s": best["expected_build_time_s"],
+        "expected_memory_mb": best["expected_memory_mb"],
+        "tuning_time_s": time.perf_counter() - start_time,
+        "history": history,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test/neighbors datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 50000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--target-recall", type=float, default=0.9)
+    parser.add_argument("--max-build-s", type=float, default=None, help="build time budget on the whole train set")
+    parser.add_argument("--max-memory-mb", type=float, default=None, help="index and vector memory budget on the whole train set")
+    parser.add_argument("--time-budget-s", type=float, default=None, help="time the search may take")
+    parser.add_argument("--n-configs", type=int, default=81, help="variants of the first rung")
+    parser.add_argument("--eta", type=int, default=3, help="cut of the variants and growth of the subsample at every rung")
+    parser.add_argument("--min-train", type=int, default=2000, help="points of the first rung")
+    parser.add_argument("--cache", default=None, help="JSON file caching the evaluations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the best variant and the history")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 50000, args.n_queries, args.dim, seed=args.seed)
+        neighbors = None
+    else:
+        train, test, neighbors = load_dataset(args.data, args.n_train, args.n_queries)
+    if neighbors is not None and neighbors.shape[1] >= args.k:
+        neighbors = neighbors[:, : args.k]
+    else:
+        neighbors = None
+
+    result = autotune(
+        train,
+        test,
+        tree=args.tree,
+        k=args.k,
+        target_recall=args.target_recall,
+        max_build_s=args.max_build_s,
+        max_memory_mb=args.max_memory_mb,
+        time_budget_s=args.time_budget_s,
+        n_configs=args.n_configs,
+        eta=args.eta,
+        min_train=args.min_train,
+        true_ids=neighbors,
+        cache_path=args.cache,
+        seed=args.seed,
+    )
+
+    if result["variant"] is None:
+        print("No variant fits the budgets")
+    else:
+        print(f"Best variant: {result['variant']}, query {result['query']}")
+        print(
+            f"  on {result['n_train']} points: {result['qps']:.1f} QPS, recall@{args.k} {result[f'recall@{args.k}']:.4f}"
+            f"{'' if result['reached'] else ' (below the target)'}, build {result['build_time_s']:.2f}s, "
+            f"memory {result['memory_mb']:.2f}MB; tuned in {result['tuning_time_s']:.1f}s"
+        )
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# bbf_benchmark.py
+"""
+Sweeps the visit budget (max_checks) of the approximate best-bin-first search, for a single KDTree and for
+KDForests of several sizes, and reports recall@k against QPS. With --slo-ms, picks the operating point: the
+configuration with the highest recall whose p99 query latency fits the SLO.
+
+Usage:
+    python benchmarks/bbf_benchmark.py --data gist-960-euclidean.hdf5 --n-train 100000 --n-queries 200 --slo-ms 5 --plot bbf.png
+    python benchmarks/bbf_benchmark.py --synthetic --dim 960 --n-train 20000 --n-trees 1 4 8 --checks 64 256 1024 4096
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kd_tree.kd_tree import KDTree
+from kd_tree.kd_forest import KDForest
+from query_benchmark import brute_force_knn, recall
+from run_benchmark import load_dataset, make_synthetic
+
+
+def sweep(index, name: str, test: np.ndarray, true_ids: np.ndarray, k: int, checks: list[int]) -> list[dict]:
+    """
+    Queries the index with every max_checks budget and returns one row of measurements per budget.
+    """
+    rows = []
+    for max_checks in checks:
+        latencies = np.empty(len(test))
+        found = np.empty((len(test), k), dtype=np.int64)
+        for row, q in enumerate(test):
+            start_time = time.perf_counter()
+            _, found[row] = index.query(q, k, max_checks=max_checks)
+            latencies[row] = time.perf_counter() - start_time
+        rows.append(
+            {
+                "index": name,
+                "max_checks": max_checks,
+                f"recall@{k}": recall(found, true_ids),
+                "qps": len(test) / latencies.sum(),
+                "latency_p50_ms": 1000 * np.percentile(latencies, 50),
+                "latency_p99_ms": 1000 * np.percentile(latencies, 99),
+            }
+        )
+        print(
+            f"{name:<14}{max_checks:>10}{rows[-1][f'recall@{k}']:>10.4f}{rows[-1]['qps']:>10.1f}"
+            f"{rows[-1]['latency_p99_ms']:>10.2f}"
+        )
+    return rows
+
+
+def plot(rows: list[dict], k: int, path: str):
+    """
+    Saves the recall@k against QPS curve of every index to path (needs matplotlib).
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(7, 5))
+    for name in dict.fromkeys(row["index"] for row in rows):
+        curve = [row for row in rows if row["index"] == name]
+        ax.plot([row[f"recall@{k}"] for row in curve], [row["qps"] for row in curve], marker="o", label=name)
+    ax.set_xlabel(f"recall@{k}")
+    ax.set_ylabel("queries per second")
+    ax.set_yscale("log")
+    ax.grid(True, which="both", alpha=0.3)
+    ax.legend()
+    fig.savefig(path, dpi=120, bbox_inches="tight")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test/neighbors datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 10000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--n-trees", type=int, nargs="+", default=[1, 4, 8], help="forest sizes (1 = a single tree)")
+    parser.add_argument("--dimension-choice", default="top_variance", choices=["random", "top_variance"])
+    parser.add_argument("--leaf-size", type=int, default=10)
+    parser.add_argument("--checks", type=int, nargs="+", default=[32, 128, 512, 2048, 8192])
+    parser.add_argument("--slo-ms", type=float, default=None, help="p99 latency target of the operating point")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--plot", default=None, help="PNG file for the recall/QPS chart")
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 10000, args.n_queries, args.dim, seed=args.seed)
+        neighbors = None
+    else:
+        train, test, neighbors = load_dataset(args.data, args.n_train, args.n_queries)
+    if neighbors is not None and neighbors.shape[1] >= args.k:
+        true_ids = neighbors[:, : args.k]
+    else:
+        _, true_ids = brute_force_knn(train, test, args.k)
+
+    print(f"{'index':<14}{'max_checks':>10}{'recall@' + str(args.k):>10}{'QPS':>10}{'p99 ms':>10}")
+    rows = []
+    for n_trees in args.n_trees:
+        random.seed(args.seed)
+        start_time = time.time()
+        if n_trees == 1:
+            index = KDTree(
+                train.shape[1], train, "max_variance", "median", leaf_size=args.leaf_size, engine="numpy", layout="flat"
+            )
+            name = "kd-tree"
+        else:
+            index = KDForest(
+                train.shape[1], train, n_trees, args.dimension_choice, "median", leaf_size=args.leaf_size
+            )
+            name = f"forest-{n_trees}"
+        print(f"{name}: built in {time.time() - start_time:.2f}s")
+        rows += sweep(index, name, test, true_ids, args.k, args.checks)
+
+    if args.slo_ms is not None:
+        fitting = [row for row in rows if row["latency_p99_ms"] <= args.slo_ms]
+        if fitting:
+            best = max(fitting, key=lambda row: (row[f"recall@{args.k}"], row["qps"]))
+            print(
+                f"Operating point for a p99 of {args.slo_ms}ms: {best['index']} with max_checks={best['max_checks']} "
+                f"(recall@{args.k} {best[f'recall@{args.k}']:.4f}, {best['qps']:.1f} QPS, p99 {best['latency_p99_ms']:.2f}ms)"
+            )
+        else:
+            print(f"No configuration meets a p99 of {args.slo_ms}ms")
+
+    if args.plot is not None:
+        try:
+            plot(rows, args.k, args.plot)
+            print(f"Chart written to {args.plot}")
+        except ImportError:
+            print("matplotlib is needed for --plot")
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# quantization_benchmark.py
+"""
+Measures the memory, QPS and recall@k of the compressed leaf vectors (vector_storage="float16" or "int8")
+against the full-precision scans, for a sweep of the number of re-ranked candidates per neighbour.
+
+The train vectors are written to a temporary .npy file that the trees memory-map, as they would index a
+dataset larger than the memory: the float32 vectors are then only read for the re-ranked candidates, and the
+"vectors MB" column is what the leaf scans keep in memory (the codes, or all the float32 vectors without
+compression).
+
+Usage:
+    python benchmarks/quantization_benchmark.py --data gist-960-euclidean.hdf5 --n-train 100000 --n-queries 200
+    python benchmarks/quantization_benchmark.py --synthetic --dim 128 --n-train 50000 --tree r --rerank 1 2 4 8
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from query_benchmark import brute_force_knn, recall
+from run_benchmark import build_tree, load_dataset, make_synthetic
+
+DEFAULT_VARIANTS = {
+    "kd": {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat"},
+    "r": {"tree": "r", "packing": "str", "fanout": 16, "leaf_size": 10, "layout": "flat"},
+}
+
+
+def measure(tree, test: np.ndarray, true_ids: np.ndarray, k: int) -> dict:
+    """
+    Queries the tree with every test point and returns its QPS, p99 latency and recall@k.
+    """
+    latencies = np.empty(len(test))
+    found = np.full((len(test), k), -1, dtype=np.int64)
+    for row, q in enumerate(test):
+        start_time = time.perf_counter()
+        _, ids = tree.query(q, k)
+        latencies[row] = time.perf_counter() - start_time
+        found[row, : len(ids)] = ids
+    return {
+        "qps": len(test) / latencies.sum(),
+        "latency_p99_ms": 1000 * np.percentile(latencies, 99),
+        f"recall@{k}": recall(found, true_ids),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 20000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--storage", nargs="+", default=["float16", "int8"], choices=["float16", "int8"])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[1, 2, 4, 8], help="re-ranked candidates per neighbour")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tmp-dir", default=None, help="directory of the temporary .npy file")
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 20000, args.n_queries, args.dim, seed=args.seed)
+    else:
+        train, test, _ = load_dataset(args.data, args.n_train, args.n_queries)
+    train = np.asarray(train, dtype=np.float32)
+    test = np.asarray(test, dtype=np.float32)
+    _, true_ids = brute_force_knn(train, test, args.k)
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp:
+        path = os.path.join(tmp, "train.npy")
+        np.save(path, train)
+        train = np.load(path, mmap_mode="r")
+
+        print(f"{'storage':<10}{'rerank':>8}{'build s':>9}{'vectors MB':>12}{'QPS':>10}{'p99 ms':>9}{f'recall@{args.k}':>11}")
+        rows = []
+        for storage in [None, *args.storage]:
+            variant = dict(DEFAULT_VARIANTS[args.tree], vector_storage=storage)
+            random.seed(args.seed)
+            start_time = time.perf_counter()
+            tree = build_tree(variant, train)
+            build_time = time.perf_counter() - start_time
+            # the float32 vectors a scan without compression would keep in memory
+            vectors = tree.codes.nbytes if tree.codes is not None else tree.data.nbytes
+
+            for rerank in [1] if storage is None else args.rerank:
+                tree.rerank = rerank
+                row = {"variant": variant, "rerank": rerank, "build_s": build_time, "vectors_mb": vectors / 2**20}
+                row.update(measure(tree, test, true_ids, args.k))
+                rows.append(row)
+                print(
+                    f"{storage or 'float32':<10}{rerank:>8}{build_time:>9.2f}{row['vectors_mb']:>12.1f}"
+                    f"{row['qps']:>10.1f}{row['latency_p99_ms']:>9.2f}{row[f'recall@{args.k}']:>11.4f}"
+                )
+            del tree
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# query_benchmark.py
+"""
+Compares the query throughput of the tree indexes against a brute-force linear scan.
+
+Usage:
+    python benchmarks/query_benchmark.py --data gist-960-euclidean.hdf5 --n-train 10000 --n-queries 100 -k 10
+    python benchmarks/query_benchmark.py --data gist-960-euclidean.hdf5 --tree r --seed-choice one_dim_farthest
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+
+def load_hdf5(path: str, n_train: int, n_queries: int):
+    """
+    Returns the first n_train train vectors and the first n_queries test vectors of an ann-benchmarks HDF5 file.
+    """
+    import h5py
+
+    with h5py.File(path, "r") as f:
+        train = f["train"][:n_train]
+        test = f["test"][:n_queries]
+    return train, test
+
+
+def brute_force_knn(train: np.ndarray, Q: np.ndarray, k: int, metric: str = "euclidean"):
+    """
+    Returns the distances and ids of the k nearest neighbours of every query by a linear scan, with the
+    Euclidean or the Manhattan distance.
+    """
+    train_sq = (train.astype(np.float64) ** 2).sum(axis=1)
+    distances = np.empty((len(Q), k), dtype=np.float64)
+    ids = np.empty((len(Q), k), dtype=np.int64)
+
+    for row, q in enumerate(Q.astype(np.float64)):
+        if metric == "manhattan":
+            dists = np.abs(train - q).sum(axis=1)
+        else:
+            dists = train_sq - 2 * (train @ q) + q @ q
+        nearest = np.argpartition(dists, k - 1)[:k]
+        nearest = nearest[np.argsort(dists[nearest])]
+        distances[row] = dists[nearest] if metric == "manhattan" else np.sqrt(np.maximum(dists[nearest], 0))
+        ids[row] = nearest
+    return distances, ids
+
+
+def recall(found_ids: np.ndarray, true_ids: np.ndarray) -> float:
+    """
+    Returns the fraction of the true neighbours that were found, averaged over the queries.
+    """
+    hits = sum(len(np.intersect1d(found, true)) for found, true in zip(found_ids, true_ids))
+    return hits / true_ids.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", required=True, help="ann-benchmarks style HDF5 file (train/test datasets)")
+    parser.add_argument("--n-train", type=int, default=10000)
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--dimension-choice", default="max_variance")
+    parser.add_argument("--split-position-choice", default="median", help="kd-tree only")
+    parser.add_argument("--grouping-choice", default="closest_seed", help="r-tree only")
+    parser.add_argument("--seed-choice", default="one_dim_farthest", help="r-tree only")
+    parser.add_argument("--leaf-size", type=int, default=10)
+    parser.add_argument("--max-depth", type=int, default=None)
+    args = parser.parse_args()
+
+    train, test = load_hdf5(args.data, args.n_train, args.n_queries)
+
+    start_time = time.time()
+    _, true_ids = brute_force_knn(train, test, args.k)
+    brute_time = time.time() - start_time
+
+    start_time = time.time()
+    if args.tree == "kd":
+        tree = KDTree(
+            k=train.shape[1],
+            datapoints=train,
+            dimension_choice=args.dimension_choice,
+            split_position_choice=args.split_position_choice,
+            leaf_size=args.leaf_size,
+            max_depth=args.max_depth,
+        )
+    else:
+        tree = RTree(
+            k=train.shape[1],
+            datapoints=train,
+            grouping_choice=args.grouping_choice,
+            seed_choice=args.seed_choice,
+            dimension_choice=args.dimension_choice,
+            leaf_size=args.leaf_size,
+            max_depth=args.max_depth,
+        )
+    build_time = time.time() - start_time
+
+    start_time = time.time()
+    _, ids, visited = tree.query_batch(test, args.k, return_visited=True)
+    tree_time = time.time() - start_time
+
+    print(f"Build Time: {build_time:.2f} seconds")
+    print(f"{'method':<12}{'QPS':>12}{'nodes/query':>14}{'recall@' + str(args.k):>12}")
+    print(f"{'brute force':<12}{len(test) / brute_time:>12.1f}{'-':>14}{1.0:>12.4f}")
+    print(f"{args.tree + '-tree':<12}{len(test) / tree_time:>12.1f}{visited.mean():>14.1f}{recall(ids, true_ids):>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+# run_benchmark.py
+"""
+Runs a grid of tree variants on an ann-benchmarks style HDF5 file (or an offline synthetic stand-in) and
+records, for every variant: build time, peak RSS, index size, the size of the vectors scanned in memory, query
+latency percentiles, QPS and recall@k.
+With --quality, also the per-leaf quality metrics of the tree and a sampled silhouette score.
+With --stats, the KD-Tree and R-Tree variants are built with collect_stats=True and their build and query
+statistics (get_stats) are recorded under "stats"; the timers add a little to the build time.
+
+Every variant is built and queried in its own process so that its peak RSS is not mixed with the others'.
+The results are written as JSON or CSV (by the extension of --out) so that runs can be compared across commits.
+
+Usage:
+    python benchmarks/run_benchmark.py --data gist-960-euclidean.hdf5 --n-train 10000 --n-queries 100 -k 10 --out kd.json
+    python benchmarks/run_benchmark.py --synthetic --dim 128 --n-train 20000 --grid benchmarks/grids/notebook_variants.json --out runs.csv
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+from m_tree.m_tree import MTree
+from query_benchmark import brute_force_knn, recall
+
+# variants run when no --grid is given; every variant names its tree and the constructor arguments
+DEFAULT_GRID = [
+    {"tree": "kd", "dimension_choice": "random", "split_position_choice": "random", "leaf_size": 10},
+    {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10},
+    {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat"},
+    {"tree": "kd", "dimension_choice": "pca", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat"},
+    {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat", "rotation": "pca"},
+    {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat", "vector_storage": "int8"},
+    {"tree": "r", "grouping_choice": "closest_seed", "seed_choice": "one_dim_farthest", "dimension_choice": "random", "leaf_size": 10},
+    {"tree": "r", "grouping_choice": "closest_seed", "seed_choice": "approx_farthest", "dimension_choice": "random", "leaf_size": 10, "layout": "flat"},
+    {"tree": "r", "packing": "str", "fanout": 16, "leaf_size": 10, "layout": "flat"},
+    {"tree": "r", "packing": "hilbert", "fanout": 32, "leaf_size": 10, "layout": "flat"},
+    {"tree": "r", "packing": "str", "fanout": 16, "leaf_size": 10, "layout": "flat", "vector_storage": "float16"},
+    {"tree": "m", "metric": "euclidean", "grouping_choice": "closest_seed", "seed_choice": "approx_farthest", "leaf_size": 10},
+    {"tree": "m", "metric": "euclidean", "grouping_choice": "closest_seed", "seed_choice": "approx_farthest", "promotion": "centroid", "leaf_size": 10},
+    {"tree": "m", "metric": "manhattan", "grouping_choice": "closest_seed", "seed_choice": "approx_farthest", "promotion": "centroid", "leaf_size": 10},
+]
+
+
+def load_dataset(path: str, n_train: int = None, n_queries: int = None):
+    """
+    Returns the train vectors, the test vectors and the ids of their true neighbours from an ann-benchmarks
+    HDF5 file. The stored neighbours index the whole train set, so they are only returned when all of it is
+    used (None otherwise).
+    """
+    import h5py
+
+    with h5py.File(path, "r") as f:
+        n_total = len(f["train"])
+        train = f["train"][:n_train]
+        test = f["test"][:n_queries]
+        neighbors = None
+        if "neighbors" in f and (n_train is None or n_train >= n_total):
+            neighbors = f["neighbors"][: len(test)]
+    return train, test, neighbors
+
+
+def make_synthetic(n_train: int, n_queries: int, dim: int, n_clusters: int = 50, seed: int = 0):
+    """
+    Returns float32 train and test vectors drawn from a mixture of Gaussian clusters, a stand-in for a real
+    dataset when none is available offline.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=4.0, size=(n_clusters, dim))
+    scales = rng.uniform(0.5, 1.5, size=n_clusters)
+
+    def draw(n):
+        labels = rng.integers(n_clusters, size=n)
+        return (centers[labels] + rng.normal(size=(n, dim)) * scales[labels, None]).astype(np.float32)
+
+    return draw(n_train), draw(n_queries)
+
+
+def build_tree(variant: dict, train: np.ndarray):
+    """
+    Builds the tree described by a grid variant.
+    """
+    params = {key: value for key, value in variant.items() if key != "tree"}
+    if variant["tree"] == "kd":
+        return KDTree(k=train.shape[1], datapoints=train, **params)
+    if variant["tree"] == "m":
+        return MTree(k=train.shape[1], datapoints=train, **params)
+    return RTree(k=train.shape[1], datapoints=train, **params)
+
+
+def index_size(tree) -> int:
+    """
+    Returns the number of bytes held by the index structure (nodes, ids, permutation and the M-Tree's point
+    distances), without the datapoints.
+    """
+    size = 0
+    for name in ("perm", "point_dists"):
+        if getattr(tree, name, None) is not None:
+            size += getattr(tree, name).nbytes
+    if tree.layout == "flat":
+        return size + sum(values.nbytes for values in tree.nodes.values())
+
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            continue
+        size += sys.getsizeof(node)
+        for value in node.values():
+            if isinstance(value, np.ndarray):
+                # views of perm are already counted
+                size += value.nbytes if value.base is None else 0
+            elif isinstance(value, list):
+                size += sys.getsizeof(value)
+        if "children" in node:
+            if node["children"] is not None:
+                size += sys.getsizeof(node["children"])
+                stack.extend(node["children"].values())
+        elif not node["leaf"]:
+            stack.extend((node["left"], node["right"]))
+    return size
+
+
+def vectors_size(tree) -> int:
+    """
+    Returns the number of bytes of the vectors the queries scan in memory: the compressed codes of a tree
+    with a vector_storage, otherwise the datapoints unless they are memory-mapped.
+    """
+    if getattr(tree, "codes", None) is not None:
+        return tree.codes.nbytes
+    return 0 if isinstance(tree.data, np.memmap) else tree.data.nbytes
+
+
+def rss_mb() -> float:
+    """
+    Returns the current resident set size of the process in MB (None if /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_variant(
+    variant: dict, train: np.ndarray, test: np.ndarray, true_ids: np.ndarray, k: int, quality: int = None, stats: bool = False
+) -> dict:
+    """
+    Builds and queries one variant and returns its measurements. With quality, also the quality metrics of
+    the tree and its silhouette score on a sample of that many points (after the peak RSS is read). With
+    stats, also the statistics of the build and of the queries of a KD-Tree or an R-Tree.
+    """
+    stats = stats and variant["tree"] in ("kd", "r")
+    rss_before = rss_mb()
+
+    start_time = time.perf_counter()
+    tree = build_tree({**variant, "collect_stats": True} if stats else variant, train)
+    build_time = time.perf_counter() - start_time
+
+    latencies = np.empty(len(test))
+    found = np.empty((len(test), k), dtype=np.int64)
+    visited = np.empty(len(test))
+    for row, q in enumerate(test):
+        start_time = time.perf_counter()
+        _, ids, visited[row] = tree.query(q, k, return_visited=True)
+        latencies[row] = time.perf_counter() - start_time
+        found[row] = -1
+        found[row, : len(ids)] = ids
+
+    peak = peak_rss_mb()
+    result = {
+        "build_time_s": build_time,
+        "peak_rss_mb": peak,
+        "build_rss_mb": None if rss_before is None else peak - rss_before,
+        "index_size_mb": index_size(tree) / 2**20,
+        "vectors_mb": vectors_size(tree) / 2**20,
+        "qps": len(test) / latencies.sum(),
+        "latency_mean_ms": 1000 * latencies.mean(),
+        "latency_p50_ms": 1000 * np.percentile(latencies, 50),
+        "latency_p90_ms": 1000 * np.percentile(latencies, 90),
+        "latency_p99_ms": 1000 * np.percentile(latencies, 99),
+        "nodes_per_query": visited.mean(),
+        f"recall@{k}": recall(found, true_ids),
+    }
+    if quality is not None:
+        result.update(tree.quality_metrics())
+        result["silhouette"] = tree.compute_silhouette_score(sample_size=quality, seed=0)
+    if stats:
+        result["stats"] = tree.get_stats()
+    return result
+
+
+def _run_in_child(connection, variant, train, test, true_ids, k, quality, stats):
+    try:
+        connection.send(run_variant(variant, train, test, true_ids, k, quality, stats))
+    except Exception as error:
+        connection.send({"error": f"{type(error).__name__}: {error}"})
+    finally:
+        connection.close()
+
+
+def run_isolated(
+    variant: dict, train: np.ndarray, test: np.ndarray, true_ids: np.ndarray, k: int, quality: int = None, stats: bool = False
+) -> dict:
+    """
+    Runs a variant in a forked process, so that its peak RSS only covers the data and its own index.
+    """
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_in_child, args=(sender, variant, train, test, true_ids, k, quality, stats))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": f"worker exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+
+def git_commit() -> str:
+    """
+    Returns the commit of the working tree, None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path: str, rows: list[dict]):
+    """
+    Writes the result rows as CSV if path ends with .csv, as JSON otherwise.
+    """
+    if path.endswith(".csv"):
+        columns = []
+        for row in rows:
+            columns += [key for key in row if key not in columns]
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({key: json.dumps(value) if isinstance(value, dict) else value for key, value in row.items()})
+    else:
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test/neighbors datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 10000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--grid", help="JSON file with a list of variants, e.g. benchmarks/grids/notebook_variants.json")
+    parser.add_argument("--tree", choices=["kd", "r", "m"], default=None, help="only run the variants of this tree")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random strategies and of the synthetic data")
+    parser.add_argument(
+        "--quality", type=int, nargs="?", const=2000, default=None, metavar="SAMPLE",
+        help="also record the leaf quality metrics and the silhouette score on SAMPLE points (2000 by default)",
+    )
+    parser.add_argument("--stats", action="store_true", help="also record the build and query statistics of the KD-Tree and R-Tree variants")
+    parser.add_argument("--no-isolate", action="store_true", help="run all the variants in this process")
+    parser.add_argument("--out", default=None, help="results file, .json or .csv")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        n_train = args.n_train or 10000
+        train, test = make_synthetic(n_train, args.n_queries, args.dim, seed=args.seed)
+        neighbors = None
+        dataset = f"synthetic-{args.dim}-{n_train}"
+    else:
+        train, test, neighbors = load_dataset(args.data, args.n_train, args.n_queries)
+        dataset = os.path.basename(args.data)
+
+    # the true neighbours of every metric of the grid, the stored ones are Euclidean
+    true_ids = {}
+    if neighbors is not None and neighbors.shape[1] >= args.k:
+        true_ids["euclidean"] = neighbors[:, : args.k]
+
+    grid = DEFAULT_GRID
+    if args.grid is not None:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    if args.tree is not None:
+        grid = [variant for variant in grid if variant["tree"] == args.tree]
+
+    meta = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "dataset": dataset,
+        "n_train": len(train),
+        "n_queries": len(test),
+        "dim": train.shape[1],
+        "k": args.k,
+        "seed": args.seed,
+    }
+
+    rows = []
+    for variant in grid:
+        print(f"Running variant: {variant}")
+        random.seed(args.seed)
+        metric = variant.get("metric", "euclidean")
+        if metric not in true_ids:
+            _, true_ids[metric] = brute_force_knn(train, test, args.k, metric)
+        if args.no_isolate or "fork" not in multiprocessing.get_all_start_methods():
+            result = run_variant(variant, train, test, true_ids[metric], args.k, args.quality, args.stats)
+        else:
+            result = run_isolated(variant, train, test, true_ids[metric], args.k, args.quality, args.stats)
+
+        rows.append({**meta, "variant": variant, **result})
+        if "error" in result:
+            print(f"  failed: {result['error']}")
+            continue
+        print(
+            f"  build {result['build_time_s']:.2f}s, peak RSS {result['peak_rss_mb']:.1f}MB, "
+            f"index {result['index_size_mb']:.2f}MB, vectors {result['vectors_mb']:.2f}MB, {result['qps']:.1f} QPS, "
+            f"p50 {result['latency_p50_ms']:.2f}ms, p99 {result['latency_p99_ms']:.2f}ms, "
+            f"recall@{args.k} {result[f'recall@{args.k}']:.4f}"
+        )
+        if "silhouette" in result:
+            print(
+                f"  {result['n_leaves']} leaves, SSE/point {result['sse_per_point']:.4f}, "
+                f"max leaf radius {result['leaf_radius_max']:.4f}, silhouette {result['silhouette']:.4f}"
+            )
+
+    if args.out is not None:
+        write_results(args.out, rows)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# seeds_benchmark.py
+"""
+Compares the R-tree seed choices: time to pick the two seeds of the root node, and how close
+their distance gets to the true diameter of the data (found by the exact blocked search).
+
+Usage:
+    python benchmarks/seeds_benchmark.py --data gist-960-euclidean.hdf5 --n-train 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from r_tree.seeds_choice import (
+    approx_farthest_seeds,
+    farthest_euc_distance_blocked_seeds,
+)
+from query_benchmark import load_hdf5
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", required=True, help="ann-benchmarks style HDF5 file (train dataset)")
+    parser.add_argument("--n-train", type=int, default=10000)
+    parser.add_argument("--sample-size", type=int, default=1000, help="sample of the sampled approx_farthest run")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of the randomised choices (different seeds)")
+    args = parser.parse_args()
+
+    train, _ = load_hdf5(args.data, args.n_train, 0)
+    points = list(train)
+
+    methods = [("farthest_euc_distance_blocked", farthest_euc_distance_blocked_seeds, {}, 1)]
+    for n_iter in (2, 4):
+        methods.append((f"approx_farthest (n_iter={n_iter})", approx_farthest_seeds, {"n_iter": n_iter}, args.repeats))
+        methods.append(
+            (
+                f"approx_farthest (n_iter={n_iter}, sample={args.sample_size})",
+                approx_farthest_seeds,
+                {"n_iter": n_iter, "sample_size": args.sample_size},
+                args.repeats,
+            )
+        )
+
+    diameter = None
+    print(f"{'seed choice':<44}{'time (s)':>10}{'distance':>12}{'/ diameter':>12}")
+    for name, seed_choice, params, repeats in methods:
+        times = []
+        dists = []
+        for repeat in range(repeats):
+            random.seed(repeat)
+            start_time = time.time()
+            seeds = seed_choice(datapoints=points, nbr_dims=train.shape[1], **params)["seeds"]
+            times.append(time.time() - start_time)
+            dists.append(float(np.linalg.norm(seeds[0].astype(np.float64) - seeds[1])))
+        if diameter is None:
+            diameter = dists[0]
+        print(f"{name:<44}{np.mean(times):>10.3f}{np.mean(dists):>12.4f}{np.mean(dists) / diameter:>12.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# shard_benchmark.py
+"""
+Measures the sharded index (ShardedIndex, one tree per shard in its own worker process, with the top-k lists
+of the shards merged) for several numbers of shards and both partitions; 1 shard is a single tree.
+
+Every run reports the build time (the wall time, and the slowest shard), the QPS of the batched search and its
+recall@k against brute-force neighbours. With --n-probe, the "tree" partition only searches the shards
+closest to every query, and with --max-leaves every shard is searched best-bin-first within the budget.
+
+Usage:
+    python benchmarks/shard_benchmark.py --data gist-960-euclidean.hdf5 --n-train 100000 --n-queries 1000 --tree kd
+    python benchmarks/shard_benchmark.py --synthetic --dim 64 --n-train 200000 --tree r --shards 1 2 4 8 --n-probe 2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from kd_tree.sharded_index import ShardedIndex as KDShardedIndex
+from r_tree.sharded_index import ShardedIndex as RShardedIndex
+from query_benchmark import brute_force_knn, recall
+from run_benchmark import load_dataset, make_synthetic
+
+DEFAULT_VARIANTS = {
+    "kd": {"dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat", "builder": "level"},
+    "r": {"packing": "str", "fanout": 16, "leaf_size": 10, "layout": "flat"},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test/neighbors datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 20000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--partitions", nargs="+", choices=["random", "tree"], default=["random", "tree"])
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, by default one per shard")
+    parser.add_argument("--n-probe", type=int, default=None, help="shards searched per query (tree partition)")
+    parser.add_argument("--max-leaves", type=int, default=None, help="leaf budget of every shard's search")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 20000, args.n_queries, args.dim, seed=args.seed)
+    else:
+        train, test, _ = load_dataset(args.data, args.n_train, args.n_queries)
+    _, true_ids = brute_force_knn(train, test, args.k)
+
+    index_class = KDShardedIndex if args.tree == "kd" else RShardedIndex
+    search_params = {} if args.max_leaves is None else {"max_leaves": args.max_leaves}
+
+    print(f"{os.cpu_count()} CPU cores, {len(train)} points, {len(test)} queries")
+    print(f"{'partition':<10}{'shards':>7}{'build (s)':>11}{'slowest (s)':>13}{'QPS':>10}{f'recall@{args.k}':>11}")
+    rows = []
+    for partition in args.partitions:
+        for n_shards in args.shards:
+            start_time = time.perf_counter()
+            index = index_class(
+                train.shape[1], train, n_shards=n_shards, partition=partition, n_workers=args.workers, seed=args.seed,
+                **DEFAULT_VARIANTS[args.tree],
+            )
+            build_time = time.perf_counter() - start_time
+            with index:
+                n_probe = args.n_probe if partition == "tree" else None
+                start_time = time.perf_counter()
+                _, ids = index.query_batch(test, args.k, n_probe=n_probe, **search_params)
+                qps = len(test) / (time.perf_counter() - start_time)
+                found = recall(ids, true_ids)
+                rows.append({
+                    "partition": partition,
+                    "n_shards": index.n_shards,
+                    "n_probe": n_probe,
+                    "build_time_s": build_time,
+                    "slowest_shard_s": float(index.build_times.max()),
+                    "qps": qps,
+                    f"recall@{args.k}": found,
+                })
+                print(f"{partition:<10}{index.n_shards:>7}{build_time:>11.2f}{index.build_times.max():>13.2f}{qps:>10.1f}{found:>11.4f}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "tree": args.tree, "variant": DEFAULT_VARIANTS[args.tree], "search_params": search_params, "rows": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# stats_benchmark.py
+"""
+Measures what the cheaper per-node statistics of the dimension choices (dimension_stats="incremental" or
+"sampled") save in build time and lose in accuracy, against the exact statistics recomputed at every node.
+
+For every dimension choice and every mode, the benchmark reports the build time and its speedup over "exact",
+the within-leaf SSE per point and the nodes visited per exact k-NN query. For the KD-Tree it also checks a
+sample of internal nodes against the exact statistics of their points: the fraction of nodes split on the
+dimension the exact statistics pick ("agreement"), and the mean ratio of the variance (or interval) of the
+chosen dimension to the best one ("score ratio", 1 when nothing is lost).
+
+Usage:
+    python benchmarks/stats_benchmark.py --synthetic --dim 128 --n-train 100000 --tree kd
+    python benchmarks/stats_benchmark.py --data gist-960-euclidean.hdf5 --n-train 20000 --tree r --sample-size 512
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from run_benchmark import build_tree, load_dataset, make_synthetic
+
+MODES = ["exact", "incremental", "sampled"]
+
+DEFAULT_VARIANTS = {
+    "kd": {"tree": "kd", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat"},
+    "r": {"tree": "r", "grouping_choice": "closest_seed", "seed_choice": "one_dim_farthest", "leaf_size": 10, "layout": "flat"},
+}
+
+
+def split_accuracy(tree, dimension_choice: str, n_nodes: int, seed: int) -> dict:
+    """
+    Compares the split dimension of n_nodes random internal nodes of a "flat" KDTree with the dimension the
+    exact statistics of their points pick.
+    """
+    internal = np.nonzero(tree.nodes["split_dim"] >= 0)[0]
+    rng = np.random.default_rng(seed)
+    checked = rng.choice(internal, size=min(n_nodes, len(internal)), replace=False)
+
+    agree = 0
+    ratios = []
+    for node in checked.tolist():
+        start, count = tree.nodes["start"][node], tree.nodes["count"][node]
+        points = tree.data[tree.perm[start : start + count]].astype(np.float64)
+        scores = np.ptp(points, axis=0) if dimension_choice == "widest_interval" else points.var(axis=0)
+        agree += int(np.argmax(scores)) == int(tree.nodes["split_dim"][node])
+        ratios.append(scores[tree.nodes["split_dim"][node]] / max(scores.max(), np.finfo(np.float64).tiny))
+    return {"agreement": agree / max(len(checked), 1), "score_ratio": float(np.mean(ratios)) if ratios else 1.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 20000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=50)
+    parser.add_argument("--dim", type=int, default=128, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--dimension-choice", nargs="+", default=["max_variance", "widest_interval"])
+    parser.add_argument("--sample-size", type=int, default=1024, help="points per node of the sampled statistics")
+    parser.add_argument("--check-nodes", type=int, default=200, help="internal nodes checked against the exact statistics")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 20000, args.n_queries, args.dim, seed=args.seed)
+    else:
+        train, test, _ = load_dataset(args.data, args.n_train, args.n_queries)
+
+    print(f"{'dimension choice':<18}{'stats':<13}{'build s':>9}{'speedup':>9}{'agreement':>11}{'score ratio':>13}{'SSE/point':>12}{'nodes/query':>13}")
+    rows = []
+    for dimension_choice in args.dimension_choice:
+        exact_time = None
+        for mode in MODES:
+            variant = dict(DEFAULT_VARIANTS[args.tree], dimension_choice=dimension_choice, dimension_stats=mode)
+            variant["stats_sample_size"] = args.sample_size
+            random.seed(args.seed)
+            start_time = time.perf_counter()
+            tree = build_tree(variant, train)
+            build_time = time.perf_counter() - start_time
+            exact_time = exact_time or build_time
+
+            row = {"variant": variant, "build_s": build_time, "speedup": exact_time / build_time}
+            if args.tree == "kd":
+                row.update(split_accuracy(tree, dimension_choice, args.check_nodes, args.seed))
+            row["sse_per_point"] = tree.quality_metrics()["sse_per_point"]
+            _, _, visited = tree.query_batch(test, args.k, return_visited=True)
+            row["nodes_per_query"] = float(visited.mean())
+            rows.append(row)
+
+            accuracy = f"{row['agreement']:>11.3f}{row['score_ratio']:>13.4f}" if "agreement" in row else f"{'-':>11}{'-':>13}"
+            print(
+                f"{dimension_choice:<18}{mode:<13}{build_time:>9.2f}{row['speedup']:>9.2f}{accuracy}"
+                f"{row['sse_per_point']:>12.4g}{row['nodes_per_query']:>13.1f}"
+            )
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# thread_benchmark.py
+"""
+Measures the throughput of the batched kNN search (query_batch with the "flat" layout) for several numbers
+of threads, against the queries answered one at a time with query. The batched search routes every block
+of queries through the tree as arrays and scans every leaf once for all the queries that reach it, with
+matrix products that release the GIL, so its blocks can run on several cores.
+
+Every run checks that the neighbours are the same as the ones of the single queries.
+
+Usage:
+    python benchmarks/thread_benchmark.py --data gist-960-euclidean.hdf5 --n-train 100000 --n-queries 1000 --tree kd
+    python benchmarks/thread_benchmark.py --synthetic --dim 64 --n-train 100000 --tree r --threads 1 2 4 8 16
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from run_benchmark import build_tree, load_dataset, make_synthetic
+
+DEFAULT_VARIANTS = {
+    "kd": {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat"},
+    "r": {"tree": "r", "packing": "str", "fanout": 16, "leaf_size": 10, "layout": "flat"},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 20000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("--dim", type=int, default=960, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--block-size", type=int, default=256, help="queries searched together")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 20000, args.n_queries, args.dim, seed=args.seed)
+    else:
+        train, test, _ = load_dataset(args.data, args.n_train, args.n_queries)
+
+    random.seed(args.seed)
+    tree = build_tree(DEFAULT_VARIANTS[args.tree], train)
+
+    start_time = time.perf_counter()
+    single = [tree.query(q, args.k) for q in test]
+    single_qps = len(test) / (time.perf_counter() - start_time)
+    single_ids = np.array([ids for _, ids in single])
+
+    print(f"{os.cpu_count()} CPU cores")
+    print(f"{'method':<16}{'QPS':>10}{'speedup':>9}{'same ids':>10}")
+    print(f"{'single queries':<16}{single_qps:>10.1f}{1:>9.2f}{1:>10.4f}")
+    rows = [{"method": "single", "qps": single_qps}]
+    for n_threads in args.threads:
+        start_time = time.perf_counter()
+        _, ids = tree.query_batch(test, args.k, n_threads=n_threads, block_size=args.block_size)
+        qps = len(test) / (time.perf_counter() - start_time)
+        same = float(np.mean(ids == single_ids))
+        rows.append({"method": "batch", "n_threads": n_threads, "qps": qps, "speedup": qps / single_qps, "same_ids": same})
+        print(f"{f'batch, {n_threads} threads':<16}{qps:>10.1f}{qps / single_qps:>9.2f}{same:>10.4f}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "variant": DEFAULT_VARIANTS[args.tree], "rows": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
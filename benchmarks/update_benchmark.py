@@ -0,0 +1,175 @@
+# update_benchmark.py
+"""
+Compares two ways of keeping an index up to date while new vectors arrive: inserting them into the tree
+(insert, with leaf splits and partial rebuilds) and rebuilding the whole tree every --rebuild-every new points.
+
+The tree is first built on --initial of the train set; the rest arrives in batches of --batch points, in
+random order or cluster by cluster (--order clustered, a drifting stream). For each strategy, the benchmark
+reports the sustained ingest throughput (points per second, rebuilds included), the p99 time of a batch, how
+many points at most were not yet searchable (periodic rebuilds only), and the QPS and recall@k of the final
+index.
+
+Usage:
+    python benchmarks/update_benchmark.py --synthetic --dim 32 --n-train 50000 --tree kd --batch 100 --rebuild-every 10000
+    python benchmarks/update_benchmark.py --data gist-960-euclidean.hdf5 --n-train 20000 --tree r --order clustered --out updates.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from query_benchmark import brute_force_knn, recall
+from run_benchmark import build_tree, load_dataset, make_synthetic
+
+DEFAULT_VARIANTS = {
+    "kd": {"tree": "kd", "dimension_choice": "max_variance", "split_position_choice": "median", "leaf_size": 10, "engine": "numpy", "layout": "flat"},
+    "r": {"tree": "r", "grouping_choice": "closest_seed", "seed_choice": "approx_farthest", "leaf_size": 10, "layout": "flat"},
+}
+
+
+def stream_order(train: np.ndarray, n_initial: int, order: str, seed: int) -> np.ndarray:
+    """
+    Returns the train set reordered so that its first n_initial rows are the initial points and the rest
+    arrive in the given order: "random", or "clustered" (sorted along the first principal axis of the arriving
+    points, so that the stream drifts across the space).
+    """
+    rng = np.random.default_rng(seed)
+    train = train[rng.permutation(len(train))]
+    if order == "clustered":
+        arriving = train[n_initial:].astype(np.float64)
+        centered = arriving - arriving.mean(axis=0)
+        axis = np.linalg.svd(centered[: min(len(centered), 5000)], full_matrices=False)[2][0]
+        train[n_initial:] = train[n_initial:][np.argsort(centered @ axis, kind="stable")]
+    return train
+
+
+def measure_queries(tree, test: np.ndarray, true_ids: np.ndarray, k: int) -> dict:
+    """
+    Returns the QPS and the recall@k of a tree on the test queries.
+    """
+    start_time = time.perf_counter()
+    _, found = tree.query_batch(test, k)
+    elapsed = time.perf_counter() - start_time
+    return {"qps": len(test) / elapsed, f"recall@{k}": recall(found, true_ids)}
+
+
+def run_inserts(variant: dict, train: np.ndarray, n_initial: int, batch: int, alpha: float, seed: int) -> tuple:
+    """
+    Builds the tree on the initial points and inserts the others batch by batch.
+    """
+    random.seed(seed)
+    start_time = time.perf_counter()
+    tree = build_tree(variant, train[:n_initial])
+    build_time = time.perf_counter() - start_time
+
+    batch_times = []
+    for start in range(n_initial, len(train), batch):
+        start_time = time.perf_counter()
+        tree.insert(train[start : start + batch], alpha=alpha)
+        batch_times.append(time.perf_counter() - start_time)
+
+    return tree, {
+        "strategy": "insert",
+        "initial_build_s": build_time,
+        "ingest_s": sum(batch_times),
+        "points_per_s": (len(train) - n_initial) / sum(batch_times),
+        "batch_p99_ms": 1000 * np.percentile(batch_times, 99),
+        "max_unsearchable": 0,
+        "rebuilds": 0,
+    }
+
+
+def run_rebuilds(variant: dict, train: np.ndarray, n_initial: int, batch: int, rebuild_every: int, seed: int) -> tuple:
+    """
+    Builds the tree on the initial points, buffers the arriving batches and rebuilds the tree on all the points
+    every rebuild_every new points (and once at the end).
+    """
+    random.seed(seed)
+    start_time = time.perf_counter()
+    tree = build_tree(variant, train[:n_initial])
+    build_time = time.perf_counter() - start_time
+
+    batch_times = []
+    pending = max_pending = rebuilds = 0
+    for start in range(n_initial, len(train), batch):
+        end = min(start + batch, len(train))
+        start_time = time.perf_counter()
+        pending += end - start
+        max_pending = max(max_pending, pending)
+        if pending >= rebuild_every or end == len(train):
+            tree = build_tree(variant, train[:end])
+            pending = 0
+            rebuilds += 1
+        batch_times.append(time.perf_counter() - start_time)
+
+    return tree, {
+        "strategy": f"rebuild every {rebuild_every}",
+        "initial_build_s": build_time,
+        "ingest_s": sum(batch_times),
+        "points_per_s": (len(train) - n_initial) / sum(batch_times),
+        "batch_p99_ms": 1000 * np.percentile(batch_times, 99),
+        "max_unsearchable": max_pending,
+        "rebuilds": rebuilds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="ann-benchmarks style HDF5 file (train/test datasets)")
+    source.add_argument("--synthetic", action="store_true", help="generate a Gaussian mixture instead of reading a file")
+    parser.add_argument("--n-train", type=int, default=None, help="by default the whole file, 20000 with --synthetic")
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=32, help="dimension of the synthetic data")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--tree", choices=["kd", "r"], default="kd")
+    parser.add_argument("--variant", default=None, help="JSON constructor arguments with a 'tree' key, instead of --tree")
+    parser.add_argument("--initial", type=float, default=0.2, help="fraction of the train set in the initial build")
+    parser.add_argument("--batch", type=int, default=100, help="points per arriving batch")
+    parser.add_argument("--rebuild-every", type=int, nargs="+", default=[5000], help="new points between full rebuilds")
+    parser.add_argument("--alpha", type=float, default=0.75, help="balance threshold of the partial rebuilds")
+    parser.add_argument("--order", choices=["random", "clustered"], default="random")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="JSON file for the measurements")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        train, test = make_synthetic(args.n_train or 20000, args.n_queries, args.dim, seed=args.seed)
+    else:
+        train, test, _ = load_dataset(args.data, args.n_train, args.n_queries)
+    variant = json.loads(args.variant) if args.variant is not None else DEFAULT_VARIANTS[args.tree]
+
+    n_initial = max(1, int(args.initial * len(train)))
+    train = stream_order(train, n_initial, args.order, args.seed)
+    _, true_ids = brute_force_knn(train, test, args.k)
+
+    print(f"{variant}: {n_initial} initial points, {len(train) - n_initial} arriving in batches of {args.batch}")
+    print(f"{'strategy':<22}{'points/s':>10}{'p99 batch ms':>14}{'unsearchable':>14}{'QPS':>10}{'recall@' + str(args.k):>10}")
+    rows = []
+    runs = [lambda: run_inserts(variant, train, n_initial, args.batch, args.alpha, args.seed)]
+    runs += [
+        lambda every=every: run_rebuilds(variant, train, n_initial, args.batch, every, args.seed)
+        for every in args.rebuild_every
+    ]
+    for run in runs:
+        tree, row = run()
+        row.update(measure_queries(tree, test, true_ids, args.k))
+        rows.append({"variant": variant, "order": args.order, "batch": args.batch, **row})
+        print(
+            f"{row['strategy']:<22}{row['points_per_s']:>10.0f}{row['batch_p99_ms']:>14.1f}"
+            f"{row['max_unsearchable']:>14}{row['qps']:>10.1f}{row[f'recall@{args.k}']:>10.4f}"
+        )
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+# all_knn.py
+"""
+The all-kNN self-join of the trees: the k nearest neighbours of every indexed point among the indexed points,
+by a dual-tree traversal. Pairs of nodes descend together, level by level as arrays, and a pair is pruned as
+soon as the lower bound of the distance between their points exceeds the bounds of the k-th distances of the
+points of both. The descent stops at blocks, the largest nodes of at most block_size points (or leaves), and
+the pairs of blocks left are compared in blocked matrix products, every block against all its partners at
+once, on a pool of threads (NumPy releases the GIL for the products).
+
+The tree only supplies its structure (the leaves' ranges of perm, the children of the inner nodes), the
+lower bound between two nodes and the distances between two blocks of points; the distances are the ones
+the tree compares (squared for the Euclidean distance).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+
+try:
+    from .batch_search import top_k
+    from .segments import gather_ranges, segment_offsets
+except ImportError:
+    from batch_search import top_k
+    from segments import gather_ranges, segment_offsets
+
+
+def slack(dists: np.ndarray) -> np.ndarray:
+    """
+    Widens bounds of distances computed by matrix products to cover their rounding.
+    """
+    return dists + 1e-5 * np.abs(dists) + 1e-12
+
+
+def tree_levels(root: int, is_leaf: np.ndarray, children):
+    """
+    Returns the nodes of every level of the tree, from the root, and the parent of every node of every level
+    (None for the root). children(parents) returns the index in parents of the parent of every child, and
+    the children, those of a parent being contiguous.
+    """
+    levels, parents = [np.array([root], dtype=np.int64)], [None]
+    while True:
+        inner = levels[-1][~is_leaf[levels[-1]]]
+        if len(inner) == 0:
+            return levels, parents
+        owners, nodes = children(inner)
+        levels.append(nodes.astype(np.int64))
+        parents.append(inner[owners])
+
+
+def node_blocks(blocks: np.ndarray, is_leaf: np.ndarray, starts: np.ndarray, counts: np.ndarray, perm: np.ndarray, children):
+    """
+    Gathers the ids of the points under every block node, one block after the other, the blocks in the order
+    of their first leaf in perm (the order of the tree, for a tree that was not updated).
+
+    Returns
+    -------
+    np.ndarray, np.ndarray, np.ndarray, np.ndarray
+        The non-empty blocks in that order, the ids of their points, and the start and the number of points
+        of every node in those ids (0 for the other nodes).
+    """
+    nodes, owners = blocks, np.arange(len(blocks))
+    leaves, leaf_owners = [], []
+    while len(nodes):
+        leaf = is_leaf[nodes]
+        leaves.append(nodes[leaf])
+        leaf_owners.append(owners[leaf])
+        below, nodes = children(nodes[~leaf])
+        owners = owners[~leaf][below]
+    leaves, owners = np.concatenate(leaves), np.concatenate(leaf_owners)
+    non_empty = counts[leaves] > 0
+    leaves, owners = leaves[non_empty], owners[non_empty]
+
+    first_start = np.full(len(blocks), np.iinfo(np.int64).max)
+    np.minimum.at(first_start, owners, starts[leaves].astype(np.int64))
+    rank = np.empty(len(blocks), dtype=np.int64)
+    rank[np.argsort(first_start, kind="stable")] = np.arange(len(blocks))
+    order = np.lexsort((starts[leaves], rank[owners]))
+    leaves, owners = leaves[order], owners[order]
+
+    block_counts = np.bincount(owners, weights=counts[leaves], minlength=len(blocks)).astype(np.int64)
+    order = np.argsort(rank)
+    blocks, block_counts = blocks[order], block_counts[order]
+    blocks, block_counts = blocks[block_counts > 0], block_counts[block_counts > 0]
+    node_starts = np.zeros(len(is_leaf), dtype=np.int64)
+    node_counts = np.zeros(len(is_leaf), dtype=np.int64)
+    node_starts[blocks] = segment_offsets(block_counts)
+    node_counts[blocks] = block_counts
+    return blocks, perm[gather_ranges(starts[leaves].astype(np.int64), counts[leaves].astype(np.int64))], node_starts, node_counts
+
+
+def scan_blocks(
+    data: np.ndarray,
+    perm: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    groups: list,
+    pairwise,
+    include_self: bool,
+    bound: np.ndarray = None,
+    k: int = None,
+    max_cells: int = 1 << 22,
+):
+    """
+    Compares the points of the block first with the points of the blocks others (perm[starts[b]:starts[b] +
+    counts[b]] for a block b), for every (first, others) of groups, in matrix products of at most max_cells
+    distances.
+
+    With bound, returns the (point, distance, neighbour) candidates within the bound of their point, in both
+    directions (from the point of first, and from the point of the other block unless it is first itself).
+    Without, returns the points of first and their k-th smallest distance (inf if they have fewer
+    neighbours).
+    """
+    found_points, found_dists, found_ids = [], [], []
+    for first, others in groups:
+        first_ids = perm[starts[first] : starts[first] + counts[first]]
+        other_ids = perm[gather_ranges(starts[others], counts[others])]
+        mirrored = np.repeat(others, counts[others]) != first
+        other_points = data[other_ids]
+        step = max(1, max_cells // max(len(other_ids), 1))
+        for row in range(0, len(first_ids), step):
+            row_ids = first_ids[row : row + step]
+            dists = pairwise(data[row_ids], other_points)
+            if not include_self:
+                dists[row_ids[:, None] == other_ids[None, :]] = np.inf
+
+            if bound is None:
+                kth = np.full(len(row_ids), np.inf)
+                if dists.shape[1] >= k:
+                    kth = np.partition(dists, k - 1, axis=1)[:, k - 1]
+                found_points.append(row_ids)
+                found_dists.append(kth)
+                continue
+
+            rows, cols = np.nonzero(dists <= bound[row_ids][:, None])
+            found_points.append(row_ids[rows])
+            found_dists.append(dists[rows, cols])
+            found_ids.append(other_ids[cols])
+            rows, cols = np.nonzero((dists <= bound[other_ids][None, :]) & mirrored[None, :])
+            found_points.append(other_ids[cols])
+            found_dists.append(dists[rows, cols])
+            found_ids.append(row_ids[rows])
+
+    if not found_points:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+    found_ids = np.concatenate(found_ids) if found_ids else None
+    return np.concatenate(found_points), np.concatenate(found_dists), found_ids
+
+
+def group_pairs(firsts: np.ndarray, seconds: np.ndarray) -> list:
+    """
+    Groups the pairs of nodes by their first node, as (first, array of the second nodes).
+    """
+    order = np.argsort(firsts, kind="stable")
+    firsts, seconds = firsts[order], seconds[order]
+    bounds = np.flatnonzero(np.diff(firsts, prepend=-1, append=-1)).tolist()
+    return [(int(firsts[start]), seconds[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def run_groups(groups: list, work, n_threads: int) -> list:
+    """
+    Runs work on parts of groups, on n_threads threads if more than one, and returns the results.
+    """
+    if n_threads == 1 or len(groups) < 2:
+        return [work(groups)]
+    size = -(-len(groups) // (4 * n_threads))
+    parts = [groups[start : start + size] for start in range(0, len(groups), size)]
+    with ThreadPoolExecutor(n_threads) as pool:
+        return list(pool.map(work, parts))
+
+
+def node_pairs(root: int, is_block: np.ndarray, counts: np.ndarray, children, lower_bound, node_bound: np.ndarray, chunk_pairs: int):
+    """
+    Yields the pairs of blocks (as two arrays, every unordered pair once, and every block with itself) whose
+    lower bound is within the bound of one of them, by descending pairs of nodes together from (root, root),
+    chunk_pairs pairs at a time (depth first, to keep the pending pairs few).
+
+    A pair of the same node is split into all the pairs of its children (each unordered pair once); another
+    pair is split on its node of most points that is not a block.
+    """
+    stack = [(np.array([root], dtype=np.int64), np.array([root], dtype=np.int64))]
+    while stack:
+        firsts, seconds = stack.pop()
+        if len(firsts) > chunk_pairs:
+            stack.append((firsts[chunk_pairs:], seconds[chunk_pairs:]))
+            firsts, seconds = firsts[:chunk_pairs], seconds[:chunk_pairs]
+
+        done = is_block[firsts] & is_block[seconds]
+        if done.any():
+            yield firsts[done], seconds[done]
+        firsts, seconds = firsts[~done], seconds[~done]
+
+        same = firsts == seconds
+        owners, nodes = children(firsts[same])
+        # the pairs of children i <= j of every parent
+        n_after = np.searchsorted(owners, owners, side="right") - np.arange(len(owners))
+        new_firsts = [np.repeat(nodes, n_after)]
+        new_seconds = [nodes[gather_ranges(np.arange(len(owners)), n_after)]]
+
+        firsts, seconds = firsts[~same], seconds[~same]
+        split_first = ~is_block[firsts] & (is_block[seconds] | (counts[firsts] >= counts[seconds]))
+        owners, nodes = children(firsts[split_first])
+        new_firsts.append(nodes)
+        new_seconds.append(seconds[split_first][owners])
+        owners, nodes = children(seconds[~split_first])
+        new_firsts.append(firsts[~split_first][owners])
+        new_seconds.append(nodes)
+
+        firsts, seconds = np.concatenate(new_firsts), np.concatenate(new_seconds)
+        keep = (counts[firsts] > 0) & (counts[seconds] > 0)
+        firsts, seconds = firsts[keep], seconds[keep]
+        distinct = np.flatnonzero(firsts != seconds)
+        keep = np.ones(len(firsts), dtype=bool)
+        keep[distinct] = lower_bound(firsts[distinct], seconds[distinct]) <= np.maximum(node_bound[firsts[distinct]], node_bound[seconds[distinct]])
+        if keep.any():
+            stack.append((firsts[keep], seconds[keep]))
+
+
+def dual_tree_knn(
+    data: np.ndarray,
+    perm: np.ndarray,
+    root: int,
+    is_leaf: np.ndarray,
+    starts: np.ndarray,
+    counts: np.ndarray,
+    children,
+    lower_bound,
+    pairwise,
+    k: int,
+    include_self: bool = False,
+    n_threads: int = None,
+    block_size: int = 64,
+    chunk_pairs: int = 4096,
+):
+    """
+    Finds the k nearest neighbours of every point under root among the points under root.
+
+    The search runs in two passes. First the points are compared by windows of consecutive points in the
+    order of the blocks (close points, as the tree groups them), which bounds the k-th distance of every
+    point; the bound of a node is the largest of its points, its children's above the blocks. Then the pairs
+    of nodes are descended from (root, root) by node_pairs, and the pairs of blocks reached are scanned by
+    scan_blocks, chunk_pairs pairs at a time, keeping the candidates within the bound of their point. The k
+    best of every point are merged after every chunk, which tightens the bounds of the points for the next
+    ones.
+
+    Parameters
+    ----------
+    data, perm : np.ndarray
+        The datapoints, and the order in which the leaves hold their ids.
+    root : int
+        The root node.
+    is_leaf, starts, counts : np.ndarray
+        Whether every node is a leaf, and the range of perm of every leaf; counts holds the number of points
+        under every node.
+    children : callable
+        children(parents) returns the index in parents of the parent of every child, and the children.
+    lower_bound : callable
+        lower_bound(firsts, seconds) returns a lower bound of the distance between the points of the nodes
+        firsts[i] and seconds[i].
+    pairwise : callable
+        pairwise(X, Y) returns the (len(X), len(Y)) distances between two blocks of points.
+    k : int
+        The number of neighbours of every point.
+    include_self : bool, optional
+        Whether a point is a candidate neighbour of itself, by default False.
+    n_threads : int, optional
+        The number of threads, by default None (the calling thread only); -1 uses all the CPU cores.
+    block_size : int, optional
+        The largest number of points of the nodes compared as blocks (leaves of more points are blocks
+        too), by default 64.
+    chunk_pairs : int, optional
+        The number of pairs of nodes expanded, and of pairs of blocks scanned, at a time, by default 4096.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        (len(data), k) arrays of the distances (ascending, inf-padded) and the ids (-1-padded) of the
+        neighbours of every point; the rows of the points not under root are empty.
+    """
+    n_threads = os.cpu_count() if n_threads == -1 else n_threads or 1
+    is_block = is_leaf | (counts[: len(is_leaf)] <= block_size)
+    levels, parents = tree_levels(root, is_block, children)
+    blocks = np.concatenate([nodes[is_block[nodes]] for nodes in levels])
+    blocks, block_perm, block_starts, block_counts = node_blocks(blocks, is_leaf, starts, counts, perm, children)
+
+    # the bound of the k-th distance of every point, from a window of the points around it (the last window
+    # takes the points left, so that no window has fewer than k + 1 points)
+    width = max(block_size, 4 * (k + 1))
+    window_starts = np.arange(0, max(len(block_perm) - width, 0) + 1, width)
+    window_counts = np.diff(np.append(window_starts, len(block_perm)))
+    point_bound = np.full(len(data), -np.inf)
+
+    def bound_work(groups):
+        return scan_blocks(data, block_perm, window_starts, window_counts, groups, pairwise, include_self, k=k)
+
+    windows = [(window, np.array([window])) for window in range(len(window_starts))]
+    for ids, kth, _ in run_groups(windows, bound_work, n_threads):
+        point_bound[ids] = slack(kth)
+
+    # the bound of every node, the largest of its points
+    node_bound = np.full(len(is_leaf), -np.inf)
+    inner = np.concatenate([nodes[~is_block[nodes]] for nodes in levels])
+
+    def update_node_bounds():
+        node_bound[blocks] = np.maximum.reduceat(point_bound[block_perm], block_starts[blocks])
+        node_bound[inner] = -np.inf
+        for nodes, above in zip(levels[:0:-1], parents[:0:-1]):
+            np.maximum.at(node_bound, above, node_bound[nodes])
+
+    update_node_bounds()
+
+    best_dists = np.full((len(data), k), np.inf)
+    best_ids = np.full((len(data), k), -1, dtype=np.int64)
+
+    def pair_work(groups):
+        return scan_blocks(data, block_perm, block_starts, block_counts, groups, pairwise, include_self, bound=point_bound)
+
+    def merge(firsts: list, seconds: list):
+        found = run_groups(group_pairs(np.concatenate(firsts), np.concatenate(seconds)), pair_work, n_threads)
+        points = np.concatenate([result[0] for result in found])
+        if len(points) == 0:
+            return
+        dists = np.concatenate([result[1] for result in found])
+        ids = np.concatenate([result[2] for result in found])
+        # the candidates merged into the k best of their points, which tightens their bounds
+        rows = np.unique(points)
+        kept = best_ids[rows].ravel() >= 0
+        merged_dists, merged_ids = top_k(
+            np.concatenate((np.repeat(np.arange(len(rows)), k)[kept], np.searchsorted(rows, points))),
+            np.concatenate((best_dists[rows].ravel()[kept], dists)),
+            np.concatenate((best_ids[rows].ravel()[kept], ids)),
+            len(rows),
+            k,
+        )
+        best_dists[rows], best_ids[rows] = merged_dists, merged_ids
+        full = np.isfinite(merged_dists[:, -1])
+        point_bound[rows[full]] = np.minimum(point_bound[rows[full]], slack(merged_dists[full, -1]))
+        # the pairs still to descend are pruned with the tighter bounds
+        update_node_bounds()
+
+    pending_firsts, pending_seconds, n_pending = [], [], 0
+    for firsts, seconds in node_pairs(root, is_block, counts, children, lower_bound, node_bound, chunk_pairs):
+        pending_firsts.append(firsts)
+        pending_seconds.append(seconds)
+        n_pending += len(firsts)
+        if n_pending >= chunk_pairs:
+            merge(pending_firsts, pending_seconds)
+            pending_firsts, pending_seconds, n_pending = [], [], 0
+    if n_pending:
+        merge(pending_firsts, pending_seconds)
+    return best_dists, best_ids
+
+
+def refine(data: np.ndarray, ids: np.ndarray, paired, chunk_rows: int = 4096):
+    """
+    Recomputes the distances from every point to its (-1-padded) neighbours ids directly with paired(X, Y)
+    (the matrix products lose precision between close points), and sorts every row.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        The distances (ascending, inf-padded) and the ids of the neighbours of every point.
+    """
+    dists = np.full(ids.shape, np.inf)
+    k = ids.shape[1]
+    for start in range(0, len(ids), chunk_rows):
+        block = ids[start : start + chunk_rows]
+        rows = np.repeat(np.arange(start, start + len(block)), k)
+        valid = block.ravel() >= 0
+        block_dists = np.full(block.size, np.inf)
+        block_dists[valid] = paired(data[rows[valid]], data[block.ravel()[valid]])
+        dists[start : start + chunk_rows] = block_dists.reshape(block.shape)
+    order = np.argsort(dists, axis=1, kind="stable")
+    return np.take_along_axis(dists, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def to_csr(dists: np.ndarray, ids: np.ndarray):
+    """
+    Converts (n_points, k) -1-padded neighbours to a CSR neighbour graph.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray, np.ndarray
+        indptr, indices and distances: the neighbours of the point i are indices[indptr[i]:indptr[i + 1]],
+        at the distances distances[indptr[i]:indptr[i + 1]].
+    """
+    valid = ids >= 0
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    return indptr, ids[valid], dists[valid]
@@ -0,0 +1,92 @@
+# batch_search.py
+"""
+The leaf work of the batched kNN searches: the queries that reach the same leaf are compared with its points
+together, in one matrix product, and the candidates of every query are merged by sorting rather than through
+per-point heaps. NumPy releases the GIL during these products and sorts, so blocks of queries searched by
+different threads run in parallel.
+"""
+import numpy as np
+
+
+def scan_leaves(
+    data: np.ndarray, perm: np.ndarray, Q: np.ndarray, queries: np.ndarray, leaves: np.ndarray, starts, counts, bound: np.ndarray = None
+):
+    """
+    Computes the squared distances between the queries Q[queries[i]] and the points of their leaves leaves[i],
+    perm[starts[leaf]:starts[leaf] + counts[leaf]], one (query, leaf) pair per i. The pairs are grouped by
+    leaf so that every leaf is read once and compared with all its queries as ||q||^2 + ||x||^2 - 2 q.x.
+    If bound is given, only the pairs within the squared distance bound[query] of their query are returned.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray, np.ndarray
+        The query (index in Q), the squared distance and the id of every (query, point) pair.
+    """
+    found_queries, found_dists, found_ids = [], [], []
+    order = np.argsort(leaves, kind="stable")
+    queries, leaves = queries[order], leaves[order]
+    bounds = np.flatnonzero(np.diff(leaves, prepend=-1, append=-1)).tolist()
+
+    # in float64, as the expansion cancels most of the digits of the distances of close points
+    Q = Q.astype(np.float64)
+    Q_norms = np.einsum("ij,ij->i", Q, Q)
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        leaf = leaves[first]
+        start, count = int(starts[leaf]), int(counts[leaf])
+        if count == 0:
+            continue
+        ids = perm[start : start + count]
+        points = data[ids].astype(np.float64)
+        group = queries[first:last]
+        dists = Q_norms[group, None] + np.einsum("ij,ij->i", points, points)[None, :] - 2 * (Q[group] @ points.T)
+        if bound is None:
+            found_queries.append(np.repeat(group, count))
+            found_dists.append(np.maximum(dists, 0).ravel())
+            found_ids.append(np.tile(ids, len(group)))
+            continue
+        rows, cols = np.nonzero(dists <= bound[group, None])
+        found_queries.append(group[rows])
+        found_dists.append(np.maximum(dists[rows, cols], 0))
+        found_ids.append(ids[cols])
+
+    if not found_ids:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+    return np.concatenate(found_queries), np.concatenate(found_dists), np.concatenate(found_ids)
+
+
+def top_k(queries: np.ndarray, dists: np.ndarray, ids: np.ndarray, n_queries: int, k: int):
+    """
+    Keeps the k smallest distances of every query among (query, squared distance, id) candidates.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        (n_queries, k) arrays of the squared distances (ascending, inf-padded) and the ids (-1-padded).
+    """
+    order = np.lexsort((dists, queries))
+    queries, dists, ids = queries[order], dists[order], ids[order]
+    # the rank of every candidate among those of its query
+    firsts = np.searchsorted(queries, np.arange(n_queries))
+    ranks = np.arange(len(queries)) - firsts[queries]
+    keep = ranks < k
+
+    best_dists = np.full((n_queries, k), np.inf)
+    best_ids = np.full((n_queries, k), -1, dtype=np.int64)
+    best_dists[queries[keep], ranks[keep]] = dists[keep]
+    best_ids[queries[keep], ranks[keep]] = ids[keep]
+    return best_dists, best_ids
+
+
+def exact_neighbours(data: np.ndarray, Q: np.ndarray, ids: np.ndarray):
+    """
+    Recomputes the distances of the (n_queries, k) candidate ids directly, as the single queries do (the
+    matrix products lose precision between close points), and sorts every row.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        The Euclidean distances (ascending) and the ids of the neighbours of every query.
+    """
+    dists = ((data[ids] - Q[:, None, :]) ** 2).sum(axis=2).astype(np.float64)
+    order = np.argsort(dists, axis=1, kind="stable")
+    return np.sqrt(np.take_along_axis(dists, order, axis=1)), np.take_along_axis(ids, order, axis=1)
@@ -0,0 +1,154 @@
+# datasource.py
+import mmap
+import os
+import random
+import tempfile
+import weakref
+
+import numpy as np
+
+
+def open_datapoints(datapoints, dtype=np.float32, chunk_rows: int = 65536, tmp_dir: str = None) -> np.ndarray:
+    """
+    Returns the datapoints as an array that can be indexed by id, without loading an on-disk dataset in memory.
+
+    A path to a .npy file is memory-mapped (read-only) and a memory-mapped array of the right dtype is used as is.
+    An HDF5 dataset (or a memory-mapped array of another dtype) is copied by chunks of chunk_rows rows to a
+    temporary memory-mapped file in tmp_dir, removed when the array is garbage collected.
+    Anything else is converted to a C-contiguous array in memory.
+    """
+    if isinstance(datapoints, (str, os.PathLike)):
+        datapoints = np.load(datapoints, mmap_mode="r")
+
+    if isinstance(datapoints, np.memmap) and datapoints.dtype == dtype and datapoints.flags.c_contiguous:
+        return datapoints
+
+    if isinstance(datapoints, np.memmap) or is_dataset(datapoints):
+        return spill_to_memmap(datapoints, dtype, chunk_rows, tmp_dir)
+
+    return np.ascontiguousarray(datapoints, dtype=dtype)
+
+
+def is_dataset(datapoints) -> bool:
+    """
+    Returns whether datapoints is an array-like read from disk on indexing (e.g. an h5py Dataset).
+    """
+    return (
+        not isinstance(datapoints, (np.ndarray, list, tuple))
+        and hasattr(datapoints, "shape")
+        and hasattr(datapoints, "dtype")
+    )
+
+
+def spill_to_memmap(
+    dataset, dtype=np.float32, chunk_rows: int = 65536, tmp_dir: str = None, transform=None, n_columns: int = None
+) -> np.memmap:
+    """
+    Copies a 2D dataset by chunks of rows to a temporary file and returns it memory-mapped (read-only).
+    If transform is given, it maps every chunk to n_columns columns on the way.
+    The file is removed when the returned array is garbage collected.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".dat", dir=tmp_dir, delete=False) as f:
+        filename = f.name
+    shape = (dataset.shape[0], dataset.shape[1] if n_columns is None else n_columns)
+
+    out = np.memmap(filename, dtype=dtype, mode="w+", shape=shape)
+    for start in range(0, shape[0], chunk_rows):
+        chunk = dataset[start : start + chunk_rows]
+        out[start : start + chunk_rows] = chunk if transform is None else transform(chunk)
+    out.flush()
+    del out
+
+    data = np.memmap(filename, dtype=dtype, mode="r", shape=shape)
+    weakref.finalize(data, os.remove, filename)
+    return data
+
+
+def memmap_location(data):
+    """
+    Returns the (filename, offset) at which the rows of a C-contiguous memory-mapped array start in its file,
+    so that another process can map them again; None if data is not such an array.
+    """
+    if not isinstance(data, np.memmap) or data.filename is None or not data.flags.c_contiguous:
+        return None
+    # slices of a memmap share its mapping, which starts at its offset rounded down to the allocation granularity
+    start = data.offset - data.offset % mmap.ALLOCATIONGRANULARITY
+    mapped = np.frombuffer(data._mmap, dtype=np.uint8)
+    return data.filename, start + data.ctypes.data - mapped.ctypes.data
+
+
+def node_stats(data: np.ndarray, ids: np.ndarray, chunk_rows: int) -> dict:
+    """
+    Returns the count and the per-dimension sum, sum of squares, min and max of the rows ids of data,
+    reading chunk_rows rows at a time (in increasing id order) so that the rows are never gathered at once.
+    The sums are accumulated in float64.
+    """
+    ids = np.sort(ids)
+    n_dims = data.shape[1]
+    stats = {
+        "count": len(ids),
+        "sum": np.zeros(n_dims, dtype=np.float64),
+        "sumsq": np.zeros(n_dims, dtype=np.float64),
+        "min": np.full(n_dims, np.inf, dtype=data.dtype),
+        "max": np.full(n_dims, -np.inf, dtype=data.dtype),
+    }
+    for start in range(0, len(ids), chunk_rows):
+        rows = data[ids[start : start + chunk_rows]]
+        stats["sum"] += rows.sum(axis=0, dtype=np.float64)
+        stats["sumsq"] += np.einsum("ij,ij->j", rows, rows, dtype=np.float64)
+        np.minimum(stats["min"], rows.min(axis=0), out=stats["min"])
+        np.maximum(stats["max"], rows.max(axis=0), out=stats["max"])
+    return stats
+
+
+class NodeRows:
+    """
+    The rows ids of data as a read-only sequence of points, for the strategies taking a list of points: an
+    index gives a row (a view of a plain ndarray data), an array or a slice of indices the rows as an array.
+    The strategies read it by chunks (see row_chunks), so the points of a node are never gathered at once
+    nor held as one Python object per point.
+    """
+
+    def __init__(self, data: np.ndarray, ids: np.ndarray):
+        self.data = data
+        self.ids = ids
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        return self.data[self.ids[index]]
+
+
+def row_chunks(datapoints, chunk_rows: int):
+    """
+    Yields the datapoints (a list of points, a NodeRows or an array) as (offset, array) chunks of chunk_rows
+    rows at most.
+    """
+    for start in range(0, len(datapoints), chunk_rows):
+        yield start, np.asarray(datapoints[start : start + chunk_rows])
+
+
+def sampled_node_stats(data: np.ndarray, ids: np.ndarray, sample_size: int, chunk_rows: int, rng=random) -> dict:
+    """
+    Returns the statistics of node_stats over a random sample of sample_size of the rows ids (all of them if
+    there are fewer), drawn from rng (the random module by default). The count is the sample's, so the means
+    and variances are estimates and the min and max only bound the sample.
+    """
+    if len(ids) > sample_size:
+        ids = ids[np.array(rng.sample(range(len(ids)), sample_size), dtype=np.int64)]
+    return node_stats(data, ids, chunk_rows)
+
+
+def complement_stats(stats: dict, part: dict) -> dict:
+    """
+    Returns the statistics of the rest of a node from those of the node and of one part of it: the count
+    and the sums are the differences (in float64), the min and max are the node's, so only bounds.
+    """
+    return {
+        "count": stats["count"] - part["count"],
+        "sum": stats["sum"] - part["sum"],
+        "sumsq": stats["sumsq"] - part["sumsq"],
+        "min": stats["min"].copy(),
+        "max": stats["max"].copy(),
+    }
@@ -0,0 +1,87 @@
+# index_file.py
+"""
+Binary index files: an 8-byte magic, the format version (uint32), the length of the header (uint64), a JSON
+header (the tree's kind and parameters, and the dtype, shape and offset of every array), then the raw arrays,
+each aligned on 64 bytes. Loading maps the file and returns views of it, so nothing is deserialised.
+"""
+import json
+import struct
+
+import numpy as np
+
+INDEX_MAGIC = b"HDTREEIX"
+INDEX_VERSION = 1
+INDEX_ALIGN = 64
+
+_PREFIX = struct.Struct("<8sIQ")
+
+
+def write_index(path: str, kind: str, params: dict, arrays: dict[str, np.ndarray]):
+    """
+    Writes the arrays and the parameters of a tree of the given kind ("kd", "r" or "m") to path.
+    """
+    table = {}
+    offset = 0
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        table[name] = {"dtype": values.dtype.str, "shape": list(values.shape), "offset": offset}
+        offset += -(-values.nbytes // INDEX_ALIGN) * INDEX_ALIGN
+
+    header = json.dumps({"kind": kind, "params": params, "arrays": table}).encode()
+    data_start = -(-(_PREFIX.size + len(header)) // INDEX_ALIGN) * INDEX_ALIGN
+
+    with open(path, "wb") as f:
+        f.write(_PREFIX.pack(INDEX_MAGIC, INDEX_VERSION, len(header)))
+        f.write(header)
+        for name, values in arrays.items():
+            f.seek(data_start + table[name]["offset"])
+            _write_array(f, values)
+        f.truncate(data_start + offset)
+
+
+def _write_array(f, values: np.ndarray, chunk_bytes: int = 1 << 24):
+    """
+    Writes the bytes of an array in C order to f, chunk_bytes at a time from the array's own buffer, so that
+    a (memory-mapped) array is not copied to memory first.
+    """
+    values = np.asarray(values).reshape(-1)
+    step = max(1, chunk_bytes // max(values.itemsize, 1))
+    for start in range(0, len(values), step):
+        f.write(values[start : start + step])
+
+
+def read_index(path: str, mmap: bool = True):
+    """
+    Returns the kind, the parameters and the arrays of an index file. With mmap, the arrays are read-only
+    views of the memory-mapped file; otherwise they are read into memory.
+
+    Raises
+    ------
+    ValueError
+        If the file is not an index file or was written by another version of the format.
+    """
+    with open(path, "rb") as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise ValueError(f"{path} is not an index file")
+        magic, version, header_len = _PREFIX.unpack(prefix)
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path} is not an index file")
+        if version != INDEX_VERSION:
+            raise ValueError(f"{path} has index format version {version}, expected {INDEX_VERSION}")
+        header = json.loads(f.read(header_len))
+        data_start = -(-(_PREFIX.size + header_len) // INDEX_ALIGN) * INDEX_ALIGN
+        if not mmap:
+            f.seek(data_start)
+            content = np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+
+    if mmap:
+        content = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start)
+
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        nbytes = int(np.prod(entry["shape"], dtype=np.int64)) * dtype.itemsize
+        raw = content[entry["offset"] : entry["offset"] + nbytes]
+        arrays[name] = raw.view(np.ndarray).view(dtype).reshape(entry["shape"])
+    return header["kind"], header["params"], arrays
@@ -0,0 +1,169 @@
+# instrumentation.py
+"""
+Opt-in statistics of the trees (collect_stats=True): the cumulative time and number of calls of the strategy
+functions and of the build phases, the shape of the built tree, and the work of the kNN searches.
+
+Without them the trees keep their plain strategy functions, and the searches only test one attribute per query
+and per leaf, so the overhead is negligible.
+"""
+import contextlib
+import threading
+import time
+
+import numpy as np
+
+QUERY_COUNTERS = ("n_queries", "nodes_visited", "leaves_scanned", "distance_evaluations")
+
+# the timer of the phases when the statistics are off (nullcontext can be entered again and again)
+NULL_TIMER = contextlib.nullcontext()
+
+
+class TreeStats:
+    """
+    A class to represent the statistics collected by a tree, updated by its build and its kNN searches,
+    also from several threads.
+
+    Attributes
+    ----------
+    timers : dict[str, list]
+        The [number of calls, cumulative seconds] of every timed strategy function or build phase.
+    queries : dict[str, int]
+        The number of queries, nodes visited, leaves scanned and distance evaluations of the kNN searches.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.queries = dict.fromkeys(QUERY_COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the statistics go with the tree to the workers of a process-parallel build, without the lock
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float, calls: int = 1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def count_queries(self, n_queries: int = 0, nodes_visited: int = 0, leaves_scanned: int = 0, distance_evaluations: int = 0):
+        with self._lock:
+            self.queries["n_queries"] += n_queries
+            self.queries["nodes_visited"] += nodes_visited
+            self.queries["leaves_scanned"] += leaves_scanned
+            self.queries["distance_evaluations"] += distance_evaluations
+
+    def reset_queries(self):
+        with self._lock:
+            self.queries = dict.fromkeys(QUERY_COUNTERS, 0)
+
+    def to_dict(self, n_points: int, structure: dict) -> dict:
+        """
+        Returns the statistics as a JSON-serialisable dict, with the structure of the tree (see
+        tree_structure) in "build" and the means per query and the pruning ratio in "queries": the fraction
+        of the n_points distances per query of a brute-force scan that the searches did not compute.
+        """
+        with self._lock:
+            timers = {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in self.timers.items()}
+            queries = dict(self.queries)
+
+        n_queries = queries["n_queries"]
+        for name in ("nodes_visited", "leaves_scanned", "distance_evaluations"):
+            queries[f"{name}_per_query"] = queries[name] / n_queries if n_queries else None
+        queries["pruning_ratio"] = 1 - queries["distance_evaluations"] / (n_queries * n_points) if n_queries and n_points else None
+        return {"build": {"timers": timers, **structure}, "queries": queries}
+
+
+class TimedFunction:
+    """
+    A strategy function that adds its time and its calls to the timer name of a TreeStats. It pickles with
+    the function, so process-parallel builds can use it, but the times of their workers are not reported back.
+    """
+
+    def __init__(self, stats: TreeStats, name: str, function):
+        self.stats = stats
+        self.name = name
+        self.function = function
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.stats.add_time(self.name, time.perf_counter() - start)
+
+
+def timed(stats: TreeStats, name: str, function):
+    """
+    Returns function timed as name in stats, or function itself without stats (or without function).
+    """
+    if stats is None or function is None:
+        return function
+    return TimedFunction(stats, name, function)
+
+
+def phase_timer(stats: TreeStats, name: str):
+    """
+    Returns a context manager timing a build phase as name in stats, doing nothing without stats.
+    """
+    return NULL_TIMER if stats is None else stats.timer(name)
+
+
+def tree_structure(root, children, leaf_size, depth, n_bins: int = 10) -> dict:
+    """
+    Walks the tree from root and returns its number of nodes per depth, the histogram of the sizes of its
+    leaves and the histogram of the imbalance of its internal nodes, (largest child - smallest child) / size
+    in points, over n_bins bins of [0, 1].
+
+    children(node) returns the children of a node (none for a leaf), leaf_size(node) the number of points of
+    a leaf and depth(node) the depth of a node.
+    """
+    parents, depths, sizes, is_leaf = [], [], [], []
+    stack = [] if root is None else [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(depths)
+        parents.append(parent)
+        depths.append(int(depth(node)))
+        nodes = list(children(node))
+        is_leaf.append(not nodes)
+        sizes.append(0 if nodes else int(leaf_size(node)))
+        stack.extend((child, index) for child in nodes)
+
+    parents = np.array(parents, dtype=np.int64)
+    sizes = np.array(sizes, dtype=np.int64)
+    is_leaf = np.array(is_leaf, dtype=bool)
+    # the children come after their parent, so the sizes add up in reverse order
+    for index in range(len(parents) - 1, 0, -1):
+        sizes[parents[index]] += sizes[index]
+
+    largest = np.zeros(len(parents), dtype=np.int64)
+    smallest = np.full(len(parents), np.iinfo(np.int64).max)
+    np.maximum.at(largest, parents[1:], sizes[1:])
+    np.minimum.at(smallest, parents[1:], sizes[1:])
+    inner = ~is_leaf
+    imbalance = (largest[inner] - smallest[inner]) / np.maximum(sizes[inner], 1)
+
+    leaf_sizes, leaf_counts = np.unique(sizes[is_leaf], return_counts=True)
+    imbalance_counts, edges = np.histogram(imbalance, bins=n_bins, range=(0, 1))
+    return {
+        "n_nodes": len(parents),
+        "n_leaves": int(is_leaf.sum()),
+        "nodes_per_depth": np.bincount(np.array(depths, dtype=np.int64)).tolist() if depths else [],
+        "leaf_size_histogram": {"sizes": leaf_sizes.tolist(), "counts": leaf_counts.tolist()},
+        "imbalance_histogram": {"bin_edges": edges.tolist(), "counts": imbalance_counts.tolist()},
+    }
@@ -0,0 +1,180 @@
+# quality.py
+"""
+Clustering-quality metrics of the trees that scale to large datasets: a sampled, chunked silhouette score
+and per-leaf metrics (sizes, radii, within-leaf SSE, depths) computed in one pass over the leaves, with the
+MBR volumes and overlaps of the RTree's nodes or the covering balls of the MTree's.
+"""
+import numpy as np
+
+
+def sampled_silhouette_score(
+    data: np.ndarray,
+    ids: np.ndarray,
+    labels: np.ndarray,
+    sample_size: int = 2000,
+    seed: int = 0,
+    chunk_bytes: int = 1 << 26,
+) -> float:
+    """
+    Returns the mean silhouette of sample_size points drawn among ids with the given seed, each compared
+    with all the points: an unbiased estimate of the silhouette score in O(sample_size * n * d) time.
+    With sample_size >= len(ids), it is the exact silhouette score (as sklearn's silhouette_score).
+
+    The distances are computed by blocks of sampled points and points, and summed per cluster, so the
+    memory stays around chunk_bytes whatever the number of points.
+    """
+    ids = np.asarray(ids)
+    _, labels = np.unique(np.asarray(labels), return_inverse=True)
+    n_labels = int(labels.max()) + 1 if len(labels) else 0
+    if not 1 < n_labels < len(ids):
+        raise ValueError(f"The silhouette needs 2 to n_samples - 1 clusters, got {n_labels}")
+    counts = np.bincount(labels, minlength=n_labels)
+
+    if sample_size < len(ids):
+        sample = np.sort(np.random.default_rng(seed).choice(len(ids), size=sample_size, replace=False))
+    else:
+        sample = np.arange(len(ids))
+
+    n_dims = data.shape[1]
+    point_chunk = max(1, min(len(ids), chunk_bytes // (16 * n_dims)))
+    sample_chunk = max(1, chunk_bytes // (8 * (n_labels + point_chunk + n_dims)))
+
+    scores = np.empty(len(sample), dtype=np.float64)
+    for sample_start in range(0, len(sample), sample_chunk):
+        rows = sample[sample_start : sample_start + sample_chunk]
+        X = data[ids[rows]].astype(np.float64)
+        X_sq = (X**2).sum(axis=1)
+
+        # sums[i, c] is the sum of the distances from the sampled point i to the points of cluster c
+        sums = np.zeros(len(rows) * n_labels, dtype=np.float64)
+        offsets = np.arange(len(rows))[:, None] * n_labels
+        for start in range(0, len(ids), point_chunk):
+            Y = data[ids[start : start + point_chunk]].astype(np.float64)
+            dists = X_sq[:, None] + (Y**2).sum(axis=1)[None, :] - 2 * X @ Y.T
+            dists = np.sqrt(np.maximum(dists, 0))
+            index = (offsets + labels[None, start : start + point_chunk]).ravel()
+            sums += np.bincount(index, weights=dists.ravel(), minlength=len(sums))
+        sums = sums.reshape(len(rows), n_labels)
+
+        own = labels[rows]
+        own_counts = counts[own]
+        a = sums[np.arange(len(rows)), own] / np.maximum(own_counts - 1, 1)
+        means = sums / counts[None, :]
+        means[np.arange(len(rows)), own] = np.inf
+        b = means.min(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            s = (b - a) / np.maximum(a, b)
+        # as sklearn, the points alone in their cluster score 0
+        scores[sample_start : sample_start + len(rows)] = np.nan_to_num(np.where(own_counts > 1, s, 0))
+
+    return float(scores.mean())
+
+
+def leaf_metrics(data: np.ndarray, leaves) -> dict:
+    """
+    Returns metrics of the partition of the points into leaves, in one pass over the leaves:
+    the number of leaves, their sizes, their radii (distance from the centroid to the farthest point),
+    the within-leaf sum of squared errors (total and per point) and the histogram of the leaf depths.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The datapoints.
+    leaves : iterable of (np.ndarray, int)
+        The ids of the points and the depth of every leaf.
+    """
+    sizes = []
+    radii = []
+    sse = 0.0
+    depths = {}
+    for ids, depth in leaves:
+        depths[int(depth)] = depths.get(int(depth), 0) + 1
+        sizes.append(len(ids))
+        if len(ids) == 0:
+            continue
+        points = data[ids].astype(np.float64)
+        sq_dists = ((points - points.mean(axis=0)) ** 2).sum(axis=1)
+        radii.append(float(np.sqrt(sq_dists.max())))
+        sse += float(sq_dists.sum())
+
+    sizes = np.array(sizes)
+    radii = np.array(radii) if radii else np.zeros(1)
+    return {
+        "n_leaves": len(sizes),
+        "leaf_size_mean": float(sizes.mean()) if len(sizes) else 0.0,
+        "leaf_size_min": int(sizes.min()) if len(sizes) else 0,
+        "leaf_size_max": int(sizes.max()) if len(sizes) else 0,
+        "leaf_radius_mean": float(radii.mean()),
+        "leaf_radius_max": float(radii.max()),
+        "sse": sse,
+        "sse_per_point": sse / max(int(sizes.sum()), 1),
+        "depth_histogram": dict(sorted(depths.items())),
+    }
+
+
+def mbr_metrics(mins: np.ndarray, maxs: np.ndarray, leaf: np.ndarray, siblings: np.ndarray) -> dict:
+    """
+    Returns metrics of the minimum bounding rectangles of an R-tree's nodes.
+
+    In high dimensions the volumes under- or overflow, so they are reported as log10 volumes (a box that is
+    flat along some dimension has a volume of 0, counted apart). The overlap of two sibling boxes is
+    measured by whether they intersect and by the fraction of the dimensions on which their intervals overlap.
+
+    Parameters
+    ----------
+    mins, maxs : np.ndarray
+        The (n_nodes, k) corners of the MBRs.
+    leaf : np.ndarray
+        Whether every node is a leaf.
+    siblings : np.ndarray
+        The (n_pairs, 2) node indices of the pairs of siblings.
+    """
+    extents = (maxs[leaf] - mins[leaf]).astype(np.float64)
+    flat = (extents <= 0).any(axis=1)
+    with np.errstate(divide="ignore"):
+        log_volumes = np.log10(extents[~flat]).sum(axis=1)
+
+    metrics = {
+        "leaf_log10_volume_mean": float(log_volumes.mean()) if len(log_volumes) else None,
+        "leaf_log10_volume_max": float(log_volumes.max()) if len(log_volumes) else None,
+        "leaf_flat_boxes": int(flat.sum()),
+        "sibling_pairs": len(siblings),
+        "sibling_overlap_rate": None,
+        "sibling_overlap_dims": None,
+    }
+    if len(siblings):
+        first, second = siblings[:, 0], siblings[:, 1]
+        overlap = np.minimum(maxs[first], maxs[second]) >= np.maximum(mins[first], mins[second])
+        metrics["sibling_overlap_rate"] = float(overlap.all(axis=1).mean())
+        metrics["sibling_overlap_dims"] = float(overlap.mean())
+    return metrics
+
+
+def ball_metrics(radii: np.ndarray, leaf: np.ndarray, sibling_dists: np.ndarray, siblings: np.ndarray) -> dict:
+    """
+    Returns metrics of the covering balls of an M-tree's nodes: the covering radii of the leaves, and the
+    overlap of sibling balls, which intersect when the distance between their routing objects is at most the
+    sum of their radii (a query falling in the intersection has to visit both).
+
+    Parameters
+    ----------
+    radii : np.ndarray
+        The covering radius of every node.
+    leaf : np.ndarray
+        Whether every node is a leaf.
+    sibling_dists : np.ndarray
+        The distance between the routing objects of every pair of siblings.
+    siblings : np.ndarray
+        The (n_pairs, 2) node indices of the pairs of siblings.
+    """
+    leaf_radii = radii[leaf].astype(np.float64)
+    metrics = {
+        "leaf_covering_radius_mean": float(leaf_radii.mean()) if len(leaf_radii) else None,
+        "leaf_covering_radius_max": float(leaf_radii.max()) if len(leaf_radii) else None,
+        "sibling_pairs": len(siblings),
+        "sibling_overlap_rate": None,
+    }
+    if len(siblings):
+        reach = radii[siblings[:, 0]] + radii[siblings[:, 1]]
+        metrics["sibling_overlap_rate"] = float((sibling_dists <= reach).mean())
+    return metrics
@@ -0,0 +1,93 @@
+# quantization.py
+"""
+Compressed copies of the datapoints for the leaf scans: float16 values or per-dimension 8-bit scalar
+quantization codes. The distances computed on them are approximate, so the searches re-rank their best
+candidates against the original vectors.
+"""
+import numpy as np
+
+
+class ScalarQuantizer:
+    """
+    Encodes vectors as float16 values or as int8 codes, one uniform grid of 256 levels per dimension between
+    the minimum and the maximum of the datapoints along it: x ~ low + (code + 128) * scale.
+
+    Attributes
+    ----------
+    kind : str
+        "float16" or "int8".
+    low : np.ndarray
+        With "int8", the minimum of every dimension (float32).
+    scale : np.ndarray
+        With "int8", the width of a quantization step along every dimension (float32).
+
+    Methods
+    -------
+    fit(data: np.ndarray, chunk_rows: int) -> ScalarQuantizer
+        Computes the range of every dimension ("int8").
+    encode(X: np.ndarray) -> np.ndarray
+        Returns the codes of points.
+    encode_datapoints(data: np.ndarray, chunk_rows: int) -> np.ndarray
+        Returns the codes of all the datapoints, encoded by chunks of rows.
+    distances(codes: np.ndarray, q: np.ndarray) -> np.ndarray
+        Returns the approximate squared distances from a query to encoded points.
+    """
+
+    def __init__(self, kind: str, low: np.ndarray = None, scale: np.ndarray = None):
+        """
+        Creates an unfitted quantizer, or one with the given ranges (e.g. read from an index file).
+        """
+        assert kind in ("float16", "int8"), "Invalid kind, choose from 'float16', 'int8'"
+
+        self.kind = kind
+        self.low = low
+        self.scale = scale
+
+    def fit(self, data: np.ndarray, chunk_rows: int = 65536) -> "ScalarQuantizer":
+        """
+        Computes the minimum and the step of every dimension over all the datapoints, by chunks of rows.
+        Nothing is needed for "float16".
+        """
+        if self.kind == "float16" or len(data) == 0:
+            return self
+
+        low = np.full(data.shape[1], np.inf)
+        high = np.full(data.shape[1], -np.inf)
+        for start in range(0, len(data), chunk_rows):
+            chunk = np.asarray(data[start : start + chunk_rows])
+            low = np.minimum(low, chunk.min(axis=0))
+            high = np.maximum(high, chunk.max(axis=0))
+
+        self.low = low.astype(np.float32)
+        # a constant dimension keeps a non-zero step, all its points get the code -128
+        self.scale = np.maximum((high - low) / 255, np.finfo(np.float32).tiny).astype(np.float32)
+        return self
+
+    def encode(self, X: np.ndarray) -> np.ndarray:
+        """
+        Returns the codes of points; the values outside the fitted range get the nearest code.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if self.kind == "float16":
+            return X.astype(np.float16)
+        return (np.clip(np.rint((X - self.low) / self.scale), 0, 255) - 128).astype(np.int8)
+
+    def encode_datapoints(self, data: np.ndarray, chunk_rows: int = 65536) -> np.ndarray:
+        """
+        Returns the codes of all the datapoints, encoded by chunks of rows so that memory-mapped datapoints
+        are never loaded whole.
+        """
+        codes = np.empty(data.shape, dtype=np.float16 if self.kind == "float16" else np.int8)
+        for start in range(0, len(data), chunk_rows):
+            codes[start : start + chunk_rows] = self.encode(data[start : start + chunk_rows])
+        return codes
+
+    def distances(self, codes: np.ndarray, q: np.ndarray) -> np.ndarray:
+        """
+        Returns the approximate squared distances from q to the encoded points. The int8 distances are
+        computed in code space, where q is shifted and scaled once, so the codes are never decoded.
+        """
+        if self.kind == "float16":
+            return ((codes.astype(np.float32) - q) ** 2).sum(axis=1)
+        q_codes = (np.asarray(q, dtype=np.float32) - self.low) / self.scale - 128
+        return ((codes.astype(np.float32) - q_codes) ** 2) @ (self.scale * self.scale)
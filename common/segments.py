@@ -0,0 +1,165 @@
+# segments.py
+"""
+Segmented array operations for the level-synchronous builds: all the nodes of a level are processed
+together, their points laid out one node after the other as contiguous segments of one array (the node of
+every point is its label). Every statistic, selection and partition is then one NumPy call over the whole
+level rather than one call per node.
+"""
+import numpy as np
+
+
+def segment_offsets(counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the offset of every segment in the concatenation of segments of the given sizes.
+    """
+    return np.cumsum(counts) - counts
+
+
+def segment_labels(counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the segment of every element of the concatenation of segments of the given sizes.
+    """
+    return np.repeat(np.arange(len(counts)), counts)
+
+
+def gather_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the positions start, ..., start + count - 1 of all the ranges, concatenated.
+    """
+    offsets = segment_offsets(counts)
+    return np.arange(int(counts.sum()), dtype=np.int64) + np.repeat(starts - offsets, counts)
+
+
+def segment_stats(
+    data: np.ndarray, ids: np.ndarray, counts: np.ndarray, chunk_rows: int, sums: bool = True, bounds: bool = True, large: int = 256
+) -> dict:
+    """
+    Returns the statistics of node_stats of every segment of the rows ids of data, as (n_segments, n_dims)
+    arrays (and the counts). The sums (skipped if sums is False) are accumulated in float64; the min and max
+    are skipped if bounds is False. The segments must not be empty.
+
+    The reductions run over contiguous blocks of rows (ufunc.reduceat over the rows of a 2-D array pays a
+    call of its inner loop per row). The segments of more than large points are reduced one by one, by
+    chunks of chunk_rows rows; the smaller ones are grouped by size, the rows of every group gathered into
+    an (n_segments, width, n_dims) block with the width the next power of two, padded by repeating the last
+    row of the segment (which leaves the min and max unchanged, and is subtracted from the sums), at most
+    chunk_rows rows at a time.
+    """
+    n_segments, n_dims = len(counts), data.shape[1]
+    offsets = segment_offsets(counts)
+    stats = {"count": counts}
+    if bounds:
+        stats["min"] = np.empty((n_segments, n_dims), dtype=data.dtype)
+        stats["max"] = np.empty((n_segments, n_dims), dtype=data.dtype)
+    if sums:
+        stats["sum"] = np.empty((n_segments, n_dims), dtype=np.float64)
+        stats["sumsq"] = np.empty((n_segments, n_dims), dtype=np.float64)
+
+    for segment in np.flatnonzero(counts > large).tolist():
+        segment_ids = ids[offsets[segment] : offsets[segment] + counts[segment]]
+        for start in range(0, len(segment_ids), chunk_rows):
+            rows = data[segment_ids[start : start + chunk_rows]]
+            first = start == 0
+            if sums:
+                row_sums = rows.sum(axis=0, dtype=np.float64)
+                row_sumsq = np.einsum("ij,ij->j", rows, rows, dtype=np.float64)
+                stats["sum"][segment] = row_sums if first else stats["sum"][segment] + row_sums
+                stats["sumsq"][segment] = row_sumsq if first else stats["sumsq"][segment] + row_sumsq
+            if bounds:
+                row_min, row_max = rows.min(axis=0), rows.max(axis=0)
+                stats["min"][segment] = row_min if first else np.minimum(stats["min"][segment], row_min)
+                stats["max"][segment] = row_max if first else np.maximum(stats["max"][segment], row_max)
+
+    small = np.flatnonzero(counts <= large)
+    widths = 1 << np.ceil(np.log2(np.maximum(counts[small], 1))).astype(np.int64)
+    for width in np.unique(widths).tolist():
+        group = small[widths == width]
+        step = max(1, chunk_rows // width)
+        for first in range(0, len(group), step):
+            segments = group[first : first + step]
+            columns = np.arange(width)
+            positions = offsets[segments, None] + np.minimum(columns, counts[segments, None] - 1)
+            rows = data[ids[positions.ravel()]].reshape(len(segments), width, n_dims)
+            if bounds:
+                stats["min"][segments] = rows.min(axis=1)
+                stats["max"][segments] = rows.max(axis=1)
+            if sums:
+                # minus the padding, copies of the last row
+                padding = (width - counts[segments])[:, None]
+                last = rows[:, -1].astype(np.float64)
+                stats["sum"][segments] = rows.sum(axis=1, dtype=np.float64) - padding * last
+                stats["sumsq"][segments] = np.einsum("ijk,ijk->ik", rows, rows, dtype=np.float64) - padding * last * last
+    return stats
+
+
+def segment_argmax(values: np.ndarray, offsets: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the position (in values) of the first largest value of every non-empty segment.
+    """
+    labels = segment_labels(counts)
+    is_max = values == np.maximum.reduceat(values, offsets)[labels]
+    # the first maximum of every segment
+    positions = np.flatnonzero(is_max)
+    return positions[np.flatnonzero(np.diff(labels[positions], prepend=-1))]
+
+
+def segment_argmin(values: np.ndarray, offsets: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the position (in values) of the first smallest value of every non-empty segment.
+    """
+    labels = segment_labels(counts)
+    is_min = values == np.minimum.reduceat(values, offsets)[labels]
+    positions = np.flatnonzero(is_min)
+    return positions[np.flatnonzero(np.diff(labels[positions], prepend=-1))]
+
+
+def segment_select(values: np.ndarray, counts: np.ndarray, kth: np.ndarray, large: int = 256) -> np.ndarray:
+    """
+    Returns the kth[i] smallest value of every segment i of values (O(n) selection rather than a sort of
+    the whole array). The segments of more than large values are selected one by one; the smaller ones are
+    grouped by size into (n_segments, width) blocks padded with inf and sorted along their rows.
+    """
+    offsets = segment_offsets(counts)
+    selected = np.empty(len(counts), dtype=values.dtype)
+    for segment in np.flatnonzero(counts > large).tolist():
+        selected[segment] = np.partition(values[offsets[segment] : offsets[segment] + counts[segment]], kth[segment])[kth[segment]]
+
+    small = np.flatnonzero(counts <= large)
+    widths = 1 << np.ceil(np.log2(np.maximum(counts[small], 1))).astype(np.int64)
+    for width in np.unique(widths).tolist():
+        segments = small[widths == width]
+        columns = np.arange(width)
+        block = values[offsets[segments, None] + np.minimum(columns, counts[segments, None] - 1)]
+        block[columns[None, :] >= counts[segments, None]] = np.inf
+        block.sort(axis=1)
+        selected[segments] = block[np.arange(len(segments)), kth[segments]]
+    return selected
+
+
+def segment_sort(values: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Returns the order that sorts values within every segment (stably), the segments staying in place.
+    """
+    return np.lexsort((values, segment_labels(counts)))
+
+
+def segment_partition(is_left: np.ndarray, counts: np.ndarray):
+    """
+    Partitions every segment stably, the elements where is_left is True first.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        The new position of every element (in the concatenation) and the number of left elements of every
+        segment.
+    """
+    offsets = segment_offsets(counts)
+    labels = segment_labels(counts)
+    is_left = is_left.astype(np.int64)
+    # the number of left elements before every element, in the whole array, then in its segment
+    before = np.cumsum(is_left) - is_left
+    rank_left = before - before[offsets][labels]
+    n_left = np.add.reduceat(is_left, offsets) if len(is_left) else np.zeros(0, dtype=np.int64)
+    local = np.arange(len(is_left)) - offsets[labels]
+    positions = offsets[labels] + np.where(is_left == 1, rank_left, n_left[labels] + local - rank_left)
+    return positions, n_left
@@ -0,0 +1,323 @@
+# sharded_index.py
+try:
+    from .datasource import open_datapoints
+    from .batch_search import top_k
+except ImportError:
+    from datasource import open_datapoints
+    from batch_search import top_k
+from multiprocessing.shared_memory import SharedMemory
+import multiprocessing
+import tempfile
+import traceback
+import weakref
+import time
+import os
+import numpy as np
+
+
+class ShardedIndex:
+    """
+    A class to represent an index split into shards, with one tree per shard built and searched in its own
+    worker process (scatter-gather kNN search).
+
+    The rows are reordered shard by shard into shared memory (a temporary memory-mapped file for on-disk
+    datapoints), so that every worker reads its shards without copying them. A query is sent to every worker
+    (or to the n_probe shards closest to it) and the top-k lists of the shards are merged.
+
+    The trees' packages subclass it with their tree_class and the _tree_partition of their "tree" partition.
+
+    Attributes
+    ----------
+    tree_class : type
+        The tree built on every shard by default.
+    k : int
+        The number of dimensions of the datapoints.
+    n_shards : int
+        The number of shards.
+    ids : np.ndarray
+        The global id of every row, in shard order.
+    offsets : np.ndarray
+        The first row of every shard in shard order, followed by the number of points.
+    mins, maxs : np.ndarray
+        The bounding box of every shard, of shape (n_shards, k).
+    build_times : np.ndarray
+        The time taken to build the tree of every shard, in seconds.
+
+    Methods
+    -------
+    query(q: list[float], k: int, n_probe: int, **search_params) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of a query point.
+    query_batch(Q: list[list[float]], k: int, n_probe: int, **search_params) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every query point over the shards.
+    close()
+        Stops the workers and releases the shared datapoints.
+    """
+
+    tree_class = None
+
+    def __init__(
+        self,
+        k: int,
+        datapoints: list[list[float]],
+        n_shards: int = 4,
+        partition: str = "random",
+        n_workers: int = None,
+        seed: int = 0,
+        tmp_dir: str = None,
+        chunk_rows: int = 65536,
+        tree_class: type = None,
+        **tree_params,
+    ):
+        """
+        Splits the datapoints into n_shards shards and builds the tree of every shard in a worker process.
+
+        Parameters
+        ----------
+        k : int
+            The number of dimensions of the datapoints.
+        datapoints : list[list[float]]
+            The datapoints, or anything open_datapoints accepts (e.g. a .npy path or an HDF5 dataset).
+        n_shards : int, optional
+            The number of shards, by default 4.
+        partition : str, optional
+            How the points are assigned to the shards, by default "random".
+            Options: "random" (a random permutation cut into shards of equal sizes), "tree" (the leaves of a
+            shallow tree, see _tree_partition: the shards are compact, so n_probe can skip the far ones).
+        n_workers : int, optional
+            The number of worker processes, by default one per shard. The shards are dealt round-robin.
+        seed : int, optional
+            The seed of the random partition, by default 0.
+        tmp_dir : str, optional
+            The directory of the temporary file of on-disk datapoints, by default the system's.
+        chunk_rows : int, optional
+            The number of rows copied at once from on-disk datapoints, by default 65536.
+        tree_class : type, optional
+            The tree built on every shard, by default the class's tree_class.
+        **tree_params
+            The keyword arguments of the trees (e.g. engine="numpy", layout="flat").
+        """
+        assert partition in ("random", "tree"), "Invalid partition, choose from 'random', 'tree'"
+        assert n_shards >= 1, "n_shards must be at least 1"
+
+        self.k = k
+        tree_class = tree_class or self.tree_class
+        data = open_datapoints(datapoints, chunk_rows=chunk_rows, tmp_dir=tmp_dir)
+        if len(data) == 0:
+            raise ValueError("Cannot shard an empty set of datapoints")
+
+        if partition == "random":
+            shards = np.array_split(np.random.default_rng(seed).permutation(len(data)), min(n_shards, len(data)))
+        else:
+            shards = self._tree_partition(data, n_shards)
+        self.n_shards = len(shards)
+        self.ids = np.concatenate(shards).astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum([len(shard) for shard in shards])]).astype(np.int64)
+
+        # the rows in shard order, so that every shard is a contiguous slice
+        self._shm = None
+        if isinstance(data, np.memmap):
+            with tempfile.NamedTemporaryFile(suffix=".dat", dir=tmp_dir, delete=False) as f:
+                filename = f.name
+            self.data = np.memmap(filename, dtype=data.dtype, mode="w+", shape=data.shape)
+            weakref.finalize(self.data, os.remove, filename)
+            source = ("memmap", filename, 0, data.shape, data.dtype)
+        else:
+            self._shm = SharedMemory(create=True, size=max(data.nbytes, 1))
+            self.data = np.ndarray(data.shape, dtype=data.dtype, buffer=self._shm.buf)
+            source = ("shm", self._shm.name, 0, data.shape, data.dtype)
+        for start in range(0, len(data), chunk_rows):
+            self.data[start : start + chunk_rows] = data[self.ids[start : start + chunk_rows]]
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        del data
+
+        self.mins = np.stack([self.data[start:end].min(axis=0) for start, end in zip(self.offsets[:-1], self.offsets[1:])])
+        self.maxs = np.stack([self.data[start:end].max(axis=0) for start, end in zip(self.offsets[:-1], self.offsets[1:])])
+
+        # the workers are started (and stopped) together, with their shards dealt round-robin
+        n_workers = min(n_workers or self.n_shards, self.n_shards)
+        self._assignment = [list(range(self.n_shards))[worker::n_workers] for worker in range(n_workers)]
+        self._connections = []
+        self._workers = []
+        for shards in self._assignment:
+            parent_end, child_end = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_serve_shards,
+                args=(child_end, source, [(shard, self.offsets[shard], self.offsets[shard + 1]) for shard in shards], tree_class, k, tree_params),
+                daemon=True,
+            )
+            worker.start()
+            child_end.close()
+            self._connections.append(parent_end)
+            self._workers.append(worker)
+        self._finalizer = weakref.finalize(self, _shutdown, self._connections, self._workers, self._shm)
+
+        self.build_times = np.zeros(self.n_shards)
+        for times in self._gather():
+            for shard, seconds in times:
+                self.build_times[shard] = seconds
+
+    @staticmethod
+    def _tree_partition(data: np.ndarray, n_shards: int) -> list:
+        """
+        Returns the ids of the leaves of a shallow tree as the shards, as the subclasses define it.
+        """
+        raise NotImplementedError("The 'tree' partition is defined by the ShardedIndex of kd_tree or r_tree")
+
+    def _gather(self) -> list:
+        """
+        Returns the reply of every worker, raising the error of a failed worker.
+        """
+        replies = [connection.recv() for connection in self._connections]
+        for kind, payload in replies:
+            if kind == "error":
+                raise RuntimeError(f"A shard worker failed:\n{payload}")
+        return [payload for _, payload in replies]
+
+    def _probe(self, Q: np.ndarray, n_probe: int) -> np.ndarray:
+        """
+        Returns a (n_shards, len(Q)) mask of the n_probe shards whose bounding boxes are the closest to every
+        query (Euclidean distance, whatever the metric of the trees).
+        """
+        probed = np.zeros((self.n_shards, len(Q)), dtype=bool)
+        if n_probe >= self.n_shards:
+            probed[:] = True
+            return probed
+        dists = np.empty((len(Q), self.n_shards))
+        for shard in range(self.n_shards):
+            gap = np.maximum(self.mins[shard] - Q, 0) + np.maximum(Q - self.maxs[shard], 0)
+            dists[:, shard] = (gap.astype(np.float64) ** 2).sum(axis=1)
+        nearest = np.argpartition(dists, n_probe - 1, axis=1)[:, :n_probe]
+        probed[nearest, np.arange(len(Q))[:, None]] = True
+        return probed
+
+    def query(self, q: list[float], k: int = 1, n_probe: int = None, **search_params):
+        """
+        Finds the k nearest neighbours of a query point, see query_batch.
+        """
+        distances, ids = self.query_batch([q], k, n_probe, **search_params)
+        return distances[0], ids[0]
+
+    def query_batch(self, Q: list[list[float]], k: int = 1, n_probe: int = None, **search_params):
+        """
+        Finds the k nearest neighbours of every query point.
+
+        The queries are sent to all the workers at once, every worker searches its shards with query_batch,
+        and the k nearest neighbours of every query are kept among those of its shards.
+
+        Parameters
+        ----------
+        Q : list[list[float]]
+            The query points.
+        k : int, optional
+            The number of neighbours to return, by default 1.
+        n_probe : int, optional
+            Only search the n_probe shards whose bounding boxes are the closest to every query, by default
+            all of them (exact if the trees' searches are).
+        **search_params
+            The keyword arguments of the trees' query_batch (e.g. max_leaves, n_threads).
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            Arrays of shape (len(Q), k) with the distances and the ids of the neighbours of each query.
+        """
+        assert self._finalizer.alive, "The index is closed"
+        Q = np.ascontiguousarray(Q, dtype=self.data.dtype).reshape(-1, self.data.shape[1])
+        k = min(k, len(self.ids))
+        probed = None if n_probe is None or n_probe >= self.n_shards else self._probe(Q, n_probe)
+
+        for connection, shards in zip(self._connections, self._assignment):
+            rows = {shard: (None if probed is None else np.flatnonzero(probed[shard])) for shard in shards}
+            connection.send(("query", Q, k, rows, search_params))
+
+        queries, dists, ids = [], [], []
+        for results in self._gather():
+            for shard, rows, shard_dists, shard_ids in results:
+                rows = np.broadcast_to((np.arange(len(Q)) if rows is None else rows)[:, None], shard_ids.shape)
+                found = shard_ids >= 0
+                queries.append(rows[found])
+                dists.append(shard_dists[found])
+                ids.append(self.ids[self.offsets[shard] + shard_ids[found]])
+
+        return top_k(np.concatenate(queries), np.concatenate(dists), np.concatenate(ids), len(Q), k)
+
+    def close(self):
+        """
+        Stops the workers and releases the shared datapoints.
+        """
+        self.data = None
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _shutdown(connections: list, workers: list, shm: SharedMemory):
+    """
+    Stops the workers of a ShardedIndex and unlinks its shared memory.
+    """
+    for connection in connections:
+        try:
+            connection.send(("close",))
+        except (BrokenPipeError, OSError):
+            pass
+    for connection, worker in zip(connections, workers):
+        worker.join(timeout=5)
+        if worker.is_alive():
+            worker.terminate()
+        connection.close()
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+def _serve_shards(connection, source: tuple, shards: list, tree_class: type, k: int, tree_params: dict):
+    """
+    Builds the trees of the given (shard, start, end) shards in a worker process, reading the rows from shared
+    memory or from their file, then answers the queries of the ShardedIndex until it is closed.
+    """
+    kind, name, offset, shape, dtype = source
+    shm = None
+    try:
+        if kind == "memmap":
+            data = np.memmap(name, dtype=dtype, mode="r", offset=offset, shape=shape)
+        else:
+            shm = SharedMemory(name=name)
+            data = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+
+        trees, times = {}, []
+        for shard, start, end in shards:
+            start_time = time.perf_counter()
+            trees[shard] = tree_class(k, data[start:end], **tree_params)
+            times.append((shard, time.perf_counter() - start_time))
+        connection.send(("built", times))
+
+        while True:
+            message = connection.recv()
+            if message[0] == "close":
+                break
+            _, Q, n_neighbours, rows, search_params = message
+            try:
+                results = []
+                for shard, tree in trees.items():
+                    queries = Q if rows[shard] is None else Q[rows[shard]]
+                    if len(queries) == 0:
+                        continue
+                    dists, ids = tree.query_batch(queries, n_neighbours, **search_params)
+                    results.append((shard, rows[shard], np.asarray(dists, dtype=np.float64), np.asarray(ids, dtype=np.int64)))
+                connection.send(("results", results))
+            except Exception:
+                connection.send(("error", traceback.format_exc()))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        trees = data = None
+        if shm is not None:
+            shm.close()
+        connection.close()
@@ -0,0 +1,92 @@
+# transform.py
+"""
+Preprocessing of the datapoints before a tree is built on them: a global PCA rotation, optionally truncated
+to the directions of highest variance, applied the same way to the queries.
+"""
+import numpy as np
+
+try:
+    from .datasource import spill_to_memmap
+except ImportError:
+    from datasource import spill_to_memmap
+
+
+class PCARotation:
+    """
+    A global PCA rotation of the datapoints: x -> (x - mean) @ components.T.
+
+    With all the components, the rotation is orthogonal, so it keeps the Euclidean distances and only aligns
+    the coordinate axes of the tree with the directions of highest variance. With fewer, the distances
+    between the projections are lower bounds of the true ones.
+
+    Attributes
+    ----------
+    n_components : int
+        The number of principal directions kept, None for all of them.
+    mean : np.ndarray
+        The mean of the datapoints (float32).
+    components : np.ndarray
+        The principal directions as a (n_components, k) array, by decreasing variance (float32).
+    explained_variance : np.ndarray
+        The variance of the datapoints along each component.
+
+    Methods
+    -------
+    fit(data: np.ndarray, sample_size: int, seed: int) -> PCARotation
+        Computes the principal directions of the datapoints.
+    transform(X: np.ndarray) -> np.ndarray
+        Rotates (and truncates) points.
+    transform_datapoints(data: np.ndarray, chunk_rows: int, tmp_dir: str) -> np.ndarray
+        Rotates all the datapoints by chunks of rows.
+    """
+
+    def __init__(self, n_components: int = None, mean: np.ndarray = None, components: np.ndarray = None):
+        """
+        Creates an unfitted rotation, or one with the given mean and components (e.g. read from an index file).
+        """
+        self.n_components = n_components if components is None else len(components)
+        self.mean = mean
+        self.components = components
+        self.explained_variance = None
+
+    def fit(self, data: np.ndarray, sample_size: int = 20000, seed: int = 0) -> "PCARotation":
+        """
+        Computes the mean and the principal directions from a random sample of sample_size rows of data
+        (all of them if there are fewer), by an eigendecomposition of their covariance in float64.
+        """
+        assert self.n_components is None or 0 < self.n_components <= data.shape[1], "Invalid n_components"
+
+        rows = np.arange(len(data))
+        if len(data) > sample_size:
+            rows = np.sort(np.random.default_rng(seed).choice(len(data), size=sample_size, replace=False))
+        X = np.asarray(data[rows], dtype=np.float64)
+        mean = X.mean(axis=0)
+        centered = X - mean
+        variances, vectors = np.linalg.eigh(centered.T @ centered / max(len(X), 1))
+
+        # eigh sorts the eigenvalues in increasing order
+        order = np.argsort(variances)[::-1][: self.n_components]
+        self.mean = mean.astype(np.float32)
+        self.components = np.ascontiguousarray(vectors[:, order].T, dtype=np.float32)
+        self.explained_variance = variances[order]
+        self.n_components = len(order)
+        return self
+
+    def transform(self, X: np.ndarray) -> np.ndarray:
+        """
+        Returns the rotated points, a 1D array for a single point.
+        """
+        X = np.asarray(X, dtype=np.float32)
+        return (X - self.mean) @ self.components.T
+
+    def transform_datapoints(self, data: np.ndarray, chunk_rows: int = 65536, tmp_dir: str = None) -> np.ndarray:
+        """
+        Returns all the rotated datapoints, rotated by chunks of rows: in memory, or in a temporary
+        memory-mapped file in tmp_dir if data is memory-mapped.
+        """
+        if isinstance(data, np.memmap):
+            return spill_to_memmap(data, np.float32, chunk_rows, tmp_dir, self.transform, self.n_components)
+        out = np.empty((len(data), self.n_components), dtype=np.float32)
+        for start in range(0, len(data), chunk_rows):
+            out[start : start + chunk_rows] = self.transform(data[start : start + chunk_rows])
+        return out
@@ -1,6 +1,8 @@
 # dimension_choice.py
 import random
 
+import numpy as np
+
 ALL_ARGS = ["datapoints", "nbr_dims", "last_dim"]
 
 
@@ -13,19 +15,33 @@ def alternate_dim(nbr_dims, last_dim, **kwargs):
 ALTERNATE_OUT_PLUS = []
 
 
-def random_dim(nbr_dims, **kwargs):
+def random_dim(nbr_dims, rng=random, **kwargs):
     """
-    Returns a random dimension to split on.
+    Returns a random dimension to split on, drawn from rng (the random module by default).
     """
-    return {"dim": random.randint(0, nbr_dims - 1)}
+    return {"dim": rng.randint(0, nbr_dims - 1)}
 
 RANDOM_OUT_PLUS = []
 
 
-def max_variance_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
+def max_variance_dim(datapoints: list[list[float]], nbr_dims: int, stats: dict = None, **kwargs):
     """
     Returns the dimension with the highest variance.
+    The variances of all the dimensions are computed at once if datapoints is an ndarray, or from the
+    "count", "sum" and "sumsq" of the points if stats is given.
     """
+    if stats is not None:
+        mean_vals = stats["sum"] / stats["count"]
+        variances = stats["sumsq"] / stats["count"] - mean_vals**2
+        max_variance_dim = int(np.argmax(variances))
+        return {"dim": max_variance_dim, "mean_val": mean_vals[max_variance_dim]}
+
+    if isinstance(datapoints, np.ndarray):
+        mean_vals = datapoints.mean(axis=0)
+        variances = datapoints.var(axis=0)
+        max_variance_dim = int(np.argmax(variances))
+        return {"dim": max_variance_dim, "mean_val": mean_vals[max_variance_dim]}
+
     max_variance = 0
     max_variance_dim = 0
 
@@ -51,15 +67,23 @@ def max_variance_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
 MAX_VARIANCE_OUT_PLUS = ["mean_val"]
 
 
-def widest_interval_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
+def widest_interval_dim(datapoints: list[list[float]], nbr_dims: int, stats: dict = None, **kwargs):
     """
     Returns the dimension with the highest maximum-minimum value.
+    The intervals of all the dimensions are computed at once if datapoints is an ndarray, or from the
+    "min" and "max" of the points if stats is given.
     """
+    if stats is not None or isinstance(datapoints, np.ndarray):
+        max_vals = stats["max"] if stats is not None else datapoints.max(axis=0)
+        min_vals = stats["min"] if stats is not None else datapoints.min(axis=0)
+        max_range_dim = int(np.argmax(max_vals - min_vals))
+        return {"dim": max_range_dim, "max_val": max_vals[max_range_dim], "min_val": min_vals[max_range_dim]}
+
     max_range = 0
     max_range_dim = 0
 
-    max_val = 0
-    min_val = 0
+    max_val_out = 0
+    min_val_out = 0
 
     for dim in range(nbr_dims):
         max_val = max([point[dim] for point in datapoints])
@@ -68,13 +92,200 @@ def widest_interval_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
         if range_val > max_range:
             max_range = range_val
             max_range_dim = dim
-    return {"dim": max_range_dim, "max_val": max_val, "min_val": min_val}
+            max_val_out = max_val
+            min_val_out = min_val
+    return {"dim": max_range_dim, "max_val": max_val_out, "min_val": min_val_out}
 
 WIDEST_INTERVAL_OUT_PLUS = ["max_val", "min_val"]
 
+def top_variance_dim(
+    datapoints: list[list[float]], nbr_dims: int, top_n: int = 5, rng=random, stats: dict = None, **kwargs
+):
+    """
+    Returns a random dimension among the top_n dimensions with the highest variance (randomized KD-trees),
+    drawn from rng (the random module by default). The variances come from stats if it is given.
+    """
+    if stats is not None:
+        mean_vals = stats["sum"] / stats["count"]
+        variances = stats["sumsq"] / stats["count"] - mean_vals**2
+    else:
+        datapoints = np.asarray(datapoints)
+        mean_vals = datapoints.mean(axis=0)
+        variances = datapoints.var(axis=0)
+    top_dims = np.argsort(-variances, kind="stable")[:top_n]
+    dim = int(top_dims[rng.randrange(len(top_dims))])
+    return {"dim": dim, "mean_val": mean_vals[dim]}
+
+TOP_VARIANCE_OUT_PLUS = ["mean_val"]
+
+
+def random_projection_dim(nbr_dims: int, rng=random, **kwargs):
+    """
+    Returns a random unit direction to split on (RP-tree), with Gaussian coordinates drawn from a NumPy
+    generator seeded from rng (the random module by default).
+    """
+    direction = np.random.default_rng(rng.getrandbits(64)).standard_normal(nbr_dims)
+    return {"direction": (direction / np.linalg.norm(direction)).astype(np.float32)}
+
+RANDOM_PROJECTION_OUT_PLUS = []
+
+
+def pca_dim(
+    datapoints: list[list[float]], nbr_dims: int, rng=random, sample_size: int = 1000, n_iter: int = 5, **kwargs
+):
+    """
+    Returns the top principal direction of the points to split on (PCA-tree), estimated by n_iter power
+    iterations on the covariance of a random sample of sample_size points drawn from rng (the random module
+    by default), and the mean of the sample along it.
+    """
+    X = np.asarray(datapoints)
+    if len(X) > sample_size:
+        X = X[np.sort(np.array(rng.sample(range(len(X)), sample_size)))]
+    X = X.astype(np.float64)
+    mean = X.mean(axis=0)
+    centered = X - mean
+
+    direction = np.random.default_rng(rng.getrandbits(64)).standard_normal(nbr_dims)
+    direction /= np.linalg.norm(direction)
+    for _ in range(n_iter):
+        # the covariance is applied as two matrix-vector products, it is never formed
+        product = centered.T @ (centered @ direction)
+        norm = np.linalg.norm(product)
+        if norm == 0:
+            break
+        direction = product / norm
+    return {"direction": direction.astype(np.float32), "mean_val": float(mean @ direction)}
+
+PCA_OUT_PLUS = ["mean_val"]
+
+
+def alternate_dims(nbr_dims: int, last_dims: np.ndarray, **kwargs):
+    """
+    Returns the next dimension to split on of every node of a level, after last_dims.
+    """
+    return {"dim": (last_dims + 1) % nbr_dims}
+
+
+def random_dims(nbr_dims: int, n_nodes: int, rng=random, **kwargs):
+    """
+    Returns a random dimension to split on for every node of a level, drawn from rng in node order.
+    """
+    return {"dim": np.array([rng.randint(0, nbr_dims - 1) for _ in range(n_nodes)], dtype=np.int64)}
+
+
+def max_variance_dims(stats: dict, **kwargs):
+    """
+    Returns the dimension with the highest variance of every node of a level, from the (n_nodes, n_dims)
+    "count", "sum" and "sumsq" of stats, and the nodes' means along them.
+    """
+    nodes = np.arange(len(stats["count"]))
+    mean_vals = stats["sum"] / stats["count"][:, None]
+    variances = stats["sumsq"] / stats["count"][:, None] - mean_vals**2
+    dims = np.argmax(variances, axis=1)
+    return {"dim": dims, "mean_val": mean_vals[nodes, dims]}
+
+
+def widest_interval_dims(stats: dict, **kwargs):
+    """
+    Returns the dimension with the highest maximum-minimum value of every node of a level, from the
+    (n_nodes, n_dims) "min" and "max" of stats, and the nodes' bounds along them.
+    """
+    nodes = np.arange(len(stats["count"]))
+    dims = np.argmax(stats["max"] - stats["min"], axis=1)
+    return {"dim": dims, "max_val": stats["max"][nodes, dims], "min_val": stats["min"][nodes, dims]}
+
+
+def top_variance_dims(stats: dict, top_n: int = 5, rng=random, **kwargs):
+    """
+    Returns a random dimension among the top_n dimensions with the highest variance of every node of a level,
+    drawn from rng in node order, and the nodes' means along them.
+    """
+    nodes = np.arange(len(stats["count"]))
+    mean_vals = stats["sum"] / stats["count"][:, None]
+    variances = stats["sumsq"] / stats["count"][:, None] - mean_vals**2
+    top_dims = np.argsort(-variances, axis=1, kind="stable")[:, :top_n]
+    picks = np.array([rng.randrange(top_dims.shape[1]) for _ in nodes], dtype=np.int64)
+    dims = top_dims[nodes, picks]
+    return {"dim": dims, "mean_val": mean_vals[nodes, dims]}
+
+
+def random_projection_dims(nbr_dims: int, n_nodes: int, rng=random, **kwargs):
+    """
+    Returns a random unit direction to split on for every node of a level, as the rows of an
+    (n_nodes, nbr_dims) array, with Gaussian coordinates drawn from one NumPy generator seeded from rng.
+    """
+    directions = np.random.default_rng(rng.getrandbits(64)).standard_normal((n_nodes, nbr_dims))
+    return {"direction": (directions / np.linalg.norm(directions, axis=1, keepdims=True)).astype(np.float32)}
+
+
+# the versions choosing for all the nodes of a level at once (level-synchronous build), None where the
+# choice is made node by node
+DIM_SEGMENTED = {
+    "alternate": alternate_dims,
+    "random": random_dims,
+    "max_variance": max_variance_dims,
+    "widest_interval": widest_interval_dims,
+    "top_variance": top_variance_dims,
+    "random_projection": random_projection_dims,
+    "pca": None,
+}
+
 DIM_OUT_PLUS = {
     "alternate": ALTERNATE_OUT_PLUS,
     "random": RANDOM_OUT_PLUS,
     "max_variance": MAX_VARIANCE_OUT_PLUS,
     "widest_interval": WIDEST_INTERVAL_OUT_PLUS,
+    "top_variance": TOP_VARIANCE_OUT_PLUS,
+    "random_projection": RANDOM_PROJECTION_OUT_PLUS,
+    "pca": PCA_OUT_PLUS,
+}
+
+# whether the function reads the datapoints (the "numpy" engine only gathers a node's points when it does)
+DIM_USES_DATAPOINTS = {
+    "alternate": False,
+    "random": False,
+    "max_variance": True,
+    "widest_interval": True,
+    "top_variance": True,
+    "random_projection": False,
+    "pca": True,
 }
+
+# whether the function returns a direction to project the points on rather than a coordinate axis
+DIM_PROJECTS = {
+    "alternate": False,
+    "random": False,
+    "max_variance": False,
+    "widest_interval": False,
+    "top_variance": False,
+    "random_projection": True,
+    "pca": True,
+}
+
+
+def project(X: np.ndarray, directions: np.ndarray) -> np.ndarray:
+    """
+    Returns the (len(X), len(directions)) projections of the points X on the directions, in float64.
+
+    The build, the queries and the updates all project through here (or project_rows), and every projection
+    is the same float64 dot product of one point and one direction whatever the shapes, so that they compute
+    bit-identical coordinates and agree on the side of every split.
+    """
+    X = np.asarray(X, dtype=np.float64).reshape(-1, directions.shape[-1])
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, X.shape[1])
+    projections = np.empty((len(X), len(directions)), dtype=np.float64)
+    if len(directions) <= len(X):
+        for j, direction in enumerate(directions):
+            projections[:, j] = np.einsum("ij,j->i", X, direction)
+    else:
+        for i, x in enumerate(X):
+            projections[i] = np.einsum("ij,j->i", directions, x)
+    return projections
+
+
+def project_rows(X: np.ndarray, directions: np.ndarray) -> np.ndarray:
+    """
+    Returns the projections of the points X on the directions of the same rows, X[i] @ directions[i], in
+    float64 with the dot product of project.
+    """
+    return np.einsum("ij,ij->i", np.asarray(X, dtype=np.float64), np.asarray(directions, dtype=np.float64))
@@ -0,0 +1,160 @@
+try:
+    from .kd_tree import KDTree
+except ImportError:
+    from kd_tree import KDTree
+try:
+    from ..common.datasource import open_datapoints
+except ImportError:
+    from common.datasource import open_datapoints
+import numpy as np
+
+
+class KDForest:
+    """
+    A class to represent a forest of randomized KDTrees searched together (approximate kNN search).
+
+    Attributes
+    ----------
+    k : int
+        The number of dimensions of the datapoints.
+    data : np.ndarray
+        The datapoints, shared by all the trees.
+    trees : list[KDTree]
+        The trees of the forest.
+
+    Methods
+    -------
+    query(q: list[float], k: int, max_checks: int, max_leaves: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of a query point, best-bin-first over all the trees.
+    query_batch(Q: list[list[float]], k: int, max_checks: int, max_leaves: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every query point.
+    """
+
+    def __init__(
+        self,
+        k: int,
+        datapoints: list[list[float]],
+        n_trees: int = 4,
+        dimension_choice: str = "top_variance",
+        split_position_choice: str = "median",
+        leaf_size: int = 10,
+        max_depth: int = None,
+        layout: str = "flat",
+        dimension_params: dict = None,
+    ):
+        """
+        Builds n_trees KDTrees ("numpy" engine) on the same datapoints. The trees differ through the random
+        draws of their strategies, so the dimension_choice should be random.
+
+        Parameters
+        ----------
+        k : int
+            The number of dimensions of the datapoints.
+        datapoints : list[list[float]]
+            The datapoints, or anything KDTree accepts with the "numpy" engine (e.g. a .npy path).
+        n_trees : int, optional
+            The number of trees, by default 4.
+        dimension_choice : str, optional
+            The function to choose the dimension to split on, by default "top_variance".
+            Options: "random", "top_variance" (random among the top_n highest-variance dimensions,
+            top_n being set through dimension_params, 5 by default), "random_projection" (random
+            directions, a forest of RP-trees).
+        split_position_choice : str, optional
+            The function to choose the split position, by default "median".
+        leaf_size : int, optional
+            The maximum number of points that can be stored in a leaf node, by default 10.
+        max_depth : int, optional
+            The maximum depth of the trees, by default None.
+        layout : str, optional
+            The node layout of the trees, by default "flat".
+        dimension_params : dict, optional
+            Extra keyword arguments of the dimension_choice function, by default None.
+        """
+        assert dimension_choice in ("random", "top_variance", "random_projection"), "Invalid dimension_choice, choose from 'random', 'top_variance', 'random_projection'"
+
+        self.k = k
+        self.data = open_datapoints(datapoints)
+        self.trees = [
+            KDTree(
+                k,
+                self.data,
+                dimension_choice=dimension_choice,
+                split_position_choice=split_position_choice,
+                leaf_size=leaf_size,
+                max_depth=max_depth,
+                engine="numpy",
+                layout=layout,
+                dimension_params=dimension_params,
+            )
+            for _ in range(n_trees)
+        ]
+
+    def query(
+        self,
+        q: list[float],
+        k: int = 1,
+        return_visited: bool = False,
+        max_checks: int = None,
+        max_leaves: int = None,
+    ):
+        """
+        Finds the k nearest neighbours of a query point. All the trees are descended best-bin-first with a
+        single priority queue, so the budget goes to the most promising branches of any tree.
+
+        Parameters
+        ----------
+        q : list[float]
+            The query point.
+        k : int, optional
+            The number of neighbours to return, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by the search, by default False.
+        max_checks : int, optional
+            Stop once this many distinct points have been compared to the query, by default None.
+        max_leaves : int, optional
+            Stop once this many leaves have been checked (over all the trees), by default None.
+            Without a budget, the search is exact.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The Euclidean distances (ascending) and the ids of the neighbours.
+        """
+        q = np.asarray(q, dtype=self.data.dtype)
+
+        heap, nodes_visited = self.trees[0]._bbf(q, k, self.trees, max_checks, max_leaves)
+        distances, ids = KDTree._sorted_neighbours(heap)
+
+        if return_visited:
+            return distances, ids, nodes_visited
+        return distances, ids
+
+    def query_batch(
+        self,
+        Q: list[list[float]],
+        k: int = 1,
+        return_visited: bool = False,
+        max_checks: int = None,
+        max_leaves: int = None,
+    ):
+        """
+        Finds the k nearest neighbours of every query point, see query.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            Arrays of shape (len(Q), k) with the distances and the ids of the neighbours of each query.
+        """
+        k = min(k, len(self.data))
+        distances = np.empty((len(Q), k), dtype=np.float64)
+        ids = np.empty((len(Q), k), dtype=np.int64)
+        visited = np.empty(len(Q), dtype=np.int64)
+
+        for row, q in enumerate(Q):
+            distances[row], ids[row], visited[row] = self.query(
+                q, k, return_visited=True, max_checks=max_checks, max_leaves=max_leaves
+            )
+
+        if return_visited:
+            return distances, ids, visited
+        return distances, ids
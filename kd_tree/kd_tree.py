@@ -1,7 +1,38 @@
-from dimension_choice import *
-from split_position_choice import *
+try:
+    from .dimension_choice import *
+    from .split_position_choice import *
+except ImportError:
+    from dimension_choice import *
+    from split_position_choice import *
+try:
+    from ..common.datasource import *
+    from ..common.index_file import *
+    from ..common.quality import *
+    from ..common.transform import *
+    from ..common.quantization import *
+    from ..common.batch_search import *
+    from ..common.segments import *
+    from ..common.all_knn import *
+    from ..common.instrumentation import *
+except ImportError:
+    from common.datasource import *
+    from common.index_file import *
+    from common.quality import *
+    from common.transform import *
+    from common.quantization import *
+    from common.batch_search import *
+    from common.segments import *
+    from common.all_knn import *
+    from common.instrumentation import *
 from sklearn.metrics import silhouette_score
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
+import heapq
+import random
+import copy
+import os
 
 class KDTree:
     """
@@ -10,7 +41,7 @@ class KDTree:
     Attributes
     ----------
     k : int
-        The number of dimensions of the datapoints.
+        The number of dimensions of the datapoints (of the rotated ones with a rotation).
     root : dict
         The root node of the KDTree.
     dimension_choice : function
@@ -21,6 +52,34 @@ class KDTree:
         The maximum number of points that can be stored in a leaf node.
     max_depth : int
         The maximum depth of the tree.
+    engine : str
+        The build engine, "list" or "numpy".
+    data : np.ndarray
+        The datapoints, indexed by the ids stored in the leaves (a np.memmap when built from a file).
+    perm : np.ndarray
+        With the "numpy" engine, the permutation of the ids into leaf order; every leaf's ids are a slice of it.
+    layout : str
+        The node layout, "dict" or "flat".
+    nodes : dict[str, np.ndarray]
+        With the "flat" layout, the parallel node arrays ("split_dim", "split_val", "left", "right",
+        "depth", "start", "count"); the root is node 0, leaves have split_dim -1 and missing children are -1.
+    directions : np.ndarray
+        With the "numpy" engine, the (n_directions, k) unit directions of the projection splits: a split_dim
+        d >= k splits on the projection of the points on directions[d - k] rather than on a coordinate.
+    pca : PCARotation
+        The global rotation applied to the datapoints and the queries, None without a rotation.
+    quantizer : ScalarQuantizer
+        The encoding of the compressed vectors scanned by the kNN searches, None to scan the datapoints.
+    codes : np.ndarray
+        With a quantizer, the compressed datapoints, indexed by id like data.
+    rng : random.Random
+        The source of the random draws of the strategies, the random module by default.
+    n_jobs : int
+        The number of workers building the subtrees below the parallel threshold, None for a sequential build.
+    n_points : int
+        The number of points in the tree (the deleted points keep their row in data).
+    tree_stats : TreeStats
+        The statistics of the build and of the kNN searches, None unless collect_stats is set.
 
     Methods
     -------
@@ -28,8 +87,30 @@ class KDTree:
         Builds the KDTree from the given datapoints.
     recursive_build(datapoints: list[list[float]], depth: int) -> dict
         Recursively builds the KDTree from the given datapoints.
-    compute_silhouette_score() -> float
-        Computes the Silhouette Score for the KDTree.
+    numpy_build(start: int, end: int, depth: int) -> dict
+        Recursively builds the KDTree over the range perm[start:end] ("numpy" engine).
+    level_build() -> int
+        Builds the KDTree level by level, all the nodes of a depth at once ("level" builder).
+    insert(points: list[list[float]], alpha: float) -> np.ndarray
+        Inserts points without rebuilding the tree (scapegoat-style partial rebuilds).
+    delete(ids: list[int], alpha: float)
+        Removes points from the tree.
+    query(q: list[float], k: int, max_checks: int, max_leaves: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of a query point, exactly or best-bin-first within a budget.
+    query_batch(Q: list[list[float]], k: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every query point.
+    all_knn(k: int, include_self: bool, n_threads: int) -> np.ndarray, np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every indexed point (a self-join), as a CSR neighbour graph.
+    compute_silhouette_score(sample_size: int, seed: int) -> float
+        Computes the Silhouette Score for the KDTree, exactly or on a sample of points.
+    quality_metrics() -> dict
+        Computes the per-leaf quality metrics of the KDTree.
+    get_stats() -> dict
+        Returns the build and query statistics collected with collect_stats.
+    save(path: str)
+        Saves a "flat" KDTree to an index file.
+    load(path: str, mmap: bool) -> KDTree
+        Loads a KDTree from an index file, memory-mapped by default.
     """
 
     def __init__(
@@ -40,6 +121,23 @@ class KDTree:
         split_position_choice: str = "random",
         leaf_size: int = 10,
         max_depth: int = None,
+        engine: str = "list",
+        layout: str = "dict",
+        n_jobs: int = None,
+        parallel_depth: int = 4,
+        parallel_size: int = None,
+        parallel_backend: str = "process",
+        chunk_rows: int = None,
+        tmp_dir: str = None,
+        dimension_params: dict = None,
+        dimension_stats: str = "exact",
+        stats_sample_size: int = 1024,
+        rotation: str = None,
+        n_components: int = None,
+        vector_storage: str = None,
+        rerank: int = 4,
+        builder: str = "recursive",
+        collect_stats: bool = False,
     ):
         """
         Initializes the KDTree with the given datapoints and the dimension_choice and split_position_choice functions.
@@ -47,10 +145,16 @@ class KDTree:
         Parameters
         ----------
         datapoints : list[list[float]]
-            The list of datapoints to build the KDTree from.
+            The list of datapoints to build the KDTree from. With the "numpy" engine, also a path to a .npy
+            file or a memory-mapped array (used without copying it to memory) or an HDF5 dataset (copied by
+            chunks to a temporary memory-mapped file in tmp_dir).
         dimension_choice : str, optional
             The function to choose the dimension to split on, by default "random".
-            Options: "alternate", "random", "max_variance", "widest_interval".
+            Options: "alternate", "random", "max_variance", "widest_interval",
+            "top_variance" (random among the top_n highest-variance dimensions, for forests),
+            "random_projection" (a random unit direction, RP-tree), "pca" (the top principal direction of the
+            node's points, by power iterations on a sample, PCA-tree). The projection choices split on
+            the projections of the points on the direction and require the "numpy" engine.
         split_position_choice : str, optional
             The function to choose the split position, by default "random".
             Options: "mean", "median", "random", "geometric_center".
@@ -58,6 +162,84 @@ class KDTree:
             The maximum number of points that can be stored in a leaf node, by default 10.
         max_depth : int, optional
             The maximum depth of the tree, by default None.
+        engine : str, optional
+            The build engine, by default "list".
+            Options: "list" (partitions Python lists of points, sorting every node),
+            "numpy" (works on a float32 ndarray and partitions an index permutation in place, with
+            vectorised per-axis statistics and O(n) median selection; gives the same trees for a fixed seed).
+        layout : str, optional
+            The node layout, by default "dict".
+            Options: "dict" (one dict per node), "flat" (parallel NumPy arrays indexed by node id, with
+            leaves stored as (start, count) ranges of perm; requires the "numpy" engine).
+        n_jobs : int, optional
+            The number of workers building subtrees in parallel, by default None (sequential build);
+            -1 uses all the CPU cores. Requires the "numpy" engine.
+            The top of the tree is built first; every node at parallel_depth, or with at most parallel_size
+            points, becomes an independent subtree built by a worker with its own random.Random, seeded
+            from the tree's random state in subtree order. The tree thus only depends on the random seed,
+            not on n_jobs (but differs from the sequential build when the strategies are random).
+        parallel_depth : int, optional
+            The depth at which the subtrees are handed to the workers, by default 4.
+        parallel_size : int, optional
+            The number of points under which a subtree is handed to the workers, by default None.
+        parallel_backend : str, optional
+            The worker pool, by default "process".
+            Options: "process" (the datapoints are shared with the workers through shared memory),
+            "thread" (only the NumPy parts of the build release the GIL).
+        chunk_rows : int, optional
+            With the "numpy" engine, compute the per-node statistics of the dimension choice by streaming
+            over chunks of this many rows instead of gathering the node's points, by default None
+            (streams 16 MB chunks for memory-mapped datapoints, gathers otherwise). Only the id
+            permutation and one column of the node are then held in memory.
+        tmp_dir : str, optional
+            The directory of the temporary file an HDF5 dataset is copied to, by default the system's.
+        dimension_params : dict, optional
+            Extra keyword arguments of the dimension_choice function, by default None.
+            E.g. {"top_n": 5} for "top_variance".
+        dimension_stats : str, optional
+            How the "numpy" engine computes the per-dimension statistics of "max_variance", "widest_interval"
+            and "top_variance" at every node, by default "exact".
+            Options: "exact" (over all the node's points, O(n * d) per level of the tree),
+            "incremental" (over the root's points only, then every node computes them over its smaller child
+            and subtracts them from its own for the larger one, halving the work per level; the sums are
+            exact up to rounding, the min and max of the larger child are the node's bounds except along the
+            split dimension),
+            "sampled" (over a random sample of stats_sample_size points of every node, drawn from the tree's
+            random state; the variances are estimates and the intervals those of the sample).
+        stats_sample_size : int, optional
+            The number of points of the "sampled" statistics, by default 1024.
+        rotation : str, optional
+            A global transform of the datapoints before the build, applied to the queries and the inserted
+            points too, by default None. Requires the "numpy" engine.
+            Options: "pca" (rotation onto the principal directions, fitted on a sample of 20000 points; the
+            axis choices then split along the directions of highest variance).
+        n_components : int, optional
+            With rotation, the number of principal directions kept, by default None (all of them, which keeps
+            the distances). With fewer, the tree indexes the truncated vectors: the search is exact in that
+            space, and its distances are lower bounds of the true ones.
+        vector_storage : str, optional
+            A compressed copy of the datapoints for the leaf scans of the kNN searches, by default None (the
+            leaves are scanned on the datapoints). Requires the "numpy" engine. The search keeps the rerank * k
+            best candidates by approximate distance, then re-ranks them on the datapoints, which only need to
+            be read for them (e.g. memory-mapped from a .npy file); the search is then approximate.
+            Options: "float16" (half the memory), "int8" (a quarter: one code per dimension on 256 levels
+            between the minimum and the maximum of the dimension).
+        rerank : int, optional
+            With vector_storage, the number of candidates re-ranked per neighbour, by default 4.
+        builder : str, optional
+            How the tree is built, by default "recursive".
+            Options: "recursive" (node by node, depth first), "level" (breadth first without recursion: all the
+            nodes of a depth are split together, with segmented array operations over the points of the level
+            for the statistics, the dimension and split choices and the partition, so the Python work is per
+            level rather than per node; requires the "numpy" engine and the "flat" layout, and neither n_jobs
+            nor a dimension_stats other than "exact"). It gives the same trees as the recursive "numpy" build
+            for the deterministic strategies, except that a split leaving one side empty makes a leaf; the
+            random draws are made in level order.
+        collect_stats : bool, optional
+            Collect the statistics of the build and of the kNN searches, read by get_stats, by default False:
+            the time and the calls of the strategy functions and of the partitions (not those of the subtrees
+            built by worker processes with n_jobs), and the nodes visited, leaves scanned and distances
+            computed by the queries.
 
         Raises
         ------
@@ -74,14 +256,29 @@ class KDTree:
             "random": random_dim,
             "max_variance": max_variance_dim,
             "widest_interval": widest_interval_dim,
+            "top_variance": top_variance_dim,
+            "random_projection": random_projection_dim,
+            "pca": pca_dim,
         }
 
-        assert dimension_choice in switcher, "Invalid dimension_choice, choose from 'alternate', 'random', 'max_variance', 'widest_interval'"
+        assert dimension_choice in switcher, "Invalid dimension_choice, choose from 'alternate', 'random', 'max_variance', 'widest_interval', 'top_variance', 'random_projection', 'pca'"
 
         self.dimension_choice = switcher[dimension_choice]
 
         self.dim_out_plus = DIM_OUT_PLUS[dimension_choice]
 
+        self.dim_uses_datapoints = DIM_USES_DATAPOINTS[dimension_choice]
+
+        self.dim_projects = DIM_PROJECTS[dimension_choice]
+
+        self.dimension_params = dimension_params or {}
+
+        assert dimension_stats in ("exact", "incremental", "sampled"), "Invalid dimension_stats, choose from 'exact', 'incremental', 'sampled'"
+        assert dimension_stats == "exact" or engine == "numpy", "dimension_stats requires the 'numpy' engine"
+
+        self.dimension_stats = dimension_stats
+        self.stats_sample_size = stats_sample_size
+
         switcher = {
             "mean": mean_split,
             "median": median_split,
@@ -92,53 +289,163 @@ class KDTree:
         assert split_position_choice in switcher, "Invalid split_position_choice, choose from 'mean', 'median', 'random', 'geometric_center'"
 
         self.split_position_choice = switcher[split_position_choice]
-        
-        self.root = self.build(datapoints)
+
+        # the names are kept to save the index
+        self.dimension_choice_name = dimension_choice
+        self.split_position_choice_name = split_position_choice
+
+        assert engine in ("list", "numpy"), "Invalid engine, choose from 'list', 'numpy'"
+
+        self.engine = engine
+
+        assert layout in ("dict", "flat"), "Invalid layout, choose from 'dict', 'flat'"
+        assert layout == "dict" or engine == "numpy", "The 'flat' layout requires the 'numpy' engine"
+
+        self.layout = layout
+
+        assert n_jobs is None or engine == "numpy", "n_jobs requires the 'numpy' engine"
+        assert not self.dim_projects or engine == "numpy", "The projection dimension choices require the 'numpy' engine"
+        assert rotation in (None, "pca"), "Invalid rotation, choose from 'pca'"
+        assert rotation is None or engine == "numpy", "rotation requires the 'numpy' engine"
+
+        self.rotation = rotation
+        self.n_components = n_components
+        self.pca = None
+
+        assert vector_storage in (None, "float16", "int8"), "Invalid vector_storage, choose from 'float16', 'int8'"
+        assert vector_storage is None or engine == "numpy", "vector_storage requires the 'numpy' engine"
+        assert rerank >= 1, "rerank must be at least 1"
+
+        self.vector_storage = vector_storage
+        self.rerank = rerank
+        self.quantizer = None if vector_storage is None else ScalarQuantizer(vector_storage)
+        self.codes = None
+        assert parallel_backend in ("process", "thread"), "Invalid parallel_backend, choose from 'process', 'thread'"
+        assert builder in ("recursive", "level"), "Invalid builder, choose from 'recursive', 'level'"
+        assert builder == "recursive" or layout == "flat", "The 'level' builder requires the 'flat' layout"
+        assert builder == "recursive" or n_jobs is None, "n_jobs is not supported by the 'level' builder"
+        assert builder == "recursive" or dimension_stats == "exact", "dimension_stats is not supported by the 'level' builder"
+
+        self.builder = builder
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.parallel_depth = parallel_depth
+        self.parallel_size = parallel_size
+        self.parallel_backend = parallel_backend
+        self.rng = random
+        self.chunk_rows = chunk_rows
+        self.tmp_dir = tmp_dir
+        # subtrees waiting for the workers during a parallel build, as (node, start, end, depth, last_dim)
+        self._tasks = None
+        # the buffers with spare capacity behind data, perm and directions once they have grown
+        self._buffers = {}
+        self.directions = np.empty((0, k), dtype=np.float32)
+
+        # the strategies are only wrapped by timers when the statistics are collected
+        self.tree_stats = TreeStats() if collect_stats else None
+        self.dimension_choice = timed(self.tree_stats, "dimension_choice", self.dimension_choice)
+        self.split_position_choice = timed(self.tree_stats, "split_position_choice", self.split_position_choice)
+
+        with phase_timer(self.tree_stats, "build"):
+            self.root = self.build(datapoints)
+        self.n_points = len(self.data)
+        # the number of points of the tree at its last full rebuild, or more if it grew since
+        self._peak_points = self.n_points
+        # the height and the number of points of the tree at its last full rebuild, measured on the first insert
+        self._built_height = self._built_points = None
 
     def build(self, datapoints):
+        if self.engine == "numpy":
+            self.data = open_datapoints(datapoints, tmp_dir=self.tmp_dir)
+            if self.chunk_rows is None and isinstance(self.data, np.memmap):
+                self.chunk_rows = max(1, (1 << 24) // (self.data.shape[1] * self.data.itemsize))
+            if self.rotation is not None and len(self.data) > 0:
+                self.pca = PCARotation(self.n_components).fit(self.data, seed=self.rng.getrandbits(32))
+                self.data = self.pca.transform_datapoints(self.data, self.chunk_rows or 65536, self.tmp_dir)
+                self.k = self.pca.n_components
+            if self.quantizer is not None:
+                self.quantizer.fit(self.data, self.chunk_rows or 65536)
+                self.codes = self.quantizer.encode_datapoints(self.data.reshape(-1, self.k), self.chunk_rows or 65536)
+            self.directions = np.empty((0, self.k), dtype=np.float32)
+            self.perm = np.arange(len(self.data), dtype=np.int64)
+            if len(self.data) == 0:
+                if self.layout == "dict":
+                    return None
+                # the searches of an empty "flat" tree read the node arrays of a root leaf without points
+                self._init_nodes(1)
+                return self._make_leaf(0, 0, 0)
+            if self.layout == "flat":
+                self._init_nodes(4 * len(self.data) // max(self.leaf_size, 1) + 1)
+            if self.builder == "level":
+                root = self.level_build()
+                self._trim_nodes()
+                return root
+            if self.n_jobs is not None:
+                self._tasks = []
+            root = self.numpy_build(0, len(self.data), 0)
+            if self._tasks:
+                self._build_tasks()
+            self._tasks = None
+            if self.layout == "flat":
+                self._trim_nodes()
+            return root
+
+        # keep an array view of the data so that queries can index the points of a leaf by id
+        self.data = np.asarray(datapoints)
         if len(datapoints) == 0:
             return None
         return self.recursive_build(datapoints, 0)
 
-    def recursive_build(self, datapoints: list[list[float]], depth: int, last_dim: int = 0):
+    def recursive_build(self, datapoints: list[list[float]], depth: int, last_dim: int = 0, ids: list[int] = None):
+        if ids is None:
+            ids = list(range(len(datapoints)))
+
         # Stop recursion if the number of points is <= leaf_size or max_depth is reached
         if len(datapoints) <= self.leaf_size or (self.max_depth is not None and depth >= self.max_depth):
             return {
                 "depth": depth,
                 "points": datapoints,
+                "ids": np.array(ids, dtype=np.int64),
                 "leaf": True,
             }
 
-        kwargs = {"datapoints": datapoints, "nbr_dims": self.k, "last_dim": last_dim}
-        dim_result = self.dimension_choice(**kwargs)
+        kwargs = {"datapoints": datapoints, "nbr_dims": self.k, "last_dim": last_dim, "rng": self.rng}
+        dim_result = self.dimension_choice(**kwargs, **self.dimension_params)
         split_dim = dim_result["dim"]
         plus = {key: dim_result[key] for key in self.dim_out_plus}
 
-        kwargs = {"datapoints": datapoints, "dim": split_dim}
+        kwargs = {"datapoints": datapoints, "dim": split_dim, "rng": self.rng}
 
         split_result = self.split_position_choice(**kwargs, **plus)
         split_val = split_result
 
-        sorted_points = sorted(datapoints, key=lambda x: x[split_dim])
+        with phase_timer(self.tree_stats, "partition"):
+            # sort the positions rather than the points so that the ids follow their points
+            order = sorted(range(len(datapoints)), key=lambda i: datapoints[i][split_dim])
 
-        left_points = []
-        right_points = []
+            left_points = []
+            right_points = []
+            left_ids = []
+            right_ids = []
 
-        for point in sorted_points:
-            if point[split_dim] < split_val:
-                left_points.append(point)
-            else:
-                right_points.append(point)
+            for i in order:
+                if datapoints[i][split_dim] < split_val:
+                    left_points.append(datapoints[i])
+                    left_ids.append(ids[i])
+                else:
+                    right_points.append(datapoints[i])
+                    right_ids.append(ids[i])
 
-        if len(left_points) == 0:
-            left_child = None
-        else:
-            left_child = self.recursive_build(left_points, depth + 1, split_dim)
+        # a node with an empty side stays a leaf: its child would get the same points and the same choice
+        if len(left_points) == 0 or len(right_points) == 0:
+            return {
+                "depth": depth,
+                "points": datapoints,
+                "ids": np.array(ids, dtype=np.int64),
+                "leaf": True,
+            }
 
-        if len(right_points) == 0:
-            right_child = None
-        else:
-            right_child = self.recursive_build(right_points, depth + 1, split_dim)
+        left_child = self.recursive_build(left_points, depth + 1, split_dim, left_ids)
+        right_child = self.recursive_build(right_points, depth + 1, split_dim, right_ids)
 
         return {
             "split_dim": split_dim,
@@ -149,24 +456,1577 @@ class KDTree:
             "leaf": False,
         }
 
-    def compute_silhouette_score(self):
+    def numpy_build(self, start: int, end: int, depth: int, last_dim: int = 0, stats: dict = None):
+        """
+        Recursively builds the KDTree over the ids perm[start:end] ("numpy" engine).
+
+        The node's points are gathered once into an ndarray (only if the dimension choice reads them),
+        so the strategies compute their statistics over axis 0; the split position choice only gets the
+        chosen column. The ids are partitioned in place around the split value without sorting.
+        With the "incremental" dimension_stats, stats are the node's statistics derived by its parent.
+        """
+        ids = self.perm[start:end]
+
+        # Stop recursion if the number of points is <= leaf_size or max_depth is reached
+        if end - start <= self.leaf_size or (self.max_depth is not None and depth >= self.max_depth):
+            return self._make_leaf(depth, start, end)
+
+        # in a parallel build, the subtree is left as a leaf until a worker builds it
+        if self._tasks is not None and (
+            depth >= self.parallel_depth or (self.parallel_size is not None and end - start <= self.parallel_size)
+        ):
+            node = self._make_leaf(depth, start, end)
+            self._tasks.append((node, start, end, depth, last_dim))
+            return node
+
+        points = None
+        kwargs = {"nbr_dims": self.k, "last_dim": last_dim, "rng": self.rng}
+        if self.dim_projects and self.dim_uses_datapoints:
+            # a streamed node only hands an evenly spaced sample of its points to the strategy
+            step = 1 if self.chunk_rows is None else -(-len(ids) // self.chunk_rows)
+            points = self.data[ids[::step]]
+        elif self.dim_uses_datapoints and self.dimension_stats != "exact":
+            if stats is None:
+                stats = self._dimension_stats(ids)
+            kwargs["stats"] = stats
+        elif self.dim_uses_datapoints and self.chunk_rows is not None:
+            kwargs["stats"] = node_stats(self.data, ids, self.chunk_rows)
+        elif self.dim_uses_datapoints:
+            points = self.data[ids]
+        kwargs["datapoints"] = points
+
+        dim_result = self.dimension_choice(**kwargs, **self.dimension_params)
+        plus = {key: dim_result[key] for key in self.dim_out_plus}
+
+        if "direction" in dim_result:
+            # the projections are the column of a new split dimension, added once the node is split
+            split_dim = None
+            if points is not None and len(points) == len(ids):
+                column = project(points, dim_result["direction"])[:, 0]
+            else:
+                column = self._project(ids, dim_result["direction"])
+        else:
+            split_dim = dim_result["dim"]
+            column = self.data[ids, split_dim]
+        del points
+
+        kwargs = {"datapoints": column[:, None], "dim": 0, "rng": self.rng}
+
+        split_val = self.split_position_choice(**kwargs, **plus)
+        if self.layout == "flat":
+            # the split value is rounded as stored, so that the partition agrees with the queries
+            split_val = self.nodes["split_val"].dtype.type(split_val)
+
+        with phase_timer(self.tree_stats, "partition"):
+            is_left = column < split_val
+            middle = start + int(np.count_nonzero(is_left))
+            self.perm[start:end] = np.concatenate((ids[is_left], ids[~is_left]))
+
+        # a node with an empty side stays a leaf: its child would get the same points and the same choice
+        if middle == start or middle == end:
+            return self._make_leaf(depth, start, end)
+        if split_dim is None:
+            split_dim = self.k + self._append("directions", dim_result["direction"][None, :])
+
+        left_stats = right_stats = None
+        if (
+            self.dimension_stats == "incremental"
+            and self.dim_uses_datapoints
+            and not self.dim_projects
+            and start < middle < end
+            and max(middle - start, end - middle) > self.leaf_size
+            and (self.max_depth is None or depth + 1 < self.max_depth)
+        ):
+            # the statistics are computed over the smaller child only, the larger one gets the difference
+            if middle - start <= end - middle:
+                left_stats = self._dimension_stats(self.perm[start:middle])
+                right_stats = complement_stats(stats, left_stats)
+            else:
+                right_stats = self._dimension_stats(self.perm[middle:end])
+                left_stats = complement_stats(stats, right_stats)
+            # along the split dimension, the intervals are known from the column
+            left_stats["min"][split_dim] = column[is_left].min()
+            left_stats["max"][split_dim] = column[is_left].max()
+            right_stats["min"][split_dim] = column[~is_left].min()
+            right_stats["max"][split_dim] = column[~is_left].max()
+
+        # the node is created before its children so that the "flat" layout stores the nodes in pre-order
+        node = self._make_node(depth, start, end, split_dim, split_val)
+
+        left_child = self.numpy_build(start, middle, depth + 1, split_dim, left_stats)
+        right_child = self.numpy_build(middle, end, depth + 1, split_dim, right_stats)
+
+        return self._set_children(node, left_child, right_child)
+
+    def level_build(self) -> int:
+        """
+        Builds the KDTree over the ids of perm breadth first, without recursion ("level" builder).
+
+        The frontier holds the nodes of one depth, each a range of perm. The ranges of the nodes to split
+        are laid out one after the other as the segments of one array of ids, so that the statistics of the
+        dimension choice, the split values and the partitions of all of them are segmented array operations
+        over the level; the partitioned ids are written back to their ranges. The "flat" nodes are stored
+        level by level, the two children of a node next to each other.
+        """
+        chunk_rows = self.chunk_rows or max(1, (1 << 24) // (self.k * self.data.itemsize))
+        dimension_choice = timed(self.tree_stats, "dimension_choice", DIM_SEGMENTED[self.dimension_choice_name])
+        split_position_choice = timed(self.tree_stats, "split_position_choice", SPLIT_SEGMENTED[self.split_position_choice_name])
+
+        root = self._new_node()
+        self.nodes["depth"][root] = 0
+        self.nodes["start"][root] = 0
+        self.nodes["count"][root] = len(self.perm)
+        frontier = np.array([root], dtype=np.int64)
+        last_dims = np.zeros(1, dtype=np.int64)
+        depth = 0
+        while len(frontier):
+            # the nodes are leaves until they are split
+            self.nodes["split_dim"][frontier] = -1
+            self.nodes["left"][frontier] = -1
+            self.nodes["right"][frontier] = -1
+            if self.max_depth is not None and depth >= self.max_depth:
+                break
+            counts = self.nodes["count"][frontier]
+            split = counts > self.leaf_size
+            frontier, last_dims, counts = frontier[split], last_dims[split], counts[split]
+            starts = self.nodes["start"][frontier]
+            if len(frontier) == 0:
+                break
+
+            positions = gather_ranges(starts, counts)
+            ids = self.perm[positions]
+            labels = segment_labels(counts)
+
+            if dimension_choice is None:
+                dim_result = self._node_dimension_choices(ids, counts, last_dims)
+            else:
+                kwargs = {"nbr_dims": self.k, "last_dims": last_dims, "n_nodes": len(frontier), "rng": self.rng}
+                if self.dim_uses_datapoints:
+                    # the interval choice only reads the bounds, the variance ones the sums
+                    bounds = self.dimension_choice_name == "widest_interval"
+                    kwargs["stats"] = segment_stats(self.data, ids, counts, chunk_rows, sums=not bounds, bounds=bounds)
+                dim_result = dimension_choice(**kwargs, **self.dimension_params)
+            plus = {key: dim_result[key] for key in self.dim_out_plus}
+
+            if "direction" in dim_result:
+                column = np.empty(len(ids), dtype=np.float64)
+                for start in range(0, len(ids), chunk_rows):
+                    rows = self.data[ids[start : start + chunk_rows]]
+                    column[start : start + chunk_rows] = project_rows(
+                        rows, dim_result["direction"][labels[start : start + chunk_rows]]
+                    )
+            else:
+                column = self.data[ids, dim_result["dim"][labels]]
+
+            # the split values are rounded as stored, so that the partition agrees with the queries
+            split_vals = split_position_choice(column=column, counts=counts, rng=self.rng, **plus)
+            split_vals = np.asarray(split_vals).astype(self.nodes["split_val"].dtype)
+
+            with phase_timer(self.tree_stats, "partition"):
+                new_positions, n_left = segment_partition(column < split_vals[labels], counts)
+                self.perm[positions[new_positions]] = ids
+            del ids, labels, column, positions, new_positions
+
+            # a node with an empty side stays a leaf: its child would get the same points and the same choice
+            split = (n_left > 0) & (n_left < counts)
+            parents, starts, counts, n_left = frontier[split], starts[split], counts[split], n_left[split]
+            if "direction" in dim_result:
+                split_dims = self.k + self._append("directions", dim_result["direction"][split]) + np.arange(len(parents))
+            else:
+                split_dims = dim_result["dim"][split]
+
+            children = self._new_node(2 * len(parents)) + np.arange(2 * len(parents))
+            left, right = children[0::2], children[1::2]
+            self.nodes["split_dim"][parents] = split_dims
+            self.nodes["split_val"][parents] = split_vals[split]
+            self.nodes["left"][parents] = left
+            self.nodes["right"][parents] = right
+            self.nodes["depth"][children] = depth + 1
+            self.nodes["start"][left] = starts
+            self.nodes["count"][left] = n_left
+            self.nodes["start"][right] = starts + n_left
+            self.nodes["count"][right] = counts - n_left
+
+            frontier = children
+            last_dims = np.repeat(split_dims, 2)
+            depth += 1
+        return root
+
+    def _node_dimension_choices(self, ids: np.ndarray, counts: np.ndarray, last_dims: np.ndarray) -> dict:
+        """
+        Calls the dimension choice on every node of a level in turn, for the choices that have no
+        segmented version, and returns the results as arrays (the directions as rows).
+        The nodes' ids are the consecutive segments of ids, of the given counts.
+        """
+        results = []
+        for offset, count, last_dim in zip(segment_offsets(counts).tolist(), counts.tolist(), last_dims.tolist()):
+            node_ids = ids[offset : offset + count]
+            # a streamed node only hands an evenly spaced sample of its points to the strategy
+            step = 1 if self.chunk_rows is None else -(-count // self.chunk_rows)
+            points = self.data[node_ids[::step]] if self.dim_uses_datapoints else None
+            kwargs = {"datapoints": points, "nbr_dims": self.k, "last_dim": last_dim, "rng": self.rng}
+            results.append(self.dimension_choice(**kwargs, **self.dimension_params))
+        return {key: np.array([result[key] for result in results]) for key in results[0]}
+
+    def _project(self, ids: np.ndarray, direction: np.ndarray) -> np.ndarray:
+        """
+        Returns the projections of the points ids on a direction (in float64, see project), by chunks of
+        chunk_rows rows if set.
+        """
+        chunk_rows = self.chunk_rows or max(len(ids), 1)
+        column = np.empty(len(ids), dtype=np.float64)
+        for start in range(0, len(ids), chunk_rows):
+            column[start : start + chunk_rows] = project(self.data[ids[start : start + chunk_rows]], direction)[:, 0]
+        return column
+
+    def _split_coords(self, q: np.ndarray) -> list:
+        """
+        Returns the coordinates of a point along all the split dimensions: its k coordinates, then its
+        projections on the directions (see project).
+        """
+        if len(self.directions) == 0:
+            return q.tolist()
+        return np.concatenate((q, project(q, self.directions)[0])).tolist()
+
+    def _dimension_stats(self, ids: np.ndarray) -> dict:
+        """
+        Returns the statistics of the dimension choice over the ids of a node, exact or sampled as set
+        by dimension_stats.
+        """
+        chunk_rows = self.chunk_rows or max(len(ids), 1)
+        if self.dimension_stats == "sampled":
+            return sampled_node_stats(self.data, ids, self.stats_sample_size, chunk_rows, self.rng)
+        return node_stats(self.data, ids, chunk_rows)
+
+    def _make_leaf(self, depth: int, start: int, end: int):
+        """
+        Creates a leaf over perm[start:end] in the tree's layout.
+        """
+        if self.layout == "dict":
+            return {
+                "depth": depth,
+                "ids": self.perm[start:end],
+                "leaf": True,
+            }
+        node = self._new_node()
+        self.nodes["split_dim"][node] = -1
+        self.nodes["left"][node] = -1
+        self.nodes["right"][node] = -1
+        self.nodes["depth"][node] = depth
+        self.nodes["start"][node] = start
+        self.nodes["count"][node] = end - start
+        return node
+
+    def _make_node(self, depth: int, start: int, end: int, split_dim: int, split_val: float):
+        """
+        Creates an internal node over perm[start:end] in the tree's layout, without its children.
+        """
+        if self.layout == "dict":
+            return {
+                "split_dim": split_dim,
+                "split_val": split_val,
+                "left": None,
+                "right": None,
+                "depth": depth,
+                "leaf": False,
+            }
+        node = self._new_node()
+        self.nodes["split_dim"][node] = split_dim
+        self.nodes["split_val"][node] = split_val
+        self.nodes["depth"][node] = depth
+        self.nodes["start"][node] = start
+        self.nodes["count"][node] = end - start
+        return node
+
+    def _set_children(self, node, left_child, right_child):
+        """
+        Links an internal node to its children (None for an empty side) and returns it.
+        """
+        if self.layout == "dict":
+            node["left"] = left_child
+            node["right"] = right_child
+            return node
+        self.nodes["left"][node] = -1 if left_child is None else left_child
+        self.nodes["right"][node] = -1 if right_child is None else right_child
+        return node
+
+    def _init_nodes(self, capacity: int):
+        """
+        Allocates the node arrays of the "flat" layout.
+        """
+        self.n_nodes = 0
+        self.nodes = {
+            "split_dim": np.empty(capacity, dtype=np.int32),
+            "split_val": np.zeros(capacity, dtype=np.float32),
+            "left": np.empty(capacity, dtype=np.int32),
+            "right": np.empty(capacity, dtype=np.int32),
+            "depth": np.empty(capacity, dtype=np.int32),
+            "start": np.empty(capacity, dtype=np.int64),
+            "count": np.empty(capacity, dtype=np.int64),
+        }
+
+    def _new_node(self, count: int = 1) -> int:
+        """
+        Returns the id of the first of count new consecutive nodes of the "flat" layout,
+        doubling the arrays until they fit.
+        """
+        capacity = len(self.nodes["depth"])
+        if self.n_nodes + count > capacity:
+            new_capacity = 2 * capacity
+            while self.n_nodes + count > new_capacity:
+                new_capacity *= 2
+            for key, values in self.nodes.items():
+                grown = np.zeros(new_capacity, dtype=values.dtype)
+                grown[:capacity] = values
+                self.nodes[key] = grown
+        self.n_nodes += count
+        return self.n_nodes - count
+
+    def _build_tasks(self):
+        """
+        Builds the subtrees left in self._tasks with n_jobs workers and stitches them into the tree.
+
+        Every worker builds its subtree in the "flat" layout over a copy of its slice of perm; the
+        partitioned slice is written back and the subtree replaces its placeholder leaf.
+        """
+        tasks, self._tasks = self._tasks, None
+
+        # the seeds are drawn in subtree order, so the tree does not depend on the number of workers
+        seeds = [self.rng.getrandbits(64) for _ in tasks]
+        args = [
+            (self.perm[start:end].copy(), depth, last_dim, seed)
+            for (_, start, end, depth, last_dim), seed in zip(tasks, seeds)
+        ]
+
+        # the workers get a copy of the tree without its data and nodes
+        template = copy.copy(self)
+        template.data = template.perm = template.root = template.nodes = template.rng = template.codes = None
+        template.layout = "flat"
+
+        if self.n_jobs == 1 or self.parallel_backend == "thread":
+            template.data = self.data
+            if self.n_jobs == 1:
+                results = [_build_subtree(template, *task) for task in args]
+            else:
+                with ThreadPoolExecutor(self.n_jobs) as pool:
+                    results = list(pool.map(lambda task: _build_subtree(template, *task), args))
+        elif memmap_location(self.data) is not None:
+            # memory-mapped datapoints are mapped again by the workers rather than copied
+            source = ("memmap", *memmap_location(self.data), self.data.shape, self.data.dtype)
+            with ProcessPoolExecutor(self.n_jobs) as pool:
+                results = list(pool.map(_build_shared_subtree, repeat((template, source)), args))
+        else:
+            shm = SharedMemory(create=True, size=max(self.data.nbytes, 1))
+            try:
+                np.ndarray(self.data.shape, dtype=self.data.dtype, buffer=shm.buf)[...] = self.data
+                source = ("shm", shm.name, 0, self.data.shape, self.data.dtype)
+                with ProcessPoolExecutor(self.n_jobs) as pool:
+                    results = list(pool.map(_build_shared_subtree, repeat((template, source)), args))
+            finally:
+                shm.close()
+                shm.unlink()
+
+        for (node, start, end, _, _), (perm, nodes, directions) in zip(tasks, results):
+            self.perm[start:end] = perm
+            if len(directions):
+                # the split dimensions of the subtree's projections index its own directions
+                offset = self._append("directions", directions)
+                nodes["split_dim"] = np.where(nodes["split_dim"] >= self.k, nodes["split_dim"] + offset, nodes["split_dim"])
+            self._attach_subtree(node, nodes, start)
+
+    def _attach_subtree(self, node, nodes: dict, offset: int):
+        """
+        Replaces the placeholder leaf node by a subtree built in the "flat" layout over perm[offset:].
+        """
+        if self.layout == "dict":
+            # update the dict in place so that its parent keeps pointing to it
+            node.clear()
+            node.update(self._flat_to_dict(nodes, 0, offset))
+            return
+
+        # the subtree root takes the place of the leaf, the other nodes are appended in order
+        count = len(nodes["depth"])
+        new_ids = np.empty(count, dtype=np.int64)
+        new_ids[0] = node
+        if count > 1:
+            new_ids[1:] = np.arange(self._new_node(count - 1), self.n_nodes)
+        for key, values in nodes.items():
+            if key in ("left", "right"):
+                values = np.where(values >= 0, new_ids[values], -1)
+            elif key == "start":
+                values = values + offset
+            self.nodes[key][new_ids] = values
+
+    def _flat_to_dict(self, nodes: dict, node: int, offset: int) -> dict:
+        """
+        Converts the subtree rooted at node of "flat" arrays over perm[offset:] to the "dict" layout.
+        """
+        depth = int(nodes["depth"][node])
+        if nodes["split_dim"][node] < 0:
+            start = offset + int(nodes["start"][node])
+            return {
+                "depth": depth,
+                "ids": self.perm[start : start + int(nodes["count"][node])],
+                "leaf": True,
+            }
+        left, right = nodes["left"][node], nodes["right"][node]
+        return {
+            "split_dim": int(nodes["split_dim"][node]),
+            "split_val": nodes["split_val"][node],
+            "left": None if left < 0 else self._flat_to_dict(nodes, left, offset),
+            "right": None if right < 0 else self._flat_to_dict(nodes, right, offset),
+            "depth": depth,
+            "leaf": False,
+        }
+
+    def _trim_nodes(self):
+        """
+        Shrinks the node arrays of the "flat" layout to the number of nodes, in place
+        (no view of them is alive at the end of the build).
+        """
+        for values in self.nodes.values():
+            values.resize((self.n_nodes,) + values.shape[1:], refcheck=False)
+
+    def save(self, path: str):
+        """
+        Saves the tree to an index file: its parameters, the node arrays, the id permutation and the datapoints
+        (in id order), in the binary format of index_file.py.
+
+        Parameters
+        ----------
+        path : str
+            The file to write.
+        """
+        assert self.layout == "flat" and self.root is not None, "Only a non-empty tree with the 'flat' layout can be saved"
+
+        if len(self.perm) != self.n_points:
+            self._compact()
+
+        params = {
+            "k": self.k,
+            "dimension_choice": self.dimension_choice_name,
+            "split_position_choice": self.split_position_choice_name,
+            "leaf_size": self.leaf_size,
+            "max_depth": self.max_depth,
+            "engine": self.engine,
+            "layout": self.layout,
+            "dimension_params": self.dimension_params,
+            "dimension_stats": self.dimension_stats,
+            "stats_sample_size": self.stats_sample_size,
+            "rotation": self.rotation,
+            "n_components": self.n_components,
+            "vector_storage": self.vector_storage,
+            "rerank": self.rerank,
+            "builder": self.builder,
+        }
+        arrays = {"data": self.data, "perm": self.perm, "directions": self.directions, **self.nodes}
+        if self.pca is not None:
+            arrays.update(pca_mean=self.pca.mean, pca_components=self.pca.components)
+        if self.quantizer is not None:
+            arrays["codes"] = self.codes
+            if self.quantizer.kind == "int8":
+                arrays.update(quantizer_low=self.quantizer.low, quantizer_scale=self.quantizer.scale)
+        write_index(path, "kd", params, arrays)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "KDTree":
+        """
+        Loads a tree saved by save.
+
+        Parameters
+        ----------
+        path : str
+            The index file.
+        mmap : bool, optional
+            Map the file rather than reading it, by default True. The arrays of the tree are then read-only
+            views of the file, so loading takes no time and the queries read the nodes and the points from
+            the page cache.
+
+        Returns
+        -------
+        KDTree
+            The loaded tree.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a KDTree index of the current format version.
+        """
+        kind, params, arrays = read_index(path, mmap)
+        if kind != "kd":
+            raise ValueError(f"{path} holds a '{kind}' index, not a KDTree")
+
+        k = params.pop("k")
+        tree = cls(k, np.empty((0, k), dtype=arrays["data"].dtype), **params)
+        tree.data = arrays.pop("data")
+        tree.perm = arrays.pop("perm")
+        # files written before the projection splits have no directions
+        tree.directions = arrays.pop("directions", np.empty((0, k), dtype=np.float32))
+        if "pca_components" in arrays:
+            tree.pca = PCARotation(mean=arrays.pop("pca_mean"), components=arrays.pop("pca_components"))
+        if "codes" in arrays:
+            tree.codes = arrays.pop("codes")
+            tree.quantizer = ScalarQuantizer(tree.vector_storage, arrays.pop("quantizer_low", None), arrays.pop("quantizer_scale", None))
+        tree.nodes = arrays
+        tree.n_nodes = len(arrays["depth"])
+        tree.root = 0
+        tree.n_points = tree._peak_points = len(tree.perm)
+        return tree
+
+    def insert(self, points: list[list[float]], alpha: float = 0.75) -> np.ndarray:
+        """
+        Inserts points into the tree without rebuilding it.
+
+        Every point is appended to the datapoints and descends to the leaf on its side of the splitting
+        hyperplanes (a missing child becomes a new leaf); a leaf that grows past leaf_size is split with the
+        tree's strategies. When a point lands deeper than c * log(n_points), the subtree of its deepest
+        ancestor that is taller than c * log(its number of points) is rebuilt, as in a scapegoat tree: the depth
+        stays logarithmic for an amortised O(log n) rebuild cost. c is 1 / log(1 / alpha), or the height to
+        log(n_points) ratio of the last full build if the strategies build taller trees (e.g. random splits),
+        so that the rebuilt subtrees do not trigger new rebuilds.
+
+        Parameters
+        ----------
+        points : list[list[float]]
+            The points to insert.
+        alpha : float, optional
+            The balance threshold, between 0.5 (rebuild often, keep the tree balanced) and 1 (never rebuild),
+            by default 0.75.
+
+        Returns
+        -------
+        np.ndarray
+            The ids of the inserted points (their row indices in data).
+        """
+        assert 0.5 <= alpha <= 1, "alpha must be between 0.5 and 1"
+
+        points = np.asarray(points, dtype=self.data.dtype)
+        if self.pca is not None:
+            points = self.pca.transform(points)
+        points = points.reshape(-1, self.k)
+        self._make_writable()
+        if self.root is None:
+            if self.layout == "flat":
+                self._init_nodes(1)
+            self.root = self._empty_leaf(0)
+
+        factor = self._height_factor(alpha)
+        if self.quantizer is not None:
+            if len(self.codes) == 0:
+                # a tree built without points fits the codes on the first inserted ones
+                self.quantizer.fit(points)
+            self._append("codes", self.quantizer.encode(points))
+        start = self._append("data", points)
+        ids = np.arange(start, start + len(points), dtype=np.int64)
+        for i in ids.tolist():
+            self.n_points += 1
+            self._insert_point(i, factor)
+
+        self._peak_points = max(self._peak_points, self.n_points)
+        self._compact_if_sparse()
+        return ids
+
+    def delete(self, ids: list[int], alpha: float = 0.75):
+        """
+        Removes points from the tree. Their rows stay in data, so the ids of the other points do not change,
+        but the queries no longer return them. Once the tree holds fewer than alpha times the points it had
+        at its last full rebuild, it is rebuilt (as a scapegoat tree), which also drops the emptied leaves.
+
+        Parameters
+        ----------
+        ids : list[int]
+            The ids of the points to remove.
+        alpha : float, optional
+            The balance threshold, see insert, by default 0.75.
+
+        Raises
+        ------
+        ValueError
+            If a point is not in the tree (the points before it are removed).
+        """
+        assert 0.5 <= alpha <= 1, "alpha must be between 0.5 and 1"
+
+        self._make_writable()
+        for i in np.asarray(ids, dtype=np.int64).ravel().tolist():
+            path = self._find_leaf(i) if self.root is not None and 0 <= i < len(self.data) else None
+            if path is None:
+                raise ValueError(f"Point {i} is not in the tree")
+            self._leaf_remove(path[-1], i)
+            if self.layout == "flat":
+                self.nodes["count"][path[:-1]] -= 1
+            self.n_points -= 1
+
+        if self.n_points < alpha * self._peak_points:
+            self._rebuild(self.root, 0, 0)
+            self._peak_points = self.n_points
+            self._built_height = None
+        self._compact_if_sparse()
+
+    def _insert_point(self, i: int, factor: float):
+        """
+        Adds the datapoint i to the leaf on its side of the splits, then splits the leaf or rebuilds the
+        subtree of a scapegoat if needed (see insert).
+        """
+        point = self._split_coords(self.data[i])
+        path = [self.root]
+        while True:
+            branch = self._branch(path[-1])
+            if branch is None:
+                break
+            dim, split_val, left, right = branch
+            go_left = point[dim] < split_val
+            child = left if go_left else right
+            if child is None:
+                # the side was empty at build time
+                child = self._empty_leaf(self._depth(path[-1]) + 1)
+                self._set_children(path[-1], child if go_left else left, right if go_left else child)
+            path.append(child)
+
+        leaf = path[-1]
+        if self.layout == "flat":
+            self.nodes["count"][path[:-1]] += 1
+        self._leaf_add(leaf, i)
+
+        depth = self._depth(leaf)
+        last_dim = self._branch(path[-2])[0] if len(path) > 1 else 0
+        if len(self._leaf_ids(leaf)) > self.leaf_size and (self.max_depth is None or depth < self.max_depth):
+            self._rebuild(leaf, depth, last_dim)
+
+        if depth <= factor * np.log(self.n_points):
+            return
+
+        # walk up to the deepest ancestor whose subtree is too tall for its number of points
+        size = self._subtree_size(leaf)
+        for level in range(len(path) - 2, -1, -1):
+            _, _, left, right = self._branch(path[level])
+            # dict nodes are compared by identity, not by content
+            on_left = path[level + 1] is left if self.layout == "dict" else path[level + 1] == left
+            sibling = right if on_left else left
+            size += 0 if sibling is None else self._subtree_size(sibling)
+            if depth - self._depth(path[level]) > factor * np.log(size):
+                last_dim = self._branch(path[level - 1])[0] if level > 0 else 0
+                self._rebuild(path[level], self._depth(path[level]), last_dim)
+                return
+
+    def _height_factor(self, alpha: float) -> float:
+        """
+        Returns the factor c of the height bound c * log(n) of the partial rebuilds (see insert).
+        """
+        if alpha == 1:
+            return np.inf
+        if self._built_height is None:
+            self._built_height = max((depth for _, depth, _ in self._leaves()), default=0)
+            self._built_points = self.n_points
+        factor = 1 / np.log(1 / alpha)
+        if self._built_points > 1:
+            factor = max(factor, self._built_height / np.log(self._built_points))
+        return factor
+
+    def _find_leaf(self, i: int):
+        """
+        Returns the path of nodes from the root to the leaf holding the id i, None if no leaf holds it.
+        A point equal to a split value is looked for on both sides (the "flat" layout rounds the split
+        values to float32).
+        """
+        point = self._split_coords(self.data[i])
+        stack = [[self.root]]
+        while stack:
+            path = stack.pop()
+            branch = self._branch(path[-1])
+            if branch is None:
+                if np.any(self._leaf_ids(path[-1]) == i):
+                    return path
+                continue
+            dim, split_val, left, right = branch
+            if right is not None and point[dim] >= split_val:
+                stack.append(path + [right])
+            if left is not None and point[dim] <= split_val:
+                stack.append(path + [left])
+        return None
+
+    def _branch(self, node):
+        """
+        Returns the (split_dim, split_val, left, right) of an internal node, with None for a missing child,
+        or None for a leaf.
+        """
+        if self.layout == "dict":
+            if node["leaf"]:
+                return None
+            return node["split_dim"], node["split_val"], node["left"], node["right"]
+        dim = int(self.nodes["split_dim"][node])
+        if dim < 0:
+            return None
+        left, right = int(self.nodes["left"][node]), int(self.nodes["right"][node])
+        return dim, self.nodes["split_val"][node], None if left < 0 else left, None if right < 0 else right
+
+    def _depth(self, node) -> int:
+        """
+        Returns the depth of a node.
+        """
+        if self.layout == "flat":
+            return int(self.nodes["depth"][node])
+        return node["depth"]
+
+    def _subtree_size(self, node) -> int:
+        """
+        Returns the number of points under a node (kept in "count" with the "flat" layout).
+        """
+        if self.layout == "flat":
+            return int(self.nodes["count"][node])
+        return sum(len(ids) for ids, _, _ in self._leaves(node))
+
+    def _empty_leaf(self, depth: int):
+        """
+        Creates a leaf without points.
+        """
+        if self.engine == "list":
+            return {"depth": depth, "points": [], "ids": np.empty(0, dtype=np.int64), "leaf": True}
+        return self._make_leaf(depth, len(self.perm), len(self.perm))
+
+    def _leaf_add(self, node, i: int):
+        """
+        Adds the id i to a leaf. With the "flat" layout, a leaf that does not end perm is moved to its end
+        (its old slots are reclaimed by _compact).
+        """
+        if self.layout == "dict":
+            node["ids"] = np.append(node["ids"], i)
+            if self.engine == "list":
+                node["points"] = [*node["points"], self.data[i].tolist()]
+            return
+        start, count = int(self.nodes["start"][node]), int(self.nodes["count"][node])
+        if start + count != len(self.perm):
+            start = self._append("perm", self.perm[start : start + count].copy())
+            self.nodes["start"][node] = start
+        self._append("perm", [i])
+        self.nodes["count"][node] = count + 1
+
+    def _leaf_remove(self, node, i: int):
+        """
+        Removes the id i from a leaf holding it. With the "flat" layout, the last id of the leaf takes its slot.
+        """
+        if self.layout == "dict":
+            keep = node["ids"] != i
+            node["ids"] = node["ids"][keep]
+            if self.engine == "list":
+                node["points"] = [point for point, kept in zip(node["points"], keep.tolist()) if kept]
+            return
+        start, count = int(self.nodes["start"][node]), int(self.nodes["count"][node])
+        position = start + int(np.flatnonzero(self.perm[start : start + count] == i)[0])
+        self.perm[position] = self.perm[start + count - 1]
+        self.nodes["count"][node] = count - 1
+
+    def _rebuild(self, node, depth: int, last_dim: int):
+        """
+        Rebuilds the subtree of a node over its current points with the tree's strategies. The new subtree
+        takes the place of the node, so its parent keeps pointing to it.
+        """
+        ids = np.concatenate([ids for ids, _, _ in self._leaves(node)])
+        if self.engine == "list":
+            subtree = self.recursive_build(self.data[ids].tolist(), depth, last_dim, ids.tolist())
+        else:
+            start = self._append("perm", ids)
+            subtree = self.numpy_build(start, start + len(ids), depth, last_dim)
+
+        if self.layout == "dict":
+            node.clear()
+            node.update(subtree)
+        else:
+            for values in self.nodes.values():
+                values[node] = values[subtree]
+
+    def _append(self, name: str, values) -> int:
+        """
+        Appends values to the data or perm array and returns the index of the first one. The array is a prefix
+        of a buffer whose capacity doubles when it is full, so that appends take amortised constant time; a
+        read-only or memory-mapped array is copied to memory on the first append.
+        """
+        array = getattr(self, name)
+        size = len(array)
+        buffer = self._buffers.get(name)
+        if buffer is None or array.base is not buffer or size + len(values) > len(buffer):
+            buffer = np.empty((max(2 * size, size + len(values), 16),) + array.shape[1:], dtype=array.dtype)
+            buffer[:size] = array
+            self._buffers[name] = buffer
+        buffer[size : size + len(values)] = values
+        setattr(self, name, buffer[: size + len(values)])
+        return size
+
+    def _make_writable(self):
+        """
+        Copies the arrays of a loaded (read-only) tree to memory before they are updated.
+        """
+        if self.data.ndim == 1:
+            # a tree built from an empty list
+            self.data = self.data.reshape(-1, self.k)
+        if self.engine == "numpy" and not self.perm.flags.writeable:
+            self.perm = np.array(self.perm)
+        if self.layout == "flat" and self.root is not None and not self.nodes["depth"].flags.writeable:
+            self.nodes = {key: np.array(values) for key, values in self.nodes.items()}
+
+    def _compact_if_sparse(self):
+        """
+        Compacts perm and the nodes once the slots left behind by the updates outnumber the points.
+        """
+        if self.engine == "numpy" and len(self.perm) > 2 * self.n_points + self.leaf_size:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites perm with the ids of the leaves from left to right, as after a build, and with the "flat"
+        layout the node arrays in pre-order without the nodes dropped by partial rebuilds.
+        """
+        if self.root is None:
+            return
+        if self.layout == "dict":
+            leaves = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                if node["leaf"]:
+                    leaves.append(node)
+                    continue
+                stack.extend(child for child in (node["right"], node["left"]) if child is not None)
+            self.perm = np.concatenate([leaf["ids"] for leaf in leaves])
+            start = 0
+            for leaf in leaves:
+                leaf["ids"] = self.perm[start : start + len(leaf["ids"])]
+                start += len(leaf["ids"])
+            return
+
+        order = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if self.nodes["split_dim"][node] >= 0:
+                stack.extend(child for child in (self.nodes["right"][node], self.nodes["left"][node]) if child >= 0)
+        order = np.array(order, dtype=np.int64)
+        new_ids = np.full(self.n_nodes, -1, dtype=np.int64)
+        new_ids[order] = np.arange(len(order))
+
+        nodes = {key: values[order] for key, values in self.nodes.items()}
+        for key in ("left", "right"):
+            nodes[key] = np.where(nodes[key] >= 0, new_ids[nodes[key]], -1).astype(np.int32)
+
+        # the directions of the nodes dropped by partial rebuilds are dropped too
+        projected = nodes["split_dim"] >= self.k
+        used, inverse = np.unique(nodes["split_dim"][projected] - self.k, return_inverse=True)
+        self.directions = self.directions[used]
+        nodes["split_dim"][projected] = self.k + inverse
+
+        # in pre-order the leaves are in left to right order
+        leaves = np.flatnonzero(nodes["split_dim"] < 0)
+        counts = nodes["count"][leaves]
+        self.perm = np.concatenate(
+            [self.perm[start : start + count] for start, count in zip(nodes["start"][leaves].tolist(), counts.tolist())]
+        )
+        nodes["start"][leaves] = np.cumsum(counts) - counts
+
+        # and the children come after their parent, so the internal ranges are computed backwards
+        for node in range(len(order) - 1, -1, -1):
+            if nodes["split_dim"][node] < 0:
+                continue
+            children = [child for child in (nodes["left"][node], nodes["right"][node]) if child >= 0]
+            nodes["start"][node] = nodes["start"][children[0]] if children else 0
+            nodes["count"][node] = sum(nodes["count"][child] for child in children)
+
+        self.nodes = nodes
+        self.n_nodes = len(order)
+        self.root = 0
+
+    def query(
+        self,
+        q: list[float],
+        k: int = 1,
+        return_visited: bool = False,
+        max_checks: int = None,
+        max_leaves: int = None,
+    ):
+        """
+        Finds the k nearest neighbours of a query point (exact search).
+
+        The tree is descended towards the side of each splitting hyperplane that contains the query,
+        then backtracked; a subtree is pruned when its distance to the hyperplane is larger than the
+        current k-th best distance.
+
+        Parameters
+        ----------
+        q : list[float]
+            The query point.
+        k : int, optional
+            The number of neighbours to return, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by the search, by default False.
+        max_checks : int, optional
+            Approximate search: stop once this many points have been compared to the query, by default None.
+        max_leaves : int, optional
+            Approximate search: stop once this many leaves have been checked, by default None.
+            With either budget, the tree is searched best-bin-first (see _bbf).
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The Euclidean distances (ascending) and the ids (row indices in the datapoints) of the
+            neighbours. Fewer than k are returned if the tree holds fewer than k points.
+        """
+        q = np.asarray(q, dtype=self.data.dtype)
+        if self.pca is not None:
+            q = self.pca.transform(q)
+
+        distances, ids, nodes_visited = self._query_point(q, self._split_coords(q), k, max_checks, max_leaves)
+
+        if return_visited:
+            return distances, ids, nodes_visited
+        return distances, ids
+
+    def _query_point(self, q: np.ndarray, coords: list, k: int, max_checks: int = None, max_leaves: int = None):
+        """
+        Searches the k nearest neighbours of a (rotated) query point whose coordinates along the split
+        dimensions are coords. Returns their distances and ids and the number of nodes visited.
+        """
+        if k <= 0:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64), 0
+        # with compressed vectors, more candidates are kept for the re-ranking
+        n_candidates = k if self.quantizer is None else k * self.rerank
+        if max_checks is not None or max_leaves is not None:
+            heap, nodes_visited = self._bbf(q, n_candidates, [self], max_checks, max_leaves)
+        elif self.layout == "flat":
+            heap, nodes_visited = self._knn_flat(q, coords, n_candidates)
+        else:
+            heap, nodes_visited = self._knn_dict(q, coords, n_candidates)
+        if self.quantizer is not None:
+            heap = self._rerank(heap, q, k)
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(n_queries=1, nodes_visited=nodes_visited)
+
+        distances, ids = self._sorted_neighbours(heap)
+        return distances, ids, nodes_visited
+
+    def _knn_dict(self, q: np.ndarray, coords: list, k: int):
+        """
+        Branch-and-bound kNN search on the "dict" layout. Returns the heap of the best candidates
+        as (-squared distance, id) and the number of nodes visited.
+        """
+        # max-heap of the best candidates, stored as (-squared distance, id)
+        heap = []
+        nodes_visited = 0
+
+        # stack of (node, lower bound of the squared distance from q to any point of the node)
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if node is None:
+                continue
+            if len(heap) == k and bound > -heap[0][0]:
+                continue
+            nodes_visited += 1
+
+            if node["leaf"]:
+                ids = node["ids"]
+                self._push_candidates(heap, k, self._leaf_distances(ids, q), ids)
+                continue
+
+            diff = coords[node["split_dim"]] - float(node["split_val"])
+            if diff < 0:
+                near, far = node["left"], node["right"]
+            else:
+                near, far = node["right"], node["left"]
+
+            # the near child is pushed last so that it is explored first
+            stack.append((far, max(bound, diff * diff)))
+            stack.append((near, bound))
+
+        return heap, nodes_visited
+
+    def _knn_flat(self, q: np.ndarray, coords: list, k: int):
+        """
+        Branch-and-bound kNN search reading the node arrays of the "flat" layout.
+        """
+        # memoryviews read the arrays without copying and return Python scalars, which are much
+        # cheaper to compare than NumPy scalars in this per-node loop
+        split_dim = memoryview(self.nodes["split_dim"])
+        split_val = memoryview(self.nodes["split_val"])
+        left = memoryview(self.nodes["left"])
+        right = memoryview(self.nodes["right"])
+        start = memoryview(self.nodes["start"])
+        count = memoryview(self.nodes["count"])
+
+        heap = []
+        nodes_visited = 0
+
+        stack = [(self.root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(heap) == k and bound > -heap[0][0]:
+                continue
+            nodes_visited += 1
+
+            dim = split_dim[node]
+            if dim < 0:
+                ids = self.perm[start[node] : start[node] + count[node]]
+                self._push_candidates(heap, k, self._leaf_distances(ids, q), ids)
+                continue
+
+            diff = coords[dim] - split_val[node]
+            if diff < 0:
+                near, far = left[node], right[node]
+            else:
+                near, far = right[node], left[node]
+
+            if far >= 0:
+                stack.append((far, max(bound, diff * diff)))
+            if near >= 0:
+                stack.append((near, bound))
+
+        return heap, nodes_visited
+
+    def _bbf(self, q: np.ndarray, k: int, trees: list, max_checks: int = None, max_leaves: int = None):
+        """
+        Best-bin-first kNN search over one or several trees built on the same datapoints (a forest).
+
+        Every descent goes to the leaf on the query's side of the splitting hyperplanes; the branches not
+        taken are kept in one priority queue, shared by all the trees, ordered by the lower bound of their
+        squared distance to the query, and the closest one is descended next. The search is exact when the
+        queue runs out of branches that can improve the k best candidates; it stops earlier once k
+        candidates have been found and max_checks points or max_leaves leaves have been checked.
+        Returns the heap of the best candidates as (-squared distance, id) and the number of nodes visited.
+        """
+        # the coordinates of q along the split dimensions of every tree
+        coords = [tree._split_coords(q) for tree in trees]
+        heap = []
+        # a point is only compared once, even if several trees lead to it
+        seen = set() if len(trees) > 1 else None
+        nodes_visited = checks = leaves = 0
+
+        branches = [tree._branch_reader() for tree in trees]
+
+        # min-heap of (lower bound, insertion order, tree, node)
+        queue = [(0.0, t, t, tree.root) for t, tree in enumerate(trees) if tree.root is not None]
+        order = len(queue)
+        while queue:
+            bound, _, t, node = heapq.heappop(queue)
+            if len(heap) == k and bound > -heap[0][0]:
+                break
+            tree = trees[t]
+
+            while node is not None:
+                nodes_visited += 1
+                branch = branches[t](node)
+                if branch is None:
+                    break
+                dim, split_val, left, right = branch
+                diff = coords[t][dim] - split_val
+                near, far = (left, right) if diff < 0 else (right, left)
+                if far is not None:
+                    heapq.heappush(queue, (max(bound, diff * diff), order, t, far))
+                    order += 1
+                node = near
+            if node is None:
+                continue
+
+            ids = tree._leaf_ids(node)
+            if seen is not None:
+                fresh = [i for i in ids.tolist() if i not in seen]
+                seen.update(fresh)
+                ids = np.array(fresh, dtype=np.int64)
+            self._push_candidates(heap, k, self._leaf_distances(ids, q), ids)
+            checks += len(ids)
+            leaves += 1
+
+            if len(heap) == k and (
+                (max_checks is not None and checks >= max_checks) or (max_leaves is not None and leaves >= max_leaves)
+            ):
+                break
+
+        return heap, nodes_visited
+
+    def _branch_reader(self):
+        """
+        Returns a function giving the (split_dim, split_val, left, right) of an internal node, with None
+        for a missing child, or None for a leaf.
+        """
+        if self.layout == "dict":
+            return lambda node: None if node["leaf"] else (
+                node["split_dim"], float(node["split_val"]), node["left"], node["right"]
+            )
+
+        # memoryviews return Python scalars, see _knn_flat
+        split_dim = memoryview(self.nodes["split_dim"])
+        split_val = memoryview(self.nodes["split_val"])
+        left = memoryview(self.nodes["left"])
+        right = memoryview(self.nodes["right"])
+
+        def branch(node):
+            dim = split_dim[node]
+            if dim < 0:
+                return None
+            return (
+                dim,
+                split_val[node],
+                None if left[node] < 0 else left[node],
+                None if right[node] < 0 else right[node],
+            )
+
+        return branch
+
+    def _leaf_ids(self, node) -> np.ndarray:
+        """
+        Returns the ids of the points of a leaf.
+        """
+        if self.layout == "flat":
+            start = self.nodes["start"][node]
+            return self.perm[start : start + self.nodes["count"][node]]
+        return node["ids"]
+
+    def _leaf_distances(self, ids: np.ndarray, q: np.ndarray) -> np.ndarray:
+        """
+        Returns the squared distances from q to the points ids, approximate ones on the codes with a quantizer.
+        """
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(leaves_scanned=1, distance_evaluations=len(ids))
+        if self.quantizer is None:
+            return ((self.data[ids] - q) ** 2).sum(axis=1)
+        return self.quantizer.distances(self.codes[ids], q)
+
+    def _rerank(self, heap: list, q: np.ndarray, k: int) -> list:
+        """
+        Returns the heap of the k best candidates of a heap by their exact distances to q, computed on the
+        datapoints (read in id order, which is sequential on a memory-mapped file).
+        """
+        ids = np.sort(np.array([i for _, i in heap], dtype=np.int64))
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(distance_evaluations=len(ids))
+        best = []
+        self._push_candidates(best, k, ((self.data[ids] - q) ** 2).sum(axis=1), ids)
+        return best
+
+    @staticmethod
+    def _sorted_neighbours(heap: list):
+        """
+        Returns the distances (ascending) and the ids of the candidates of a (-squared distance, id) heap.
+        """
+        best = sorted((-neg_dist, i) for neg_dist, i in heap)
+        distances = np.sqrt(np.array([dist for dist, _ in best], dtype=np.float64))
+        ids = np.array([i for _, i in best], dtype=np.int64)
+        return distances, ids
+
+    @staticmethod
+    def _push_candidates(heap: list, k: int, dists: np.ndarray, ids: np.ndarray):
+        """
+        Merges the squared distances of a leaf's points into the max-heap of the k best candidates.
+        """
+        if len(heap) == k:
+            closer = dists < -heap[0][0]
+            dists, ids = dists[closer], ids[closer]
+        for dist, i in zip(dists.tolist(), ids.tolist()):
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist, i))
+            elif dist < -heap[0][0]:
+                heapq.heapreplace(heap, (-dist, i))
+
+    def query_batch(
+        self,
+        Q: list[list[float]],
+        k: int = 1,
+        return_visited: bool = False,
+        max_checks: int = None,
+        max_leaves: int = None,
+        n_threads: int = None,
+        block_size: int = 256,
+    ):
+        """
+        Finds the k nearest neighbours of every query point.
+
+        The queries are split into blocks of at most block_size, searched by a pool of n_threads threads.
+        With the "flat" layout, an exact search (no budget) and no vector_storage, every block is searched
+        at once (see _knn_block): the queries are routed through the tree level by level as arrays, and the
+        queries that reach the same leaf are compared with its points in one matrix product. NumPy releases
+        the GIL for this work, so the threads run in parallel. Otherwise the queries of a block are
+        searched one by one, and the threads mostly wait for the GIL.
+
+        Parameters
+        ----------
+        Q : list[list[float]]
+            The query points.
+        k : int, optional
+            The number of neighbours to return per query, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by each query, by default False.
+        max_checks, max_leaves : int, optional
+            The budget of an approximate search, see query.
+        n_threads : int, optional
+            The number of threads, by default None (the calling thread only); -1 uses all the CPU cores.
+        block_size : int, optional
+            The maximum number of queries searched together, by default 256.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            Arrays of shape (len(Q), k) with the distances and the ids of the neighbours of each query.
+        """
+        k = min(k, self.n_points)
+        distances = np.empty((len(Q), k), dtype=np.float64)
+        ids = np.empty((len(Q), k), dtype=np.int64)
+        visited = np.zeros(len(Q), dtype=np.int64)
+
+        # the rotation and the projections on the split directions are computed once for all the queries
+        Q = np.asarray(Q, dtype=self.data.dtype)
+        if self.pca is not None and len(Q):
+            Q = self.pca.transform(Q)
+        coords = np.hstack((Q, project(Q, self.directions))) if len(self.directions) and len(Q) else Q
+
+        batched = (
+            self.layout == "flat"
+            and max_checks is None
+            and max_leaves is None
+            and self.quantizer is None
+            and self.root is not None
+            and k > 0
+        )
+
+        def search(rows: range):
+            if batched:
+                distances[rows], ids[rows], visited[rows] = self._knn_block(Q[rows], coords[rows], k)
+                return
+            for row in rows:
+                distances[row], ids[row], visited[row] = self._query_point(
+                    Q[row], coords[row].tolist(), k, max_checks, max_leaves
+                )
+
+        n_threads = os.cpu_count() if n_threads == -1 else n_threads or 1
+        # at least one block per thread
+        size = max(1, min(block_size, -(-len(Q) // n_threads)))
+        blocks = [range(start, min(start + size, len(Q))) for start in range(0, len(Q), size)]
+        if n_threads == 1:
+            for rows in blocks:
+                search(rows)
+        else:
+            with ThreadPoolExecutor(n_threads) as pool:
+                list(pool.map(search, blocks))
+
+        if return_visited:
+            return distances, ids, visited
+        return distances, ids
+
+    def _knn_block(self, Q: np.ndarray, coords: np.ndarray, k: int):
+        """
+        Exact kNN search of a block of (rotated) queries on the "flat" layout, whose coordinates along the
+        split dimensions are the rows of coords.
+
+        Every query first goes down its side of the splits to the deepest node that still holds 4k points, its
+        anchor, whose points give it k candidates and so an upper bound of its k-th distance (a few times k
+        points tighten the bound for little work). Then all the queries descend from the root again, keeping
+        the branches whose lower bound is within their own bound (outside of their anchor). In both passes the (query, node) pairs of a level are expanded as
+        arrays, and the leaves are scanned by scan_leaves.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray, np.ndarray
+            The distances and the ids of the neighbours of every query, and the number of nodes it visited.
+        """
+        nodes = self.nodes
+        rows = np.arange(len(Q))
+
+        anchor = np.full(len(Q), self.root, dtype=np.int64)
+        active = rows[nodes["split_dim"][anchor] >= 0]
+        while len(active):
+            node = anchor[active]
+            diff = coords[active, nodes["split_dim"][node]] - nodes["split_val"][node]
+            near = np.where(diff < 0, nodes["left"][node], nodes["right"][node])
+            down = near >= 0
+            down[down] = nodes["count"][near[down]] >= 4 * k
+            active, near = active[down], near[down]
+            anchor[active] = near
+            active = active[nodes["split_dim"][near] >= 0]
+
+        unbounded = np.full(len(Q), np.inf)
+        queries, leaves, visited = self._block_leaves(coords, rows, anchor, unbounded)
+        n_scanned, n_computed = len(leaves), nodes["count"][leaves].sum()
+        dists, ids = top_k(*scan_leaves(self.data, self.perm, Q, queries, leaves, nodes["start"], nodes["count"]), len(Q), k)
+
+        # the slack covers the rounding of the distances computed by matrix products
+        bound = dists[:, -1] * (1 + 1e-5) + 1e-12
+        queries, leaves, more_visited = self._block_leaves(coords, rows, np.full(len(Q), self.root), bound, anchor)
+        found = scan_leaves(self.data, self.perm, Q, queries, leaves, nodes["start"], nodes["count"], bound)
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(
+                n_queries=len(Q),
+                nodes_visited=int(visited.sum() + more_visited.sum()),
+                leaves_scanned=int(n_scanned + len(leaves)),
+                distance_evaluations=int(n_computed + nodes["count"][leaves].sum() + ids.size),
+            )
+
+        kept = ids.ravel() >= 0
+        dists, ids = top_k(
+            np.concatenate((np.repeat(rows, k)[kept], found[0])),
+            np.concatenate((dists.ravel()[kept], found[1])),
+            np.concatenate((ids.ravel()[kept], found[2])),
+            len(Q),
+            k,
+        )
+        distances, ids = exact_neighbours(self.data, Q, ids)
+        return distances, ids, visited + more_visited
+
+    def _block_leaves(self, coords: np.ndarray, queries: np.ndarray, nodes: np.ndarray, bound: np.ndarray, skip: np.ndarray = None):
+        """
+        Descends from the node nodes[i] for the query queries[i], for all the pairs at once, level by level,
+        and returns the (query, leaf) pairs reached whose lower bound of the squared distance is within the
+        bound of their query, skipping the subtree skip[query] if given, and the number of nodes visited
+        per query.
+        """
+        split_dim, split_val = self.nodes["split_dim"], self.nodes["split_val"]
+        left, right = self.nodes["left"], self.nodes["right"]
+        if skip is not None:
+            queries, nodes = queries[nodes != skip[queries]], nodes[nodes != skip[queries]]
+        lower = np.zeros(len(queries))
+        visited = np.zeros(len(bound), dtype=np.int64)
+
+        found_queries, found_leaves = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        while len(queries):
+            visited += np.bincount(queries, minlength=len(bound))
+            dims = split_dim[nodes]
+            leaf = dims < 0
+            found_queries.append(queries[leaf])
+            found_leaves.append(nodes[leaf])
+
+            inner = ~leaf
+            queries, nodes, lower, dims = queries[inner], nodes[inner], lower[inner], dims[inner]
+            diff = coords[queries, dims] - split_val[nodes]
+            near = np.where(diff < 0, left[nodes], right[nodes])
+            far = np.where(diff < 0, right[nodes], left[nodes])
+
+            queries = np.concatenate((queries, queries))
+            nodes = np.concatenate((near, far)).astype(np.int64)
+            lower = np.concatenate((lower, np.maximum(lower, diff.astype(np.float64) ** 2)))
+            keep = (nodes >= 0) & (lower <= bound[queries])
+            if skip is not None:
+                keep &= nodes != skip[queries]
+            queries, nodes, lower = queries[keep], nodes[keep], lower[keep]
+
+        return np.concatenate(found_queries), np.concatenate(found_leaves), visited
+
+    def all_knn(self, k: int = 1, include_self: bool = False, n_threads: int = None, block_size: int = 64):
+        """
+        Finds the k nearest neighbours of every indexed point among the indexed points (an all-kNN self-join,
+        e.g. for a kNN graph), by a dual-tree traversal of the "flat" layout (see all_knn.py).
+
+        Two nodes are compared by the extents of their points along the normals of the split planes (the
+        split dimensions and directions): their gaps along the split dimensions add up, squared, to a lower
+        bound of the squared distance between their points, and the gap along any direction bounds it too.
+        The pairs of blocks left are compared in float64 matrix products, and the distances of the neighbours
+        found are recomputed directly. With a PCA rotation the distances are those of the rotated points.
+
+        Parameters
+        ----------
+        k : int, optional
+            The number of neighbours of every point, by default 1.
+        include_self : bool, optional
+            Whether a point is a neighbour of itself, by default False.
+        n_threads : int, optional
+            The number of threads comparing the leaves, by default None (the calling thread only); -1 uses
+            all the CPU cores.
+        block_size : int, optional
+            The largest number of points of the nodes compared together in one matrix product rather than
+            descended (larger leaves are too), by default 64.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray, np.ndarray
+            The neighbour graph in CSR form, with a row per datapoint (empty for the deleted points): indptr,
+            the ids of the neighbours (indices) and their Euclidean distances (ascending along a row).
+            scipy.sparse.csr_matrix((distances, indices, indptr)) builds the sparse matrix.
+        """
+        assert self.layout == "flat", "all_knn needs the flat layout"
+        k = min(k, self.n_points if include_self else self.n_points - 1)
+        if self.root is None or k <= 0:
+            return to_csr(np.empty((len(self.data), 0)), np.empty((len(self.data), 0), dtype=np.int64))
+
+        nodes = self.nodes
+        is_leaf = nodes["split_dim"][: self.n_nodes] < 0
+        lows, highs, axis = self._split_extents(is_leaf)
+        # as many rows of the pairs at a time as 4M gaps
+        step = max(1, (1 << 22) // max(lows.shape[1], 1))
+
+        def lower_bound(firsts: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+            bound = np.zeros(len(firsts))
+            for start in range(0, len(firsts), step):
+                first, second = firsts[start : start + step], seconds[start : start + step]
+                gaps = np.maximum(np.maximum(lows[second] - highs[first], lows[first] - highs[second]), 0).astype(np.float64)
+                gaps *= gaps
+                bound[start : start + step] = gaps[:, axis].sum(axis=1)
+                if not axis.all():
+                    bound[start : start + step] = np.maximum(bound[start : start + step], gaps[:, ~axis].max(axis=1))
+            return bound
+
+        def pairwise(X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+            X, Y = X.astype(np.float64), Y.astype(np.float64)
+            dists = np.einsum("ij,ij->i", X, X)[:, None] + np.einsum("ij,ij->i", Y, Y)[None, :] - 2 * (X @ Y.T)
+            return np.maximum(dists, 0)
+
+        def paired(X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+            return ((X.astype(np.float64) - Y) ** 2).sum(axis=1)
+
+        dists, ids = dual_tree_knn(
+            self.data, self.perm, self.root, is_leaf, nodes["start"], nodes["count"], self._expand_children,
+            lower_bound, pairwise, k, include_self, n_threads, block_size,
+        )
+        dists, ids = refine(self.data, ids, paired)
+        return to_csr(np.sqrt(dists), ids)
+
+    def _expand_children(self, parents: np.ndarray):
+        """
+        Returns the children of the "flat" internal nodes parents, as the index in parents of the parent of
+        every child and the child, left before right.
+        """
+        children = np.stack((self.nodes["left"][parents], self.nodes["right"][parents]), axis=1).ravel()
+        owners = np.repeat(np.arange(len(parents)), 2)
+        return owners[children >= 0], children[children >= 0].astype(np.int64)
+
+    def _split_extents(self, is_leaf: np.ndarray):
+        """
+        Returns the extents of the points of every node along the split coordinates (the split dimensions,
+        then the directions used), as two (n_nodes, n_coords) arrays of the min and max, and whether every
+        coordinate is a dimension. The leaves are read by chunks of about chunk_rows points, the inner nodes
+        take the extents of their children.
+        """
+        nodes = self.nodes
+        coords = np.unique(nodes["split_dim"][: self.n_nodes][~is_leaf])
+        axis = coords < self.k
+        directions = self.directions[coords[~axis] - self.k]
+        lows = np.full((self.n_nodes, len(coords)), np.inf, dtype=np.float64)
+        highs = np.full((self.n_nodes, len(coords)), -np.inf, dtype=np.float64)
+
+        levels, _ = tree_levels(self.root, is_leaf, self._expand_children)
+        leaves = np.concatenate([level[is_leaf[level]] for level in levels])
+        leaves = leaves[nodes["count"][leaves] > 0]
+        counts = nodes["count"][leaves].astype(np.int64)
+        offsets = segment_offsets(counts)
+        ends = offsets + counts
+        chunk_rows = self.chunk_rows or 65536
+        first = 0
+        while first < len(leaves):
+            last = max(first + 1, int(np.searchsorted(ends, offsets[first] + chunk_rows, side="right")))
+            block = leaves[first:last]
+            X = self.data[self.perm[gather_ranges(nodes["start"][block], counts[first:last])]]
+            values = np.hstack((X[:, coords[axis]], project(X, directions)))
+            lows[block] = np.minimum.reduceat(values, offsets[first:last] - offsets[first], axis=0)
+            highs[block] = np.maximum.reduceat(values, offsets[first:last] - offsets[first], axis=0)
+            first = last
+
+        for level in levels[::-1]:
+            inner = level[~is_leaf[level]]
+            left, right = nodes["left"][inner], nodes["right"][inner]
+            left, right = np.where(left >= 0, left, right), np.where(right >= 0, right, left)
+            lows[inner] = np.minimum(lows[left], lows[right])
+            highs[inner] = np.maximum(highs[left], highs[right])
+        return lows, highs, axis
+
+    def compute_silhouette_score(self, sample_size: int = None, seed: int = 0):
         """
         Computes the Silhouette Score for the KDTree.
 
+        Parameters
+        ----------
+        sample_size : int, optional
+            Estimate the score from the silhouettes of this many points (each compared with all the points),
+            by default None: the exact score with sklearn, in O(n^2) time and memory.
+        seed : int, optional
+            The seed of the sample, by default 0.
+
         Returns
         -------
         float
             The Silhouette Score of the KDTree.
         """
+        if sample_size is not None:
+            leaves = list(self._leaves())
+            ids = np.concatenate([leaf_ids for leaf_ids, _, _ in leaves])
+            labels = np.concatenate([np.full(len(leaf_ids), label) for leaf_ids, _, label in leaves])
+            return sampled_silhouette_score(self.data, ids, labels, sample_size, seed)
+
         # Flatten the tree to get all points and their cluster labels
-        points, labels = self._flatten_tree(self.root, 0)
+        if self.layout == "flat":
+            points, labels = self._flatten_flat()
+        else:
+            points, labels = self._flatten_tree(self.root, 0)
         points = np.array(points)
         labels = np.array(labels)
-        
+
         # Compute the Silhouette Score
         score = silhouette_score(points, labels)
         return score
 
+    def quality_metrics(self) -> dict:
+        """
+        Computes quality metrics of the leaves in one pass: their number, sizes, radii, within-leaf sum of
+        squared errors and the histogram of their depths (see quality.leaf_metrics).
+
+        Returns
+        -------
+        dict
+            The metrics.
+        """
+        return leaf_metrics(self.data, ((ids, depth) for ids, depth, _ in self._leaves()))
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics collected since the tree was built with collect_stats=True.
+
+        Returns
+        -------
+        dict
+            A JSON-serialisable dict. "build" holds the timers ({"calls", "seconds"} of the strategy functions,
+            of the partitions and of the whole build) and the structure of the tree (see
+            instrumentation.tree_structure): the number of nodes per depth and the histograms of the leaf
+            sizes and of the imbalance of the splits. "queries" holds the number of kNN queries, of nodes
+            visited, of leaves scanned and of distance evaluations, their means per query and the pruning
+            ratio, the fraction of the distances of a brute-force scan that were not computed.
+        """
+        assert self.tree_stats is not None, "get_stats requires collect_stats=True"
+        structure = tree_structure(self.root, self._node_children, lambda node: len(self._leaf_ids(node)), self._depth)
+        return self.tree_stats.to_dict(self.n_points, structure)
+
+    def reset_stats(self):
+        """
+        Resets the query counters of the statistics, e.g. between two benchmark runs (the build timers are kept).
+        """
+        assert self.tree_stats is not None, "reset_stats requires collect_stats=True"
+        self.tree_stats.reset_queries()
+
+    def _node_children(self, node) -> list:
+        """
+        Returns the children of a node, none for a leaf.
+        """
+        branch = self._branch(node)
+        if branch is None:
+            return []
+        return [child for child in branch[2:] if child is not None]
+
+    def _leaves(self, node=None):
+        """
+        Yields the ids, the depth and the cluster label of every leaf under node (the root by default),
+        from left to right, labelling the leaves the same way as _flatten_tree.
+        """
+        if node is None:
+            node = self.root
+        if node is None:
+            return
+        stack = [(node, 0)]
+        while stack:
+            node, label = stack.pop()
+            if self.layout == "flat":
+                if self.nodes["split_dim"][node] < 0:
+                    yield self._leaf_ids(node), self.nodes["depth"][node], label
+                    continue
+                left, right = self.nodes["left"][node], self.nodes["right"][node]
+                children = [(child, child_label) for child, child_label in ((right, label + 1), (left, label)) if child >= 0]
+            else:
+                if node["leaf"]:
+                    yield node["ids"], node["depth"], label
+                    continue
+                children = [(child, child_label) for child, child_label in ((node["right"], label + 1), (node["left"], label)) if child is not None]
+            stack.extend(children)
+
     def _flatten_tree(self, node, label):
         """
         Flattens the KDTree to get all points and their cluster labels.
@@ -187,11 +2047,77 @@ class KDTree:
             return [], []
 
         if node["leaf"]:
-            points = node["points"]
+            # leaves built by the "numpy" engine only keep the ids of their points
+            points = node["points"] if "points" in node else list(self.data[node["ids"]])
             labels = [label] * len(points)
             return points, labels
 
         left_points, left_labels = self._flatten_tree(node["left"], label)
         right_points, right_labels = self._flatten_tree(node["right"], label + 1)
 
-        return left_points + right_points, left_labels + right_labels
\ No newline at end of file
+        return left_points + right_points, left_labels + right_labels
+
+    def _flatten_flat(self):
+        """
+        Flattens the "flat" layout to get all points and their cluster labels, labelling the
+        leaves the same way as _flatten_tree.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The points and their cluster labels.
+        """
+        ids = []
+        labels = []
+
+        stack = [(self.root, 0)]
+        while stack:
+            node, label = stack.pop()
+            if self.nodes["split_dim"][node] < 0:
+                start = self.nodes["start"][node]
+                ids.append(self.perm[start : start + self.nodes["count"][node]])
+                labels.append(np.full(len(ids[-1]), label))
+                continue
+            if self.nodes["right"][node] >= 0:
+                stack.append((self.nodes["right"][node], label + 1))
+            if self.nodes["left"][node] >= 0:
+                stack.append((self.nodes["left"][node], label))
+
+        return self.data[np.concatenate(ids)], np.concatenate(labels)
+
+def _build_subtree(template: KDTree, ids: np.ndarray, depth: int, last_dim: int, seed: int):
+    """
+    Builds a subtree over the given ids in the "flat" layout, for a parallel build.
+    Returns the partitioned ids, the node arrays, with starts relative to the ids, and the directions of
+    the projection splits of the subtree.
+    """
+    tree = copy.copy(template)
+    tree.perm = ids
+    tree.rng = random.Random(seed)
+    tree._buffers = {}
+    tree.directions = np.empty((0, tree.k), dtype=np.float32)
+    tree._init_nodes(4 * len(ids) // max(tree.leaf_size, 1) + 1)
+    tree.numpy_build(0, len(ids), depth, last_dim)
+    tree._trim_nodes()
+    return tree.perm, tree.nodes, tree.directions
+
+
+def _build_shared_subtree(shared: tuple, task: tuple):
+    """
+    Builds a subtree in a worker process, reading the datapoints from shared memory or from their file.
+    """
+    template, (kind, name, offset, shape, dtype) = shared
+    if kind == "memmap":
+        template.data = np.memmap(name, dtype=dtype, mode="r", offset=offset, shape=shape)
+        try:
+            return _build_subtree(template, *task)
+        finally:
+            template.data = None
+
+    shm = SharedMemory(name=name)
+    try:
+        template.data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return _build_subtree(template, *task)
+    finally:
+        template.data = None
+        shm.close()
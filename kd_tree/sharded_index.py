@@ -0,0 +1,45 @@
+# sharded_index.py
+try:
+    from .kd_tree import KDTree
+    from .dimension_choice import max_variance_dim
+except ImportError:
+    from kd_tree import KDTree
+    from dimension_choice import max_variance_dim
+try:
+    from ..common.sharded_index import ShardedIndex as BaseShardedIndex
+    from ..common.datasource import node_stats
+except ImportError:
+    from common.sharded_index import ShardedIndex as BaseShardedIndex
+    from common.datasource import node_stats
+import numpy as np
+
+
+class ShardedIndex(BaseShardedIndex):
+    """
+    The sharded index of KDTrees (see common/sharded_index.py). Its "tree" partition cuts the points by KD
+    splits along the dimension of highest variance, into exactly n_shards shards of n / n_shards points
+    (rounded either way): a node to cut into m shards puts the points of its first m // 2 shards on the left.
+    """
+
+    tree_class = KDTree
+
+    @staticmethod
+    def _tree_partition(data: np.ndarray, n_shards: int) -> list:
+        """
+        Returns the ids of the leaves of a shallow KD split as the shards, from left to right.
+        """
+        chunk_rows = max(1, (1 << 24) // (data.shape[1] * data.itemsize))
+        shards = []
+        # the nodes still to cut, as (ids, number of shards), the leftmost last
+        stack = [(np.arange(len(data), dtype=np.int64), min(n_shards, len(data)))]
+        while stack:
+            ids, m = stack.pop()
+            if m == 1:
+                shards.append(ids)
+                continue
+            dim = max_variance_dim(None, data.shape[1], stats=node_stats(data, ids, chunk_rows))["dim"]
+            n_left = len(ids) * (m // 2) // m
+            order = np.argsort(data[ids, dim], kind="stable")
+            stack.append((ids[order[n_left:]], m - m // 2))
+            stack.append((ids[order[:n_left]], m // 2))
+        return shards
@@ -1,6 +1,13 @@
 # split_position_choice.py
 import random
 
+import numpy as np
+
+try:
+    from ..common.segments import segment_offsets, segment_select
+except ImportError:
+    from common.segments import segment_offsets, segment_select
+
 ALL_ARGS = ["datapoints", "dim", "sort", "length"]
 
 
@@ -13,6 +20,8 @@ def mean_split(
 
     if mean_val is not None:
         return mean_val
+    if isinstance(datapoints, np.ndarray):
+        return datapoints[:, dim].mean()
     return sum([point[dim] for point in datapoints]) / len(datapoints)
 
 
@@ -25,7 +34,11 @@ def median_split(
 ):
     """
     Returns the median value of the given dimension.
+    If datapoints is an ndarray, the median is found by selection (O(n)) instead of sorting.
     """
+    if isinstance(datapoints, np.ndarray):
+        mid = len(datapoints) // 2
+        return np.partition(datapoints[:, dim], mid)[mid]
     if not sort:
         sorted_points = sorted(datapoints, key=lambda x: x[dim])
         mid = len(sorted_points) // 2
@@ -36,18 +49,22 @@ def median_split(
 
 
 def random_split(
-    datapoints: list[list[float]], dim: int, sort: bool = False, **kwargs
+    datapoints: list[list[float]], dim: int, sort: bool = False, rng=random, **kwargs
 ):
     """
-    Returns a random value of the given dimension.
+    Returns a random value of the given dimension, drawn from rng (the random module by default).
     """
 
+    if isinstance(datapoints, np.ndarray):
+        values = datapoints[:, dim]
+        min_val = values.min()
+        return rng.random() * (values.max() - min_val) + min_val
     if not sort:
         sorted_points = sorted(datapoints, key=lambda x: x[dim])
     else:
         sorted_points = datapoints
     split = (
-        random.random() * (sorted_points[-1][dim] - sorted_points[0][dim])
+        rng.random() * (sorted_points[-1][dim] - sorted_points[0][dim])
         + sorted_points[0][dim]
     )
     return split
@@ -67,8 +84,57 @@ def geometric_center_split(
 
     if max_val is not None and min_val is not None:
         return (max_val + min_val) / 2
+    if isinstance(datapoints, np.ndarray):
+        values = datapoints[:, dim]
+        return (values.min() + values.max()) / 2
     if not sort:
         sorted_points = sorted(datapoints, key=lambda x: x[dim])
     else:
         sorted_points = datapoints
     return (sorted_points[0][dim] + sorted_points[-1][dim]) / 2
+
+
+def mean_splits(column: np.ndarray, counts: np.ndarray, mean_val: np.ndarray = None, **kwargs):
+    """
+    Returns the mean of every segment of column (the nodes of a level, one after the other), or mean_val.
+    """
+    if mean_val is not None:
+        return mean_val
+    return np.add.reduceat(column.astype(np.float64), segment_offsets(counts)) / counts
+
+
+def median_splits(column: np.ndarray, counts: np.ndarray, **kwargs):
+    """
+    Returns the median of every segment of column, found by selection as in median_split.
+    """
+    return segment_select(column, counts, counts // 2)
+
+
+def random_splits(column: np.ndarray, counts: np.ndarray, rng=random, **kwargs):
+    """
+    Returns a random value between the minimum and the maximum of every segment of column, drawn from rng
+    in segment order.
+    """
+    offsets = segment_offsets(counts)
+    min_vals = np.minimum.reduceat(column, offsets)
+    draws = np.array([rng.random() for _ in range(len(counts))])
+    return draws * (np.maximum.reduceat(column, offsets) - min_vals) + min_vals
+
+
+def geometric_center_splits(column: np.ndarray, counts: np.ndarray, max_val: np.ndarray = None, min_val: np.ndarray = None, **kwargs):
+    """
+    Returns the geometric center of every segment of column, or of max_val and min_val.
+    """
+    if max_val is not None and min_val is not None:
+        return (max_val + min_val) / 2
+    offsets = segment_offsets(counts)
+    return (np.minimum.reduceat(column, offsets) + np.maximum.reduceat(column, offsets)) / 2
+
+
+# the versions choosing for all the nodes of a level at once (level-synchronous build)
+SPLIT_SEGMENTED = {
+    "mean": mean_splits,
+    "median": median_splits,
+    "random": random_splits,
+    "geometric_center": geometric_center_splits,
+}
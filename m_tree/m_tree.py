@@ -0,0 +1,713 @@
+try:
+    from .metrics import *
+except ImportError:
+    from metrics import *
+try:
+    from ..r_tree.seeds_choice import *
+    from ..r_tree.grouping_choice import *
+    from ..r_tree.metrics import L1, SquaredL2
+except ImportError:
+    from r_tree.seeds_choice import *
+    from r_tree.grouping_choice import *
+    from r_tree.metrics import L1, SquaredL2
+try:
+    from ..common.datasource import *
+    from ..common.index_file import *
+    from ..common.quality import *
+except ImportError:
+    from common.datasource import *
+    from common.index_file import *
+    from common.quality import *
+from sklearn.metrics import silhouette_score
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import heapq
+import random
+import os
+
+class MTree:
+    """
+    MTree class
+
+    A metric tree: every node is a ball, given by a routing object (its center) and a covering radius that
+    bounds the distance from the routing object to all the points under the node. Every node also keeps the
+    distance from its routing object to its parent's, and every point the distance to the routing object of
+    its leaf, so that the searches can discard children and points by the triangle inequality before
+    computing their distance to the query.
+
+    Attributes:
+    ----------
+    k : int
+        The number of dimensions of the datapoints.
+    metric : str
+        The distance of the tree, "euclidean" or "manhattan".
+    distance : function
+        The vectorised distance of the metric (see metrics.py).
+    split_metric : Metric
+        The metric, as the RTree's metric object (see r_tree/metrics.py), of the seed and grouping choices.
+    grouping_choice : function
+        The function partitioning the points of a node between its two children.
+    seed_choice : function
+        The function choosing the two seeds of the partition.
+    dimension_choice : str
+        The dimension choice of the "one_dim_farthest" seed choice.
+    promotion : str
+        How the routing objects of the children are chosen, "seeds" or "centroid".
+    data : np.ndarray
+        The datapoints, indexed by the ids stored in perm (a np.memmap when built from a file).
+    layout : str
+        The node layout, always "flat".
+    nodes : dict[str, np.ndarray]
+        The parallel node arrays: "center" (the routing objects, one (n_nodes, k) array), "radius" (the covering
+        radii), "parent_dist" (the distance from the routing object to the parent's, 0 at the root),
+        "first_child" and "n_children" (the children of a node are contiguous), "depth", "start" and "count".
+        The root is node 0.
+    perm : np.ndarray
+        The permutation of the ids into leaf order; the points of every node are a contiguous range of it.
+    point_dists : np.ndarray
+        The distance from every point of perm to the routing object of its leaf, in perm order.
+    rng : random.Random
+        The source of the random draws of the strategies, the random module by default.
+    n_points : int
+        The number of points in the tree.
+
+    Methods:
+    -------
+    build(datapoints: list[list[float]]) -> int
+        Builds the MTree from the given datapoints.
+    range_build(node: int, depth: int, last_dim: int)
+        Recursively splits a node in two balls.
+    query(q: list[float], k: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of a query point (best-first search on the balls).
+    query_batch(Q: list[list[float]], k: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every query point.
+    query_radius(q: list[float], r: float) -> np.ndarray, np.ndarray
+        Finds all the points within distance r of a query point.
+    query_radius_batch(Q: list[list[float]], r: float) -> list[np.ndarray], list[np.ndarray]
+        Finds all the points within distance r of every query point.
+    compute_silhouette_score(sample_size: int, seed: int) -> float
+        Computes the Silhouette Score for the MTree, exactly or on a sample of points.
+    quality_metrics() -> dict
+        Computes the per-leaf and covering-ball quality metrics of the MTree.
+    save(path: str)
+        Saves the MTree to an index file.
+    load(path: str, mmap: bool) -> MTree
+        Loads an MTree from an index file, memory-mapped by default.
+    """
+
+    def __init__(
+        self,
+        k: int,
+        datapoints: list[list[float]],
+        metric: str = "euclidean",
+        grouping_choice: str = "closest_seed",
+        seed_choice: str = "one_dim_farthest",
+        dimension_choice: str = "random",
+        promotion: str = "seeds",
+        leaf_size: int = 10,
+        max_depth: int = None,
+        seed_params: dict = None,
+        tmp_dir: str = None,
+    ):
+        """
+        Initializes the MTree with the given datapoints, metric and strategies.
+
+        Parameters
+        ----------
+        k : int
+            The number of dimensions of the datapoints.
+        datapoints : list[list[float]]
+            The list of datapoints to build the MTree from, or a path to a .npy file or a memory-mapped array
+            (used without copying it to memory) or an HDF5 dataset (copied by chunks to a temporary
+            memory-mapped file in tmp_dir).
+        metric : str, optional
+            The distance of the tree, by default "euclidean".
+            Options: "euclidean", "manhattan".
+        grouping_choice : str, optional
+            The partition of the points of a node between the two seeds, by default "closest_seed".
+            Options: "closest_seed" (every point goes with its closest seed), "sorting_distance_to_one_seed"
+            (the half of the points closest to the first seed, and the other half). Both use the metric.
+        seed_choice : str, optional
+            The function to choose the two seeds of a split, by default "one_dim_farthest".
+            Options: "one_dim_farthest", "farthest_euc_distance", "farthest_euc_distance_blocked",
+            "approx_farthest" (the RTree's; the farthest pairs are measured with the metric).
+        dimension_choice : str, optional
+            Used by the seed_choice function when it's "one_dim_farthest", by default "random".
+            Options: "alternate", "random", "max_variance", "widest_interval", "random_projection", "pca".
+        promotion : str, optional
+            The routing objects of the two children of a split, by default "seeds".
+            Options: "seeds" (the seeds are promoted, each routing the group it seeded), "centroid" (the mean
+            of every group, which usually has a smaller covering radius than a seed on its border).
+            The routing object of the root is the mean of all the points.
+        leaf_size : int, optional
+            The maximum number of points that can be stored in a leaf node, by default 10.
+        max_depth : int, optional
+            The maximum depth of the tree, by default None.
+        seed_params : dict, optional
+            Extra keyword arguments of the seed_choice function, by default None.
+        tmp_dir : str, optional
+            The directory of the temporary file an HDF5 dataset is copied to, by default the system's.
+        """
+        self.k = k
+        self.leaf_size = leaf_size
+        self.max_depth = max_depth
+
+        switcher: dict[str, function] = {
+            "euclidean": euclidean_distances,
+            "manhattan": manhattan_distances,
+        }
+
+        assert metric in switcher, "Invalid metric, choose from 'euclidean', 'manhattan'"
+
+        self.metric = metric
+        self.distance = switcher[metric]
+        # the seed and grouping choices only compare distances, so the Euclidean one is compared squared
+        self.split_metric = {"euclidean": SquaredL2(), "manhattan": L1()}[metric]
+
+        switcher = {
+            "closest_seed": closest_seed_group,
+            "sorting_distance_to_one_seed": sorting_distance_to_one_seed_group,
+        }
+        self.grouping_choice = switcher[grouping_choice]
+
+        switcher = {
+            "one_dim_farthest": one_dim_farthest_seeds,
+            "farthest_euc_distance": farthest_euc_distance_seeds,
+            "farthest_euc_distance_blocked": farthest_euc_distance_blocked_seeds,
+            "approx_farthest": approx_farthest_seeds,
+        }
+        self.seed_choice = switcher[seed_choice]
+
+        # the names are kept to save the index
+        self.grouping_choice_name = grouping_choice
+        self.seed_choice_name = seed_choice
+
+        self.seed_params = seed_params or {}
+        self.dimension_choice = dimension_choice
+
+        assert promotion in ("seeds", "centroid"), "Invalid promotion, choose from 'seeds', 'centroid'"
+
+        self.promotion = promotion
+
+        # the benchmarks read the node arrays as those of the other trees' "flat" layout
+        self.layout = "flat"
+        self.rng = random
+        self.tmp_dir = tmp_dir
+
+        self.root = self.build(datapoints)
+        self.n_points = len(self.perm)
+
+    def build(self, datapoints: list[list[float]]) -> int:
+        """
+        Builds the MTree from the given datapoints.
+
+        Parameters
+        ----------
+        datapoints : list[list[float]]
+            The list of datapoints to build the MTree from.
+        """
+        self.data = open_datapoints(datapoints, tmp_dir=self.tmp_dir).reshape(-1, self.k)
+        self.perm = np.arange(len(self.data), dtype=np.int64)
+        self.point_dists = np.zeros(len(self.data), dtype=np.float64)
+
+        # start from the size of a balanced binary tree, the arrays grow if the splits are uneven
+        n_leaves = max(1, -(-len(self.data) // max(self.leaf_size, 1)))
+        self._init_nodes(2 * (1 << (n_leaves - 1).bit_length()) - 1)
+        root = self._new_nodes(1)
+        self._set_node(root, 0, 0, len(self.data), self._centroid(0, len(self.data)), 0.0)
+        self.range_build(root, 1)
+        self._trim_nodes()
+        return root
+
+    def range_build(self, node: int, depth: int, last_dim: int = 0):
+        """
+        Recursively splits a node holding a range of perm in two balls.
+
+        The seed choice picks two seeds among the node's points and the grouping choice partitions the points
+        between them; the ids are reordered in place so that each group is a contiguous range of perm, and
+        the two children are allocated next to each other. The distances from the points to the routing
+        objects of the children are computed once here, for the covering radii and the point distances.
+        """
+        start, end = self._node_range(node)
+
+        # Stop recursion if the number of points is <= leaf_size or max_depth is reached
+        if end - start <= self.leaf_size or (self.max_depth is not None and depth >= self.max_depth):
+            return
+
+        ids = self.perm[start:end]
+        # plain ndarray rows, also of memory-mapped datapoints, read by the strategies by chunks
+        points = NodeRows(self.data.view(np.ndarray), ids)
+
+        seeds_result = self.seed_choice(
+            datapoints=points,
+            nbr_dims=self.k,
+            dimension_choice_alg=self.dimension_choice,
+            last_dim=last_dim,
+            rng=self.rng,
+            metric=self.split_metric,
+            **self.seed_params,
+        )
+
+        seeds = seeds_result["seeds"]
+        if len(seeds) < 2:
+            # no two points are apart
+            seeds = [points[0], points[-1]]
+
+        groups = self.grouping_choice(
+            seed=seeds[0], seed2=seeds[1], nbr_dims=self.k, datapoints=points, return_ids=True, metric=self.split_metric
+        )
+        del points
+        left = np.array(groups[0], dtype=np.int64)
+        right = np.array(groups[1], dtype=np.int64)
+        if len(left) == 0 or len(right) == 0:
+            # the seeds do not separate the points (duplicates), cut them in halves
+            left, right = np.arange((end - start) // 2), np.arange((end - start) // 2, end - start)
+
+        self.perm[start:end] = np.concatenate((ids[left], ids[right]))
+        middle = start + len(left)
+
+        left_child = self._new_nodes(2)
+        right_child = left_child + 1
+        self.nodes["first_child"][node] = left_child
+        self.nodes["n_children"][node] = 2
+        center = self.nodes["center"][node]
+        for child, seed, child_start, child_end in ((left_child, seeds[0], start, middle), (right_child, seeds[1], middle, end)):
+            child_center = np.array(seed) if self.promotion == "seeds" else self._centroid(child_start, child_end)
+            parent_dist = float(self.distance(child_center[None, :], center)[0])
+            self._set_node(child, depth, child_start, child_end, child_center, parent_dist)
+
+        last_dim = seeds_result["dim"] if "dim" in seeds_result else None
+        self.range_build(left_child, depth + 1, last_dim)
+        self.range_build(right_child, depth + 1, last_dim)
+
+    def _range_distances(self, start: int, end: int, y: np.ndarray, chunk_bytes: int = 1 << 24) -> np.ndarray:
+        """
+        Returns the distances from the points of perm[start:end] to y, reading the points by chunks.
+        """
+        chunk_rows = max(1, chunk_bytes // (self.k * self.data.itemsize))
+        dists = np.empty(end - start, dtype=np.float64)
+        for chunk_start in range(start, end, chunk_rows):
+            chunk_end = min(chunk_start + chunk_rows, end)
+            dists[chunk_start - start : chunk_end - start] = self.distance(self.data[self.perm[chunk_start:chunk_end]], y)
+        return dists
+
+    def _centroid(self, start: int, end: int, chunk_bytes: int = 1 << 24) -> np.ndarray:
+        """
+        Returns the mean of the points of perm[start:end] (the origin for no points), reading them by chunks.
+        """
+        chunk_rows = max(1, chunk_bytes // (self.k * self.data.itemsize))
+        total = np.zeros(self.k, dtype=np.float64)
+        for chunk_start in range(start, end, chunk_rows):
+            total += self.data[self.perm[chunk_start : min(chunk_start + chunk_rows, end)]].sum(axis=0, dtype=np.float64)
+        return (total / max(end - start, 1)).astype(self.data.dtype)
+
+    def _node_range(self, node: int):
+        """
+        Returns the (start, end) range of perm holding the points of a node.
+        """
+        start = self.nodes["start"][node]
+        return start, start + self.nodes["count"][node]
+
+    def _init_nodes(self, capacity: int):
+        """
+        Allocates the node arrays.
+        """
+        self.n_nodes = 0
+        self.nodes = {
+            "center": np.empty((capacity, self.k), dtype=self.data.dtype),
+            "radius": np.empty(capacity, dtype=np.float64),
+            "parent_dist": np.empty(capacity, dtype=np.float64),
+            "first_child": np.empty(capacity, dtype=np.int32),
+            "n_children": np.empty(capacity, dtype=np.int32),
+            "depth": np.empty(capacity, dtype=np.int32),
+            "start": np.empty(capacity, dtype=np.int64),
+            "count": np.empty(capacity, dtype=np.int64),
+        }
+
+    def _new_nodes(self, count: int) -> int:
+        """
+        Returns the id of the first of count new contiguous nodes, doubling the arrays when they are full.
+        """
+        capacity = len(self.nodes["depth"])
+        if self.n_nodes + count > capacity:
+            for key, values in self.nodes.items():
+                grown = np.zeros((2 * capacity + count,) + values.shape[1:], dtype=values.dtype)
+                grown[:capacity] = values
+                self.nodes[key] = grown
+        self.n_nodes += count
+        return self.n_nodes - count
+
+    def _set_node(self, node: int, depth: int, start: int, end: int, center: np.ndarray, parent_dist: float):
+        """
+        Fills a leaf holding perm[start:end] with the given routing object: its covering radius is the
+        distance to its farthest point, and the distances of its points are kept in point_dists (the
+        children of the node overwrite them with the distances to their own routing objects).
+        """
+        dists = self._range_distances(start, end, center)
+        self.point_dists[start:end] = dists
+        self.nodes["center"][node] = center
+        self.nodes["radius"][node] = dists.max() if len(dists) else 0.0
+        self.nodes["parent_dist"][node] = parent_dist
+        self.nodes["first_child"][node] = -1
+        self.nodes["n_children"][node] = 0
+        self.nodes["depth"][node] = depth
+        self.nodes["start"][node] = start
+        self.nodes["count"][node] = end - start
+
+    def _trim_nodes(self):
+        """
+        Shrinks the node arrays to the number of nodes, in place (no view of them is alive at the end of the build).
+        """
+        for values in self.nodes.values():
+            values.resize((self.n_nodes,) + values.shape[1:], refcheck=False)
+
+    def _is_leaf(self, node: int) -> bool:
+        """
+        Returns whether a node has no children.
+        """
+        return self.nodes["n_children"][node] == 0
+
+    def _node_ids(self, node: int) -> np.ndarray:
+        """
+        Returns the ids of the points under a node.
+        """
+        start, end = self._node_range(node)
+        return self.perm[start:end]
+
+    @staticmethod
+    def _push_candidates(heap: list, k: int, dists: np.ndarray, ids: np.ndarray):
+        """
+        Merges the distances of a leaf's points into the max-heap of the k best candidates.
+        """
+        if len(heap) == k:
+            closer = dists < -heap[0][0]
+            dists, ids = dists[closer], ids[closer]
+        for dist, i in zip(dists.tolist(), ids.tolist()):
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist, i))
+            elif dist < -heap[0][0]:
+                heapq.heapreplace(heap, (-dist, i))
+
+    def save(self, path: str):
+        """
+        Saves the tree to an index file: its parameters, the node arrays, the id permutation, the point
+        distances and the datapoints (in id order), in the binary format of index_file.py.
+
+        Parameters
+        ----------
+        path : str
+            The file to write.
+        """
+        params = {
+            "k": self.k,
+            "metric": self.metric,
+            "grouping_choice": self.grouping_choice_name,
+            "seed_choice": self.seed_choice_name,
+            "dimension_choice": self.dimension_choice,
+            "promotion": self.promotion,
+            "leaf_size": self.leaf_size,
+            "max_depth": self.max_depth,
+            "seed_params": self.seed_params,
+        }
+        arrays = {"data": self.data, "perm": self.perm, "point_dists": self.point_dists, **self.nodes}
+        write_index(path, "m", params, arrays)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "MTree":
+        """
+        Loads a tree saved by save.
+
+        Parameters
+        ----------
+        path : str
+            The index file.
+        mmap : bool, optional
+            Map the file rather than reading it, by default True.
+
+        Returns
+        -------
+        MTree
+            The loaded tree.
+
+        Raises
+        ------
+        ValueError
+            If the file is not an MTree index of the current format version.
+        """
+        kind, params, arrays = read_index(path, mmap)
+        if kind != "m":
+            raise ValueError(f"{path} holds a '{kind}' index, not an MTree")
+
+        k = params.pop("k")
+        tree = cls(k, np.empty((0, k), dtype=arrays["data"].dtype), **params)
+        tree.data = arrays.pop("data")
+        tree.perm = arrays.pop("perm")
+        tree.point_dists = arrays.pop("point_dists")
+        tree.nodes = arrays
+        tree.n_nodes = len(arrays["depth"])
+        tree.root = 0
+        tree.n_points = len(tree.perm)
+        return tree
+
+    def query(self, q: list[float], k: int = 1, return_visited: bool = False):
+        """
+        Finds the k nearest neighbours of a query point (exact search).
+
+        The nodes are explored best-first from a priority queue keyed on the distance from q to their ball,
+        d(q, O) - r (0 inside it); the search stops when the closest remaining ball is farther than the
+        current k-th best distance dk. Once k candidates are found, the triangle inequality skips work:
+        a child C of a node N is discarded without computing d(q, O_C) if |d(q, O_N) - d(O_C, O_N)| - r_C > dk,
+        and a point x of a leaf L without computing d(q, x) if |d(q, O_L) - d(x, O_L)| > dk.
+
+        Parameters
+        ----------
+        q : list[float]
+            The query point.
+        k : int, optional
+            The number of neighbours to return, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by the search, by default False.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The distances (ascending, in the tree's metric) and the ids (row indices in the datapoints) of
+            the neighbours.
+        """
+        q = np.asarray(q, dtype=self.data.dtype)
+        centers, radii, parent_dists = self.nodes["center"], self.nodes["radius"], self.nodes["parent_dist"]
+
+        # max-heap of the best candidates, stored as (-distance, id)
+        best = []
+        nodes_visited = 0
+
+        # min-heap of (distance to the ball, tie breaker, node, distance to the routing object)
+        queue = []
+        if k > 0 and self.n_points > 0:
+            dist = float(self.distance(centers[self.root][None, :], q)[0])
+            queue.append((max(dist - radii[self.root], 0.0), 0, self.root, dist))
+        counter = 1
+        while queue:
+            bound, _, node, dist = heapq.heappop(queue)
+            if len(best) == k and bound > -best[0][0]:
+                break
+            nodes_visited += 1
+
+            start, end = self._node_range(node)
+            if self._is_leaf(node):
+                ids = self.perm[start:end]
+                if len(best) == k:
+                    # only the points in the ring of width 2 dk around d(q, O_L) can be closer than dk
+                    ids = ids[np.abs(self.point_dists[start:end] - dist) <= -best[0][0]]
+                self._push_candidates(best, k, self.distance(self.data[ids], q), ids)
+                continue
+
+            first = self.nodes["first_child"][node]
+            children = np.arange(first, first + self.nodes["n_children"][node])
+            if len(best) == k:
+                children = children[np.abs(parent_dists[children] - dist) - radii[children] <= -best[0][0]]
+            dists = self.distance(centers[children], q)
+            bounds = np.maximum(dists - radii[children], 0)
+            for child, bound, dist in zip(children.tolist(), bounds.tolist(), dists.tolist()):
+                if len(best) < k or bound <= -best[0][0]:
+                    heapq.heappush(queue, (bound, counter, child, dist))
+                    counter += 1
+
+        best = sorted((-neg_dist, i) for neg_dist, i in best)
+        distances = np.array([dist for dist, _ in best], dtype=np.float64)
+        ids = np.array([i for _, i in best], dtype=np.int64)
+
+        if return_visited:
+            return distances, ids, nodes_visited
+        return distances, ids
+
+    def query_batch(
+        self,
+        Q: list[list[float]],
+        k: int = 1,
+        return_visited: bool = False,
+        n_threads: int = None,
+        block_size: int = 256,
+    ):
+        """
+        Finds the k nearest neighbours of every query point.
+
+        The queries are split into blocks of at most block_size, searched one by one by a pool of n_threads
+        threads.
+
+        Parameters
+        ----------
+        Q : list[list[float]]
+            The query points.
+        k : int, optional
+            The number of neighbours to return per query, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by each query, by default False.
+        n_threads : int, optional
+            The number of threads, by default None (the calling thread only); -1 uses all the CPU cores.
+        block_size : int, optional
+            The maximum number of queries given to a thread at once, by default 256.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            Arrays of shape (len(Q), k) with the distances and the ids of the neighbours of each query.
+        """
+        k = min(k, self.n_points)
+        distances = np.empty((len(Q), k), dtype=np.float64)
+        ids = np.empty((len(Q), k), dtype=np.int64)
+        visited = np.zeros(len(Q), dtype=np.int64)
+
+        def search(rows: range):
+            for row in rows:
+                distances[row], ids[row], visited[row] = self.query(Q[row], k, return_visited=True)
+
+        n_threads = os.cpu_count() if n_threads == -1 else n_threads or 1
+        # at least one block per thread
+        size = max(1, min(block_size, -(-len(Q) // n_threads)))
+        blocks = [range(start, min(start + size, len(Q))) for start in range(0, len(Q), size)]
+        if n_threads == 1:
+            for rows in blocks:
+                search(rows)
+        else:
+            with ThreadPoolExecutor(n_threads) as pool:
+                list(pool.map(search, blocks))
+
+        if return_visited:
+            return distances, ids, visited
+        return distances, ids
+
+    def query_radius(self, q: list[float], r: float):
+        """
+        Finds all the points within distance r of a query point (in the tree's metric).
+        Subtrees whose ball is farther than r from q are skipped, and the children and points that the
+        triangle inequality places farther than r are discarded without computing their distance (see query).
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The distances (ascending) and the ids of the points found.
+        """
+        q = np.asarray(q, dtype=self.data.dtype)
+        centers, radii, parent_dists = self.nodes["center"], self.nodes["radius"], self.nodes["parent_dist"]
+
+        found_dists = []
+        found_ids = []
+
+        stack = []
+        if self.n_points > 0:
+            dist = float(self.distance(centers[self.root][None, :], q)[0])
+            if dist - radii[self.root] <= r:
+                stack.append((self.root, dist))
+        while stack:
+            node, dist = stack.pop()
+
+            start, end = self._node_range(node)
+            if self._is_leaf(node):
+                ids = self.perm[start:end][np.abs(self.point_dists[start:end] - dist) <= r]
+                dists = self.distance(self.data[ids], q)
+                inside = dists <= r
+                found_dists.append(dists[inside])
+                found_ids.append(ids[inside])
+                continue
+
+            first = self.nodes["first_child"][node]
+            children = np.arange(first, first + self.nodes["n_children"][node])
+            children = children[np.abs(parent_dists[children] - dist) - radii[children] <= r]
+            dists = self.distance(centers[children], q)
+            in_range = dists - radii[children] <= r
+            stack.extend(zip(children[in_range].tolist(), dists[in_range].tolist()))
+
+        if not found_ids:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+        dists = np.concatenate(found_dists)
+        ids = np.concatenate(found_ids)
+        order = np.argsort(dists, kind="stable")
+        return dists[order], ids[order]
+
+    def query_radius_batch(self, Q: list[list[float]], r: float):
+        """
+        Finds all the points within distance r of every query point.
+
+        Returns
+        -------
+        list[np.ndarray], list[np.ndarray]
+            The distances and the ids of the points found, one array per query.
+        """
+        results = [self.query_radius(q, r) for q in Q]
+        return [dists for dists, _ in results], [ids for _, ids in results]
+
+    def compute_silhouette_score(self, sample_size: int = None, seed: int = 0):
+        """
+        Computes the Silhouette Score for the MTree, with the leaves as clusters (on Euclidean distances,
+        as for the other trees).
+
+        Parameters
+        ----------
+        sample_size : int, optional
+            Estimate the score from the silhouettes of this many points (each compared with all the points),
+            by default None: the exact score with sklearn, in O(n^2) time and memory.
+        seed : int, optional
+            The seed of the sample, by default 0.
+
+        Returns
+        -------
+        float
+            The Silhouette Score of the MTree.
+        """
+        leaves = list(self._leaves())
+        ids = np.concatenate([leaf_ids for leaf_ids, _, _ in leaves])
+        labels = np.concatenate([np.full(len(leaf_ids), label) for leaf_ids, _, label in leaves])
+        if sample_size is not None:
+            return sampled_silhouette_score(self.data, ids, labels, sample_size, seed)
+
+        # Compute the Silhouette Score
+        score = silhouette_score(self.data[ids], labels)
+        return score
+
+    def quality_metrics(self) -> dict:
+        """
+        Computes quality metrics of the tree in one pass over the nodes: the number, sizes, radii, within-leaf
+        sum of squared errors and depth histogram of the leaves (see quality.leaf_metrics), and the covering
+        radii of the leaves and the overlap of sibling balls (see quality.ball_metrics).
+
+        Returns
+        -------
+        dict
+            The metrics.
+        """
+        n_children = self.nodes["n_children"]
+        first = self.nodes["first_child"]
+        leaf = n_children == 0
+
+        siblings = [
+            (first[node] + i, first[node] + j)
+            for node in np.flatnonzero(~leaf)
+            for i in range(n_children[node])
+            for j in range(i + 1, n_children[node])
+        ]
+        siblings = np.array(siblings, dtype=np.int64).reshape(-1, 2)
+        # both metrics are norms of the difference of the two points
+        centers = self.nodes["center"]
+        sibling_dists = self.distance(centers[siblings[:, 0]] - centers[siblings[:, 1]], 0)
+
+        metrics = leaf_metrics(self.data, ((ids, depth) for ids, depth, _ in self._leaves()))
+        metrics.update(ball_metrics(self.nodes["radius"], leaf, sibling_dists, siblings))
+        return metrics
+
+    def _leaves(self, node: int = None):
+        """
+        Yields the ids, the depth and the cluster label of every leaf under node (the root by default),
+        from left to right; the label of a node's i-th child is the node's label plus i, as for the RTree.
+        """
+        if node is None:
+            node = self.root
+        stack = [(node, 0)]
+        while stack:
+            node, label = stack.pop()
+            if self._is_leaf(node):
+                yield self._node_ids(node), self.nodes["depth"][node], label
+                continue
+            first = self.nodes["first_child"][node]
+            stack.extend(reversed([(first + i, label + i) for i in range(self.nodes["n_children"][node])]))
@@ -0,0 +1,21 @@
+# metrics.py
+"""
+The distances of the M-Tree, vectorised over the rows of an array of points. The tree only relies on them
+being metrics: the triangle inequality bounds the distances it skips.
+"""
+import numpy as np
+
+
+def euclidean_distances(X: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Returns the Euclidean distances from every row of X to the point y, summed in float64.
+    """
+    diff = np.asarray(X) - y
+    return np.sqrt(np.einsum("ij,ij->i", diff, diff, dtype=np.float64))
+
+
+def manhattan_distances(X: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Returns the Manhattan (L1) distances from every row of X to the point y, summed in float64.
+    """
+    return np.abs(np.asarray(X) - y).sum(axis=1, dtype=np.float64)
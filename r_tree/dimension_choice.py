@@ -2,6 +2,8 @@
 
 import random
 
+import numpy as np
+
 ALL_ARGS = ["datapoints", "nbr_dims", "last_dim"]
 
 
@@ -14,19 +16,26 @@ def alternate_dim(nbr_dims, last_dim, **kwargs):
 ALTERNATE_OUT_PLUS = []
 
 
-def random_dim(nbr_dims, **kwargs):
+def random_dim(nbr_dims, rng=random, **kwargs):
     """
-    Returns a random dimension to split on.
+    Returns a random dimension to split on, drawn from rng (the random module by default).
     """
-    return {"dim": random.randint(0, nbr_dims - 1)}
+    return {"dim": rng.randint(0, nbr_dims - 1)}
 
 RANDOM_OUT_PLUS = []
 
 
-def max_variance_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
+def max_variance_dim(datapoints: list[list[float]], nbr_dims: int, stats: dict = None, **kwargs):
     """
     Returns the dimension with the highest variance.
+    The variances come from the "count", "sum" and "sumsq" of the points if stats is given.
     """
+    if stats is not None:
+        mean_vals = stats["sum"] / stats["count"]
+        variances = stats["sumsq"] / stats["count"] - mean_vals**2
+        max_variance_dim = int(np.argmax(variances))
+        return {"dim": max_variance_dim, "mean_val": mean_vals[max_variance_dim]}
+
     max_variance = 0
     max_variance_dim = 0
 
@@ -52,10 +61,15 @@ def max_variance_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
 MAX_VARIANCE_OUT_PLUS = ["mean_val"]
 
 
-def widest_interval_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
+def widest_interval_dim(datapoints: list[list[float]], nbr_dims: int, stats: dict = None, **kwargs):
     """
     Returns the dimension with the highest maximum-minimum value.
+    The intervals come from the "min" and "max" of the points if stats is given.
     """
+    if stats is not None:
+        max_range_dim = int(np.argmax(stats["max"] - stats["min"]))
+        return {"dim": max_range_dim, "max_val": stats["max"][max_range_dim], "min_val": stats["min"][max_range_dim]}
+
     max_range = 0
     max_range_dim = 0
 
@@ -73,9 +87,108 @@ def widest_interval_dim(datapoints: list[list[float]], nbr_dims: int, **kwargs):
 
 WIDEST_INTERVAL_OUT_PLUS = ["max_val", "min_val"]
 
+
+def random_projection_dim(nbr_dims: int, rng=random, **kwargs):
+    """
+    Returns a random unit direction to split on (RP-tree), with Gaussian coordinates drawn from a NumPy
+    generator seeded from rng (the random module by default).
+    """
+    direction = np.random.default_rng(rng.getrandbits(64)).standard_normal(nbr_dims)
+    return {"direction": (direction / np.linalg.norm(direction)).astype(np.float32)}
+
+RANDOM_PROJECTION_OUT_PLUS = []
+
+
+def pca_dim(
+    datapoints: list[list[float]], nbr_dims: int, rng=random, sample_size: int = 1000, n_iter: int = 5, **kwargs
+):
+    """
+    Returns the top principal direction of the points to split on (PCA-tree), estimated by n_iter power
+    iterations on the covariance of a random sample of sample_size points drawn from rng (the random module
+    by default), and the mean of the sample along it. Only the sample is gathered into an array.
+    """
+    positions = range(len(datapoints))
+    if len(datapoints) > sample_size:
+        positions = sorted(rng.sample(positions, sample_size))
+    X = np.array([datapoints[i] for i in positions], dtype=np.float64)
+    mean = X.mean(axis=0)
+    centered = X - mean
+
+    direction = np.random.default_rng(rng.getrandbits(64)).standard_normal(nbr_dims)
+    direction /= np.linalg.norm(direction)
+    for _ in range(n_iter):
+        # the covariance is applied as two matrix-vector products, it is never formed
+        product = centered.T @ (centered @ direction)
+        norm = np.linalg.norm(product)
+        if norm == 0:
+            break
+        direction = product / norm
+    return {"direction": direction.astype(np.float32), "mean_val": float(mean @ direction)}
+
+PCA_OUT_PLUS = ["mean_val"]
+
+
+def alternate_dims(nbr_dims: int, last_dims: np.ndarray, **kwargs):
+    """
+    Returns the next dimension to split on of every node of a level, after last_dims.
+    """
+    return {"dim": (last_dims + 1) % nbr_dims}
+
+
+def random_dims(nbr_dims: int, n_nodes: int, rng=random, **kwargs):
+    """
+    Returns a random dimension to split on for every node of a level, drawn from rng in node order.
+    """
+    return {"dim": np.array([rng.randint(0, nbr_dims - 1) for _ in range(n_nodes)], dtype=np.int64)}
+
+
+def max_variance_dims(stats: dict, **kwargs):
+    """
+    Returns the dimension with the highest variance of every node of a level, from the (n_nodes, n_dims)
+    "count", "sum" and "sumsq" of stats, and the nodes' means along them.
+    """
+    nodes = np.arange(len(stats["count"]))
+    mean_vals = stats["sum"] / stats["count"][:, None]
+    variances = stats["sumsq"] / stats["count"][:, None] - mean_vals**2
+    dims = np.argmax(variances, axis=1)
+    return {"dim": dims, "mean_val": mean_vals[nodes, dims]}
+
+
+def widest_interval_dims(stats: dict, **kwargs):
+    """
+    Returns the dimension with the highest maximum-minimum value of every node of a level, from the
+    (n_nodes, n_dims) "min" and "max" of stats, and the nodes' bounds along them.
+    """
+    nodes = np.arange(len(stats["count"]))
+    dims = np.argmax(stats["max"] - stats["min"], axis=1)
+    return {"dim": dims, "max_val": stats["max"][nodes, dims], "min_val": stats["min"][nodes, dims]}
+
+
+def random_projection_dims(nbr_dims: int, n_nodes: int, rng=random, **kwargs):
+    """
+    Returns a random unit direction to split on for every node of a level, as the rows of an
+    (n_nodes, nbr_dims) array, with Gaussian coordinates drawn from one NumPy generator seeded from rng.
+    """
+    directions = np.random.default_rng(rng.getrandbits(64)).standard_normal((n_nodes, nbr_dims))
+    return {"direction": (directions / np.linalg.norm(directions, axis=1, keepdims=True)).astype(np.float32)}
+
+
+# the versions choosing for all the nodes of a level at once (level-synchronous build, from the MBRs and
+# the sums of the nodes' points), None where the choice is made node by node
+DIM_SEGMENTED = {
+    "alternate": alternate_dims,
+    "random": random_dims,
+    "max_variance": max_variance_dims,
+    "widest_interval": widest_interval_dims,
+    "random_projection": random_projection_dims,
+    "pca": None,
+}
+
 DIM_OUT_PLUS = {
     "alternate": ALTERNATE_OUT_PLUS,
     "random": RANDOM_OUT_PLUS,
     "max_variance": MAX_VARIANCE_OUT_PLUS,
     "widest_interval": WIDEST_INTERVAL_OUT_PLUS,
+    "random_projection": RANDOM_PROJECTION_OUT_PLUS,
+    "pca": PCA_OUT_PLUS,
 }
@@ -1,33 +1,117 @@
 # group_choice.py
 
-def closest_seed_group(seed:list[float], seed2:list[float], nbr_dims:int, datapoints:list[list[float]]):
+import numpy as np
+
+try:
+    from .metrics import *
+except ImportError:
+    from metrics import *
+try:
+    from ..common.segments import *
+except ImportError:
+    from common.segments import *
+
+
+def closest_seed_group(
+    seed: list[float],
+    seed2: list[float],
+    nbr_dims: int,
+    datapoints: list[list[float]],
+    return_ids: bool = False,
+    metric: Metric = None,
+    chunk_rows: int = 4096,
+):
     """
-    Returns the group of points that are closest to either seed1 or seed2.
+    Returns the group of points that are closest to either seed1 or seed2, by the metric (squared Euclidean
+    by default). The distances of the points to a seed are computed as arrays, chunk_rows points at a time.
+    If return_ids is True, the positions of the points in datapoints are returned instead of the points.
     """
-    group1 = []
-    group2 = []
+    metric = metric or SquaredL2()
+    closer = datapoint_distances(metric, datapoints, np.asarray(seed), chunk_rows) < datapoint_distances(
+        metric, datapoints, np.asarray(seed2), chunk_rows
+    )
+    group1 = np.flatnonzero(closer).tolist()
+    group2 = np.flatnonzero(~closer).tolist()
 
-    for point in datapoints:
-        dist1 = sum([(point[dim] - seed[dim]) ** 2 for dim in range(nbr_dims)]) ** 0.5
-        dist2 = sum([(point[dim] - seed2[dim]) ** 2 for dim in range(nbr_dims)]) ** 0.5
+    if return_ids:
+        return group1, group2
+    return [datapoints[i] for i in group1], [datapoints[i] for i in group2]
 
-        if dist1 < dist2:
-            group1.append(point)
-        else:
-            group2.append(point)
 
-    return group1, group2
+def sorting_distance_to_one_seed_group(
+    seed: list[float],
+    nbr_dims: int,
+    datapoints: list[list[float]],
+    return_ids: bool = False,
+    metric: Metric = None,
+    chunk_rows: int = 4096,
+    **kwargs
+):
+    """
+    Sorts the points based on the distance from the seed (by the metric, squared Euclidean by default,
+    computed chunk_rows points at a time). Then splits the sorted points into two groups.
+    If return_ids is True, the positions of the points in datapoints are returned instead of the points.
+    """
+    metric = metric or SquaredL2()
+    order = np.argsort(datapoint_distances(metric, datapoints, np.asarray(seed), chunk_rows), kind="stable").tolist()
+    group1 = order[:len(order) // 2]
+    group2 = order[len(order) // 2:]
+
+    if return_ids:
+        return group1, group2
+    return [datapoints[i] for i in group1], [datapoints[i] for i in group2]
 
 
-def sorting_distance_to_one_seed_group(seed:list[float], nbr_dims:int, datapoints:list[list[float]], **kwargs):
+def closest_seed_segmented_group(
+    data: np.ndarray,
+    ids: np.ndarray,
+    counts: np.ndarray,
+    seeds: np.ndarray,
+    seeds2: np.ndarray,
+    metric: Metric = None,
+    chunk_rows: int = 65536,
+    **kwargs
+):
     """
-    Sorts the points based on the distance from the seed. Then splits the sorted points into two groups.
+    Returns the groups of closest_seed_group of every node of a level at once, the points of the nodes being
+    the consecutive segments of the rows ids of data, of the given counts, and their seeds the rows of seeds
+    and seeds2.
+
+    Returns
+    -------
+    np.ndarray, np.ndarray
+        The positions in ids in their new order, every node's first group before its second one, each in the
+        order of ids, and the size of every first group.
     """
-    sorted_points = sorted(datapoints, key=lambda x: sum([(x[dim] - seed[dim]) ** 2 for dim in range(nbr_dims)]))
-    group1 = sorted_points[:len(sorted_points) // 2]
-    group2 = sorted_points[len(sorted_points) // 2:]
+    metric = metric or SquaredL2()
+    labels = segment_labels(counts)
+    closer = paired_distances(metric, data, ids, seeds, labels, chunk_rows) < paired_distances(metric, data, ids, seeds2, labels, chunk_rows)
+    positions, n_first = segment_partition(closer, counts)
+    order = np.empty_like(positions)
+    order[positions] = np.arange(len(positions))
+    return order, n_first
+
 
-    return group1, group2
-    
+def sorting_distance_to_one_seed_segmented_group(
+    data: np.ndarray,
+    ids: np.ndarray,
+    counts: np.ndarray,
+    seeds: np.ndarray,
+    metric: Metric = None,
+    chunk_rows: int = 65536,
+    **kwargs
+):
+    """
+    Returns the groups of sorting_distance_to_one_seed_group of every node of a level at once, as
+    closest_seed_segmented_group does: every node's points sorted by distance to its seed, the closer half first.
+    """
+    metric = metric or SquaredL2()
+    dists = paired_distances(metric, data, ids, seeds, segment_labels(counts), chunk_rows)
+    return segment_sort(dists, counts), counts // 2
 
 
+# the versions grouping the points of all the nodes of a level at once (level-synchronous build)
+GROUPING_SEGMENTED = {
+    "closest_seed": closest_seed_segmented_group,
+    "sorting_distance_to_one_seed": sorting_distance_to_one_seed_segmented_group,
+}
@@ -0,0 +1,211 @@
+# metrics.py
+"""
+The distances of the RTree, every one computed on whole arrays: from all the points of a node to a seed in
+one call, between blocks of points, and from a query to all the MBRs of a node's children (a lower bound of
+the distance to any point inside them, for the pruning of the searches).
+
+Inside the tree only the order of the distances matters, so the Euclidean distance is compared squared;
+to_output converts the compared distances to the ones the queries return.
+"""
+import numpy as np
+
+try:
+    from ..common.datasource import row_chunks, spill_to_memmap
+except ImportError:
+    from common.datasource import row_chunks, spill_to_memmap
+
+
+class Metric:
+    """
+    Base class of the distances of the RTree.
+
+    Attributes
+    ----------
+    name : str
+        The name of the metric, as given to the RTree.
+    euclidean : bool
+        Whether the compared distances are squared Euclidean distances (on the prepared points), so that the
+        Euclidean machinery (PCA rotation, quantized scans, batched matrix products) applies.
+
+    Methods
+    -------
+    prepare(X: np.ndarray) -> np.ndarray
+        Returns the points (or a point) as the tree stores them.
+    prepare_datapoints(data: np.ndarray, chunk_rows: int, tmp_dir: str) -> np.ndarray
+        Returns all the datapoints as the tree stores them, prepared by chunks of rows.
+    distances(X: np.ndarray, y: np.ndarray) -> np.ndarray
+        Returns the distances from every row of X to the point y.
+    paired(X: np.ndarray, Y: np.ndarray) -> np.ndarray
+        Returns the distances from every row of X to the same row of Y.
+    pairwise(X: np.ndarray, Y: np.ndarray) -> np.ndarray
+        Returns the (len(X), len(Y)) distances between two blocks of points.
+    box_distances(q: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray
+        Returns a lower bound of the distance from q to the points of every box.
+    box_pair_distances(mins1: np.ndarray, maxs1: np.ndarray, mins2: np.ndarray, maxs2: np.ndarray) -> np.ndarray
+        Returns a lower bound of the distance between the points of the boxes of the same row.
+    to_output(dists: np.ndarray) -> np.ndarray
+        Converts compared distances to returned ones.
+    from_output(r: float) -> float
+        Converts a returned distance (e.g. a query radius) to a compared one.
+    """
+
+    name = None
+    euclidean = False
+
+    def prepare(self, X: np.ndarray) -> np.ndarray:
+        return X
+
+    def prepare_datapoints(self, data: np.ndarray, chunk_rows: int = 65536, tmp_dir: str = None) -> np.ndarray:
+        return data
+
+    def to_output(self, dists: np.ndarray) -> np.ndarray:
+        return dists
+
+    def from_output(self, r: float) -> float:
+        return r
+
+
+class SquaredL2(Metric):
+    """
+    The Euclidean distance, compared squared; the queries return the Euclidean distances.
+    """
+
+    name = "sqeuclidean"
+    euclidean = True
+
+    def distances(self, X: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return ((np.asarray(X) - y) ** 2).sum(axis=1)
+
+    def paired(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        return self.distances(X, Y)
+
+    def pairwise(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        # ||x||^2 + ||y||^2 - 2xy, in float64 as the expansion cancels most of the digits of close points
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        return (X**2).sum(axis=1)[:, None] + (Y**2).sum(axis=1)[None, :] - 2 * (X @ Y.T)
+
+    def box_distances(self, q: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+        # 0 along the dimensions where q is inside the box
+        gap = np.maximum(mins - q, 0) + np.maximum(q - maxs, 0)
+        return (gap * gap).sum(axis=-1)
+
+    def box_pair_distances(self, mins1: np.ndarray, maxs1: np.ndarray, mins2: np.ndarray, maxs2: np.ndarray) -> np.ndarray:
+        # 0 along the dimensions where the boxes overlap
+        gap = np.maximum(np.maximum(mins2 - maxs1, mins1 - maxs2), 0).astype(np.float64)
+        return (gap * gap).sum(axis=-1)
+
+    def to_output(self, dists: np.ndarray) -> np.ndarray:
+        return np.sqrt(dists)
+
+    def from_output(self, r: float) -> float:
+        return r * r
+
+
+class L1(Metric):
+    """
+    The Manhattan distance.
+    """
+
+    name = "l1"
+
+    def distances(self, X: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return np.abs(np.asarray(X) - y).sum(axis=1)
+
+    def paired(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        return self.distances(X, Y)
+
+    def pairwise(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        # one row at a time, a (len(X), len(Y), k) difference would not fit in memory
+        Y = np.asarray(Y)
+        return np.stack([self.distances(Y, x) for x in np.asarray(X)]).reshape(len(X), len(Y))
+
+    def box_distances(self, q: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+        return (np.maximum(mins - q, 0) + np.maximum(q - maxs, 0)).sum(axis=-1)
+
+    def box_pair_distances(self, mins1: np.ndarray, maxs1: np.ndarray, mins2: np.ndarray, maxs2: np.ndarray) -> np.ndarray:
+        return np.maximum(np.maximum(mins2 - maxs1, mins1 - maxs2), 0).sum(axis=-1, dtype=np.float64)
+
+
+class Cosine(SquaredL2):
+    """
+    The cosine distance 1 - cos(x, y). The points are normalised to unit length (the zero vector is kept),
+    where ||x - y||^2 = 2 (1 - cos(x, y)): the tree compares the squared Euclidean distances of the
+    normalised points, and the queries return the cosine distances.
+    """
+
+    name = "cosine"
+
+    def prepare(self, X: np.ndarray) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float32)
+        norms = np.linalg.norm(X, axis=-1, keepdims=True)
+        return X / np.where(norms > 0, norms, 1)
+
+    def prepare_datapoints(self, data: np.ndarray, chunk_rows: int = 65536, tmp_dir: str = None) -> np.ndarray:
+        """
+        Returns the normalised datapoints, in memory, or in a temporary memory-mapped file in tmp_dir if
+        data is memory-mapped.
+        """
+        if isinstance(data, np.memmap):
+            return spill_to_memmap(data, np.float32, chunk_rows, tmp_dir, self.prepare, data.shape[1])
+        out = np.empty(data.shape, dtype=np.float32)
+        for start in range(0, len(data), chunk_rows):
+            out[start : start + chunk_rows] = self.prepare(data[start : start + chunk_rows])
+        return out
+
+    def to_output(self, dists: np.ndarray) -> np.ndarray:
+        return dists / 2
+
+    def from_output(self, r: float) -> float:
+        return 2 * r
+
+
+class InnerProduct(Metric):
+    """
+    The negative inner product -x.y, for maximum inner product search: the nearest neighbours are the
+    points of largest inner product with the query. It is not a metric (the distance of a point to itself
+    is not 0), but the bound over a box stays exact: the inner product is largest at a corner, taken
+    dimension by dimension. The queries return the negative inner products.
+    """
+
+    name = "ip"
+
+    def distances(self, X: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return -(np.asarray(X) @ y)
+
+    def paired(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        return -np.einsum("ij,ij->i", np.asarray(X), Y)
+
+    def pairwise(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        return -(np.asarray(X, dtype=np.float64) @ np.asarray(Y, dtype=np.float64).T)
+
+    def box_distances(self, q: np.ndarray, mins: np.ndarray, maxs: np.ndarray) -> np.ndarray:
+        return -np.maximum(q * mins, q * maxs).sum(axis=-1)
+
+    def box_pair_distances(self, mins1: np.ndarray, maxs1: np.ndarray, mins2: np.ndarray, maxs2: np.ndarray) -> np.ndarray:
+        # the largest product of two coordinates of the intervals is at one of their four pairs of ends
+        largest = np.maximum(np.maximum(mins1 * mins2, mins1 * maxs2), np.maximum(maxs1 * mins2, maxs1 * maxs2))
+        return -largest.sum(axis=-1, dtype=np.float64)
+
+
+def paired_distances(metric: Metric, data: np.ndarray, ids: np.ndarray, points: np.ndarray, labels: np.ndarray, chunk_rows: int) -> np.ndarray:
+    """
+    Returns the distances by the metric from every point data[ids[i]] to the point points[labels[i]],
+    reading chunk_rows rows at a time.
+    """
+    dists = np.empty(len(ids), dtype=np.float64)
+    for start in range(0, len(ids), chunk_rows):
+        rows = data[ids[start : start + chunk_rows]]
+        dists[start : start + chunk_rows] = metric.paired(rows, points[labels[start : start + chunk_rows]])
+    return dists
+
+
+def datapoint_distances(metric: Metric, datapoints, y: np.ndarray, chunk_rows: int) -> np.ndarray:
+    """
+    Returns the distances by the metric from every point of datapoints (a list of points, a NodeRows or an
+    array) to the point y, reading chunk_rows points at a time.
+    """
+    dists = np.empty(len(datapoints), dtype=np.float64)
+    for start, rows in row_chunks(datapoints, chunk_rows):
+        dists[start : start + chunk_rows] = metric.distances(rows, y)
+    return dists
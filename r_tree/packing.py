@@ -0,0 +1,112 @@
+# packing.py
+"""
+Orders of the points for bulk-loading a packed R-tree: every function returns the ids reordered so that
+consecutive runs of at most capacity ids, starting at the returned offsets, form the nodes of one level.
+The same functions pack the upper levels, on the centers of the MBRs of the level below.
+"""
+import numpy as np
+
+try:
+    from ..common.datasource import node_stats
+except ImportError:
+    from common.datasource import node_stats
+
+
+def str_tiles(points: np.ndarray, ids: np.ndarray, capacity: int, chunk_rows: int = 65536):
+    """
+    Sort-Tile-Recursive (Leutenegger et al.): the points are sorted along an axis and cut into S slabs of
+    whole tiles, then every slab is sorted and cut along the next axis, and so on, with S = ceil(P^(1/a)) for
+    the P tiles of a slab and its a remaining axes. The a = min(k, ceil(log2(P))) axes are the widest ones of
+    every slab rather than the first ones, which in high dimensions cuts the axes that spread the points.
+    All the tiles are full but the last one of every slab.
+    """
+    ids = np.array(ids, dtype=np.int64)
+    n_tiles = -(-len(ids) // capacity)
+    n_axes = min(points.shape[1], max(1, int(np.ceil(np.log2(max(n_tiles, 2))))))
+
+    starts = []
+    stack = [(0, len(ids), n_axes)]
+    while stack:
+        start, end, axes_left = stack.pop()
+        tiles = -(-(end - start) // capacity)
+        if tiles <= 1 or axes_left == 0:
+            starts.extend(range(start, end, capacity))
+            continue
+
+        stats = node_stats(points, ids[start:end], chunk_rows)
+        axis = int(np.argmax(stats["max"] - stats["min"]))
+        slab = ids[start:end]
+        ids[start:end] = slab[np.argsort(points[slab, axis], kind="stable")]
+
+        slabs = int(np.ceil(tiles ** (1 / axes_left) - 1e-9))
+        slab_size = capacity * -(-tiles // slabs)
+        # pushed backwards so that the tiles are cut from left to right
+        for slab_start in reversed(range(start, end, slab_size)):
+            stack.append((slab_start, min(slab_start + slab_size, end), axes_left - 1))
+
+    return ids, np.array(starts, dtype=np.int64)
+
+
+def hilbert_tiles(points: np.ndarray, ids: np.ndarray, capacity: int, chunk_rows: int = 65536, n_dims: int = 8):
+    """
+    Hilbert packing (Kamel & Faloutsos): the points are sorted by their index along a Hilbert curve and cut
+    into consecutive tiles, all full but the last one. The curve runs through the n_dims axes of highest
+    variance, quantized on 63 // n_dims bits each so that the index fits in 64 bits.
+    """
+    ids = np.array(ids, dtype=np.int64)
+    if len(ids) <= capacity:
+        return ids, np.zeros(min(len(ids), 1), dtype=np.int64)
+
+    stats = node_stats(points, ids, chunk_rows)
+    variance = stats["sumsq"] / len(ids) - (stats["sum"] / len(ids)) ** 2
+    axes = np.sort(np.argsort(-variance, kind="stable")[: min(n_dims, points.shape[1])])
+    bits = min(63 // len(axes), 20)
+
+    low = stats["min"][axes].astype(np.float64)
+    scale = (2**bits - 1) / np.maximum(stats["max"][axes] - low, np.finfo(np.float64).tiny)
+    keys = np.empty(len(ids), dtype=np.uint64)
+    for start in range(0, len(ids), chunk_rows):
+        rows = points[ids[start : start + chunk_rows]][:, axes]
+        coords = np.clip(np.rint((rows - low) * scale), 0, 2**bits - 1)
+        keys[start : start + chunk_rows] = hilbert_keys(coords.astype(np.uint64), bits)
+
+    ids = ids[np.argsort(keys, kind="stable")]
+    return ids, np.arange(0, len(ids), capacity, dtype=np.int64)
+
+
+def hilbert_keys(coords: np.ndarray, bits: int) -> np.ndarray:
+    """
+    Returns the index along the Hilbert curve of every row of coords, integers in [0, 2^bits), with
+    Skilling's transpose algorithm vectorised over the rows. coords.shape[1] * bits must be at most 64.
+    """
+    X = coords.astype(np.uint64).T.copy()
+    n_dims = len(X)
+
+    # inverse undo of the excess work
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = np.uint64(q - 1)
+        for i in range(n_dims):
+            high = (X[i] & np.uint64(q)) != 0
+            X[0] = np.where(high, X[0] ^ p, X[0])
+            t = np.where(high, np.uint64(0), (X[0] ^ X[i]) & p)
+            X[0] ^= t
+            X[i] ^= t
+        q >>= 1
+
+    # Gray encoding
+    for i in range(1, n_dims):
+        X[i] ^= X[i - 1]
+    t = np.zeros(X.shape[1], dtype=np.uint64)
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((X[n_dims - 1] & np.uint64(q)) != 0, t ^ np.uint64(q - 1), t)
+        q >>= 1
+    X ^= t
+
+    # the transposed index is interleaved bit by bit, most significant first
+    keys = np.zeros(X.shape[1], dtype=np.uint64)
+    for bit in range(bits - 1, -1, -1):
+        for i in range(n_dims):
+            keys = (keys << np.uint64(1)) | ((X[i] >> np.uint64(bit)) & np.uint64(1))
+    return keys
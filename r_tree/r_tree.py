@@ -1,7 +1,40 @@
-from seeds_choice import *
-from grouping_choice import *
+try:
+    from .seeds_choice import *
+    from .grouping_choice import *
+    from .packing import *
+    from .metrics import *
+except ImportError:
+    from seeds_choice import *
+    from grouping_choice import *
+    from packing import *
+    from metrics import *
+try:
+    from ..common.datasource import *
+    from ..common.index_file import *
+    from ..common.quality import *
+    from ..common.transform import *
+    from ..common.quantization import *
+    from ..common.batch_search import *
+    from ..common.all_knn import *
+    from ..common.instrumentation import *
+except ImportError:
+    from common.datasource import *
+    from common.index_file import *
+    from common.quality import *
+    from common.transform import *
+    from common.quantization import *
+    from common.batch_search import *
+    from common.all_knn import *
+    from common.instrumentation import *
 from sklearn.metrics import silhouette_score
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from multiprocessing.shared_memory import SharedMemory
 import numpy as np
+import heapq
+import random
+import copy
+import os
 
 class RTree:
     """
@@ -10,7 +43,7 @@ class RTree:
     Attributes:
     ----------
     k : int
-        The number of dimensions of the datapoints.
+        The number of dimensions of the datapoints (of the rotated ones with a rotation).
     root : dict
         The root node of the RTree.
     grouping_choice : function
@@ -19,6 +52,39 @@ class RTree:
         The function to choose the seed points.
     dimension_choice : str
         The function to choose the dimension to split on.
+    metric : Metric
+        The distance of the strategies and the searches (see metrics.py).
+    data : np.ndarray
+        The datapoints, indexed by the ids stored in the nodes (a np.memmap when built from a file).
+    layout : str
+        The node layout, "dict" or "flat".
+    packing : str
+        The bulk-loading order of a packed tree, "str" or "hilbert", or None for the binary seed/grouping splits.
+    fanout : int
+        The number of children of the internal nodes of a packed tree.
+    nodes : dict[str, np.ndarray]
+        With the "flat" layout, the parallel node arrays: "min" and "max" (the MBRs, one (n_nodes, k) array each),
+        "first_child" and "n_children" (the children of a node are contiguous), "depth", "start" and "count".
+        The root is node 0.
+    storage : str
+        How the nodes hold their points, "points" or "ranges".
+    perm : np.ndarray
+        With the "ranges" storage, the permutation of the ids into leaf order; the points of every node are
+        a contiguous range of it.
+    pca : PCARotation
+        The global rotation applied to the datapoints and the queries, None without a rotation.
+    quantizer : ScalarQuantizer
+        The encoding of the compressed vectors scanned by the kNN search, None to scan the datapoints.
+    codes : np.ndarray
+        With a quantizer, the compressed datapoints, indexed by id like data.
+    rng : random.Random
+        The source of the random draws of the strategies, the random module by default.
+    n_jobs : int
+        The number of workers building the subtrees below the parallel threshold, None for a sequential build.
+    n_points : int
+        The number of points in the tree (the deleted points keep their row in data).
+    tree_stats : TreeStats
+        The statistics of the build and of the kNN searches, None unless collect_stats is set.
 
     Methods:
     -------
@@ -26,8 +92,40 @@ class RTree:
         Builds the RTree from the given datapoints.
     recursive_build(datapoints: list[list[float]], depth: int, last_dim: int) -> dict
         Recursively builds the RTree from the given datapoints.
-    compute_silhouette_score() -> float
-        Computes the Silhouette Score for the RTree.
+    range_build(node, depth: int, last_dim: int)
+        Recursively splits a node holding a range of the id permutation ("ranges" storage).
+    level_build() -> int
+        Builds the RTree level by level, all the nodes of a depth at once ("level" builder).
+    pack_build(ids: np.ndarray, depth: int) -> np.ndarray, dict
+        Bulk-loads a packed subtree of full, fanout-wide nodes over the given ids.
+    insert(points: list[list[float]], alpha: float) -> np.ndarray
+        Inserts points without rebuilding the tree (leaf-overflow splits, scapegoat-style partial rebuilds).
+    delete(ids: list[int], alpha: float)
+        Removes points from the tree.
+    query(q: list[float], k: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of a query point (best-first search on the MBRs).
+    query_batch(Q: list[list[float]], k: int) -> np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every query point.
+    all_knn(k: int, include_self: bool, n_threads: int) -> np.ndarray, np.ndarray, np.ndarray
+        Finds the k nearest neighbours of every indexed point (a self-join), as a CSR neighbour graph.
+    query_radius(q: list[float], r: float) -> np.ndarray, np.ndarray
+        Finds all the points within distance r of a query point.
+    query_radius_batch(Q: list[list[float]], r: float) -> list[np.ndarray], list[np.ndarray]
+        Finds all the points within distance r of every query point.
+    query_box(low: list[float], high: list[float]) -> np.ndarray
+        Finds all the points inside an axis-aligned box.
+    query_box_batch(lows: list[list[float]], highs: list[list[float]]) -> list[np.ndarray]
+        Finds all the points inside every box.
+    compute_silhouette_score(sample_size: int, seed: int) -> float
+        Computes the Silhouette Score for the RTree, exactly or on a sample of points.
+    quality_metrics() -> dict
+        Computes the per-leaf and MBR quality metrics of the RTree.
+    get_stats() -> dict
+        Returns the build and query statistics collected with collect_stats.
+    save(path: str)
+        Saves a "flat" RTree to an index file.
+    load(path: str, mmap: bool) -> RTree
+        Loads an RTree from an index file, memory-mapped by default.
     _flatten_tree(node: dict, label: int) -> list[list[float]], list[int]
         Flattens the RTree to get all points and their cluster labels.
     """
@@ -41,6 +139,25 @@ class RTree:
         dimension_choice: str = "random",
         leaf_size: int = 10,
         max_depth: int = None,
+        layout: str = "dict",
+        storage: str = None,
+        packing: str = None,
+        fanout: int = 16,
+        seed_params: dict = None,
+        n_jobs: int = None,
+        parallel_depth: int = 4,
+        parallel_size: int = None,
+        parallel_backend: str = "process",
+        tmp_dir: str = None,
+        dimension_stats: str = "exact",
+        stats_sample_size: int = 1024,
+        rotation: str = None,
+        n_components: int = None,
+        vector_storage: str = None,
+        rerank: int = 4,
+        metric: str = "sqeuclidean",
+        builder: str = "recursive",
+        collect_stats: bool = False,
     ):
         """
         Initializes the RTree with the given datapoints and the grouping_choice and seed_choice functions.
@@ -50,20 +167,120 @@ class RTree:
         k : int
             The number of dimensions of the datapoints.
         datapoints : list[list[float]]
-            The list of datapoints to build the RTree from.
+            The list of datapoints to build the RTree from. With the "ranges" storage, also a path to a .npy
+            file or a memory-mapped array (used without copying it to memory) or an HDF5 dataset (copied by
+            chunks to a temporary memory-mapped file in tmp_dir).
         grouping_choice : str, optional
             The function to choose the grouping of points, by default "closest_seed_group".
             Options: "closest_seed_group", "sorting_distance_to_one_seed_group".
         seed_choice : str, optional
             The function to choose the seed points, by default "one_dim_farthest".
-            Options: "one_dim_farthest", "farthest_euc_distance".
+            Options: "one_dim_farthest", "farthest_euc_distance", "farthest_euc_distance_blocked"
+            (exact, vectorised by blocks), "approx_farthest" (linear-time approximation).
         dimension_choice : str, optional
             Used by the seed_choice function when it's "one_dim_farthest", by default "random".
-            Options: "alternate", "random", "max_variance", "widest_interval".
+            Options: "alternate", "random", "max_variance", "widest_interval", "random_projection" (the seeds
+            are the farthest apart along a random unit direction), "pca" (along the top principal direction of
+            the node's points, by power iterations on a sample).
         leaf_size : int, optional
             The maximum number of points that can be stored in a leaf node, by default 10.
         max_depth : int, optional
             The maximum depth of the tree, by default None.
+        layout : str, optional
+            The node layout, by default "dict".
+            Options: "dict" (one dict per node, each holding its points), "flat" (contiguous NumPy arrays
+            for the MBRs and the child offsets, and (start, count) ranges of one id permutation for the points).
+        storage : str, optional
+            How the nodes hold their points, by default "points" with the "dict" layout and "ranges" with the "flat" one.
+            Options: "points" (every node keeps the list of its points and their ids, at every depth),
+            "ranges" (the ids are permuted once into leaf order and every node only keeps the (offset, count)
+            range of its points; the "flat" layout always uses it).
+        packing : str, optional
+            Bulk-load a packed tree instead of splitting the nodes in two, by default None. Requires the "flat"
+            layout. The points are ordered once, cut into full leaves of leaf_size points, and every level is
+            packed the same way into full nodes of fanout children, bottom-up: the tree is shallow, its nodes
+            full, and it is built without the seed and grouping choices.
+            Options: "str" (Sort-Tile-Recursive on the widest axes), "hilbert" (Hilbert curve order on the
+            axes of highest variance).
+            With max_depth, the leaves are enlarged so that the tree is not deeper.
+        fanout : int, optional
+            The number of children of the internal nodes of a packed tree, by default 16 (16 to 64 is typical).
+        seed_params : dict, optional
+            Extra keyword arguments of the seed_choice function, by default None.
+            E.g. {"block_size": 512} for "farthest_euc_distance_blocked", {"n_iter": 3, "sample_size": 1000} for "approx_farthest".
+        n_jobs : int, optional
+            The number of workers building subtrees in parallel, by default None (sequential build);
+            -1 uses all the CPU cores. Requires the "ranges" storage.
+            The top of the tree is built first; every node at parallel_depth, or with at most parallel_size
+            points, becomes an independent subtree built by a worker with its own random.Random, seeded
+            from the tree's random state in subtree order. The tree thus only depends on the random seed,
+            not on n_jobs (but differs from the sequential build when the strategies are random).
+        parallel_depth : int, optional
+            The depth at which the subtrees are handed to the workers, by default 4.
+        parallel_size : int, optional
+            The number of points under which a subtree is handed to the workers, by default None.
+        parallel_backend : str, optional
+            The worker pool, by default "process".
+            Options: "process" (the datapoints are shared with the workers through shared memory),
+            "thread" (only the NumPy parts of the build release the GIL).
+        tmp_dir : str, optional
+            The directory of the temporary file an HDF5 dataset is copied to, by default the system's.
+        dimension_stats : str, optional
+            How the per-dimension statistics of the "max_variance" and "widest_interval" dimension choices of
+            "one_dim_farthest" are computed at every node, by default "exact". Requires the "ranges" storage
+            unless "exact".
+            Options: "exact" (over all the node's points, in Python),
+            "incremental" (vectorised over the root's points only, then every node computes the sums over its
+            smaller group and subtracts them from its own for the larger one; the min and max are the MBRs
+            of the groups, so "widest_interval" stays exact),
+            "sampled" (over a random sample of stats_sample_size points of every node, drawn from the tree's
+            random state; the variances are estimates and the intervals those of the sample).
+        stats_sample_size : int, optional
+            The number of points of the "sampled" statistics, by default 1024.
+        rotation : str, optional
+            A global transform of the datapoints before the build, applied to the queries and the inserted
+            points too, by default None. Requires the "ranges" storage; query_box is then not available, as
+            the boxes would be rotated.
+            Options: "pca" (rotation onto the principal directions, fitted on a sample of 20000 points).
+        n_components : int, optional
+            With rotation, the number of principal directions kept, by default None (all of them, which keeps
+            the distances). With fewer, the tree indexes the truncated vectors: the search is exact in that
+            space, and its distances are lower bounds of the true ones.
+        vector_storage : str, optional
+            A compressed copy of the datapoints for the leaf scans of the kNN search, by default None (the
+            leaves are scanned on the datapoints). Requires the "ranges" storage. The search keeps the
+            rerank * k best candidates by approximate distance, then re-ranks them on the datapoints, which
+            only need to be read for them (e.g. memory-mapped from a .npy file); the search is then approximate.
+            The radius and box queries stay exact, on the datapoints.
+            Options: "float16" (half the memory), "int8" (a quarter: one code per dimension on 256 levels
+            between the minimum and the maximum of the dimension).
+        rerank : int, optional
+            With vector_storage, the number of candidates re-ranked per neighbour, by default 4.
+        metric : str, optional
+            The distance used by the seed and grouping choices and by the kNN and radius searches, by default
+            "sqeuclidean". Every metric computes its distances on whole arrays, and bounds the distance from a
+            query to the points of an MBR so that the searches stay exact.
+            Options: "sqeuclidean" (the Euclidean distance, compared squared; the queries return Euclidean
+            distances), "l1" (Manhattan), "cosine" (the points and the queries are normalised to unit length,
+            where the squared Euclidean distance is twice the cosine distance; the queries return cosine
+            distances; requires the "ranges" storage), "ip" (the negative inner product, for maximum inner
+            product search; the queries return negative inner products).
+            rotation and vector_storage require "sqeuclidean" or "cosine", and query_box is not available
+            with "cosine".
+        builder : str, optional
+            How the tree is built, by default "recursive".
+            Options: "recursive" (node by node, depth first), "level" (breadth first without recursion: all the
+            nodes of a depth are split together, their MBRs, statistics, seeds and groups computed with
+            segmented array operations over the points of the level, so the Python work is per level rather
+            than per node; the "farthest_euc_distance" seeds and the "pca" dimension choice are still chosen
+            node by node; requires the "flat" layout, and neither packing, n_jobs nor a dimension_stats
+            other than "exact"). It gives the same trees as range_build for the deterministic strategies; the
+            random draws are made in level order.
+        collect_stats : bool, optional
+            Collect the statistics of the build and of the kNN searches, read by get_stats, by default False:
+            the time and the calls of the seed, grouping and packing functions (not those of the subtrees
+            built by worker processes with n_jobs), and the nodes visited, leaves scanned and distances
+            computed by the queries.
         """
         self.k = k
         self.leaf_size = leaf_size
@@ -75,15 +292,119 @@ class RTree:
         }
         self.grouping_choice = switcher[grouping_choice]
 
+        switcher = {
+            "sqeuclidean": SquaredL2,
+            "l1": L1,
+            "cosine": Cosine,
+            "ip": InnerProduct,
+        }
+
+        assert metric in switcher, "Invalid metric, choose from 'sqeuclidean', 'l1', 'cosine', 'ip'"
+
+        self.metric = switcher[metric]()
+
         switcher = {
             "one_dim_farthest": one_dim_farthest_seeds,
             "farthest_euc_distance": farthest_euc_distance_seeds,
+            "farthest_euc_distance_blocked": farthest_euc_distance_blocked_seeds,
+            "approx_farthest": approx_farthest_seeds,
         }
         self.seed_choice = switcher[seed_choice]
 
+        # the names are kept to save the index
+        self.grouping_choice_name = grouping_choice
+        self.seed_choice_name = seed_choice
+
+        self.seed_params = seed_params or {}
+
         self.dimension_choice = dimension_choice
 
-        self.root = self.build(datapoints)
+        assert dimension_stats in ("exact", "incremental", "sampled"), "Invalid dimension_stats, choose from 'exact', 'incremental', 'sampled'"
+
+        self.dimension_stats = dimension_stats
+        self.stats_sample_size = stats_sample_size
+        # whether the seeds are chosen on a dimension picked from per-dimension statistics
+        self._uses_stats = (
+            dimension_stats != "exact"
+            and seed_choice == "one_dim_farthest"
+            and dimension_choice in ("max_variance", "widest_interval")
+        )
+
+        assert layout in ("dict", "flat"), "Invalid layout, choose from 'dict', 'flat'"
+
+        self.layout = layout
+
+        if storage is None:
+            storage = "ranges" if layout == "flat" else "points"
+
+        assert storage in ("points", "ranges"), "Invalid storage, choose from 'points', 'ranges'"
+        assert layout == "dict" or storage == "ranges", "The 'flat' layout requires the 'ranges' storage"
+        assert dimension_stats == "exact" or storage == "ranges", "dimension_stats requires the 'ranges' storage"
+
+        self.storage = storage
+
+        assert packing in (None, "str", "hilbert"), "Invalid packing, choose from 'str', 'hilbert'"
+        assert packing is None or layout == "flat", "packing requires the 'flat' layout"
+        assert fanout >= 2, "fanout must be at least 2"
+
+        self.packing = packing
+        self.fanout = fanout
+
+        assert rotation in (None, "pca"), "Invalid rotation, choose from 'pca'"
+        assert rotation is None or storage == "ranges", "rotation requires the 'ranges' storage"
+        assert rotation is None or self.metric.euclidean, "rotation requires the 'sqeuclidean' or 'cosine' metric"
+        assert metric != "cosine" or storage == "ranges", "the 'cosine' metric requires the 'ranges' storage"
+
+        self.rotation = rotation
+        self.n_components = n_components
+        self.pca = None
+
+        assert vector_storage in (None, "float16", "int8"), "Invalid vector_storage, choose from 'float16', 'int8'"
+        assert vector_storage is None or storage == "ranges", "vector_storage requires the 'ranges' storage"
+        assert vector_storage is None or self.metric.euclidean, "vector_storage requires the 'sqeuclidean' or 'cosine' metric"
+        assert rerank >= 1, "rerank must be at least 1"
+
+        self.vector_storage = vector_storage
+        self.rerank = rerank
+        self.quantizer = None if vector_storage is None else ScalarQuantizer(vector_storage)
+        self.codes = None
+
+        assert n_jobs is None or storage == "ranges", "n_jobs requires the 'ranges' storage"
+        assert n_jobs is None or packing is None, "n_jobs is not supported by packing"
+        assert builder in ("recursive", "level"), "Invalid builder, choose from 'recursive', 'level'"
+        assert builder == "recursive" or layout == "flat", "The 'level' builder requires the 'flat' layout"
+        assert builder == "recursive" or packing is None, "packing is not supported by the 'level' builder"
+        assert builder == "recursive" or n_jobs is None, "n_jobs is not supported by the 'level' builder"
+        assert builder == "recursive" or dimension_stats == "exact", "dimension_stats is not supported by the 'level' builder"
+
+        self.builder = builder
+        assert parallel_backend in ("process", "thread"), "Invalid parallel_backend, choose from 'process', 'thread'"
+
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.parallel_depth = parallel_depth
+        self.parallel_size = parallel_size
+        self.parallel_backend = parallel_backend
+        self.rng = random
+        self.tmp_dir = tmp_dir
+        # subtrees waiting for the workers during a parallel build, as (node, start, end, depth, last_dim)
+        self._tasks = None
+        # the buffers with spare capacity behind data and perm once points have been inserted
+        self._buffers = {}
+        # whether the internal nodes' ids (or ranges) are up to date, the updates only maintain the leaves'
+        self._inner_ids_valid = True
+
+        # the strategies are only wrapped by timers when the statistics are collected
+        self.tree_stats = TreeStats() if collect_stats else None
+        self.seed_choice = timed(self.tree_stats, "seed_choice", self.seed_choice)
+        self.grouping_choice = timed(self.tree_stats, "grouping_choice", self.grouping_choice)
+
+        with phase_timer(self.tree_stats, "build"):
+            self.root = self.build(datapoints)
+        self.n_points = len(self.data)
+        # the number of points of the tree at its last full rebuild, or more if it grew since
+        self._peak_points = self.n_points
+        # the height and the number of points of the tree at its last full rebuild, measured on the first insert
+        self._built_height = self._built_points = None
 
     def build(self, datapoints: list[list[float]]) -> dict:
         """
@@ -94,20 +415,63 @@ class RTree:
         datapoints : list[list[float]]
             The list of datapoints to build the RTree from.
         """
-        Pmin = [min(point[dim] for point in datapoints) for dim in range(self.k)]
-        Pmax = [max(point[dim] for point in datapoints) for dim in range(self.k)]
+        if self.storage == "ranges":
+            self.data = open_datapoints(datapoints, tmp_dir=self.tmp_dir)
+            self.data = self.metric.prepare_datapoints(self.data, tmp_dir=self.tmp_dir)
+            if self.rotation is not None and len(self.data) > 0:
+                self.pca = PCARotation(self.n_components).fit(self.data, seed=self.rng.getrandbits(32))
+                self.data = self.pca.transform_datapoints(self.data, tmp_dir=self.tmp_dir)
+                self.k = self.pca.n_components
+            if self.quantizer is not None:
+                self.quantizer.fit(self.data)
+                self.codes = self.quantizer.encode_datapoints(self.data.reshape(-1, self.k))
+            self.perm = np.arange(len(self.data), dtype=np.int64)
+            if self.packing is not None:
+                self.perm, self.nodes = self.pack_build(self.perm, 0)
+                self.n_nodes = len(self.nodes["depth"])
+                return 0
+            if self.layout == "flat":
+                # start from the size of a balanced binary tree, the arrays grow if the splits are uneven
+                n_leaves = max(1, -(-len(self.data) // max(self.leaf_size, 1)))
+                self._init_nodes(2 * (1 << (n_leaves - 1).bit_length()) - 1)
+            if self.builder == "level" and len(self.data) > 0:
+                root = self.level_build()
+                self._trim_nodes()
+                return root
+            if self.layout == "flat":
+                root = self._new_nodes(1)
+                self._set_node(root, 0, 0, len(self.data))
+            else:
+                root = self._range_node(0, 0, len(self.data))
+            if self.n_jobs is not None:
+                self._tasks = []
+            self.range_build(root, 1)
+            if self._tasks:
+                self._build_tasks()
+            self._tasks = None
+            if self.layout == "flat":
+                self._trim_nodes()
+            return root
+
+        # keep an array view of the data so that the MBRs and the queries can index the points by id
+        self.data = np.asarray(datapoints)
+        ids = np.arange(len(datapoints), dtype=np.int64)
 
         return {
-            "min": Pmin,
-            "max": Pmax,
+            "min": self.data.min(axis=0),
+            "max": self.data.max(axis=0),
             "points": datapoints,
+            "ids": ids,
             "depth": 0,
-            "children": self.recursive_build(datapoints, 1),
+            "children": self.recursive_build(datapoints, 1, ids=ids),
         }
 
     def recursive_build(
-        self, datapoints: list[list[float]], depth: int, last_dim: int = 0
+        self, datapoints: list[list[float]], depth: int, last_dim: int = 0, ids: np.ndarray = None
     ) -> dict:
+        if ids is None:
+            ids = np.arange(len(datapoints), dtype=np.int64)
+
         # Stop recursion if the number of points is <= leaf_size or max_depth is reached
         if len(datapoints) <= self.leaf_size or (self.max_depth is not None and depth >= self.max_depth):
             return None
@@ -117,57 +481,1556 @@ class RTree:
             nbr_dims=self.k,
             dimension_choice_alg=self.dimension_choice,
             last_dim=last_dim,
+            rng=self.rng,
+            metric=self.metric,
+            **self.seed_params,
         )
 
         seeds = seeds_result["seeds"]
+        if len(seeds) < 2:
+            # no two points are apart
+            seeds = [datapoints[0], datapoints[-1]]
 
         groups = self.grouping_choice(
-            seed=seeds[0], seed2=seeds[1], nbr_dims=self.k, datapoints=datapoints
+            seed=seeds[0], seed2=seeds[1], nbr_dims=self.k, datapoints=datapoints, return_ids=True, metric=self.metric
         )
+        if not groups[0] or not groups[1]:
+            # the seeds do not separate the points (duplicates), cut them in halves
+            groups = (list(range(len(datapoints) // 2)), list(range(len(datapoints) // 2, len(datapoints))))
 
-        Pmin = [min(point[dim] for point in groups[0]) for dim in range(self.k)]
-        Pmax = [max(point[dim] for point in groups[0]) for dim in range(self.k)]
+        points = [datapoints[i] for i in groups[0]]
+        group_ids = ids[np.array(groups[0], dtype=np.int64)]
 
         left = {
-            "min": Pmin,
-            "max": Pmax,
-            "points": groups[0],
+            "min": self.data[group_ids].min(axis=0),
+            "max": self.data[group_ids].max(axis=0),
+            "points": points,
+            "ids": group_ids,
             "depth": depth,
             "children": self.recursive_build(
-                groups[0],
+                points,
                 depth + 1,
                 last_dim=seeds_result["dim"] if "dim" in seeds_result else None,
+                ids=group_ids,
             ),
         }
 
-        Pmin = [min(point[dim] for point in groups[1]) for dim in range(self.k)]
-        Pmax = [max(point[dim] for point in groups[1]) for dim in range(self.k)]
+        points = [datapoints[i] for i in groups[1]]
+        group_ids = ids[np.array(groups[1], dtype=np.int64)]
 
         right = {
-            "min": Pmin,
-            "max": Pmax,
-            "points": groups[1],
+            "min": self.data[group_ids].min(axis=0),
+            "max": self.data[group_ids].max(axis=0),
+            "points": points,
+            "ids": group_ids,
             "depth": depth,
             "children": self.recursive_build(
-                groups[1],
+                points,
                 depth + 1,
                 last_dim=seeds_result["dim"] if "dim" in seeds_result else None,
+                ids=group_ids,
             ),
         }
 
         return {"left": left, "right": right}
 
-    def compute_silhouette_score(self):
+    def range_build(self, node, depth: int, last_dim: int = 0, stats: dict = None):
+        """
+        Recursively splits a node holding a range of perm ("ranges" storage, either layout),
+        using the same seed and grouping choices as recursive_build.
+
+        The strategies get the node's rows as a NodeRows, which they read by chunks rather than copy; the ids are
+        reordered in place so that each group is a contiguous range of perm. With the "flat" layout,
+        the two children are allocated next to each other.
+        With the "incremental" dimension_stats, stats are the node's statistics derived by its parent.
+        """
+        start, end = self._node_range(node)
+
+        # Stop recursion if the number of points is <= leaf_size or max_depth is reached
+        if end - start <= self.leaf_size or (self.max_depth is not None and depth >= self.max_depth):
+            return
+
+        # in a parallel build, the node is left as a leaf until a worker splits it
+        if self._tasks is not None and (
+            depth - 1 >= self.parallel_depth or (self.parallel_size is not None and end - start <= self.parallel_size)
+        ):
+            self._tasks.append((node, start, end, depth, last_dim))
+            return
+
+        ids = self.perm[start:end]
+        # the strategies read the rows by chunks of 4 MB, also of memory-mapped datapoints
+        chunk_rows = max(1, (1 << 22) // (self.k * self.data.itemsize))
+        points = NodeRows(self.data.view(np.ndarray), ids)
+
+        stats_kwargs = {}
+        if self._uses_stats:
+            if stats is None:
+                stats = self._dimension_stats(ids)
+            stats_kwargs["stats"] = stats
+
+        seeds_result = self.seed_choice(
+            datapoints=points,
+            nbr_dims=self.k,
+            dimension_choice_alg=self.dimension_choice,
+            last_dim=last_dim,
+            rng=self.rng,
+            metric=self.metric,
+            chunk_rows=chunk_rows,
+            **stats_kwargs,
+            **self.seed_params,
+        )
+
+        seeds = seeds_result["seeds"]
+        if len(seeds) < 2:
+            # no two points are apart
+            seeds = [points[0], points[-1]]
+
+        groups = self.grouping_choice(
+            seed=seeds[0],
+            seed2=seeds[1],
+            nbr_dims=self.k,
+            datapoints=points,
+            return_ids=True,
+            metric=self.metric,
+            chunk_rows=chunk_rows,
+        )
+        if not groups[0] or not groups[1]:
+            # the seeds do not separate the points (duplicates), cut them in halves
+            groups = (list(range(len(points) // 2)), list(range(len(points) // 2, len(points))))
+        del points
+        left = np.array(groups[0], dtype=np.int64)
+        right = np.array(groups[1], dtype=np.int64)
+
+        self.perm[start:end] = np.concatenate((ids[left], ids[right]))
+        middle = start + len(left)
+
+        if self.layout == "flat":
+            left_child = self._new_nodes(2)
+            right_child = left_child + 1
+            self.nodes["first_child"][node] = left_child
+            self.nodes["n_children"][node] = 2
+            self._set_node(left_child, depth, start, middle)
+            self._set_node(right_child, depth, middle, end)
+        else:
+            left_child = self._range_node(depth, start, middle)
+            right_child = self._range_node(depth, middle, end)
+            node["children"] = {"left": left_child, "right": right_child}
+
+        left_stats = right_stats = None
+        if (
+            self._uses_stats
+            and self.dimension_stats == "incremental"
+            and start < middle < end
+            and max(middle - start, end - middle) > self.leaf_size
+            and (self.max_depth is None or depth + 1 < self.max_depth)
+        ):
+            # the sums are computed over the smaller group only, the larger one gets the difference
+            if middle - start <= end - middle:
+                left_stats = self._dimension_stats(self.perm[start:middle])
+                right_stats = complement_stats(stats, left_stats)
+            else:
+                right_stats = self._dimension_stats(self.perm[middle:end])
+                left_stats = complement_stats(stats, right_stats)
+            # and the intervals are the MBRs of the groups
+            for child, child_stats in ((left_child, left_stats), (right_child, right_stats)):
+                low, high = self._node_mbr(child)
+                child_stats["min"], child_stats["max"] = low.copy(), high.copy()
+
+        last_dim = seeds_result["dim"] if "dim" in seeds_result else None
+        self.range_build(left_child, depth + 1, last_dim, left_stats)
+        self.range_build(right_child, depth + 1, last_dim, right_stats)
+
+    def level_build(self) -> int:
+        """
+        Builds the RTree over the ids of perm breadth first, without recursion ("level" builder), with the
+        same seed and grouping choices as range_build.
+
+        The frontier holds the nodes of one depth, each a range of perm, laid out one after the other as
+        the segments of one array of ids. One pass over the points of the level computes the MBRs of all
+        the nodes (and the sums of the "max_variance" choice); the seeds and the groups of all the nodes to
+        split are then segmented array operations over the level, and the grouped ids are written back to
+        their ranges. The "flat" nodes are stored level by level, the two children of a node next to each other.
+        """
+        chunk_rows = max(1, (1 << 24) // (self.k * self.data.itemsize))
+        seed_choice = timed(self.tree_stats, "seed_choice", SEEDS_SEGMENTED[self.seed_choice_name])
+        grouping_choice = timed(self.tree_stats, "grouping_choice", GROUPING_SEGMENTED[self.grouping_choice_name])
+        sums = self.seed_choice_name == "one_dim_farthest" and self.dimension_choice == "max_variance"
+
+        root = self._new_nodes(1)
+        self.nodes["depth"][root] = 0
+        self.nodes["start"][root] = 0
+        self.nodes["count"][root] = len(self.perm)
+        frontier = np.array([root], dtype=np.int64)
+        last_dims = np.zeros(1, dtype=np.int64)
+        depth = 0
+        while len(frontier):
+            starts = self.nodes["start"][frontier]
+            counts = self.nodes["count"][frontier]
+            stats = segment_stats(self.data, self.perm[gather_ranges(starts, counts)], counts, chunk_rows, sums=sums)
+            self.nodes["min"][frontier] = stats["min"]
+            self.nodes["max"][frontier] = stats["max"]
+            self.nodes["first_child"][frontier] = -1
+            self.nodes["n_children"][frontier] = 0
+
+            # the children are at depth + 1, a node of one point cannot be split in two
+            if self.max_depth is not None and depth + 1 >= self.max_depth:
+                break
+            split = counts > max(self.leaf_size, 1)
+            if not split.any():
+                break
+            frontier, starts, counts, last_dims = frontier[split], starts[split], counts[split], last_dims[split]
+            stats = {key: values[split] for key, values in stats.items()}
+            positions = gather_ranges(starts, counts)
+            ids = self.perm[positions]
+            offsets = segment_offsets(counts)
+
+            kwargs = {"data": self.data, "ids": ids, "counts": counts, "rng": self.rng, "metric": self.metric, "chunk_rows": chunk_rows}
+            if seed_choice is None:
+                seeds_result = self._node_seed_choices(ids, counts, last_dims)
+            else:
+                seeds_result = seed_choice(
+                    nbr_dims=self.k,
+                    dimension_choice_alg=self.dimension_choice,
+                    last_dims=last_dims,
+                    stats=stats,
+                    **kwargs,
+                    **self.seed_params,
+                )
+            seeds, seeds2 = seeds_result["seeds"]
+
+            order, n_first = grouping_choice(seeds=seeds, seeds2=seeds2, **kwargs)
+            bad = (n_first == 0) | (n_first == counts)
+            if bad.any():
+                # the seeds do not separate the points (duplicates), cut them in halves
+                in_bad = np.repeat(bad, counts)
+                order[in_bad] = np.flatnonzero(in_bad)
+                n_first[bad] = counts[bad] // 2
+            self.perm[positions] = ids[order]
+            del ids, positions, order
+
+            children = self._new_nodes(2 * len(frontier)) + np.arange(2 * len(frontier))
+            left, right = children[0::2], children[1::2]
+            self.nodes["first_child"][frontier] = left
+            self.nodes["n_children"][frontier] = 2
+            self.nodes["depth"][children] = depth + 1
+            self.nodes["start"][left] = starts
+            self.nodes["count"][left] = n_first
+            self.nodes["start"][right] = starts + n_first
+            self.nodes["count"][right] = counts - n_first
+
+            frontier = children
+            last_dims = np.repeat(seeds_result["dim"] if "dim" in seeds_result else last_dims, 2)
+            depth += 1
+        return root
+
+    def _node_seed_choices(self, ids: np.ndarray, counts: np.ndarray, last_dims: np.ndarray) -> dict:
+        """
+        Calls the seed choice on every node of a level in turn, for the choices that have no segmented
+        version, and returns the seeds as the rows of two arrays, as the segmented choices do.
+        The nodes' ids are the consecutive segments of ids, of the given counts.
+        """
+        # plain ndarray rows, also of memory-mapped datapoints
+        data = self.data.view(np.ndarray)
+        seeds = []
+        for offset, count, last_dim in zip(segment_offsets(counts).tolist(), counts.tolist(), last_dims.tolist()):
+            points = NodeRows(data, ids[offset : offset + count])
+            node_seeds = self.seed_choice(
+                datapoints=points,
+                nbr_dims=self.k,
+                dimension_choice_alg=self.dimension_choice,
+                last_dim=last_dim,
+                rng=self.rng,
+                metric=self.metric,
+                **self.seed_params,
+            )["seeds"]
+            if len(node_seeds) < 2:
+                # no two points are apart
+                node_seeds = [points[0], points[-1]]
+            seeds.append(node_seeds[:2])
+        seeds = np.array(seeds, dtype=self.data.dtype)
+        return {"seeds": (seeds[:, 0], seeds[:, 1])}
+
+    def _dimension_stats(self, ids: np.ndarray) -> dict:
+        """
+        Returns the statistics of the dimension choice over the ids of a node, exact or sampled as set
+        by dimension_stats.
+        """
+        chunk_rows = max(1, (1 << 24) // (self.k * self.data.itemsize))
+        if self.dimension_stats == "sampled":
+            return sampled_node_stats(self.data, ids, self.stats_sample_size, chunk_rows, self.rng)
+        return node_stats(self.data, ids, chunk_rows)
+
+    def pack_build(self, ids: np.ndarray, depth: int):
+        """
+        Bulk-loads a packed subtree over the given ids, its root at depth ("flat" layout).
+
+        The ids are ordered by the packing function and cut into full leaves; the centers of the MBRs of
+        every level are then packed the same way into nodes of fanout children, until one node is left.
+        Returns the ids in leaf order and the node arrays in depth-first order, with starts relative to the
+        ids, as _build_subtree.
+        """
+        switcher: dict[str, function] = {
+            "str": str_tiles,
+            "hilbert": hilbert_tiles,
+        }
+        tiles = timed(self.tree_stats, "packing", switcher[self.packing])
+
+        capacity = max(self.leaf_size, 1)
+        if self.max_depth is not None:
+            # the leaves of a node at depth d are at depth <= max_depth - 1, as with range_build
+            levels = max(self.max_depth - 1 - depth, 0)
+            capacity = max(capacity, -(-len(ids) // self.fanout**levels))
+
+        if len(ids) == 0:
+            # an empty leaf, with the empty MBR
+            nodes = {
+                "min": np.full((1, self.k), np.inf, dtype=self.data.dtype),
+                "max": np.full((1, self.k), -np.inf, dtype=self.data.dtype),
+                "first_child": np.full(1, -1, dtype=np.int32),
+                "n_children": np.zeros(1, dtype=np.int32),
+                "depth": np.full(1, depth, dtype=np.int32),
+                "start": np.zeros(1, dtype=np.int64),
+                "count": np.zeros(1, dtype=np.int64),
+            }
+            return np.array(ids, dtype=np.int64), nodes
+
+        ids, starts = tiles(self.data, ids, capacity)
+        bounds = np.append(starts, len(ids))
+        mins = np.empty((len(starts), self.k), dtype=self.data.dtype)
+        maxs = np.empty((len(starts), self.k), dtype=self.data.dtype)
+        # the MBRs of the leaves are reduced over chunks of about 16MB of rows
+        chunk_size = max(1, (1 << 24) // (self.k * self.data.itemsize))
+        tile = 0
+        while tile < len(starts):
+            last = max(tile + 1, int(np.searchsorted(bounds, bounds[tile] + chunk_size, side="right")) - 1)
+            rows = self.data[ids[bounds[tile] : bounds[last]]]
+            mins[tile:last] = np.minimum.reduceat(rows, starts[tile:last] - bounds[tile])
+            maxs[tile:last] = np.maximum.reduceat(rows, starts[tile:last] - bounds[tile])
+            tile = last
+
+        level = {
+            "min": mins,
+            "max": maxs,
+            "first_child": np.full(len(starts), -1, dtype=np.int64),
+            "n_children": np.zeros(len(starts), dtype=np.int64),
+            "start": starts,
+            "count": np.diff(bounds),
+        }
+        levels = [level]
+        while len(levels[-1]["count"]) > 1:
+            below = levels[-1]
+            centers = (below["min"].astype(np.float64) + below["max"]) / 2
+            order, groups = tiles(centers, np.arange(len(centers)), self.fanout)
+            for key in below:
+                below[key] = below[key][order]
+            levels.append(
+                {
+                    "min": np.minimum.reduceat(below["min"], groups),
+                    "max": np.maximum.reduceat(below["max"], groups),
+                    "first_child": groups,
+                    "n_children": np.diff(np.append(groups, len(centers))),
+                    "start": np.zeros(len(groups), dtype=np.int64),
+                    "count": np.add.reduceat(below["count"], groups),
+                }
+            )
+
+        # the levels are laid out from the root down, then depth-first
+        levels.reverse()
+        offsets = np.cumsum([0] + [len(level["count"]) for level in levels])
+        for above, level in enumerate(levels[:-1]):
+            level["first_child"] = level["first_child"] + offsets[above + 1]
+        nodes = {key: np.concatenate([level[key] for level in levels]) for key in levels[0]}
+        nodes["depth"] = np.repeat(np.arange(depth, depth + len(levels)), np.diff(offsets))
+        for key, dtype in (("first_child", np.int32), ("n_children", np.int32), ("depth", np.int32)):
+            nodes[key] = nodes[key].astype(dtype)
+        for key in ("start", "count"):
+            nodes[key] = nodes[key].astype(np.int64)
+        nodes, ids = self._depth_first_layout(nodes, 0, ids)
+        return ids, nodes
+
+    def _build_tasks(self):
+        """
+        Builds the subtrees left in self._tasks with n_jobs workers and stitches them into the tree.
+
+        Every worker builds its subtree in the "flat" layout over a copy of its slice of perm; the
+        partitioned slice is written back and the subtree replaces its placeholder leaf.
+        """
+        tasks, self._tasks = self._tasks, None
+
+        # the seeds are drawn in subtree order, so the tree does not depend on the number of workers
+        seeds = [self.rng.getrandbits(64) for _ in tasks]
+        args = [
+            (self.perm[start:end].copy(), depth, last_dim, seed)
+            for (_, start, end, depth, last_dim), seed in zip(tasks, seeds)
+        ]
+
+        # the workers get a copy of the tree without its data and nodes
+        template = copy.copy(self)
+        template.data = template.perm = template.root = template.nodes = template.rng = template.codes = None
+        template.layout = "flat"
+
+        if self.n_jobs == 1 or self.parallel_backend == "thread":
+            template.data = self.data
+            if self.n_jobs == 1:
+                results = [_build_subtree(template, *task) for task in args]
+            else:
+                with ThreadPoolExecutor(self.n_jobs) as pool:
+                    results = list(pool.map(lambda task: _build_subtree(template, *task), args))
+        elif memmap_location(self.data) is not None:
+            # memory-mapped datapoints are mapped again by the workers rather than copied
+            source = ("memmap", *memmap_location(self.data), self.data.shape, self.data.dtype)
+            with ProcessPoolExecutor(self.n_jobs) as pool:
+                results = list(pool.map(_build_shared_subtree, repeat((template, source)), args))
+        else:
+            shm = SharedMemory(create=True, size=max(self.data.nbytes, 1))
+            try:
+                np.ndarray(self.data.shape, dtype=self.data.dtype, buffer=shm.buf)[...] = self.data
+                source = ("shm", shm.name, 0, self.data.shape, self.data.dtype)
+                with ProcessPoolExecutor(self.n_jobs) as pool:
+                    results = list(pool.map(_build_shared_subtree, repeat((template, source)), args))
+            finally:
+                shm.close()
+                shm.unlink()
+
+        for (node, start, end, _, _), (perm, nodes) in zip(tasks, results):
+            self.perm[start:end] = perm
+            self._attach_subtree(node, nodes, start)
+
+    def _attach_subtree(self, node, nodes: dict, offset: int):
+        """
+        Replaces the placeholder leaf node by a subtree built in the "flat" layout over perm[offset:].
+        """
+        if self.layout == "dict":
+            node["children"] = self._flat_to_dict(nodes, 0, offset)["children"]
+            return
+
+        # the subtree root takes the place of the leaf, the other nodes are appended in order
+        # (which keeps the children of every node contiguous)
+        count = len(nodes["depth"])
+        new_ids = np.empty(count, dtype=np.int64)
+        new_ids[0] = node
+        if count > 1:
+            new_ids[1:] = np.arange(self._new_nodes(count - 1), self.n_nodes)
+        for key, values in nodes.items():
+            if key == "first_child":
+                values = np.where(values >= 0, new_ids[values], -1)
+            elif key == "start":
+                values = values + offset
+            self.nodes[key][new_ids] = values
+
+    def _flat_to_dict(self, nodes: dict, node: int, offset: int) -> dict:
+        """
+        Converts the subtree rooted at node of "flat" arrays over perm[offset:] to the "dict" layout.
+        """
+        children = None
+        if nodes["n_children"][node] > 0:
+            first = nodes["first_child"][node]
+            children = {
+                "left": self._flat_to_dict(nodes, first, offset),
+                "right": self._flat_to_dict(nodes, first + 1, offset),
+            }
+        return {
+            "min": nodes["min"][node],
+            "max": nodes["max"][node],
+            "offset": offset + int(nodes["start"][node]),
+            "count": int(nodes["count"][node]),
+            "depth": int(nodes["depth"][node]),
+            "children": children,
+        }
+
+    def _range_node(self, depth: int, start: int, end: int) -> dict:
+        """
+        Creates a leaf of the "dict" layout holding perm[start:end] ("ranges" storage).
+        """
+        Pmin, Pmax = self._range_mbr(start, end)
+        return {
+            "min": Pmin,
+            "max": Pmax,
+            "offset": start,
+            "count": end - start,
+            "depth": depth,
+            "children": None,
+        }
+
+    def _range_mbr(self, start: int, end: int, chunk_bytes: int = 1 << 18):
+        """
+        Returns the MBR of the points perm[start:end], reduced over chunks of rows (of about
+        chunk_bytes each) so that the points are never gathered all at once.
+        """
+        chunk_size = max(1, chunk_bytes // (self.k * self.data.itemsize))
+        Pmin = np.full(self.k, np.inf, dtype=self.data.dtype)
+        Pmax = np.full(self.k, -np.inf, dtype=self.data.dtype)
+        for chunk in range(start, end, chunk_size):
+            points = self.data[self.perm[chunk : min(chunk + chunk_size, end)]]
+            np.minimum(Pmin, points.min(axis=0), out=Pmin)
+            np.maximum(Pmax, points.max(axis=0), out=Pmax)
+        return Pmin, Pmax
+
+    def _node_range(self, node):
+        """
+        Returns the (start, end) range of perm holding the points of a node ("ranges" storage).
+        """
+        if self.layout == "flat":
+            start = self.nodes["start"][node]
+            return start, start + self.nodes["count"][node]
+        return node["offset"], node["offset"] + node["count"]
+
+    def _init_nodes(self, capacity: int):
+        """
+        Allocates the node arrays of the "flat" layout.
+        """
+        self.n_nodes = 0
+        self.nodes = {
+            "min": np.empty((capacity, self.k), dtype=self.data.dtype),
+            "max": np.empty((capacity, self.k), dtype=self.data.dtype),
+            "first_child": np.empty(capacity, dtype=np.int32),
+            "n_children": np.empty(capacity, dtype=np.int32),
+            "depth": np.empty(capacity, dtype=np.int32),
+            "start": np.empty(capacity, dtype=np.int64),
+            "count": np.empty(capacity, dtype=np.int64),
+        }
+
+    def _new_nodes(self, count: int) -> int:
+        """
+        Returns the id of the first of count new contiguous nodes of the "flat" layout,
+        doubling the arrays when they are full.
+        """
+        capacity = len(self.nodes["depth"])
+        if self.n_nodes + count > capacity:
+            for key, values in self.nodes.items():
+                grown = np.zeros((2 * capacity + count,) + values.shape[1:], dtype=values.dtype)
+                grown[:capacity] = values
+                self.nodes[key] = grown
+        self.n_nodes += count
+        return self.n_nodes - count
+
+    def _set_node(self, node: int, depth: int, start: int, end: int):
+        """
+        Fills a leaf of the "flat" layout holding perm[start:end].
+        """
+        self.nodes["min"][node], self.nodes["max"][node] = self._range_mbr(start, end)
+        self.nodes["first_child"][node] = -1
+        self.nodes["n_children"][node] = 0
+        self.nodes["depth"][node] = depth
+        self.nodes["start"][node] = start
+        self.nodes["count"][node] = end - start
+
+    def _trim_nodes(self):
+        """
+        Shrinks the node arrays of the "flat" layout to the number of nodes, in place
+        (no view of them is alive at the end of the build).
+        """
+        for values in self.nodes.values():
+            values.resize((self.n_nodes,) + values.shape[1:], refcheck=False)
+
+    def _is_leaf(self, node) -> bool:
+        """
+        Returns whether a node (a dict, or a node id with the "flat" layout) has no children.
+        """
+        if self.layout == "flat":
+            return self.nodes["n_children"][node] == 0
+        return node["children"] is None
+
+    def _node_ids(self, node) -> np.ndarray:
+        """
+        Returns the ids of the points under a node.
+        """
+        if not self._inner_ids_valid and not self._is_leaf(node):
+            # after insertions or deletions, only the leaves know their points
+            return np.concatenate([ids for ids, _, _ in self._leaves(node)])
+        if self.storage == "ranges":
+            start, end = self._node_range(node)
+            return self.perm[start:end]
+        return node["ids"]
+
+    def _node_mbr(self, node):
+        """
+        Returns the min and max corners of the MBR of a node.
+        """
+        if self.layout == "flat":
+            return self.nodes["min"][node], self.nodes["max"][node]
+        return node["min"], node["max"]
+
+    def _children_mbrs(self, node):
+        """
+        Returns the children of an internal node and their MBRs as two (n_children, k) arrays.
+        With the "flat" layout the children are contiguous, so the MBRs are views of the node arrays.
+        """
+        if self.layout == "flat":
+            first = self.nodes["first_child"][node]
+            last = first + self.nodes["n_children"][node]
+            return range(first, last), self.nodes["min"][first:last], self.nodes["max"][first:last]
+        children = (node["children"]["left"], node["children"]["right"])
+        return children, np.stack([child["min"] for child in children]), np.stack([child["max"] for child in children])
+
+    def _mindist(self, q: np.ndarray, mins: np.ndarray, maxs: np.ndarray):
+        """
+        Returns the lower bound of the metric's distance between a query point and the points of one MBR, or
+        of each row of stacked MBRs (the squared distance to the box by default, 0 if q is inside it).
+        """
+        return self.metric.box_distances(q, mins, maxs)
+
+    def _leaf_distances(self, ids: np.ndarray, q: np.ndarray) -> np.ndarray:
+        """
+        Returns the metric's distances from q to the points ids, approximate squared Euclidean ones on the
+        codes with a quantizer.
+        """
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(leaves_scanned=1, distance_evaluations=len(ids))
+        if self.quantizer is None:
+            return self.metric.distances(self.data[ids], q)
+        return self.quantizer.distances(self.codes[ids], q)
+
+    def _rerank(self, heap: list, q: np.ndarray, k: int) -> list:
+        """
+        Returns the heap of the k best candidates of a heap by their exact distances to q, computed on the
+        datapoints (read in id order, which is sequential on a memory-mapped file).
+        """
+        ids = np.sort(np.array([i for _, i in heap], dtype=np.int64))
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(distance_evaluations=len(ids))
+        best = []
+        self._push_candidates(best, k, self.metric.distances(self.data[ids], q), ids)
+        return best
+
+    @staticmethod
+    def _push_candidates(heap: list, k: int, dists: np.ndarray, ids: np.ndarray):
+        """
+        Merges the distances of a leaf's points into the max-heap of the k best candidates.
+        """
+        if len(heap) == k:
+            closer = dists < -heap[0][0]
+            dists, ids = dists[closer], ids[closer]
+        for dist, i in zip(dists.tolist(), ids.tolist()):
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist, i))
+            elif dist < -heap[0][0]:
+                heapq.heapreplace(heap, (-dist, i))
+
+    def save(self, path: str):
+        """
+        Saves the tree to an index file: its parameters, the node arrays (with the MBRs), the id permutation
+        and the datapoints (in id order), in the binary format of index_file.py.
+
+        Parameters
+        ----------
+        path : str
+            The file to write.
+        """
+        assert self.layout == "flat", "Only a tree with the 'flat' layout can be saved"
+
+        if not self._inner_ids_valid or len(self.perm) != self.n_points:
+            self._compact()
+
+        params = {
+            "k": self.k,
+            "grouping_choice": self.grouping_choice_name,
+            "seed_choice": self.seed_choice_name,
+            "dimension_choice": self.dimension_choice,
+            "leaf_size": self.leaf_size,
+            "max_depth": self.max_depth,
+            "layout": self.layout,
+            "storage": self.storage,
+            "packing": self.packing,
+            "fanout": self.fanout,
+            "seed_params": self.seed_params,
+            "dimension_stats": self.dimension_stats,
+            "stats_sample_size": self.stats_sample_size,
+            "rotation": self.rotation,
+            "n_components": self.n_components,
+            "vector_storage": self.vector_storage,
+            "rerank": self.rerank,
+            "metric": self.metric.name,
+            "builder": self.builder,
+        }
+        arrays = {"data": self.data, "perm": self.perm, **self.nodes}
+        if self.pca is not None:
+            arrays.update(pca_mean=self.pca.mean, pca_components=self.pca.components)
+        if self.quantizer is not None:
+            arrays["codes"] = self.codes
+            if self.quantizer.kind == "int8":
+                arrays.update(quantizer_low=self.quantizer.low, quantizer_scale=self.quantizer.scale)
+        write_index(path, "r", params, arrays)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "RTree":
+        """
+        Loads a tree saved by save.
+
+        Parameters
+        ----------
+        path : str
+            The index file.
+        mmap : bool, optional
+            Map the file rather than reading it, by default True. The arrays of the tree are then read-only
+            views of the file, so loading takes no time and the queries read the nodes and the points from
+            the page cache.
+
+        Returns
+        -------
+        RTree
+            The loaded tree.
+
+        Raises
+        ------
+        ValueError
+            If the file is not an RTree index of the current format version.
+        """
+        kind, params, arrays = read_index(path, mmap)
+        if kind != "r":
+            raise ValueError(f"{path} holds a '{kind}' index, not an RTree")
+
+        k = params.pop("k")
+        tree = cls(k, np.empty((0, k), dtype=arrays["data"].dtype), **params)
+        tree.data = arrays.pop("data")
+        tree.perm = arrays.pop("perm")
+        if "pca_components" in arrays:
+            tree.pca = PCARotation(mean=arrays.pop("pca_mean"), components=arrays.pop("pca_components"))
+        if "codes" in arrays:
+            tree.codes = arrays.pop("codes")
+            tree.quantizer = ScalarQuantizer(tree.vector_storage, arrays.pop("quantizer_low", None), arrays.pop("quantizer_scale", None))
+        tree.nodes = arrays
+        tree.n_nodes = len(arrays["depth"])
+        tree.root = 0
+        tree.n_points = tree._peak_points = len(tree.perm)
+        return tree
+
+    def insert(self, points: list[list[float]], alpha: float = 0.75) -> np.ndarray:
+        """
+        Inserts points into the tree without rebuilding it.
+
+        Every point is appended to the datapoints and descends, as in Guttman's ChooseLeaf, to the child whose
+        MBR grows the least (in L1, i.e. in margin, which unlike the volume does not vanish in high dimensions),
+        widening the MBRs along its path. A leaf that grows past leaf_size is split with the tree's seed and
+        grouping choices, as during the build. As the splits never propagate up, a skewed stream of points
+        would grow a deep chain of nodes; so when a point lands deeper than c * log(n_points), the subtree of
+        its deepest ancestor that is taller than c * log(its number of points) is rebuilt, as in a scapegoat
+        tree. c is 1 / log(1 / alpha), or the height to log(n_points) ratio of the last full build if the
+        strategies build taller trees, so that the rebuilt subtrees do not trigger new rebuilds.
+
+        Parameters
+        ----------
+        points : list[list[float]]
+            The points to insert.
+        alpha : float, optional
+            The balance threshold, between 0.5 (rebuild often) and 1 (never rebuild), by default 0.75.
+
+        Returns
+        -------
+        np.ndarray
+            The ids of the inserted points (their row indices in data).
+        """
+        assert 0.5 <= alpha <= 1, "alpha must be between 0.5 and 1"
+
+        points = self.metric.prepare(np.asarray(points, dtype=self.data.dtype))
+        if self.pca is not None:
+            points = self.pca.transform(points)
+        points = points.reshape(-1, self.k)
+        self._make_writable()
+
+        factor = self._height_factor(alpha)
+        if self.quantizer is not None:
+            if len(self.codes) == 0:
+                # a tree built without points fits the codes on the first inserted ones
+                self.quantizer.fit(points)
+            self._append("codes", self.quantizer.encode(points))
+        start = self._append("data", points)
+        ids = np.arange(start, start + len(points), dtype=np.int64)
+        for i in ids.tolist():
+            self.n_points += 1
+            self._insert_point(i, factor)
+
+        self._peak_points = max(self._peak_points, self.n_points)
+        self._compact_if_sparse()
+        return ids
+
+    def delete(self, ids: list[int], alpha: float = 0.75):
+        """
+        Removes points from the tree and shrinks the MBRs along their paths. Their rows stay in data, so the
+        ids of the other points do not change, but the queries no longer return them. An emptied leaf keeps
+        an empty MBR, which no search enters; once the tree holds fewer than alpha times the points it had at
+        its last full rebuild, it is rebuilt.
+
+        Parameters
+        ----------
+        ids : list[int]
+            The ids of the points to remove.
+        alpha : float, optional
+            The balance threshold, see insert, by default 0.75.
+
+        Raises
+        ------
+        ValueError
+            If a point is not in the tree (the points before it are removed).
+        """
+        assert 0.5 <= alpha <= 1, "alpha must be between 0.5 and 1"
+
+        self._make_writable()
+        for i in np.asarray(ids, dtype=np.int64).ravel().tolist():
+            path = self._find_leaf(i) if 0 <= i < len(self.data) else None
+            if path is None:
+                raise ValueError(f"Point {i} is not in the tree")
+            self._inner_ids_valid = False
+            self._leaf_remove(path[-1], i)
+            for node in reversed(path):
+                self._add_count(node, -1)
+                self._refit_mbr(node)
+            self.n_points -= 1
+
+        if self.n_points < alpha * self._peak_points:
+            self._rebuild(self.root)
+            self._peak_points = self.n_points
+            self._built_height = None
+        self._compact_if_sparse()
+
+    def _insert_point(self, i: int, factor: float):
+        """
+        Adds the datapoint i to the leaf chosen for it, then splits the leaf if it overflows or rebuilds the
+        subtree of a scapegoat (see insert).
+        """
+        point = self.data[i]
+        node = self.root
+        path = [node]
+        while not self._is_leaf(node):
+            children, mins, maxs = self._children_mbrs(node)
+            growth = (np.maximum(mins - point, 0) + np.maximum(point - maxs, 0)).sum(axis=1)
+            margin = (maxs - mins).sum(axis=1)
+            node = list(children)[np.lexsort((margin, growth))[0]]
+            path.append(node)
+
+        self._inner_ids_valid = False
+        for node in path:
+            self._add_count(node, 1)
+            low, high = self._node_mbr(node)
+            self._set_mbr(node, np.minimum(low, point), np.maximum(high, point))
+        self._leaf_add(node, i)
+
+        depth = self._depth(node)
+        if len(self._node_ids(node)) > self.leaf_size and (self.max_depth is None or depth < self.max_depth):
+            if self.storage == "ranges":
+                self.range_build(node, depth + 1)
+            else:
+                node["children"] = self.recursive_build(node["points"], depth + 1, ids=node["ids"])
+
+        if depth <= factor * np.log(self.n_points):
+            return
+
+        # walk up to the deepest ancestor whose subtree is too tall for its number of points
+        size = self._subtree_size(path[-1])
+        for level in range(len(path) - 2, -1, -1):
+            children, _, _ = self._children_mbrs(path[level])
+            # dict nodes are compared by identity, not by content
+            size += sum(
+                self._subtree_size(child)
+                for child in children
+                if (child is not path[level + 1] if self.layout == "dict" else child != path[level + 1])
+            )
+            if depth - self._depth(path[level]) > factor * np.log(size):
+                self._rebuild(path[level])
+                return
+
+    def _height_factor(self, alpha: float) -> float:
+        """
+        Returns the factor c of the height bound c * log(n) of the partial rebuilds (see insert).
+        """
+        if alpha == 1:
+            return np.inf
+        if self._built_height is None:
+            self._built_height = max((depth for _, depth, _ in self._leaves()), default=0)
+            self._built_points = self.n_points
+        factor = 1 / np.log(1 / alpha)
+        if self._built_points > 1:
+            factor = max(factor, self._built_height / np.log(self._built_points))
+        return factor
+
+    def _rebuild(self, node):
+        """
+        Rebuilds the subtree of a node over its current points with the tree's strategies. The node stays in
+        place, so its parent keeps pointing to it.
+        """
+        ids = np.concatenate([ids for ids, _, _ in self._leaves(node)])
+        depth = self._depth(node)
+        if self.storage == "points":
+            points = self.data[ids].tolist()
+            node.update(points=points, ids=ids, children=self.recursive_build(points, depth + 1, ids=ids))
+        elif self.packing is not None:
+            start = self._append("perm", ids)
+            perm, nodes = self.pack_build(ids, depth)
+            self.perm[start : start + len(ids)] = perm
+            self._attach_subtree(node, nodes, start)
+        else:
+            start = self._append("perm", ids)
+            if self.layout == "flat":
+                self.nodes["first_child"][node] = -1
+                self.nodes["n_children"][node] = 0
+            else:
+                node["children"] = None
+            self._set_range(node, start, start + len(ids))
+            self.range_build(node, depth + 1)
+        self._refit_mbr(node)
+
+    def _depth(self, node) -> int:
+        """
+        Returns the depth of a node.
+        """
+        if self.layout == "flat":
+            return int(self.nodes["depth"][node])
+        return node["depth"]
+
+    def _subtree_size(self, node) -> int:
+        """
+        Returns the number of points under a node (kept in "count" with the "ranges" storage).
+        """
+        if self.storage == "ranges":
+            return int(self.nodes["count"][node] if self.layout == "flat" else node["count"])
+        if self._is_leaf(node):
+            return len(node["ids"])
+        return sum(len(ids) for ids, _, _ in self._leaves(node))
+
+    def _find_leaf(self, i: int):
+        """
+        Returns the path of nodes from the root to the leaf holding the id i, searching the nodes whose MBR
+        contains the point, None if no leaf holds it.
+        """
+        point = self.data[i]
+        stack = [[self.root]]
+        while stack:
+            path = stack.pop()
+            node = path[-1]
+            low, high = self._node_mbr(node)
+            if np.any(point < low) or np.any(point > high):
+                continue
+            if self._is_leaf(node):
+                if np.any(self._node_ids(node) == i):
+                    return path
+                continue
+            children, _, _ = self._children_mbrs(node)
+            stack.extend(path + [child] for child in reversed(list(children)))
+        return None
+
+    def _leaf_add(self, node, i: int):
+        """
+        Adds the id i to a leaf. With the "ranges" storage, a leaf that does not end perm is moved to its end
+        (its old slots are reclaimed by _compact).
+        """
+        if self.storage == "points":
+            node["ids"] = np.append(node["ids"], i)
+            node["points"] = [*node["points"], self.data[i].tolist()]
+            return
+        start, end = self._node_range(node)
+        if end != len(self.perm):
+            count = end - start
+            start = self._append("perm", self.perm[start:end].copy())
+            end = start + count
+        self._append("perm", [i])
+        self._set_range(node, start, end + 1)
+
+    def _leaf_remove(self, node, i: int):
+        """
+        Removes the id i from a leaf holding it and recomputes the leaf's MBR. With the "ranges" storage, the
+        last id of the leaf takes its slot.
+        """
+        if self.storage == "points":
+            keep = node["ids"] != i
+            node["ids"] = node["ids"][keep]
+            node["points"] = [point for point, kept in zip(node["points"], keep.tolist()) if kept]
+            return
+        start, end = self._node_range(node)
+        position = start + int(np.flatnonzero(self.perm[start:end] == i)[0])
+        self.perm[position] = self.perm[end - 1]
+        self._set_range(node, start, end - 1)
+
+    def _refit_mbr(self, node):
+        """
+        Recomputes the MBR of a node from its points (a leaf) or from its children's MBRs; an empty leaf
+        gets the empty MBR [inf, -inf].
+        """
+        if self._is_leaf(node):
+            if self.storage == "ranges":
+                self._set_mbr(node, *self._range_mbr(*self._node_range(node)))
+                return
+            points = self.data[node["ids"]]
+            if len(points) == 0:
+                self._set_mbr(node, np.full(self.k, np.inf, self.data.dtype), np.full(self.k, -np.inf, self.data.dtype))
+            else:
+                self._set_mbr(node, points.min(axis=0), points.max(axis=0))
+            return
+        _, mins, maxs = self._children_mbrs(node)
+        self._set_mbr(node, mins.min(axis=0), maxs.max(axis=0))
+
+    def _set_mbr(self, node, low: np.ndarray, high: np.ndarray):
+        """
+        Sets the MBR of a node.
+        """
+        if self.layout == "flat":
+            self.nodes["min"][node] = low
+            self.nodes["max"][node] = high
+        else:
+            node["min"], node["max"] = low, high
+
+    def _set_range(self, node, start: int, end: int):
+        """
+        Sets the range perm[start:end] of a leaf ("ranges" storage).
+        """
+        if self.layout == "flat":
+            self.nodes["start"][node] = start
+            self.nodes["count"][node] = end - start
+        else:
+            node["offset"], node["count"] = start, end - start
+
+    def _add_count(self, node, delta: int):
+        """
+        Updates the number of points of an internal node ("ranges" storage; the leaves' follow their range).
+        """
+        if self.storage == "ranges" and not self._is_leaf(node):
+            if self.layout == "flat":
+                self.nodes["count"][node] += delta
+            else:
+                node["count"] += delta
+
+    def _append(self, name: str, values) -> int:
+        """
+        Appends values to the data or perm array and returns the index of the first one. The array is a prefix
+        of a buffer whose capacity doubles when it is full, so that appends take amortised constant time; a
+        read-only or memory-mapped array is copied to memory on the first append.
+        """
+        array = getattr(self, name)
+        size = len(array)
+        buffer = self._buffers.get(name)
+        if buffer is None or array.base is not buffer or size + len(values) > len(buffer):
+            buffer = np.empty((max(2 * size, size + len(values), 16),) + array.shape[1:], dtype=array.dtype)
+            buffer[:size] = array
+            self._buffers[name] = buffer
+        buffer[size : size + len(values)] = values
+        setattr(self, name, buffer[: size + len(values)])
+        return size
+
+    def _make_writable(self):
+        """
+        Copies the arrays of a loaded (read-only) tree to memory before they are updated.
+        """
+        if self.storage == "ranges" and not self.perm.flags.writeable:
+            self.perm = np.array(self.perm)
+        if self.layout == "flat" and not self.nodes["depth"].flags.writeable:
+            self.nodes = {key: np.array(values) for key, values in self.nodes.items()}
+
+    def _compact_if_sparse(self):
+        """
+        Compacts perm once the slots left behind by the updates outnumber the points ("ranges" storage).
+        """
+        if self.storage == "ranges" and len(self.perm) > 2 * self.n_points + self.leaf_size:
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrites perm with the ids of the leaves from left to right and recomputes the ranges of the internal
+        nodes, as after a build ("ranges" storage). With the "flat" layout, the node arrays are rewritten
+        in depth-first order too, the children of every node staying contiguous.
+        """
+        if self.storage == "points":
+            return
+        if self.layout == "dict":
+            order = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                order.append(node)
+                if not self._is_leaf(node):
+                    stack.extend((node["children"]["right"], node["children"]["left"]))
+            leaves = [node for node in order if self._is_leaf(node)]
+            self.perm = np.concatenate([self._node_ids(leaf) for leaf in leaves])
+            start = 0
+            for leaf in leaves:
+                leaf["offset"] = start
+                start += leaf["count"]
+            for node in reversed(order):
+                if not self._is_leaf(node):
+                    left, right = node["children"]["left"], node["children"]["right"]
+                    node["offset"], node["count"] = left["offset"], left["count"] + right["count"]
+            self._inner_ids_valid = True
+            return
+
+        self.nodes, self.perm = self._depth_first_layout(self.nodes, self.root, self.perm)
+        self.n_nodes = len(self.nodes["depth"])
+        self.root = 0
+        self._inner_ids_valid = True
+
+    @staticmethod
+    def _depth_first_layout(nodes: dict, root: int, perm: np.ndarray):
+        """
+        Returns the node arrays of the "flat" layout rewritten in depth-first order from root (the children of
+        every node staying contiguous) and perm rewritten with the ids of the leaves from left to right, the
+        ranges of the internal nodes being recomputed from those of the leaves.
+        """
+        # new ids are given to the children of a node together, when it is visited
+        order = [root]
+        first_child = {}
+        visited = []
+        stack = [0]
+        while stack:
+            new = stack.pop()
+            visited.append(new)
+            old = order[new]
+            n_children = int(nodes["n_children"][old])
+            if n_children:
+                first_child[new] = len(order)
+                old_first = int(nodes["first_child"][old])
+                order.extend(range(old_first, old_first + n_children))
+                stack.extend(range(len(order) - 1, len(order) - n_children - 1, -1))
+
+        nodes = {key: values[order] for key, values in nodes.items()}
+        nodes["first_child"] = np.array([first_child.get(new, -1) for new in range(len(order))], dtype=np.int32)
+
+        # the nodes are visited in depth-first order, so the leaves come from left to right
+        leaves = [new for new in visited if nodes["n_children"][new] == 0]
+        counts = nodes["count"][leaves]
+        perm = np.concatenate(
+            [perm[start : start + count] for start, count in zip(nodes["start"][leaves].tolist(), counts.tolist())]
+        ).astype(np.int64, copy=False)
+        nodes["start"][leaves] = np.cumsum(counts) - counts
+
+        # and after their parent, so the internal ranges are computed backwards
+        for new in reversed(visited):
+            n_children = nodes["n_children"][new]
+            if n_children:
+                first = nodes["first_child"][new]
+                nodes["start"][new] = nodes["start"][first]
+                nodes["count"][new] = nodes["count"][first : first + n_children].sum()
+
+        return nodes, perm
+
+    def query(self, q: list[float], k: int = 1, return_visited: bool = False):
+        """
+        Finds the k nearest neighbours of a query point (exact search).
+
+        The nodes are explored best-first from a priority queue keyed on the distance from q to their MBR
+        (MINDIST, by the metric); the search stops when the closest remaining MBR is farther than the current
+        k-th best distance.
+
+        Parameters
+        ----------
+        q : list[float]
+            The query point.
+        k : int, optional
+            The number of neighbours to return, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by the search, by default False.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The distances (ascending; Euclidean by default, see metric) and the ids (row indices in the
+            datapoints) of the neighbours.
+        """
+        q = self.metric.prepare(np.asarray(q, dtype=self.data.dtype))
+        if self.pca is not None:
+            q = self.pca.transform(q)
+
+        # with compressed vectors, more candidates are kept for the re-ranking
+        n_candidates = k if self.quantizer is None else k * self.rerank
+
+        # max-heap of the best candidates, stored as (-distance, id)
+        best = []
+        nodes_visited = 0
+
+        # min-heap of (MINDIST, tie breaker, node)
+        queue = [(float(self._mindist(q, *self._node_mbr(self.root))), 0, self.root)]
+        counter = 1
+        while queue:
+            bound, _, node = heapq.heappop(queue)
+            if len(best) == n_candidates and bound > -best[0][0]:
+                break
+            nodes_visited += 1
+
+            if self._is_leaf(node):
+                ids = self._node_ids(node)
+                self._push_candidates(best, n_candidates, self._leaf_distances(ids, q), ids)
+                continue
+
+            children, mins, maxs = self._children_mbrs(node)
+            for child, bound in zip(children, self._mindist(q, mins, maxs).tolist()):
+                if len(best) < n_candidates or bound <= -best[0][0]:
+                    heapq.heappush(queue, (bound, counter, child))
+                    counter += 1
+
+        if self.quantizer is not None:
+            best = self._rerank(best, q, k)
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(n_queries=1, nodes_visited=nodes_visited)
+
+        best = sorted((-neg_dist, i) for neg_dist, i in best)
+        distances = self.metric.to_output(np.array([dist for dist, _ in best], dtype=np.float64))
+        ids = np.array([i for _, i in best], dtype=np.int64)
+
+        if return_visited:
+            return distances, ids, nodes_visited
+        return distances, ids
+
+    def query_batch(
+        self,
+        Q: list[list[float]],
+        k: int = 1,
+        return_visited: bool = False,
+        n_threads: int = None,
+        block_size: int = 256,
+    ):
+        """
+        Finds the k nearest neighbours of every query point.
+
+        The queries are split into blocks of at most block_size, searched by a pool of n_threads threads.
+        With the "flat" layout and no vector_storage, every block is searched at once (see _knn_block): the
+        queries are routed through the tree level by level as arrays, and the queries that reach the same
+        leaf are compared with its points in one matrix product. NumPy releases the GIL for this work, so
+        the threads run in parallel. Otherwise the queries of a block are searched one by one, and the
+        threads mostly wait for the GIL.
+
+        Parameters
+        ----------
+        Q : list[list[float]]
+            The query points.
+        k : int, optional
+            The number of neighbours to return per query, by default 1.
+        return_visited : bool, optional
+            Also return the number of nodes visited by each query, by default False.
+        n_threads : int, optional
+            The number of threads, by default None (the calling thread only); -1 uses all the CPU cores.
+        block_size : int, optional
+            The maximum number of queries searched together, by default 256.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            Arrays of shape (len(Q), k) with the distances and the ids of the neighbours of each query.
+        """
+        k = min(k, self.n_points)
+        distances = np.empty((len(Q), k), dtype=np.float64)
+        ids = np.empty((len(Q), k), dtype=np.int64)
+        visited = np.zeros(len(Q), dtype=np.int64)
+
+        Q = np.asarray(Q, dtype=self.data.dtype)
+        batched = self.layout == "flat" and self.quantizer is None and self.metric.euclidean and k > 0
+        if batched:
+            Q = self.metric.prepare(Q)
+        if batched and self.pca is not None and len(Q):
+            Q = self.pca.transform(Q)
+
+        def search(rows: range):
+            if batched:
+                distances[rows], ids[rows], visited[rows] = self._knn_block(Q[rows], k)
+                return
+            for row in rows:
+                distances[row], ids[row], visited[row] = self.query(Q[row], k, return_visited=True)
+
+        n_threads = os.cpu_count() if n_threads == -1 else n_threads or 1
+        # at least one block per thread
+        size = max(1, min(block_size, -(-len(Q) // n_threads)))
+        blocks = [range(start, min(start + size, len(Q))) for start in range(0, len(Q), size)]
+        if n_threads == 1:
+            for rows in blocks:
+                search(rows)
+        else:
+            with ThreadPoolExecutor(n_threads) as pool:
+                list(pool.map(search, blocks))
+
+        if return_visited:
+            return distances, ids, visited
+        return distances, ids
+
+    def _knn_block(self, Q: np.ndarray, k: int):
+        """
+        Exact kNN search of a block of (rotated) queries on the "flat" layout.
+
+        Every query first goes down to the child of smallest MINDIST as long as it holds 4k points: the points
+        of this last node, its anchor, give it k candidates and so an upper bound of its k-th distance. Then
+        all the queries descend from the root again, keeping the children whose MINDIST is within their own
+        bound (outside of their anchor). In both passes the (query, node) pairs of a level are expanded as
+        arrays, and the leaves are scanned by scan_leaves.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray, np.ndarray
+            The distances and the ids of the neighbours of every query, and the number of nodes it visited.
+        """
+        nodes = self.nodes
+        rows = np.arange(len(Q))
+
+        anchor = np.full(len(Q), self.root, dtype=np.int64)
+        active = rows[nodes["n_children"][anchor] > 0]
+        while len(active):
+            owners, children = self._expand_children(anchor[active])
+            dists = self._mindist(Q[active[owners]], nodes["min"][children], nodes["max"][children])
+            dists[nodes["count"][children] < 4 * k] = np.inf
+            # the children of a query are contiguous, sorted by MINDIST its first one is the closest
+            order = np.lexsort((dists, owners))
+            firsts = order[np.searchsorted(owners[order], np.arange(len(active)))]
+            down = np.isfinite(dists[firsts])
+            active, closest = active[down], children[firsts[down]]
+            anchor[active] = closest
+            active = active[nodes["n_children"][closest] > 0]
+
+        unbounded = np.full(len(Q), np.inf)
+        queries, leaves, visited = self._block_leaves(Q, rows, anchor, unbounded)
+        n_scanned, n_computed = len(leaves), nodes["count"][leaves].sum()
+        dists, ids = top_k(*scan_leaves(self.data, self.perm, Q, queries, leaves, nodes["start"], nodes["count"]), len(Q), k)
+
+        # the slack covers the rounding of the distances computed by matrix products
+        bound = dists[:, -1] * (1 + 1e-5) + 1e-12
+        queries, leaves, more_visited = self._block_leaves(Q, rows, np.full(len(Q), self.root), bound, anchor)
+        found = scan_leaves(self.data, self.perm, Q, queries, leaves, nodes["start"], nodes["count"], bound)
+        if self.tree_stats is not None:
+            self.tree_stats.count_queries(
+                n_queries=len(Q),
+                nodes_visited=int(visited.sum() + more_visited.sum()),
+                leaves_scanned=int(n_scanned + len(leaves)),
+                distance_evaluations=int(n_computed + nodes["count"][leaves].sum() + ids.size),
+            )
+
+        kept = ids.ravel() >= 0
+        dists, ids = top_k(
+            np.concatenate((np.repeat(rows, k)[kept], found[0])),
+            np.concatenate((dists.ravel()[kept], found[1])),
+            np.concatenate((ids.ravel()[kept], found[2])),
+            len(Q),
+            k,
+        )
+        distances, ids = exact_neighbours(self.data, Q, ids)
+        # the Euclidean distances, or the cosine ones
+        return self.metric.to_output(distances**2), ids, visited + more_visited
+
+    def _block_leaves(self, Q: np.ndarray, queries: np.ndarray, nodes: np.ndarray, bound: np.ndarray, skip: np.ndarray = None):
+        """
+        Descends from the node nodes[i] for the query queries[i], for all the pairs at once, level by level,
+        and returns the (query, leaf) pairs reached whose MINDIST is within the bound of their query,
+        skipping the subtree skip[query] if given, and the number of nodes visited per query.
+        """
+        if skip is not None:
+            queries, nodes = queries[nodes != skip[queries]], nodes[nodes != skip[queries]]
+        visited = np.zeros(len(bound), dtype=np.int64)
+
+        found_queries, found_leaves = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        while len(queries):
+            visited += np.bincount(queries, minlength=len(bound))
+            leaf = self.nodes["n_children"][nodes] == 0
+            found_queries.append(queries[leaf])
+            found_leaves.append(nodes[leaf])
+
+            owners, nodes = self._expand_children(nodes[~leaf])
+            queries = queries[~leaf][owners]
+            keep = self._mindist(Q[queries], self.nodes["min"][nodes], self.nodes["max"][nodes]) <= bound[queries]
+            if skip is not None:
+                keep &= nodes != skip[queries]
+            queries, nodes = queries[keep], nodes[keep]
+
+        return np.concatenate(found_queries), np.concatenate(found_leaves), visited
+
+    def _expand_children(self, parents: np.ndarray):
+        """
+        Returns the children of the "flat" internal nodes parents, as the index in parents of the parent of
+        every child and the child, the children of a parent being contiguous.
+        """
+        n_children = self.nodes["n_children"][parents].astype(np.int64)
+        owners = np.repeat(np.arange(len(parents)), n_children)
+        offsets = np.arange(len(owners)) - np.repeat(np.cumsum(n_children) - n_children, n_children)
+        return owners, self.nodes["first_child"][parents][owners].astype(np.int64) + offsets
+
+    def all_knn(self, k: int = 1, include_self: bool = False, n_threads: int = None, block_size: int = 64):
+        """
+        Finds the k nearest neighbours of every indexed point among the indexed points (an all-kNN self-join,
+        e.g. for a kNN graph), by a dual-tree traversal of the "flat" layout (see all_knn.py).
+
+        Two nodes are compared by the metric's lower bound of the distance between the points of their MBRs
+        (for the Euclidean distance, the squared gaps between the boxes along every dimension). The pairs of
+        blocks left are compared by the metric's matrix products, and the distances of the neighbours found
+        are recomputed directly. With a PCA rotation the distances are those of the rotated points.
+
+        Parameters
+        ----------
+        k : int, optional
+            The number of neighbours of every point, by default 1.
+        include_self : bool, optional
+            Whether a point is a neighbour of itself, by default False.
+        n_threads : int, optional
+            The number of threads comparing the blocks, by default None (the calling thread only); -1 uses
+            all the CPU cores.
+        block_size : int, optional
+            The largest number of points of the nodes compared together in one matrix product rather than
+            descended (larger leaves are too), by default 64.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray, np.ndarray
+            The neighbour graph in CSR form, with a row per datapoint (empty for the deleted points): indptr,
+            the ids of the neighbours (indices) and their distances by the metric (ascending along a row).
+            scipy.sparse.csr_matrix((distances, indices, indptr)) builds the sparse matrix.
+        """
+        assert self.layout == "flat", "all_knn needs the flat layout"
+        k = min(k, self.n_points if include_self else self.n_points - 1)
+        if self.root is None or k <= 0:
+            return to_csr(np.empty((len(self.data), 0)), np.empty((len(self.data), 0), dtype=np.int64))
+
+        nodes = self.nodes
+        is_leaf = nodes["n_children"][: self.n_nodes] == 0
+        # as many rows of the pairs at a time as 4M coordinates
+        step = max(1, (1 << 22) // self.data.shape[1])
+
+        def lower_bound(firsts: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+            bound = np.empty(len(firsts))
+            for start in range(0, len(firsts), step):
+                first, second = firsts[start : start + step], seconds[start : start + step]
+                bound[start : start + step] = self.metric.box_pair_distances(
+                    nodes["min"][first], nodes["max"][first], nodes["min"][second], nodes["max"][second]
+                )
+            return bound
+
+        dists, ids = dual_tree_knn(
+            self.data, self.perm, self.root, is_leaf, nodes["start"], nodes["count"], self._expand_children,
+            lower_bound, self.metric.pairwise, k, include_self, n_threads, block_size,
+        )
+        dists, ids = refine(self.data, ids, self.metric.paired)
+        return to_csr(self.metric.to_output(dists), ids)
+
+    def query_radius(self, q: list[float], r: float):
+        """
+        Finds all the points within distance r of a query point (Euclidean by default, see metric).
+        Subtrees whose MBR is farther than r from q are skipped.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The distances (ascending) and the ids of the points found.
+        """
+        q = self.metric.prepare(np.asarray(q, dtype=self.data.dtype))
+        if self.pca is not None:
+            q = self.pca.transform(q)
+        r2 = self.metric.from_output(r)
+
+        found_dists = []
+        found_ids = []
+
+        stack = [self.root] if self._mindist(q, *self._node_mbr(self.root)) <= r2 else []
+        while stack:
+            node = stack.pop()
+
+            if self._is_leaf(node):
+                ids = self._node_ids(node)
+                dists = self.metric.distances(self.data[ids], q)
+                inside = dists <= r2
+                found_dists.append(dists[inside])
+                found_ids.append(ids[inside])
+                continue
+
+            children, mins, maxs = self._children_mbrs(node)
+            in_range = self._mindist(q, mins, maxs) <= r2
+            stack.extend(child for child, keep in zip(children, in_range) if keep)
+
+        if not found_ids:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+        dists = np.concatenate(found_dists)
+        ids = np.concatenate(found_ids)
+        order = np.argsort(dists, kind="stable")
+        return self.metric.to_output(dists[order].astype(np.float64)), ids[order]
+
+    def query_radius_batch(self, Q: list[list[float]], r: float):
+        """
+        Finds all the points within distance r of every query point.
+
+        Returns
+        -------
+        list[np.ndarray], list[np.ndarray]
+            The distances and the ids of the points found, one array per query.
+        """
+        results = [self.query_radius(q, r) for q in Q]
+        return [dists for dists, _ in results], [ids for _, ids in results]
+
+    def query_box(self, low: list[float], high: list[float]):
+        """
+        Finds all the points inside the axis-aligned box [low, high] (bounds included).
+        Subtrees whose MBR does not intersect the box are skipped, and subtrees whose MBR is
+        contained in the box are reported without checking their points.
+
+        Returns
+        -------
+        np.ndarray
+            The ids of the points found, in ascending order.
+        """
+        assert self.pca is None, "query_box is not available with a rotation"
+        assert self.metric.name != "cosine", "query_box is not available with the 'cosine' metric"
+
+        low = np.asarray(low, dtype=self.data.dtype)
+        high = np.asarray(high, dtype=self.data.dtype)
+
+        found_ids = []
+
+        # stack of (node, whether its MBR is contained in the box)
+        mins, maxs = self._node_mbr(self.root)
+        stack = []
+        if not (np.any(maxs < low) or np.any(mins > high)):
+            stack.append((self.root, bool(np.all(mins >= low) and np.all(maxs <= high))))
+
+        while stack:
+            node, contained = stack.pop()
+            if contained:
+                found_ids.append(self._node_ids(node))
+                continue
+
+            if self._is_leaf(node):
+                ids = self._node_ids(node)
+                points = self.data[ids]
+                inside = np.all((points >= low) & (points <= high), axis=1)
+                found_ids.append(ids[inside])
+                continue
+
+            children, mins, maxs = self._children_mbrs(node)
+            intersects = ~(np.any(maxs < low, axis=1) | np.any(mins > high, axis=1))
+            contained = np.all(mins >= low, axis=1) & np.all(maxs <= high, axis=1)
+            for child, keep, inside in zip(children, intersects.tolist(), contained.tolist()):
+                if keep:
+                    stack.append((child, inside))
+
+        if not found_ids:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(found_ids))
+
+    def query_box_batch(self, lows: list[list[float]], highs: list[list[float]]):
+        """
+        Finds all the points inside every box [lows[i], highs[i]].
+
+        Returns
+        -------
+        list[np.ndarray]
+            The ids of the points found, one array per box.
+        """
+        return [self.query_box(low, high) for low, high in zip(lows, highs)]
+
+    def compute_silhouette_score(self, sample_size: int = None, seed: int = 0):
         """
         Computes the Silhouette Score for the RTree.
 
+        Parameters
+        ----------
+        sample_size : int, optional
+            Estimate the score from the silhouettes of this many points (each compared with all the points),
+            by default None: the exact score with sklearn, in O(n^2) time and memory.
+        seed : int, optional
+            The seed of the sample, by default 0.
+
         Returns
         -------
         float
             The Silhouette Score of the RTree.
         """
+        if sample_size is not None:
+            leaves = list(self._leaves())
+            ids = np.concatenate([leaf_ids for leaf_ids, _, _ in leaves])
+            labels = np.concatenate([np.full(len(leaf_ids), label) for leaf_ids, _, label in leaves])
+            return sampled_silhouette_score(self.data, ids, labels, sample_size, seed)
+
         # Flatten the tree to get all points and their cluster labels
-        points, labels = self._flatten_tree(self.root, 0)
+        if self.layout == "flat":
+            points, labels = self._flatten_flat()
+        else:
+            points, labels = self._flatten_tree(self.root, 0)
         points = np.array(points)
         labels = np.array(labels)
 
@@ -175,6 +2038,108 @@ class RTree:
         score = silhouette_score(points, labels)
         return score
 
+    def quality_metrics(self) -> dict:
+        """
+        Computes quality metrics of the tree in one pass over the nodes: the number, sizes, radii, within-leaf
+        sum of squared errors and depth histogram of the leaves (see quality.leaf_metrics), and the volumes
+        of the leaf MBRs and the overlap of sibling MBRs (see quality.mbr_metrics).
+
+        Returns
+        -------
+        dict
+            The metrics.
+        """
+        if self.layout == "flat":
+            n_children = self.nodes["n_children"][: self.n_nodes]
+            first = self.nodes["first_child"][: self.n_nodes]
+            mins, maxs = self.nodes["min"][: self.n_nodes], self.nodes["max"][: self.n_nodes]
+            leaf = n_children == 0
+        else:
+            # number the dict nodes breadth-first, so that the children of a node are contiguous
+            order = [self.root]
+            first = []
+            n_children = []
+            for node in order:
+                first.append(len(order))
+                children = [] if self._is_leaf(node) else [node["children"]["left"], node["children"]["right"]]
+                n_children.append(len(children))
+                order.extend(children)
+            mins = np.stack([node["min"] for node in order])
+            maxs = np.stack([node["max"] for node in order])
+            first, n_children = np.array(first), np.array(n_children)
+            leaf = n_children == 0
+
+        siblings = [
+            (first[node] + i, first[node] + j)
+            for node in np.flatnonzero(~leaf)
+            for i in range(n_children[node])
+            for j in range(i + 1, n_children[node])
+        ]
+        siblings = np.array(siblings, dtype=np.int64).reshape(-1, 2)
+
+        metrics = leaf_metrics(self.data, ((ids, depth) for ids, depth, _ in self._leaves()))
+        metrics.update(mbr_metrics(mins, maxs, leaf, siblings))
+        return metrics
+
+    def get_stats(self) -> dict:
+        """
+        Returns the statistics collected since the tree was built with collect_stats=True.
+
+        Returns
+        -------
+        dict
+            A JSON-serialisable dict. "build" holds the timers ({"calls", "seconds"} of the seed, grouping and
+            packing functions and of the whole build) and the structure of the tree (see
+            instrumentation.tree_structure): the number of nodes per depth and the histograms of the leaf
+            sizes and of the imbalance of the children. "queries" holds the number of kNN queries, of nodes
+            visited, of leaves scanned and of distance evaluations, their means per query and the pruning
+            ratio, the fraction of the distances of a brute-force scan that were not computed.
+        """
+        assert self.tree_stats is not None, "get_stats requires collect_stats=True"
+        structure = tree_structure(self.root, self._node_children, lambda node: len(self._node_ids(node)), self._depth)
+        return self.tree_stats.to_dict(self.n_points, structure)
+
+    def reset_stats(self):
+        """
+        Resets the query counters of the statistics, e.g. between two benchmark runs (the build timers are kept).
+        """
+        assert self.tree_stats is not None, "reset_stats requires collect_stats=True"
+        self.tree_stats.reset_queries()
+
+    def _node_children(self, node) -> list:
+        """
+        Returns the children of a node, none for a leaf.
+        """
+        if self._is_leaf(node):
+            return []
+        if self.layout == "flat":
+            first = int(self.nodes["first_child"][node])
+            return list(range(first, first + int(self.nodes["n_children"][node])))
+        return [node["children"]["left"], node["children"]["right"]]
+
+    def _leaves(self, node=None):
+        """
+        Yields the ids, the depth and the cluster label of every leaf under node (the root by default),
+        from left to right, labelling the leaves the same way as _flatten_tree.
+        """
+        if node is None:
+            node = self.root
+        if node is None:
+            return
+        stack = [(node, 0)]
+        while stack:
+            node, label = stack.pop()
+            if self._is_leaf(node):
+                depth = self.nodes["depth"][node] if self.layout == "flat" else node["depth"]
+                yield self._node_ids(node), depth, label
+                continue
+            if self.layout == "flat":
+                first = self.nodes["first_child"][node]
+                children = [(first + i, label + i) for i in range(self.nodes["n_children"][node])]
+            else:
+                children = [(node["children"]["left"], label), (node["children"]["right"], label + 1)]
+            stack.extend(reversed(children))
+
     def _flatten_tree(self, node, label):
         """
         Flattens the RTree to get all points and their cluster labels.
@@ -195,11 +2160,76 @@ class RTree:
             return [], []
 
         if "children" not in node or node["children"] is None:
-            points = node["points"]
+            # with the "ranges" storage the nodes only keep the range of their points
+            points = node["points"] if self.storage == "points" else list(self.data[self._node_ids(node)])
             labels = [label] * len(points)
             return points, labels
 
         left_points, left_labels = self._flatten_tree(node["children"]["left"], label)
         right_points, right_labels = self._flatten_tree(node["children"]["right"], label + 1)
 
-        return left_points + right_points, left_labels + right_labels
\ No newline at end of file
+        return left_points + right_points, left_labels + right_labels
+
+    def _flatten_flat(self):
+        """
+        Flattens the "flat" layout to get all points and their cluster labels, labelling the
+        leaves the same way as _flatten_tree.
+
+        Returns
+        -------
+        np.ndarray, np.ndarray
+            The points and their cluster labels.
+        """
+        ids = []
+        labels = []
+
+        stack = [(self.root, 0)]
+        while stack:
+            node, label = stack.pop()
+            if self._is_leaf(node):
+                ids.append(self._node_ids(node))
+                labels.append(np.full(len(ids[-1]), label))
+                continue
+            first = self.nodes["first_child"][node]
+            stack.append((first + 1, label + 1))
+            stack.append((first, label))
+
+        return self.data[np.concatenate(ids)], np.concatenate(labels)
+
+def _build_subtree(template: RTree, ids: np.ndarray, depth: int, last_dim: int, seed: int):
+    """
+    Builds a subtree over the given ids in the "flat" layout, for a parallel build; depth is the
+    depth of the children of its root. Returns the partitioned ids and the node arrays, with starts
+    relative to the ids.
+    """
+    tree = copy.copy(template)
+    tree.perm = ids
+    tree.rng = random.Random(seed)
+    n_leaves = max(1, -(-len(ids) // max(tree.leaf_size, 1)))
+    tree._init_nodes(2 * (1 << (n_leaves - 1).bit_length()) - 1)
+    root = tree._new_nodes(1)
+    tree._set_node(root, depth - 1, 0, len(ids))
+    tree.range_build(root, depth, last_dim)
+    tree._trim_nodes()
+    return tree.perm, tree.nodes
+
+
+def _build_shared_subtree(shared: tuple, task: tuple):
+    """
+    Builds a subtree in a worker process, reading the datapoints from shared memory or from their file.
+    """
+    template, (kind, name, offset, shape, dtype) = shared
+    if kind == "memmap":
+        template.data = np.memmap(name, dtype=dtype, mode="r", offset=offset, shape=shape)
+        try:
+            return _build_subtree(template, *task)
+        finally:
+            template.data = None
+
+    shm = SharedMemory(name=name)
+    try:
+        template.data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return _build_subtree(template, *task)
+    finally:
+        template.data = None
+        shm.close()
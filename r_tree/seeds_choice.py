@@ -1,6 +1,21 @@
 # seeds_choice.py
 
-from dimension_choice import *
+import random
+
+import numpy as np
+
+try:
+    from .dimension_choice import *
+    from .metrics import *
+except ImportError:
+    from dimension_choice import *
+    from metrics import *
+try:
+    from ..common.datasource import *
+    from ..common.segments import *
+except ImportError:
+    from common.datasource import *
+    from common.segments import *
 
 
 def one_dim_farthest_seeds(
@@ -8,10 +23,17 @@ def one_dim_farthest_seeds(
     nbr_dims: int,
     dimension_choice_alg: str = "random",
     last_dim: int = None,
+    rng=random,
+    stats: dict = None,
+    chunk_rows: int = 4096,
     **kwargs
 ):
     """
     Returns the seeds that are the farthest apart from each other on a single dimension.
+    A random dimension choice draws from rng (the random module by default); the "max_variance" and
+    "widest_interval" choices read the per-dimension statistics of the points from stats if it is given.
+    The "random_projection" and "pca" choices return a direction rather than a dimension: the seeds are then
+    the farthest apart along it. The coordinates are read chunk_rows points at a time.
     """
 
     switcher: dict[str, function] = {
@@ -19,41 +41,207 @@ def one_dim_farthest_seeds(
         "random": random_dim,
         "max_variance": max_variance_dim,
         "widest_interval": widest_interval_dim,
+        "random_projection": random_projection_dim,
+        "pca": pca_dim,
     }
 
     assert (
         dimension_choice_alg in switcher
-    ), "Invalid dimension_choice_alg, choose from 'alternate', 'random', 'max_variance', 'widest_interval'"
+    ), "Invalid dimension_choice_alg, choose from 'alternate', 'random', 'max_variance', 'widest_interval', 'random_projection', 'pca'"
 
     dimension_choice = switcher[dimension_choice_alg]
 
-    dim_result = dimension_choice(datapoints=datapoints, nbr_dims=nbr_dims, last_dim=last_dim)
-
-    chosen_dim = dim_result["dim"]
+    dim_result = dimension_choice(datapoints=datapoints, nbr_dims=nbr_dims, last_dim=last_dim, rng=rng, stats=stats)
 
-    max_point = max(datapoints, key=lambda x: x[chosen_dim])
-    min_point = min(datapoints, key=lambda x: x[chosen_dim])
+    column = np.empty(len(datapoints), dtype=np.float64)
+    for start, rows in row_chunks(datapoints, chunk_rows):
+        if "direction" in dim_result:
+            column[start : start + chunk_rows] = np.einsum("ij,j->i", rows, dim_result["direction"])
+        else:
+            column[start : start + chunk_rows] = rows[:, dim_result["dim"]]
+    # the first points of largest and of smallest coordinate
+    seeds = [datapoints[int(np.argmax(column))], datapoints[int(np.argmin(column))]]
 
-    return {"seeds": [max_point, min_point], "dim": chosen_dim}
+    if "direction" in dim_result:
+        return {"seeds": seeds}
+    return {"seeds": seeds, "dim": dim_result["dim"]}
 
 
 def farthest_euc_distance_seeds(
     datapoints: list[list[float]],
     nbr_dims: int,
+    metric: Metric = None,
+    **kwargs
+):
+    """
+    Returns the seeds that are the farthest apart from each other on all dimensions, by the metric (squared
+    Euclidean by default). The distances of all the pairs are computed as arrays, block by block, as in
+    farthest_euc_distance_blocked_seeds.
+    """
+    return farthest_euc_distance_blocked_seeds(datapoints, nbr_dims, metric=metric, **kwargs)
+
+
+def farthest_euc_distance_blocked_seeds(
+    datapoints: list[list[float]],
+    nbr_dims: int,
+    block_size: int = 1024,
+    metric: Metric = None,
+    **kwargs
+):
+    """
+    Returns the seeds that are the farthest apart from each other on all dimensions, by the metric (squared
+    Euclidean by default, computed as ||x||^2 + ||y||^2 - 2xy). The distances are computed block by block, so
+    at most block_size x block_size distances (and two blocks of points) are held at once, and only the pairs
+    i < j are compared.
+    """
+    metric = metric or SquaredL2()
+
+    max_dist = -np.inf
+    max_dist_ids = None
+
+    for i in range(0, len(datapoints), block_size):
+        block_i = np.asarray(datapoints[i:i + block_size])
+        for j in range(i, len(datapoints), block_size):
+            dists = metric.pairwise(block_i, np.asarray(datapoints[j:j + block_size]))
+            if i == j:
+                # the distance of a point to itself (not 0 for the inner product) and the pairs seen twice
+                dists[np.tril_indices(len(dists), m=dists.shape[1])] = -np.inf
+            row, col = np.unravel_index(np.argmax(dists), dists.shape)
+            if dists[row, col] > max_dist:
+                max_dist = dists[row, col]
+                max_dist_ids = (i + row, j + col)
+
+    if max_dist_ids is None:
+        return {"seeds": []}
+    return {"seeds": [datapoints[min(max_dist_ids)], datapoints[max(max_dist_ids)]]}
+
+
+def approx_farthest_seeds(
+    datapoints: list[list[float]],
+    nbr_dims: int,
+    n_iter: int = 2,
+    sample_size: int = None,
+    rng=random,
+    metric: Metric = None,
+    chunk_rows: int = 4096,
     **kwargs
 ):
     """
-    Returns the seeds that are the farthest apart from each other on all dimensions.
+    Returns two seeds that are approximately the farthest apart from each other, in linear time.
+    Starting from a random point, the seeds are the last two points of a chain where each point is the
+    farthest from the previous one by the metric (squared Euclidean by default), n_iter steps. If sample_size is given, the chain only visits a random
+    sample of that many points. The random draws come from rng (the random module by default).
+    The distances are computed chunk_rows points at a time.
     """
+    X = datapoints
+    ids = np.arange(len(X))
+    if sample_size is not None and sample_size < len(X):
+        ids = np.array(sorted(rng.sample(range(len(X)), sample_size)))
+        X = np.asarray([datapoints[i] for i in ids])
+
+    metric = metric or SquaredL2()
+    seed1 = rng.randrange(len(X))
+    seed2 = seed1
+    for _ in range(n_iter):
+        dists = datapoint_distances(metric, X, np.asarray(X[seed2]), chunk_rows)
+        seed1, seed2 = seed2, int(np.argmax(dists))
+
+    return {"seeds": [datapoints[ids[seed1]], datapoints[ids[seed2]]]}
+
+
+def one_dim_farthest_segmented_seeds(
+    data: np.ndarray,
+    ids: np.ndarray,
+    counts: np.ndarray,
+    nbr_dims: int,
+    dimension_choice_alg: str = "random",
+    last_dims: np.ndarray = None,
+    rng=random,
+    stats: dict = None,
+    chunk_rows: int = 65536,
+    **kwargs
+):
+    """
+    Returns the seeds of one_dim_farthest_seeds of every node of a level at once, the points of the nodes
+    being the consecutive segments of the rows ids of data, of the given counts. The seeds are the first
+    points of largest and of smallest coordinate along the dimension, or direction, chosen for every node,
+    as the rows of two (n_nodes, n_dims) arrays. The "max_variance" and "widest_interval" choices read the (n_nodes, n_dims)
+    statistics of segment_stats from stats; "pca" is chosen node by node.
+    """
+    offsets = segment_offsets(counts)
+    labels = segment_labels(counts)
+
+    dimension_choice = DIM_SEGMENTED[dimension_choice_alg]
+    if dimension_choice is None:
+        results = [
+            pca_dim(datapoints=NodeRows(data, ids[offset : offset + count]), nbr_dims=nbr_dims, rng=rng)
+            for offset, count in zip(offsets.tolist(), counts.tolist())
+        ]
+        dim_result = {"direction": np.array([result["direction"] for result in results])}
+    else:
+        dim_result = dimension_choice(nbr_dims=nbr_dims, last_dims=last_dims, n_nodes=len(counts), rng=rng, stats=stats)
+
+    if "direction" in dim_result:
+        column = np.empty(len(ids), dtype=np.float64)
+        for start in range(0, len(ids), chunk_rows):
+            rows = data[ids[start : start + chunk_rows]]
+            column[start : start + chunk_rows] = np.einsum("ij,ij->i", rows, dim_result["direction"][labels[start : start + chunk_rows]])
+    else:
+        column = data[ids, dim_result["dim"][labels]]
+    seeds = (data[ids[segment_argmax(column, offsets, counts)]], data[ids[segment_argmin(column, offsets, counts)]])
+
+    if "direction" in dim_result:
+        return {"seeds": seeds}
+    return {"seeds": seeds, "dim": dim_result["dim"]}
+
+
+def approx_farthest_segmented_seeds(
+    data: np.ndarray,
+    ids: np.ndarray,
+    counts: np.ndarray,
+    n_iter: int = 2,
+    sample_size: int = None,
+    rng=random,
+    metric: Metric = None,
+    chunk_rows: int = 65536,
+    **kwargs
+):
+    """
+    Returns the seeds of approx_farthest_seeds of every node of a level at once, the points of the nodes
+    being the consecutive segments of the rows ids of data, of the given counts, as the rows of two
+    (n_nodes, n_dims) arrays. Every step of the chains of all the nodes is one pass over the points of the level.
+    """
+    metric = metric or SquaredL2()
+    offsets = segment_offsets(counts)
+    labels = segment_labels(counts)
+
+    # the points the chains may visit, a random sample of every node larger than sample_size
+    candidates = None
+    if sample_size is not None:
+        candidates = np.ones(len(ids), dtype=bool)
+        for offset, count in zip(offsets.tolist(), counts.tolist()):
+            if sample_size < count:
+                candidates[offset : offset + count] = False
+                candidates[offset + np.array(sorted(rng.sample(range(count), sample_size)))] = True
+    positions = np.arange(len(ids)) if candidates is None else np.flatnonzero(candidates)
+    first_candidates = np.searchsorted(positions, offsets)
+    n_candidates = np.diff(np.append(first_candidates, len(positions)))
+
+    seed1 = seed2 = positions[first_candidates + np.array([rng.randrange(n) for n in n_candidates.tolist()], dtype=np.int64)]
+    for _ in range(n_iter):
+        dists = paired_distances(metric, data, ids, data[ids[seed2]], labels, chunk_rows)
+        if candidates is not None:
+            dists[~candidates] = -np.inf
+        seed1, seed2 = seed2, segment_argmax(dists, offsets, counts)
 
-    max_dist = 0
-    max_dist_points = []
+    return {"seeds": (data[ids[seed1]], data[ids[seed2]])}
 
-    for point1 in datapoints:
-        for point2 in datapoints:
-            dist = sum([(point1[dim] - point2[dim]) ** 2 for dim in range(nbr_dims)]) ** 0.5
-            if dist > max_dist:
-                max_dist = dist
-                max_dist_points = [point1, point2]
 
-    return {"seeds": max_dist_points}
+# the versions choosing for all the nodes of a level at once (level-synchronous build), None where the
+# seeds are chosen node by node
+SEEDS_SEGMENTED = {
+    "one_dim_farthest": one_dim_farthest_segmented_seeds,
+    "farthest_euc_distance": None,
+    "farthest_euc_distance_blocked": None,
+    "approx_farthest": approx_farthest_segmented_seeds,
+}
@@ -0,0 +1,28 @@
+# sharded_index.py
+try:
+    from .r_tree import RTree
+except ImportError:
+    from r_tree import RTree
+try:
+    from ..common.sharded_index import ShardedIndex as BaseShardedIndex
+except ImportError:
+    from common.sharded_index import ShardedIndex as BaseShardedIndex
+import math
+import numpy as np
+
+
+class ShardedIndex(BaseShardedIndex):
+    """
+    The sharded index of RTrees (see common/sharded_index.py). Its "tree" partition takes the leaves of an
+    RTree packed with "str" tiles of ceil(n / n_shards) points.
+    """
+
+    tree_class = RTree
+
+    @staticmethod
+    def _tree_partition(data: np.ndarray, n_shards: int) -> list:
+        """
+        Returns the ids of the leaves of a shallow tree as the shards.
+        """
+        tree = RTree(data.shape[1], data, leaf_size=math.ceil(len(data) / n_shards), layout="flat", packing="str")
+        return [np.asarray(ids) for ids, _, _ in tree._leaves() if len(ids)]
@@ -0,0 +1,58 @@
+# conftest.py
+"""
+The trees are imported as the benchmarks import them, from the root of the repository.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+@pytest.fixture
+def points():
+    """
+    2000 float32 points of a Gaussian mixture in 8 dimensions, with some duplicates.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=4, size=(10, 8))
+    data = centers[rng.integers(len(centers), size=2000)] + rng.normal(size=(2000, 8))
+    data[-20:] = data[:20]
+    return data.astype(np.float32)
+
+
+@pytest.fixture
+def queries():
+    """
+    50 float32 query points of the same distribution as points, but not in it.
+    """
+    rng = np.random.default_rng(1)
+    return (rng.normal(scale=4, size=(50, 8)) + rng.normal(size=(50, 8))).astype(np.float32)
+
+
+@pytest.fixture
+def brute_force():
+    """
+    Returns a function computing the distances (float64, ascending) from every query to its k nearest points
+    by the Minkowski distance of order p.
+    """
+
+    def distances(points: np.ndarray, queries: np.ndarray, k: int, p: int = 2) -> np.ndarray:
+        diffs = np.abs(queries[:, None, :].astype(np.float64) - points[None, :, :].astype(np.float64))
+        return np.sort((diffs**p).sum(axis=2) ** (1 / p), axis=1)[:, :k]
+
+    return distances
+
+
+@pytest.fixture
+def leaves():
+    """
+    Returns a function listing the (depth, sorted ids) of the leaves of a tree, from left to right.
+    """
+
+    def tree_leaves(tree) -> list:
+        return [(int(depth), sorted(np.asarray(ids).tolist())) for ids, depth, _ in tree._leaves()]
+
+    return tree_leaves
@@ -0,0 +1,60 @@
+# test_all_knn.py
+"""
+The all-kNN self-join of the trees against the brute-force neighbours of every point.
+"""
+import numpy as np
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+TREES = [
+    (KDTree, {"engine": "numpy", "layout": "flat"}),
+    (KDTree, {"engine": "numpy", "layout": "flat", "dimension_choice": "random_projection"}),
+    (KDTree, {"engine": "numpy", "layout": "flat", "builder": "level"}),
+    (RTree, {"layout": "flat"}),
+    (RTree, {"layout": "flat", "packing": "str", "fanout": 4}),
+]
+
+
+def true_distances(points: np.ndarray, k: int, include_self: bool, p: int = 2) -> np.ndarray:
+    X = points.astype(np.float64)
+    dists = np.stack([(np.abs(X - x) ** p).sum(axis=1) ** (1 / p) for x in X])
+    if not include_self:
+        np.fill_diagonal(dists, np.inf)
+    return np.sort(dists, axis=1)[:, :k]
+
+
+@pytest.mark.parametrize("tree_class, params", TREES)
+@pytest.mark.parametrize("include_self", [False, True])
+@pytest.mark.parametrize("n_threads", [None, 2])
+def test_all_knn(points, tree_class, params, include_self, n_threads):
+    tree = tree_class(8, points, leaf_size=8, **params)
+    indptr, indices, distances = tree.all_knn(5, include_self=include_self, n_threads=n_threads, block_size=32)
+
+    np.testing.assert_array_equal(indptr, np.arange(0, 5 * len(points) + 1, 5))
+    rows = np.repeat(np.arange(len(points)), 5)
+    if not include_self:
+        assert not np.any(indices == rows)
+    np.testing.assert_allclose(distances.reshape(-1, 5), true_distances(points, 5, include_self), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(np.sqrt(((points[indices] - points[rows]).astype(np.float64) ** 2).sum(axis=1)), distances, rtol=1e-5, atol=1e-5)
+
+
+def test_all_knn_metric(points):
+    tree = RTree(8, points, layout="flat", leaf_size=8, metric="l1")
+    _, _, distances = tree.all_knn(5)
+    np.testing.assert_allclose(distances.reshape(-1, 5), true_distances(points, 5, False, p=1), rtol=1e-5, atol=1e-5)
+
+
+def test_all_knn_after_delete(points):
+    tree = KDTree(8, points, engine="numpy", layout="flat", leaf_size=8)
+    deleted = np.arange(0, len(points), 3)
+    # a third of the points, fewer than would trigger a rebuild
+    tree.delete(deleted, alpha=0.5)
+    indptr, indices, distances = tree.all_knn(3)
+
+    kept = np.setdiff1d(np.arange(len(points)), deleted)
+    counts = np.diff(indptr)
+    assert np.all(counts[deleted] == 0) and np.all(counts[kept] == 3)
+    assert not np.isin(indices, deleted).any()
+    np.testing.assert_allclose(distances.reshape(-1, 3), true_distances(points[kept], 3, False), rtol=1e-5, atol=1e-5)
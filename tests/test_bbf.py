@@ -0,0 +1,81 @@
+# test_bbf.py
+"""
+The best-bin-first searches of the KDTree and of the KDForest: exact with a large enough budget, bounded by
+a small one, and without duplicate neighbours over the trees of a forest.
+"""
+import random
+
+import numpy as np
+import pytest
+
+from kd_tree.kd_forest import KDForest
+from kd_tree.kd_tree import KDTree
+
+
+def count_checks(monkeypatch, tree) -> list:
+    """
+    Counts the points compared to the queries by the searches of tree (the first tree of a forest), as
+    [points, leaves].
+    """
+    counts = [0, 0]
+    leaf_distances = tree._leaf_distances
+
+    def counted(ids, q):
+        counts[0] += len(ids)
+        counts[1] += 1
+        return leaf_distances(ids, q)
+
+    monkeypatch.setattr(tree, "_leaf_distances", counted)
+    return counts
+
+
+@pytest.fixture
+def forest(points):
+    # the trees draw from the random module
+    random.seed(0)
+    return KDForest(8, points, n_trees=4, leaf_size=8)
+
+
+@pytest.mark.parametrize("layout", ["dict", "flat"])
+@pytest.mark.parametrize("budget", ["max_checks", "max_leaves"])
+def test_kd_bbf_large_budget_is_exact(points, queries, brute_force, layout, budget):
+    tree = KDTree(8, points, engine="numpy", layout=layout, leaf_size=8)
+    distances, _ = tree.query_batch(queries, 10, **{budget: len(points)})
+    np.testing.assert_allclose(distances, brute_force(points, queries, 10), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("budget", ["max_checks", "max_leaves"])
+def test_forest_large_budget_is_exact(points, queries, brute_force, forest, budget):
+    distances, _ = forest.query_batch(queries, 10, **{budget: len(points)})
+    np.testing.assert_allclose(distances, brute_force(points, queries, 10), rtol=1e-5, atol=1e-5)
+    # without a budget too
+    distances, _ = forest.query_batch(queries, 10)
+    np.testing.assert_allclose(distances, brute_force(points, queries, 10), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("max_checks", [10, 40, 200])
+def test_forest_never_returns_duplicates(queries, forest, max_checks):
+    _, ids = forest.query_batch(queries, 20, max_checks=max_checks)
+    for row in ids:
+        assert len(set(row.tolist())) == len(row)
+
+
+@pytest.mark.parametrize("max_checks", [8, 50, 200])
+def test_max_checks_bounds_the_points_compared(monkeypatch, points, queries, forest, max_checks):
+    tree = KDTree(8, points, engine="numpy", layout="flat", leaf_size=8)
+    for searched in (tree, forest):
+        counts = count_checks(monkeypatch, tree if searched is tree else forest.trees[0])
+        for q in queries:
+            counts[0] = 0
+            searched.query(q, 5, max_checks=max_checks)
+            # the search stops after the leaf that reaches the budget, once it has k candidates
+            assert counts[0] < max(max_checks, 5) + tree.leaf_size
+
+
+@pytest.mark.parametrize("max_leaves", [1, 3, 10])
+def test_max_leaves_bounds_the_leaves_checked(monkeypatch, points, queries, forest, max_leaves):
+    counts = count_checks(monkeypatch, forest.trees[0])
+    for q in queries:
+        counts[1] = 0
+        forest.query(q, 1, max_leaves=max_leaves)
+        assert counts[1] <= max_leaves
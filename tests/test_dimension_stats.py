@@ -0,0 +1,61 @@
+# test_dimension_stats.py
+"""
+The "incremental" and "sampled" dimension_stats: the same splits as the exact statistics when they see the
+same points, and searchable trees otherwise.
+"""
+import random
+
+import numpy as np
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+
+@pytest.mark.parametrize("dimension_choice", ["random_projection", "pca"])
+@pytest.mark.parametrize("dimension_stats", ["incremental", "sampled"])
+def test_projections_ignore_dimension_stats(points, queries, brute_force, dimension_choice, dimension_stats):
+    tree = KDTree(8, points, dimension_choice=dimension_choice, dimension_stats=dimension_stats, engine="numpy", layout="flat", leaf_size=8)
+    distances, _ = tree.query_batch(queries, 5)
+    np.testing.assert_allclose(distances, brute_force(points, queries, 5), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("dimension_choice", ["max_variance", "top_variance"])
+@pytest.mark.parametrize("layout", ["dict", "flat"])
+def test_kd_incremental_stats_give_the_exact_splits(points, leaves, dimension_choice, layout):
+    # the splits are medians, so only the choice of the dimensions depends on the statistics
+    params = {"dimension_choice": dimension_choice, "split_position_choice": "median", "engine": "numpy", "layout": layout, "leaf_size": 8}
+    random.seed(0)
+    exact = leaves(KDTree(8, points, dimension_stats="exact", **params))
+    random.seed(0)
+    assert leaves(KDTree(8, points, dimension_stats="incremental", **params)) == exact
+
+
+def test_kd_sampled_stats_of_every_point_give_the_exact_splits(points, leaves):
+    params = {"dimension_choice": "max_variance", "split_position_choice": "median", "engine": "numpy", "layout": "flat", "leaf_size": 8}
+    exact = leaves(KDTree(8, points, **params))
+    assert leaves(KDTree(8, points, dimension_stats="sampled", stats_sample_size=len(points), **params)) == exact
+
+
+@pytest.mark.parametrize("dimension_choice", ["max_variance", "widest_interval", "top_variance"])
+@pytest.mark.parametrize("dimension_stats, stats_sample_size", [("incremental", 1024), ("sampled", 64)])
+def test_kd_approximate_stats_keep_the_search_exact(points, queries, brute_force, dimension_choice, dimension_stats, stats_sample_size):
+    tree = KDTree(
+        8,
+        points,
+        dimension_choice=dimension_choice,
+        dimension_stats=dimension_stats,
+        stats_sample_size=stats_sample_size,
+        engine="numpy",
+        layout="flat",
+        leaf_size=8,
+    )
+    distances, _ = tree.query_batch(queries, 5)
+    np.testing.assert_allclose(distances, brute_force(points, queries, 5), rtol=1e-5, atol=1e-5)
+
+
+def test_r_incremental_stats_give_the_exact_splits(points, leaves):
+    params = {"seed_choice": "one_dim_farthest", "dimension_choice": "max_variance", "layout": "flat", "leaf_size": 8}
+    exact = leaves(RTree(8, points, dimension_stats="exact", **params))
+    assert leaves(RTree(8, points, dimension_stats="incremental", **params)) == exact
+    assert leaves(RTree(8, points, dimension_stats="sampled", stats_sample_size=len(points), **params)) == exact
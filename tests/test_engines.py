@@ -0,0 +1,21 @@
+# test_engines.py
+"""
+The "list" and "numpy" build engines of the KDTree build the same tree.
+"""
+import pytest
+
+from kd_tree.kd_tree import KDTree
+
+
+@pytest.mark.parametrize("dimension_choice", ["alternate", "max_variance", "widest_interval"])
+@pytest.mark.parametrize("split_position_choice", ["median", "mean", "geometric_center"])
+@pytest.mark.parametrize("max_depth", [None, 4])
+def test_engines_build_the_same_tree(points, leaves, dimension_choice, split_position_choice, max_depth):
+    params = {
+        "dimension_choice": dimension_choice,
+        "split_position_choice": split_position_choice,
+        "leaf_size": 8,
+        "max_depth": max_depth,
+        "layout": "dict",
+    }
+    assert leaves(KDTree(8, points, engine="list", **params)) == leaves(KDTree(8, points, engine="numpy", **params))
@@ -0,0 +1,77 @@
+# test_index_file.py
+"""
+save and load: a loaded tree answers the queries as the saved one, and foreign files are refused.
+"""
+import struct
+
+import numpy as np
+import pytest
+
+from common.index_file import INDEX_VERSION
+from kd_tree.kd_tree import KDTree
+from m_tree.m_tree import MTree
+from r_tree.r_tree import RTree
+
+TREES = [
+    (KDTree, {"engine": "numpy", "layout": "flat"}),
+    (KDTree, {"engine": "numpy", "layout": "flat", "dimension_choice": "pca"}),
+    (KDTree, {"engine": "numpy", "layout": "flat", "rotation": "pca", "vector_storage": "int8"}),
+    (RTree, {"layout": "flat"}),
+    (RTree, {"layout": "flat", "packing": "str", "metric": "l1"}),
+    (MTree, {}),
+    (MTree, {"metric": "manhattan", "promotion": "centroid"}),
+]
+
+
+@pytest.mark.parametrize("tree_class, params", TREES)
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load_round_trip(tmp_path, points, queries, tree_class, params, mmap):
+    tree = tree_class(8, points, leaf_size=8, **params)
+    path = tmp_path / "index.bin"
+    tree.save(str(path))
+    loaded = tree_class.load(str(path), mmap=mmap)
+
+    assert loaded.n_points == tree.n_points
+    for name, values in tree.nodes.items():
+        np.testing.assert_array_equal(loaded.nodes[name], values[: len(loaded.nodes[name])], err_msg=name)
+    distances, ids = tree.query_batch(queries, 10)
+    loaded_distances, loaded_ids = loaded.query_batch(queries, 10)
+    np.testing.assert_array_equal(loaded_ids, ids)
+    np.testing.assert_array_equal(loaded_distances, distances)
+
+
+def test_loaded_tree_can_be_updated(tmp_path, points, queries):
+    tree = KDTree(8, points[:1000], engine="numpy", layout="flat", leaf_size=8)
+    path = tmp_path / "index.bin"
+    tree.save(str(path))
+    loaded = KDTree.load(str(path))
+    ids = loaded.insert(points[1000:])
+    loaded.delete(ids[:10])
+    assert loaded.n_points == len(points) - 10
+
+
+def test_load_other_version(tmp_path, points):
+    path = tmp_path / "index.bin"
+    KDTree(8, points, engine="numpy", layout="flat").save(str(path))
+    with open(path, "r+b") as f:
+        f.seek(8)
+        f.write(struct.pack("<I", INDEX_VERSION + 1))
+    with pytest.raises(ValueError, match=f"index format version {INDEX_VERSION + 1}, expected {INDEX_VERSION}"):
+        KDTree.load(str(path))
+
+
+def test_load_foreign_files(tmp_path, points):
+    path = tmp_path / "index.bin"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError, match="is not an index file"):
+        KDTree.load(str(path))
+    # shorter than the magic, the version and the header length
+    path.write_bytes(b"HDTREE")
+    with pytest.raises(ValueError, match="is not an index file"):
+        KDTree.load(str(path))
+
+    RTree(8, points, layout="flat").save(str(path))
+    with pytest.raises(ValueError):
+        KDTree.load(str(path))
+    with pytest.raises(ValueError):
+        MTree.load(str(path))
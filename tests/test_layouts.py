@@ -0,0 +1,36 @@
+# test_layouts.py
+"""
+The "flat" layout stores the same tree as the "dict" layout, in node arrays.
+"""
+import numpy as np
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+
+@pytest.mark.parametrize("dimension_choice", ["alternate", "max_variance", "widest_interval"])
+@pytest.mark.parametrize("split_position_choice", ["median", "mean"])
+def test_kd_flat_layout(points, leaves, dimension_choice, split_position_choice):
+    params = {"dimension_choice": dimension_choice, "split_position_choice": split_position_choice, "leaf_size": 8, "engine": "numpy"}
+    assert leaves(KDTree(8, points, layout="flat", **params)) == leaves(KDTree(8, points, layout="dict", **params))
+
+
+@pytest.mark.parametrize("seed_choice", ["one_dim_farthest", "farthest_euc_distance_blocked"])
+@pytest.mark.parametrize("grouping_choice", ["closest_seed", "sorting_distance_to_one_seed"])
+def test_r_flat_layout(points, leaves, seed_choice, grouping_choice):
+    params = {"seed_choice": seed_choice, "grouping_choice": grouping_choice, "dimension_choice": "max_variance", "leaf_size": 8}
+    assert leaves(RTree(8, points[:600], layout="flat", **params)) == leaves(RTree(8, points[:600], layout="dict", **params))
+
+
+@pytest.mark.parametrize("layout, builder", [("dict", "recursive"), ("flat", "recursive"), ("flat", "level")])
+def test_kd_empty_tree(queries, layout, builder):
+    tree = KDTree(8, np.empty((0, 8), dtype=np.float32), engine="numpy", layout=layout, builder=builder)
+    distances, ids = tree.query(queries[0], 5)
+    assert len(distances) == 0 and len(ids) == 0
+    distances, ids = tree.query_batch(queries, 5)
+    assert distances.shape == ids.shape == (len(queries), 0)
+
+    ids = tree.insert(queries[:3])
+    _, found = tree.query(queries[0], 1)
+    assert found.tolist() == [ids[0]]
@@ -0,0 +1,43 @@
+# test_parallel_build.py
+"""
+The parallel builds give the same tree whatever the number of workers and the pool.
+"""
+import random
+
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+KD_PARAMS = {"engine": "numpy", "layout": "flat", "leaf_size": 8, "parallel_depth": 3}
+R_PARAMS = {"storage": "ranges", "leaf_size": 8, "parallel_depth": 3}
+
+
+def build(tree_class, points, seed, **params):
+    # the trees draw from the random module
+    random.seed(seed)
+    return tree_class(8, points, **params)
+
+
+@pytest.mark.parametrize("dimension_choice", ["random", "top_variance", "random_projection", "pca"])
+@pytest.mark.parametrize("parallel_backend", ["process", "thread"])
+def test_kd_parallel_build_is_deterministic(points, leaves, dimension_choice, parallel_backend):
+    params = {**KD_PARAMS, "dimension_choice": dimension_choice, "parallel_backend": parallel_backend}
+    reference = leaves(build(KDTree, points, 0, n_jobs=1, **params))
+    for n_jobs in (2, 3):
+        assert leaves(build(KDTree, points, 0, n_jobs=n_jobs, **params)) == reference
+
+
+@pytest.mark.parametrize("dimension_choice", ["alternate", "max_variance"])
+def test_kd_parallel_build_matches_sequential(points, leaves, dimension_choice):
+    params = {**KD_PARAMS, "dimension_choice": dimension_choice, "split_position_choice": "median"}
+    assert leaves(build(KDTree, points, 0, n_jobs=2, **params)) == leaves(build(KDTree, points, 0, **params))
+
+
+@pytest.mark.parametrize("seed_choice", ["one_dim_farthest", "approx_farthest"])
+@pytest.mark.parametrize("parallel_backend", ["process", "thread"])
+def test_r_parallel_build_is_deterministic(points, leaves, seed_choice, parallel_backend):
+    params = {**R_PARAMS, "seed_choice": seed_choice, "dimension_choice": "random", "parallel_backend": parallel_backend}
+    reference = leaves(build(RTree, points, 0, n_jobs=1, **params))
+    for n_jobs in (2, 3):
+        assert leaves(build(RTree, points, 0, n_jobs=n_jobs, **params)) == reference
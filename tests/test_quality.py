@@ -0,0 +1,68 @@
+# test_quality.py
+"""
+The sampled silhouette score and the leaf metrics of quality_metrics, against a direct computation.
+"""
+import numpy as np
+import pytest
+from sklearn.metrics import silhouette_score
+
+from kd_tree.kd_tree import KDTree
+from m_tree.m_tree import MTree
+from r_tree.r_tree import RTree
+
+TREES = [
+    (KDTree, {"engine": "numpy", "layout": "flat"}),
+    (KDTree, {"engine": "numpy", "layout": "dict"}),
+    (RTree, {"layout": "flat"}),
+    (RTree, {"layout": "dict"}),
+    (MTree, {}),
+]
+
+
+def leaf_labels(tree):
+    """
+    Returns the ids of the points of a tree and their cluster labels, those of their leaves.
+    """
+    leaves = list(tree._leaves())
+    return np.concatenate([ids for ids, _, _ in leaves]), np.concatenate([np.full(len(ids), label) for ids, _, label in leaves])
+
+
+@pytest.mark.parametrize("tree_class, params", TREES)
+def test_sampled_silhouette_of_every_point_is_exact(points, tree_class, params):
+    tree = tree_class(8, points[:500], leaf_size=16, **params)
+    ids, labels = leaf_labels(tree)
+    expected = silhouette_score(points[ids].astype(np.float64), labels)
+    for sample_size in (500, 10_000):
+        assert tree.compute_silhouette_score(sample_size=sample_size) == pytest.approx(expected, abs=1e-6)
+    assert tree.compute_silhouette_score() == pytest.approx(expected, abs=1e-6)
+
+
+def test_sampled_silhouette_estimate(points):
+    tree = KDTree(8, points, engine="numpy", layout="flat", leaf_size=64)
+    exact = tree.compute_silhouette_score(sample_size=len(points))
+    estimate = tree.compute_silhouette_score(sample_size=400, seed=1)
+    assert estimate == tree.compute_silhouette_score(sample_size=400, seed=1)
+    assert estimate == pytest.approx(exact, abs=0.05)
+
+
+@pytest.mark.parametrize("tree_class, params", TREES)
+def test_leaf_metrics(points, tree_class, params):
+    tree = tree_class(8, points, leaf_size=16, **params)
+    metrics = tree.quality_metrics()
+    leaves = [(np.asarray(ids), depth) for ids, depth, _ in tree._leaves()]
+    sizes = [len(ids) for ids, _ in leaves]
+
+    assert metrics["n_leaves"] == len(leaves)
+    assert metrics["leaf_size_min"] == min(sizes) and metrics["leaf_size_max"] == max(sizes)
+    assert metrics["leaf_size_mean"] == pytest.approx(len(points) / len(leaves))
+    assert sum(metrics["depth_histogram"].values()) == len(leaves)
+
+    sse = radius = 0.0
+    for ids, _ in leaves:
+        leaf = points[ids].astype(np.float64)
+        sq_dists = ((leaf - leaf.mean(axis=0)) ** 2).sum(axis=1)
+        sse += sq_dists.sum()
+        radius = max(radius, np.sqrt(sq_dists.max()))
+    assert metrics["sse"] == pytest.approx(sse)
+    assert metrics["sse_per_point"] == pytest.approx(sse / len(points))
+    assert metrics["leaf_radius_max"] == pytest.approx(radius)
@@ -0,0 +1,143 @@
+# test_queries.py
+"""
+The exact searches of the trees against a brute-force scan.
+"""
+import numpy as np
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from m_tree.m_tree import MTree
+from r_tree.r_tree import RTree
+
+KD_VARIANTS = [
+    {"engine": "list", "layout": "dict"},
+    {"engine": "numpy", "layout": "dict"},
+    {"engine": "numpy", "layout": "flat"},
+    {"engine": "numpy", "layout": "flat", "builder": "level"},
+]
+
+R_VARIANTS = [
+    {"layout": "dict"},
+    {"layout": "dict", "storage": "ranges"},
+    {"layout": "flat"},
+    {"layout": "flat", "builder": "level"},
+    {"layout": "flat", "packing": "str"},
+    {"layout": "flat", "packing": "hilbert"},
+]
+
+
+def assert_neighbours(points, q, distances, ids, true_distances):
+    # the ids are compared through their distances, as the duplicated points tie
+    np.testing.assert_allclose(distances, true_distances, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(np.sqrt(((points[ids] - q).astype(np.float64) ** 2).sum(axis=1)), distances, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("variant", KD_VARIANTS)
+@pytest.mark.parametrize("dimension_choice", ["alternate", "max_variance", "random"])
+def test_kd_query(points, queries, brute_force, variant, dimension_choice):
+    tree = KDTree(8, points, dimension_choice=dimension_choice, leaf_size=8, **variant)
+    true = brute_force(points, queries, 10)
+    for q, true_distances in zip(queries, true):
+        distances, ids = tree.query(q, 10)
+        assert_neighbours(points, q, distances, ids, true_distances)
+
+
+@pytest.mark.parametrize("variant", KD_VARIANTS)
+@pytest.mark.parametrize("n_threads", [None, 2])
+def test_kd_query_batch(points, queries, brute_force, variant, n_threads):
+    tree = KDTree(8, points, dimension_choice="max_variance", leaf_size=8, **variant)
+    distances, ids = tree.query_batch(queries, 10, n_threads=n_threads, block_size=16)
+    assert distances.shape == ids.shape == (len(queries), 10)
+    for q, row_distances, row_ids, true_distances in zip(queries, distances, ids, brute_force(points, queries, 10)):
+        assert_neighbours(points, q, row_distances, row_ids, true_distances)
+
+
+def test_kd_query_more_than_points(points):
+    tree = KDTree(8, points[:5], engine="numpy", layout="flat")
+    distances, ids = tree.query(points[0], 10)
+    assert sorted(ids.tolist()) == list(range(5))
+    assert distances[0] == 0
+
+
+@pytest.mark.parametrize("variant", R_VARIANTS)
+def test_r_query(points, queries, brute_force, variant):
+    tree = RTree(8, points, leaf_size=8, **variant)
+    true = brute_force(points, queries, 10)
+    for q, true_distances in zip(queries, true):
+        distances, ids = tree.query(q, 10)
+        assert_neighbours(points, q, distances, ids, true_distances)
+    distances, ids = tree.query_batch(queries, 10)
+    for q, row_distances, row_ids, true_distances in zip(queries, distances, ids, true):
+        assert_neighbours(points, q, row_distances, row_ids, true_distances)
+
+
+@pytest.mark.parametrize("metric", ["l1", "cosine", "ip"])
+@pytest.mark.parametrize("variant", [{"layout": "dict", "storage": "ranges"}, {"layout": "flat"}])
+def test_r_query_metric(points, queries, metric, variant):
+    tree = RTree(8, points, leaf_size=8, metric=metric, **variant)
+    X, Q = points.astype(np.float64), queries.astype(np.float64)
+    if metric == "l1":
+        true = np.abs(Q[:, None] - X[None]).sum(axis=2)
+    elif metric == "cosine":
+        true = 1 - (Q / np.linalg.norm(Q, axis=1, keepdims=True)) @ (X / np.linalg.norm(X, axis=1, keepdims=True)).T
+    else:
+        true = -(Q @ X.T)
+    for q, true_row in zip(queries, true):
+        distances, ids = tree.query(q, 10)
+        np.testing.assert_allclose(distances, np.sort(true_row)[:10], rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(true_row[ids], distances, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("variant", R_VARIANTS)
+def test_r_query_radius(points, variant):
+    tree = RTree(8, points, leaf_size=8, **variant)
+    r = 2.5
+    n_found = 0
+    # balls around points of the clusters, so that they hold some points
+    for q in points[::100] + 0.1:
+        distances, ids = tree.query_radius(q, r)
+        n_found += len(ids)
+        true = np.sqrt(((points - q).astype(np.float64) ** 2).sum(axis=1))
+        # only the points clearly inside or outside the ball are compared, the rounding decides the others
+        assert set(np.flatnonzero(true <= r - 1e-4)) <= set(ids.tolist()) <= set(np.flatnonzero(true <= r + 1e-4))
+        assert np.all(np.diff(distances) >= 0)
+        np.testing.assert_allclose(distances, true[ids], rtol=1e-5, atol=1e-5)
+    assert n_found > 0
+
+
+@pytest.mark.parametrize("variant", R_VARIANTS)
+def test_r_query_box(points, variant):
+    tree = RTree(8, points, leaf_size=8, **variant)
+    n_found = 0
+    for q in points[::100] + 0.1:
+        low, high = q - 1.5, q + 1.5
+        ids = tree.query_box(low, high)
+        n_found += len(ids)
+        true = np.flatnonzero(np.all((points >= low) & (points <= high), axis=1))
+        np.testing.assert_array_equal(ids, true)
+    assert n_found > 0
+
+
+@pytest.mark.parametrize("metric, p", [("euclidean", 2), ("manhattan", 1)])
+@pytest.mark.parametrize("seed_choice", ["one_dim_farthest", "farthest_euc_distance", "approx_farthest"])
+@pytest.mark.parametrize("promotion", ["seeds", "centroid"])
+def test_m_query(points, queries, brute_force, metric, p, seed_choice, promotion):
+    tree = MTree(8, points, metric=metric, seed_choice=seed_choice, promotion=promotion, leaf_size=8)
+    true = brute_force(points, queries, 10, p=p)
+    distances, ids = tree.query_batch(queries, 10)
+    np.testing.assert_allclose(distances, true, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose((np.abs(points[ids] - queries[:, None]).astype(np.float64) ** p).sum(axis=2) ** (1 / p), distances, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("metric, p", [("euclidean", 2), ("manhattan", 1)])
+def test_m_query_radius(points, metric, p):
+    tree = MTree(8, points, metric=metric, leaf_size=8)
+    r = 2.5 if metric == "euclidean" else 6.0
+    n_found = 0
+    for q in points[::100] + 0.1:
+        distances, ids = tree.query_radius(q, r)
+        n_found += len(ids)
+        true = (np.abs(points - q).astype(np.float64) ** p).sum(axis=1) ** (1 / p)
+        assert set(np.flatnonzero(true <= r - 1e-4)) <= set(ids.tolist()) <= set(np.flatnonzero(true <= r + 1e-4))
+        np.testing.assert_allclose(distances, true[ids], rtol=1e-5, atol=1e-5)
+    assert n_found > 0
@@ -0,0 +1,63 @@
+# test_sharded_index.py
+"""
+The sharded index is exact when every shard is searched.
+"""
+import numpy as np
+import pytest
+
+from kd_tree.sharded_index import ShardedIndex as KDShardedIndex
+from r_tree.sharded_index import ShardedIndex as RShardedIndex
+
+INDEXES = [
+    (KDShardedIndex, {"engine": "numpy", "layout": "flat", "leaf_size": 8}),
+    (RShardedIndex, {"layout": "flat", "leaf_size": 8}),
+]
+
+
+@pytest.mark.parametrize("index_class, tree_params", INDEXES)
+@pytest.mark.parametrize("partition", ["random", "tree"])
+@pytest.mark.parametrize("n_shards, n_workers", [(1, None), (3, None), (4, 2)])
+def test_sharded_index_exact(points, queries, brute_force, index_class, tree_params, partition, n_shards, n_workers):
+    with index_class(8, points, n_shards=n_shards, partition=partition, n_workers=n_workers, **tree_params) as index:
+        assert sorted(index.ids.tolist()) == list(range(len(points)))
+        for n_probe in (None, index.n_shards):
+            distances, ids = index.query_batch(queries, 10, n_probe=n_probe)
+            np.testing.assert_allclose(distances, brute_force(points, queries, 10), rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(np.sqrt(((points[ids] - queries[:, None]).astype(np.float64) ** 2).sum(axis=2)), distances, rtol=1e-5, atol=1e-5)
+        distances, ids = index.query(queries[0], 10)
+        np.testing.assert_allclose(distances, brute_force(points, queries[:1], 10)[0], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("index_class", [KDShardedIndex, RShardedIndex])
+@pytest.mark.parametrize("n_shards", [2, 3, 5, 8])
+def test_tree_partition_shards(points, index_class, n_shards):
+    shards = index_class._tree_partition(points, n_shards)
+    assert len(shards) == n_shards
+    assert sorted(np.concatenate(shards).tolist()) == list(range(len(points)))
+
+
+def test_sharded_index_memmap(tmp_path, points, queries, brute_force):
+    path = tmp_path / "points.npy"
+    np.save(path, points)
+    with KDShardedIndex(8, str(path), n_shards=3, partition="tree", tmp_dir=str(tmp_path), engine="numpy", layout="flat") as index:
+        distances, _ = index.query_batch(queries, 5)
+    np.testing.assert_allclose(distances, brute_force(points, queries, 5), rtol=1e-5, atol=1e-5)
+
+
+def test_sharded_index_probe(points, queries):
+    with RShardedIndex(8, points, n_shards=4, partition="tree", layout="flat") as index:
+        distances, ids = index.query_batch(queries, 5, n_probe=1)
+        assert ids.shape == (len(queries), 5) and np.all(ids >= 0)
+        exact, _ = index.query_batch(queries, 5)
+        assert np.all(distances >= exact - 1e-6)
+
+
+def test_sharded_index_errors(points, queries):
+    index = KDShardedIndex(8, points, n_shards=2, engine="numpy", layout="flat")
+    with pytest.raises(RuntimeError, match="A shard worker failed"):
+        index.query_batch(queries, 5, no_such_param=1)
+    # the workers keep serving after an error
+    assert index.query_batch(queries, 5)[1].shape == (len(queries), 5)
+    index.close()
+    with pytest.raises(AssertionError, match="closed"):
+        index.query_batch(queries, 5)
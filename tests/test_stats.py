@@ -0,0 +1,73 @@
+# test_stats.py
+"""
+The statistics of collect_stats: JSON-serialisable, consistent with the built tree, and query counters that
+count the searches until reset_stats.
+"""
+import json
+
+import numpy as np
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+TREES = [
+    (KDTree, {"engine": "list", "layout": "dict"}),
+    (KDTree, {"engine": "numpy", "layout": "dict"}),
+    (KDTree, {"engine": "numpy", "layout": "flat"}),
+    (KDTree, {"engine": "numpy", "layout": "flat", "builder": "level"}),
+    (RTree, {"layout": "dict"}),
+    (RTree, {"layout": "flat"}),
+    (RTree, {"layout": "flat", "packing": "str"}),
+]
+
+
+@pytest.mark.parametrize("tree_class, params", TREES)
+def test_build_stats(points, tree_class, params):
+    tree = tree_class(8, points, leaf_size=16, collect_stats=True, **params)
+    stats = tree.get_stats()
+    assert json.loads(json.dumps(stats)) == stats
+
+    build = stats["build"]
+    assert sum(build["nodes_per_depth"]) == build["n_nodes"]
+    assert build["n_leaves"] == len(list(tree._leaves())) == sum(build["leaf_size_histogram"]["counts"])
+    sizes, counts = build["leaf_size_histogram"]["sizes"], build["leaf_size_histogram"]["counts"]
+    assert np.dot(sizes, counts) == len(points)
+    assert sum(build["imbalance_histogram"]["counts"]) == build["n_nodes"] - build["n_leaves"]
+    assert build["timers"]["build"]["calls"] == 1
+
+
+@pytest.mark.parametrize("tree_class, params", TREES)
+def test_query_stats_reset(points, queries, tree_class, params):
+    tree = tree_class(8, points, leaf_size=16, collect_stats=True, **params)
+    assert tree.get_stats()["queries"]["n_queries"] == 0
+
+    for q in queries[:10]:
+        tree.query(q, 5)
+    tree.query_batch(queries[10:], 5)
+    counters = tree.get_stats()["queries"]
+    assert counters["n_queries"] == len(queries)
+    assert 0 < counters["leaves_scanned"] <= counters["nodes_visited"]
+    assert 5 * len(queries) <= counters["distance_evaluations"] <= len(queries) * len(points)
+    assert 0 <= counters["pruning_ratio"] < 1
+    assert json.loads(json.dumps(tree.get_stats())) == tree.get_stats()
+
+    build = tree.get_stats()["build"]
+    tree.reset_stats()
+    stats = tree.get_stats()
+    for name in ("n_queries", "nodes_visited", "leaves_scanned", "distance_evaluations"):
+        assert stats["queries"][name] == 0
+    assert stats["queries"]["pruning_ratio"] is None
+    # the build statistics are kept
+    assert stats["build"] == build
+
+    tree.query(queries[0], 5)
+    assert tree.get_stats()["queries"]["n_queries"] == 1
+
+
+def test_stats_require_collect_stats(points):
+    tree = KDTree(8, points, engine="numpy", layout="flat", leaf_size=16)
+    with pytest.raises(AssertionError):
+        tree.get_stats()
+    with pytest.raises(AssertionError):
+        tree.reset_stats()
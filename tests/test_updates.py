@@ -0,0 +1,79 @@
+# test_updates.py
+"""
+insert and delete: every point of a tree can be found again, whatever the splits it was built with.
+"""
+import numpy as np
+import pytest
+
+from kd_tree.kd_tree import KDTree
+from r_tree.r_tree import RTree
+
+KD_DIMENSION_CHOICES = ["alternate", "random", "max_variance", "widest_interval", "top_variance", "random_projection", "pca"]
+R_DIMENSION_CHOICES = ["alternate", "random", "max_variance", "widest_interval", "random_projection", "pca"]
+
+
+def assert_empty(tree):
+    assert tree.n_points == 0
+    distances, ids = tree.query(np.zeros(tree.k, dtype=np.float32), 5)
+    assert len(distances) == 0 and len(ids) == 0
+
+
+@pytest.mark.parametrize("dimension_choice", KD_DIMENSION_CHOICES)
+@pytest.mark.parametrize("layout, builder", [("dict", "recursive"), ("flat", "recursive"), ("flat", "level")])
+def test_kd_delete_every_point(points, dimension_choice, layout, builder):
+    tree = KDTree(8, points, dimension_choice=dimension_choice, engine="numpy", layout=layout, builder=builder, leaf_size=8)
+    tree.delete(np.arange(len(points)))
+    assert_empty(tree)
+
+
+@pytest.mark.parametrize("dimension_choice", KD_DIMENSION_CHOICES)
+@pytest.mark.parametrize("layout", ["dict", "flat"])
+def test_kd_insert_delete_round_trip(points, queries, dimension_choice, layout):
+    tree = KDTree(8, points[:1000], dimension_choice=dimension_choice, engine="numpy", layout=layout, leaf_size=8)
+    ids = tree.insert(points[1000:])
+    np.testing.assert_array_equal(ids, np.arange(1000, len(points)))
+    assert tree.n_points == len(points)
+
+    # the inserted points are found by the queries and by delete
+    for q in queries[:10]:
+        _, found = tree.query(q, 5)
+        true = np.argsort(((points - q) ** 2).sum(axis=1), kind="stable")[:5]
+        np.testing.assert_allclose(((points[found] - q) ** 2).sum(axis=1), ((points[true] - q) ** 2).sum(axis=1), rtol=1e-5)
+    tree.delete(ids)
+    tree.delete(np.arange(1000))
+    assert_empty(tree)
+
+
+@pytest.mark.parametrize("dimension_choice", R_DIMENSION_CHOICES)
+@pytest.mark.parametrize("layout", ["dict", "flat"])
+def test_r_insert_delete_round_trip(points, dimension_choice, layout):
+    tree = RTree(8, points[:1000], dimension_choice=dimension_choice, layout=layout, leaf_size=8)
+    ids = tree.insert(points[1000:])
+    assert tree.n_points == len(points)
+    tree.delete(np.arange(1000))
+    tree.delete(ids)
+    assert_empty(tree)
+
+
+@pytest.mark.parametrize(
+    "engine, layout, builder",
+    [("list", "dict", "recursive"), ("numpy", "dict", "recursive"), ("numpy", "flat", "recursive"), ("numpy", "flat", "level")],
+)
+def test_kd_insert_duplicates(points, engine, layout, builder):
+    tree = KDTree(8, points, engine=engine, layout=layout, builder=builder, leaf_size=8)
+    ids = tree.insert(np.repeat(points[:1], 3 * tree.leaf_size, axis=0))
+    assert tree.n_points == len(points) + len(ids)
+
+    # the duplicates share one leaf larger than leaf_size, found whole by a query (points[0] is in points twice)
+    distances, found = tree.query(points[0], len(ids) + 2)
+    np.testing.assert_array_equal(distances, 0)
+    assert sorted(found.tolist()) == [0, len(points) - 20, *ids.tolist()]
+    tree.delete(ids)
+    assert tree.n_points == len(points)
+
+
+def test_delete_missing_point(points):
+    tree = KDTree(8, points, engine="numpy", layout="flat")
+    tree.delete([3])
+    with pytest.raises(ValueError, match="Point 3 is not in the tree"):
+        tree.delete([3])